@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Benchmarks the 'coverage' and 'depths' commands on a synthetic BAM file.
+
+Reads are placed uniformly at random on a number of contigs and assigned to
+one of several read-groups (samples / libraries), using a small set of CIGAR
+strings that include clipping, indels, and skipped regions. The BAM file (and
+BED file, if --regions is used) is written to the specified directory, which
+allows the resulting tables to be compared between versions of PALEOMIX:
+
+    $ python misc/benchmark_bam_stats.py --tool depths /tmp/benchmark 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pysam
+
+import paleomix.tools.coverage
+import paleomix.tools.depths
+
+
+_TOOLS = {
+    "coverage": paleomix.tools.coverage.main,
+    "depths": paleomix.tools.depths.main,
+}
+
+# Read groups as (ID, sample, library)
+_READGROUPS = (
+    ("RG1", "Sample1", "Library1"),
+    ("RG2", "Sample1", "Library1"),
+    ("RG3", "Sample1", "Library2"),
+    ("RG4", "Sample2", "Library3"),
+)
+
+# CIGAR strings used for synthetic reads, all covering 100 bp of the read
+_CIGARS = (
+    ((0, 100),),
+    ((0, 100),),
+    ((0, 100),),
+    ((4, 10), (0, 90)),
+    ((0, 40), (2, 2), (0, 60)),
+    ((0, 50), (1, 1), (0, 49)),
+    ((0, 30), (3, 100), (0, 70)),
+)
+
+# Fraction of reads marked as PCR duplicates (and hence excluded or counted as such)
+_DUPLICATE_RATE = 0.05
+
+
+def write_bam(filename, nreads, ncontigs, contig_length, seed):
+    rng = random.Random(seed)
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [
+            {"SN": "contig%i" % (idx,), "LN": contig_length}
+            for idx in range(1, ncontigs + 1)
+        ],
+        "RG": [{"ID": key, "SM": sm, "LB": lb} for (key, sm, lb) in _READGROUPS],
+    }
+
+    positions = []
+    for _ in range(nreads):
+        tid = rng.randrange(ncontigs)
+        positions.append((tid, rng.randrange(contig_length - 250)))
+    positions.sort()
+
+    with pysam.AlignmentFile(filename, "wb", header=header) as handle:
+        for (idx, (tid, pos)) in enumerate(positions):
+            record = pysam.AlignedSegment(handle.header)
+            record.query_name = "read%i" % (idx,)
+            record.reference_id = tid
+            record.reference_start = pos
+            record.mapping_quality = 30
+            record.cigartuples = rng.choice(_CIGARS)
+            record.query_sequence = "A" * 100
+            record.query_qualities = pysam.qualitystring_to_array("I" * 100)
+            record.set_tag("RG", rng.choice(_READGROUPS)[0])
+            if rng.random() < _DUPLICATE_RATE:
+                record.flag |= 0x400
+
+            handle.write(record)
+
+    pysam.index(filename)
+
+
+def write_bed(filename, nregions, ncontigs, contig_length, seed):
+    rng = random.Random(seed)
+    regions = []
+    for idx in range(nregions):
+        contig = "contig%i" % (rng.randrange(ncontigs) + 1,)
+        start = rng.randrange(contig_length - 1000)
+        end = start + rng.randrange(100, 1000)
+        regions.append((contig, start, end, "region%i" % (idx % 10,)))
+
+    with open(filename, "w") as handle:
+        for region in sorted(regions):
+            handle.write("%s\t%i\t%i\t%s\n" % region)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", help="Directory in which to write files")
+    parser.add_argument("nreads", type=int, help="Number of reads")
+    parser.add_argument("--tool", choices=sorted(_TOOLS), default="depths")
+    parser.add_argument("--contigs", type=int, default=4)
+    parser.add_argument("--contig-length", type=int, default=1000000)
+    parser.add_argument("--regions", type=int, default=0, help="Number of ROIs")
+    parser.add_argument("--seed", type=int, default=12345)
+
+    # Remaining options are passed to the tool
+    args, args.extra = parser.parse_known_args(argv)
+
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    os.makedirs(args.root, exist_ok=True)
+
+    in_bam = os.path.join(args.root, "%i.bam" % (args.nreads,))
+    if not os.path.exists(in_bam):
+        write_bam(in_bam, args.nreads, args.contigs, args.contig_length, args.seed)
+
+    command = [in_bam, os.path.join(args.root, "output." + args.tool)]
+    command.append("--overwrite-output")
+    if args.regions:
+        in_bed = os.path.join(args.root, "%i.bed" % (args.regions,))
+        write_bed(in_bed, args.regions, args.contigs, args.contig_length, args.seed)
+        command.extend(("--regions-file", in_bed))
+    command.extend(args.extra)
+
+    start = time.time()
+    returncode = _TOOLS[args.tool](command)
+    print("%s\t%i\t%.2f" % (args.tool, args.nreads, time.time() - start))
+
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Benchmarks the propagation of state changes through the NodeGraph.
+
+Graphs consist of a number of chains of nodes (lanes) merged into a single node,
+followed by a chain of nodes depending on that node (e.g. genotyping steps). All
+nodes are then marked as running and done, in the order in which they would be
+run, and the time spent updating the graph is reported. Files are never created,
+since the time spent checking files is not of interest here.
+
+    $ python misc/benchmark_nodegraph.py 1000 10000
+"""
+import argparse
+import heapq
+import logging
+import sys
+import time
+
+from paleomix.node import Node
+from paleomix.nodegraph import FileStatusCache, NodeGraph
+
+
+class _NullCache(FileStatusCache):
+    """Cache reporting that no files exist, to avoid benchmarking file-systems."""
+
+    def prefetch(self, _fpaths):
+        pass
+
+    def _get_state(self, _fpath):
+        return None
+
+
+def build_graph(nchains, chain_length, tail_length):
+    counter = 0
+    heads = []
+    for _ in range(nchains):
+        dependencies = ()
+        for _ in range(chain_length):
+            counter += 1
+            dependencies = (_new_node(counter, dependencies),)
+        heads.extend(dependencies)
+
+    dependencies = heads
+    for _ in range(max(1, tail_length)):
+        counter += 1
+        dependencies = (_new_node(counter, dependencies),)
+
+    return dependencies
+
+
+def _new_node(counter, dependencies):
+    # Any existing file may be used as input, since nodes are never run
+    input_files = [__file__]
+    for node in dependencies:
+        input_files.extend(node.output_files)
+
+    return Node(
+        input_files=input_files,
+        output_files=("/missing/%i" % (counter,),),
+        dependencies=dependencies,
+    )
+
+
+def _legacy_set_node_state(nodegraph, node, state):
+    """Copy of the previous implementation of NodeGraph.set_node_state, which
+    re-visited every (recursive) dependant of a node on every state change."""
+    nodegraph._states[node] = state
+    nodegraph._runable.pop(node, None)
+
+    intersections = _legacy_calculate_intersections(nodegraph, node)
+
+    requires_update = dict.fromkeys(intersections, False)
+    for dependency in nodegraph._reverse_dependencies[node]:
+        requires_update[dependency] = True
+
+    cache = nodegraph._cache_factory()
+    while any(requires_update.values()):
+        for (node, count) in tuple(intersections.items()):
+            if not count:
+                has_changed = False
+                if requires_update[node]:
+                    old_state = nodegraph._states.pop(node)
+                    nodegraph._runable.pop(node, None)
+                    new_state = _legacy_update_node_state(nodegraph, node, cache)
+                    has_changed |= new_state != old_state
+
+                for dependency in nodegraph._reverse_dependencies[node]:
+                    intersections[dependency] -= 1
+                    requires_update[dependency] |= has_changed
+
+                intersections.pop(node)
+                requires_update.pop(node)
+
+
+def _legacy_update_node_state(nodegraph, node, cache):
+    """Simplified copy of the previous implementation of _update_node_state, which
+    checked the state of every dependency whenever the state of a node changed."""
+    if node in nodegraph._states:
+        return nodegraph._states[node]
+
+    dependency_states = set((NodeGraph.DONE,))
+    for dependency in node.dependencies:
+        dependency_states.add(_legacy_update_node_state(nodegraph, dependency, cache))
+
+    state = max(dependency_states)
+    if state == NodeGraph.DONE:
+        if not nodegraph.is_done(node, cache):
+            state = NodeGraph.RUNABLE
+        elif nodegraph.is_outdated(node, cache):
+            state = NodeGraph.RUNABLE
+    elif state in (NodeGraph.RUNNING, NodeGraph.RUNABLE, NodeGraph.QUEUED):
+        if nodegraph.is_done(node, cache):
+            state = NodeGraph.OUTDATED
+        else:
+            state = NodeGraph.QUEUED
+    nodegraph._states[node] = state
+
+    if state == NodeGraph.RUNABLE:
+        counter = nodegraph._runable[node] = next(nodegraph._runable_counter)
+        heapq.heappush(nodegraph._runable_queue, (0, counter, node))
+
+    return state
+
+
+def _legacy_calculate_intersections(nodegraph, for_node):
+    def count_nodes(node, counts):
+        for node in nodegraph._reverse_dependencies[node]:
+            if node in counts:
+                counts[node] += 1
+            else:
+                counts[node] = 1
+                count_nodes(node, counts)
+        return counts
+
+    cache = nodegraph._legacy_intersections
+    if for_node not in cache:
+        counts = count_nodes(for_node, {})
+        for dependency in nodegraph._reverse_dependencies[for_node]:
+            counts[dependency] -= 1
+        cache[for_node] = counts
+
+    return dict(cache[for_node])
+
+
+def benchmark(args, nchains):
+    nodes = build_graph(nchains, args.chain_length, args.tail_length)
+
+    start = time.time()
+    nodegraph = NodeGraph(nodes, _NullCache)
+    graph_time = time.time() - start
+
+    set_node_state = nodegraph.set_node_state
+    if args.legacy:
+        nodegraph._legacy_intersections = {}
+
+        def set_node_state(node, state):
+            _legacy_set_node_state(nodegraph, node, state)
+
+    start = time.time()
+    while nodegraph.has_runable_nodes():
+        for node in list(nodegraph.iter_runable_nodes()):
+            set_node_state(node, nodegraph.RUNNING)
+            set_node_state(node, nodegraph.DONE)
+    run_time = time.time() - start
+
+    states = [nodegraph.get_node_state(node) for node in nodegraph.iterflat()]
+    assert all(state == nodegraph.DONE for state in states)
+
+    print(
+        "%s\t%i\t%i\t%.2f\t%.2f"
+        % (
+            "legacy" if args.legacy else "current",
+            nchains,
+            len(states),
+            graph_time,
+            run_time,
+        )
+    )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nchains", type=int, nargs="+", help="Number of chains")
+    parser.add_argument("--chain-length", type=int, default=5)
+    parser.add_argument("--tail-length", type=int, default=10)
+    parser.add_argument(
+        "--legacy",
+        default=False,
+        action="store_true",
+        help="Benchmark the previous implementation of NodeGraph.set_node_state",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    logging.disable(logging.CRITICAL)
+    # The legacy implementation is recursive
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * args.chain_length))
+
+    print("Method\tChains\tNodes\tGraphSecs\tRunSecs")
+    for nchains in args.nchains:
+        benchmark(args, nchains)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,264 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Benchmarks the overhead of the Pypeline scheduler on synthetic graphs.
+
+Nodes are never actually run; instead a fake pool marks every node as finished
+immediately, so that the time measured is that spent by the scheduler itself
+(selecting nodes to start and propagating state changes through the NodeGraph).
+Graphs resemble those generated by the BAM pipeline: a number of short chains
+of nodes (lanes) are merged into a single node per group (libraries / samples).
+
+    $ python misc/benchmark_scheduler.py 10000 100000
+
+The previous scheduler may be benchmarked by specifying the git revision to use
+(e.g. the commit prior to the scheduler being rewritten) using --legacy.
+"""
+import argparse
+import collections
+import logging
+import os
+import subprocess
+import sys
+import time
+import types
+
+from queue import Empty
+
+from paleomix.executors import LocalExecutor
+from paleomix.node import Node
+from paleomix.nodegraph import NodeGraph
+from paleomix.pipeline import Pypeline
+
+
+class _FakeQueue:
+    def __init__(self):
+        self._items = collections.deque()
+
+    def put(self, item):
+        self._items.append(item)
+
+    def get(self, block=True, timeout=None):
+        if not self._items:
+            raise Empty()
+
+        return self._items.popleft()
+
+
+class _FakeResult:
+    def get(self):
+        return None
+
+
+class _FakePool:
+    def __init__(self, queue):
+        self._queue = queue
+
+    def apply_async(self, _func, args):
+        self._queue.put(args[0])
+
+        return _FakeResult()
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class _FakeExecutor(LocalExecutor):
+    """Executor that marks nodes as finished immediately, without running them."""
+
+    def start(self):
+        self._queue = _FakeQueue()
+        self._pool = _FakePool(self._queue)
+
+
+def build_graph(nnodes, chain_length, chains_per_group):
+    nodes = []
+    # Any existing file may be used as input, since nodes are never run
+    input_file = __file__
+    group = []
+    counter = 0
+    while counter < nnodes:
+        dependencies = ()
+        filename = input_file
+        for _ in range(chain_length):
+            output_file = "/missing/%i" % (counter,)
+            node = Node(
+                input_files=(filename,),
+                output_files=(output_file,),
+                dependencies=dependencies,
+            )
+
+            dependencies = (node,)
+            filename = output_file
+            counter += 1
+
+        group.extend(dependencies)
+        if len(group) >= chains_per_group:
+            nodes.append(_merge(group, counter))
+            counter += 1
+            group = []
+
+    if group:
+        nodes.append(_merge(group, counter))
+
+    return nodes
+
+
+def _merge(dependencies, counter):
+    input_files = []
+    for node in dependencies:
+        input_files.extend(node.output_files)
+
+    return Node(
+        input_files=input_files,
+        output_files=("/missing/%i" % (counter,),),
+        dependencies=dependencies,
+    )
+
+
+def load_legacy_modules(revision):
+    """Loads the 'nodegraph' and 'pipeline' modules as of a git revision, e.g. the
+    last revision prior to the current scheduler, as modules separate from the
+    current versions of these modules.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    modules = {}
+    current_nodegraph = sys.modules["paleomix.nodegraph"]
+    try:
+        for name in ("nodegraph", "pipeline"):
+            source = subprocess.check_output(
+                ["git", "show", "%s:paleomix/%s.py" % (revision, name)], cwd=root
+            )
+
+            module = types.ModuleType("legacy_" + name)
+            exec(compile(source, "%s:%s.py" % (revision, name), "exec"), vars(module))
+            modules[name] = module
+
+            # The legacy pipeline module must import the legacy nodegraph module
+            sys.modules["paleomix.nodegraph"] = module
+    finally:
+        sys.modules["paleomix.nodegraph"] = current_nodegraph
+
+    return modules["nodegraph"], modules["pipeline"]
+
+
+def _run_legacy(modules, nodes, max_threads):
+    nodegraph_module, pipeline_module = modules
+
+    start = time.time()
+    nodegraph = nodegraph_module.NodeGraph(nodes)
+    graph_time = time.time() - start
+
+    pipeline = pipeline_module.Pypeline(config=None)
+    pipeline._summarize_pipeline = lambda _nodegraph: None
+    pipeline._queue = _FakeQueue()
+    pipeline._pool = _FakePool(pipeline._queue)
+
+    start = time.time()
+    pipeline._run(nodegraph, max_threads)
+    run_time = time.time() - start
+
+    return nodegraph, graph_time, run_time
+
+
+def _run_current(nodes, max_threads):
+    start = time.time()
+    nodegraph = NodeGraph(nodes)
+    graph_time = time.time() - start
+
+    pipeline = Pypeline(config=None)
+    # Avoid summarizing / logging every state change
+    pipeline._summarize_pipeline = lambda _nodegraph: None
+    executor = _FakeExecutor(max_threads)
+    executor.start()
+
+    start = time.time()
+    nodegraph.set_priorities(pipeline._priority(nodegraph))
+    pipeline._run(nodegraph, executor)
+    run_time = time.time() - start
+
+    return nodegraph, graph_time, run_time
+
+
+def benchmark(args, legacy_modules, nnodes):
+    nodes = build_graph(nnodes, args.chain_length, args.chains_per_group)
+
+    if legacy_modules is None:
+        nodegraph, graph_time, run_time = _run_current(nodes, args.max_threads)
+    else:
+        nodegraph, graph_time, run_time = _run_legacy(
+            legacy_modules, nodes, args.max_threads
+        )
+
+    states = collections.Counter(map(nodegraph.get_node_state, nodegraph.iterflat()))
+    total = sum(states.values())
+    assert states[nodegraph.DONE] == total, states
+
+    print(
+        "%s\t%i\t%.2f\t%.2f\t%.1f"
+        % (
+            "current" if legacy_modules is None else args.legacy,
+            total,
+            graph_time,
+            run_time,
+            total / max(run_time, 1e-9),
+        )
+    )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nnodes", type=int, nargs="+", help="Number of nodes")
+    parser.add_argument("--chain-length", type=int, default=5)
+    parser.add_argument("--chains-per-group", type=int, default=20)
+    parser.add_argument("--max-threads", type=int, default=32)
+    parser.add_argument(
+        "--legacy",
+        metavar="REVISION",
+        help="Benchmark the scheduler (pipeline.py and nodegraph.py) as of this git "
+        "revision instead of the current scheduler",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    logging.disable(logging.CRITICAL)
+
+    legacy_modules = None
+    if args.legacy is not None:
+        legacy_modules = load_legacy_modules(args.legacy)
+
+    print("Scheduler\tNodes\tGraphSecs\tRunSecs\tNodesPerSec")
+    for nnodes in args.nnodes:
+        benchmark(args, legacy_modules, nnodes)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
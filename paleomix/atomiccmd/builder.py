@@ -21,7 +21,7 @@
 # SOFTWARE.
 #
 from paleomix.atomiccmd.command import AtomicCmd
-from paleomix.common.utilities import safe_coerce_to_tuple
+from paleomix.common.utilities import parse_size, safe_coerce_to_tuple
 
 
 class AtomicCmdBuilderError(RuntimeError):
@@ -66,7 +66,7 @@ class AtomicCmdBuilder:
     AtomicCmdBuilder object is passed, this will be finalized as well.
     """
 
-    def __init__(self, call, **kwargs):
+    def __init__(self, call, memory=0, **kwargs):
         """See AtomiCmd.__init__ for parameters / keyword arguments.
         """
         self._call = safe_coerce_to_tuple(call)
@@ -74,6 +74,7 @@ class AtomicCmdBuilder:
         self._values = []
         self._kwargs = {}
         self._object = None
+        self._memory = memory
 
         self.set_kwargs(**kwargs)
 
@@ -137,6 +138,19 @@ class AtomicCmdBuilder:
                 raise AtomicCmdBuilderError(message % key)
         self._kwargs.update(kwargs)
 
+    def set_memory(self, memory):
+        """Sets the estimated peak memory usage (in bytes) of the command."""
+        if self._object:
+            message = "Parameters have already been finalized"
+            raise AtomicCmdBuilderError(message)
+
+        self._memory = memory
+
+    @property
+    def memory(self):
+        """Returns the estimated peak memory usage (in bytes) of the command."""
+        return self._memory
+
     def add_multiple_options(self, key, values, sep=None, template="IN_FILE_%02i"):
         """Add multiple options as once, with corresponding kwargs.
 
@@ -224,7 +238,11 @@ class AtomicCmdBuilder:
         """Creates an AtomicCmd object based on the AtomicParam object. Once
         finalized, the AtomicCmdBuilder cannot be modified further."""
         if not self._object:
-            self._object = AtomicCmd(self.call, **self.kwargs)
+            kwargs = self.kwargs
+            if self._memory:
+                kwargs["memory"] = self._memory
+
+            self._object = AtomicCmd(self.call, **kwargs)
 
         return self._object
 
@@ -306,6 +324,8 @@ class AtomicJavaCmdBuilder(AtomicCmdBuilder):
             call.append("-Xmx4g")
 
         call.extend(("-jar", "%(AUX_JAR)s"))
+        kwargs.setdefault("memory", _get_jre_memory(call))
+
         AtomicCmdBuilder.__init__(self, call, AUX_JAR=jar, **kwargs)
 
 
@@ -376,6 +396,26 @@ def apply_options(builder, options, pred=lambda s: s.startswith("-")):
                 builder.set_option(key, values)
 
 
+def _get_jre_memory(call):
+    """Estimates the peak memory usage of a JRE from the (last) -Xmx option, which
+    determines the max size of the heap, plus a fixed amount for the JRE itself.
+    """
+    heap_size = None
+    for value in call:
+        if isinstance(value, str) and value.startswith("-Xmx"):
+            heap_size = value[4:]
+
+    try:
+        heap_size = parse_size(heap_size)
+    except (TypeError, ValueError):
+        return 0
+
+    return heap_size + _JRE_OVERHEAD
+
+
+# Estimated memory used by the JRE in addition to the heap (e.g. JIT, stacks, GC)
+_JRE_OVERHEAD = 512 * 1024 ** 2
+
 _ADDABLE_TYPES = (float, int, str)
 _SETABLE_ONLY_TYPES = (bool, type(None))
 _SETABLE_TYPES = _ADDABLE_TYPES + _SETABLE_ONLY_TYPES
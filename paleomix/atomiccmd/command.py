@@ -71,7 +71,7 @@ class AtomicCmd:
     PIPE = procs.PIPE
     DEVNULL = procs.DEVNULL
 
-    def __init__(self, command, set_cwd=False, **kwargs):
+    def __init__(self, command, set_cwd=False, memory=0, **kwargs):
         """Takes a command and a set of files.
 
         The command is expected to be an iterable starting with the name of an
@@ -138,7 +138,10 @@ class AtomicCmd:
 
         If 'set_cwd' is True, the current working directory is set to the
         temporary directory before the command is executed. Input paths are
-        automatically turned into absolute paths in this case."""
+        automatically turned into absolute paths in this case.
+
+        'memory' is the estimated peak memory usage of the command in bytes, or
+        0 if the memory usage is unknown or negligible."""
         self._proc = None
         self._temp = None
         self._running = False
@@ -148,6 +151,12 @@ class AtomicCmd:
 
         if not self._command or not self._command[0]:
             raise ValueError("Empty command in AtomicCmd constructor")
+        elif not isinstance(memory, int):
+            raise TypeError("'memory' must be an integer, not %r" % (memory,))
+        elif memory < 0:
+            raise ValueError("'memory' must be 0 or greater, not %i" % (memory,))
+
+        self.memory = memory
 
         arguments = self._process_arguments(id(self), self._command, kwargs)
         self._files = self._build_files_dict(arguments)
@@ -126,6 +126,11 @@ class ParallelCmds(_CommandSet):
                 )
         _CommandSet.__init__(self, commands)
 
+    @property
+    def memory(self):
+        """Commands are run simultaneously, so their memory usage is summed."""
+        return sum(command.memory for command in self._commands)
+
     def run(self, temp):
         for command in self._commands:
             command.run(temp)
@@ -179,6 +184,11 @@ class SequentialCmds(_CommandSet):
                 )
         _CommandSet.__init__(self, commands)
 
+    @property
+    def memory(self):
+        """Commands are run one at a time, so the peak usage is the largest usage."""
+        return max(command.memory for command in self._commands)
+
     def run(self, temp):
         self._ready = False
         for command in self._commands:
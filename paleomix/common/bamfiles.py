@@ -21,6 +21,7 @@
 # SOFTWARE.
 #
 import itertools
+import operator
 
 # BAM flags as defined in the BAM specification
 BAM_SUPPLEMENTARY_ALIGNMENT = 0x800
@@ -45,6 +46,11 @@ EXCLUDED_FLAGS = (
     | BAM_READ_IS_UNMAPPED
 )
 
+# Key functions used to group records; these are implemented in C, and so avoid
+# the overhead of calling a Python function for every record
+_GET_TID = operator.attrgetter("tid")
+_GET_POS = operator.attrgetter("pos")
+
 
 class BAMRegionsIter:
     """Iterates over a BAM file, yield a separate iterator for each contig
@@ -86,16 +92,11 @@ class BAMRegionsIter:
                 tid = self._handle.gettid(region.contig)
                 yield _BAMRegion(tid, records, region.name, region.start, region.end)
         else:
-
-            def _by_tid(record):
-                """Group by reference ID."""
-                return record.tid
-
             # Save a copy, as these are properties generated upon every access!
             names = self._handle.references
             lengths = self._handle.lengths
             records = self._filter(self._handle)
-            records = itertools.groupby(records, key=_by_tid)
+            records = itertools.groupby(records, key=_GET_TID)
 
             for (tid, items) in records:
                 if tid >= 0:
@@ -108,9 +109,10 @@ class BAMRegionsIter:
 
     def _filter(self, records):
         """Filters records by flags, if 'exclude_flags' is set."""
-        if self._excluded:
-            pred = lambda record: not record.flag & self._excluded
-            return filter(pred, records)
+        excluded = self._excluded
+        if excluded:
+            # A generator expression avoids a function call per record
+            return (record for record in records if not record.flag & excluded)
         return records
 
 
@@ -127,9 +129,4 @@ class _BAMRegion:
         self.end = end
 
     def __iter__(self):
-        def _by_pos(record):
-            """Group by position."""
-            return record.pos
-
-        for group in itertools.groupby(self._records, _by_pos):
-            yield group
+        return itertools.groupby(self._records, _GET_POS)
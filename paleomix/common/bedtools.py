@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 #
+import collections
 import copy
 
 from paleomix.common.fileutils import open_ro
@@ -275,3 +276,149 @@ def merge_bed_records(records):
             last_record.end = record.end
 
     return results
+
+
+def cluster_bed_records(records, max_distance=0):
+    """Groups BED records into clusters of records on the same contig, that
+    overlap or are at most 'max_distance' bp apart. The records are expected to
+    be sorted by contig and start position (see 'sort_bed_by_bamfile'). Returns
+    a list of (region, records) tuples, where 'region' is a BEDRecord spanning
+    every record in the cluster and named after the contig.
+    """
+    clusters = []
+    last_region = None
+    for record in records:
+        if (
+            last_region is None
+            or last_region.contig != record.contig
+            or last_region.end + max_distance < record.start
+        ):
+            last_region = BEDRecord()
+            last_region._fields = [record.contig, record.start, record.end]
+            last_region.name = record.contig
+            clusters.append((last_region, [record]))
+        else:
+            last_region.end = max(last_region.end, record.end)
+            clusters[-1][1].append(record)
+
+    return clusters
+
+
+def split_bed_records(records, count):
+    """Splits a sequence of non-overlapping BED records into 'count' lists of
+    records, each covering (nearly) the same number of bases. The order of the
+    records is preserved, and records spanning the boundary between two lists
+    are split in two. Lists are empty if the records cover fewer than 'count'
+    bases in total.
+    """
+    if count < 1:
+        raise ValueError("'count' must be >= 1 in 'split_bed_records'")
+
+    records = list(records)
+    total = sum(record.end - record.start for record in records)
+    shards = [[] for _ in range(count)]
+
+    idx = 0
+    offset = 0
+    for record in records:
+        start = record.start
+        while start < record.end:
+            # Number of bases covered by this and all previous lists
+            shard_end = (total * (idx + 1)) // count
+            end = min(record.end, start + shard_end - offset)
+            if end > start:
+                shard = BEDRecord()
+                shard._fields = [record.contig, start, end]
+                shards[idx].append(shard)
+
+                offset += end - start
+                start = end
+
+            if offset >= shard_end:
+                idx += 1
+
+    return shards
+
+
+class BEDSweep:
+    """Finds the BED records overlapping each of a series of intervals (e.g.
+    aligned reads), in a single pass over the intervals. The records and the
+    intervals must be located on the same contig, and the intervals must be
+    sorted by their start positions.
+
+    Records that can no longer overlap any interval are returned by 'retire',
+    allowing any state kept for these records to be finalized:
+
+    sweep = BEDSweep(records)
+    for (position, reads) in region:
+        for record in sweep.retire(position):
+            # Finalize record
+        for read in reads:
+            for record in sweep.overlapping(read.start, read.end):
+                # Process read for record
+    for record in sweep.retire(float("inf")):
+        # Finalize record
+    """
+
+    def __init__(self, records):
+        # Coordinates are cached, as accessing BEDRecord properties is slow
+        records = [(record.start, record.end, record) for record in records]
+        records.sort(key=lambda value: value[:2])
+
+        self._pending = collections.deque(records)
+        self._active = []
+        # Records in self._active, and the min end and max start of these
+        self._records = ()
+        self._min_end = float("inf")
+        self._max_start = float("-inf")
+
+    def overlapping(self, start, end):
+        """Returns a tuple of the records overlapping the interval start .. end - 1;
+        the start position must not be less than that of the previous interval."""
+        pending = self._pending
+        if pending and pending[0][0] < end:
+            self._activate(end)
+
+        # Typically every active record overlaps the interval
+        if self._max_start < end and self._min_end > start:
+            return self._records
+
+        return tuple(
+            record
+            for (record_start, record_end, record) in self._active
+            if record_start < end and record_end > start
+        )
+
+    def retire(self, position):
+        """Removes and returns a tuple of the records that cannot overlap intervals
+        starting at or after 'position', including records that did not overlap
+        any intervals.
+        """
+        pending = self._pending
+        if pending and pending[0][0] < position:
+            self._activate(position)
+
+        if self._min_end > position:
+            return ()
+
+        retired = tuple(record for (_, end, record) in self._active if end <= position)
+        self._active = [value for value in self._active if value[1] > position]
+        self._update()
+
+        return retired
+
+    def _activate(self, position):
+        """Activates pending records starting before 'position'."""
+        pending = self._pending
+        active = self._active
+        while pending and pending[0][0] < position:
+            active.append(pending.popleft())
+
+        self._update()
+
+    def _update(self):
+        active = self._active
+        self._records = tuple(record for (_, _, record) in active)
+        self._min_end = min((end for (_, end, _) in active), default=float("inf"))
+        # Records are activated in order of their start positions
+        self._max_start = active[-1][0] if active else float("-inf")
@@ -58,6 +58,30 @@ def try_cast(value, cast_to):
         return value
 
 
+def parse_size(value):
+    """Parses a size in bytes, optionally with a (case-insensitive) K, M, G, or T
+    suffix, as used by e.g. 'java -Xmx4g' and 'samtools sort -m 768M'. Binary
+    multiples are used (e.g. 1K = 1024 bytes).
+    """
+    if not isinstance(value, str):
+        raise TypeError("size must be a string, not %r" % (type(value).__name__,))
+
+    value = value.strip()
+    multiplier = _SIZE_MULTIPLIERS.get(value[-1:].upper())
+    if multiplier is None:
+        multiplier = 1
+    else:
+        value = value[:-1]
+
+    if not value.isdigit():
+        raise ValueError("invalid size %r" % (value,))
+
+    return int(value) * multiplier
+
+
+_SIZE_MULTIPLIERS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
 def set_in(dictionary, keys, value):
     """Traverses a set of nested dictionaries using the given keys,
        and assigns the specified value to the inner-most
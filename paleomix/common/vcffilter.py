@@ -26,8 +26,7 @@ import collections
 import paleomix.common.vcfwrap as vcfwrap
 
 
-_INF = float("inf")
-# Rough number of records to keep in memory at once
+# Number of records for which properties are evaluated at once
 _CHUNK_SIZE = 10000
 
 
@@ -132,101 +131,54 @@ def add_varfilter_options(parser):
 
 
 def describe_filters(options):
+    names = _get_filter_names(options)
+
     return {
-        "HET": "Heterozygous SNPs observed on homozygous chromosome (e.g. chrX)",
-        "q:%i" % options.min_quality: "Minimum Phred score recorded in the QUAL column",
-        "k": "SNPs without a most likely genotype (based on PL)",
-        "Q:%i" % options.min_mapping_quality: "Minimum RMS mapping quality",
-        "d:%i" % options.min_read_depth: "Minimum read depth",
-        "D:%i" % options.max_read_depth: "Maximum read depth",
-        "a:%i"
-        % options.min_num_alt_bases: "Minimum number of alternative bases observed for variants",
-        "w:%i" % options.min_distance_to_indels: "SNP within INT bp around a gap",
-        "W:%i"
-        % options.min_distance_between_indels: "Indel within INT bp of another indel",
-        "1:%e" % options.min_strand_bias: "Min P-value for strand bias (given PV4)",
-        "2:%e" % options.min_baseq_bias: "Min P-value for baseQ bias (given PV4)",
-        "3:%e" % options.min_mapq_bias: "Min P-value for mapQ bias (given PV4)",
-        "4:%e"
-        % options.min_end_distance_bias: "Min P-value for end distance bias (given PV4)",
+        names["HET"]: "Heterozygous SNPs observed on homozygous chromosome (e.g. chrX)",
+        names["q"]: "Minimum Phred score recorded in the QUAL column",
+        names["k"]: "SNPs without a most likely genotype (based on PL)",
+        names["Q"]: "Minimum RMS mapping quality",
+        names["d"]: "Minimum read depth",
+        names["D"]: "Maximum read depth",
+        names["a"]: "Minimum number of alternative bases observed for variants",
+        names["w"]: "SNP within INT bp around a gap",
+        names["W"]: "Indel within INT bp of another indel",
+        names["1"]: "Min P-value for strand bias (given PV4)",
+        names["2"]: "Min P-value for baseQ bias (given PV4)",
+        names["3"]: "Min P-value for mapQ bias (given PV4)",
+        names["4"]: "Min P-value for end distance bias (given PV4)",
     }
 
 
-def filter_vcfs(options, vcfs):
-    vcfs = iter(vcfs)
-    chunk = collections.deque()
-
-    while _read_chunk(vcfs, chunk):
-        chunk = _filter_chunk(options, chunk)
-        for vcf in _trim_chunk(options, chunk):
-            if vcf.filter == ".":
-                vcf.filter = "PASS"
-
-            yield vcf
-
-
-def _read_chunk(vcfs, chunk):
-    try:
-        while len(chunk) < _CHUNK_SIZE:
-            chunk.append(next(vcfs))
-    except StopIteration:
-        chunk.append(None)
-
-    return len(chunk) > 1
-
-
-def _trim_chunk(options, chunk):
-    min_distance = max(
-        options.min_distance_between_indels, options.min_distance_to_indels
-    )
-
-    if not chunk:
-        return
-    elif chunk[-1] is None:
-        end_chr = "!@#$%^&*()_+"
-        end_pos = _INF
-        chunk.pop()
-    else:
-        end_chr = chunk[-1].contig
-        end_pos = chunk[-1].pos
-
-    while chunk:
-        vcf = chunk[0]
-        if vcf.contig == end_chr:
-            # 'length' will become a too large value for heterozygous SNPs,
-            # but it is faster than having to parse every position, and has
-            # no effect on the final results.
-            length = max(len(vcf.ref), len(vcf.alt))
-            if (vcf.pos + length + min_distance) >= end_pos:
-                break
-
-        yield chunk.popleft()
-
-
-def _group_indels_near_position(indels, distance):
-    """Returns a dictionary of positions that are either directly covered by, or
-    adjacent to indels, given some arbitrary distance. For each position, a list
-    of adjacent/overlapping indels are provided."""
-    positions = collections.defaultdict(list)
-    if not distance:
-        return positions
-
-    for vcf in indels:
-        # The number of bases covered (excluding the prefix)
-        # For ambigious indels (e.g. in low complexity regions), this ensures
-        # that the entire region is considered. Note that we do not need to
-        # consider the alternative sequence(s)
-        length = len(vcf.ref) - 1
+def _get_filter_names(options):
+    """Returns the names used in the FILTER column for each filter, including the
+    thresholds specified by the user."""
+    return {
+        "HET": "HET",
+        "q": "q:%i" % options.min_quality,
+        "k": "k",
+        "Q": "Q:%i" % options.min_mapping_quality,
+        "d": "d:%i" % options.min_read_depth,
+        "D": "D:%i" % options.max_read_depth,
+        "a": "a:%i" % options.min_num_alt_bases,
+        "w": "w:%i" % options.min_distance_to_indels,
+        "W": "W:%i" % options.min_distance_between_indels,
+        "1": "1:%e" % options.min_strand_bias,
+        "2": "2:%e" % options.min_baseq_bias,
+        "3": "3:%e" % options.min_mapq_bias,
+        "4": "4:%e" % options.min_end_distance_bias,
+    }
 
-        # Inclusive start/end positions for bases that should be blacklisted
-        # Note that vcf.pos is the base just before the insertion/deletion
-        start = vcf.pos + 1 - distance
-        end = vcf.pos + 1 + distance + length
 
-        for position in range(start, end + 1):
-            positions[position].append(vcf)
+def filter_vcfs(options, vcfs):
+    chunk = []
+    for vcf in _filter_by_indels(options, vcfs):
+        chunk.append(vcf)
+        if len(chunk) >= _CHUNK_SIZE:
+            yield from _filter_chunk(options, chunk)
+            chunk = []
 
-    return positions
+    yield from _filter_chunk(options, chunk)
 
 
 def _select_best_indel(indels):
@@ -242,95 +194,238 @@ def _select_best_indel(indels):
     return max(indels, key=_indel_by_quality_and_position)
 
 
-def _filter_by_indels(options, chunk):
-    """Filters a list of SNPs and Indels, such that no SNP is closer to
+def _filter_by_indels(options, vcfs):
+    """Filters a stream of SNPs and Indels, such that no SNP is closer to
     an indel than the value set in options.min_distance_to_indels, and
     such that no two indels too close. If two or more indels are within
     this distance, the indel with the highest QUAL score is retained. When
     no unique highest QUAL score exists, an arbitrary indel is retained
     among those indels with the highest QUAL score. SNPs are filtered
-    based on prefiltered Indels."""
-    indels = [vcf for vcf in chunk if vcfwrap.is_indel(vcf)]
+    based on prefiltered Indels.
 
-    distance_between = options.min_distance_between_indels
-    indel_blacklist = _group_indels_near_position(indels, distance_between)
-    distance_to = options.min_distance_to_indels
-    snp_blacklist = _group_indels_near_position(indels, distance_to)
+    Records must be sorted by position, and are yielded once every indel near
+    the record has been read. Only indels that may overlap the records not yet
+    yielded are kept in memory."""
+    distance = max(
+        options.min_distance_between_indels, options.min_distance_to_indels
+    )
 
-    for vcf in chunk:
-        if vcfwrap.is_indel(vcf):
-            blacklisted = indel_blacklist.get(vcf.pos + 1, [vcf])
+    # Records not yet yielded, and indels near these records, in input order
+    pending = collections.deque()
+    indels = collections.deque()
+    contig = None
+    for vcf in vcfs:
+        if vcf.contig != contig:
+            # Indels only affect records on the same contig
+            while pending:
+                yield _filter_by_nearby_indels(options, pending.popleft(), indels)
+
+            indels.clear()
+            contig = vcf.contig
+        else:
+            # Indels affect records at most 'distance' bp before the indel
+            while pending and pending[0][0].pos + distance < vcf.pos:
+                yield _filter_by_nearby_indels(options, pending.popleft(), indels)
+
+        is_indel = vcfwrap.is_indel(vcf)
+        pending.append((vcf, is_indel))
+        if is_indel:
+            # The number of bases covered (excluding the prefix)
+            # For ambigious indels (e.g. in low complexity regions), this ensures
+            # that the entire region is considered. Note that we do not need to
+            # consider the alternative sequence(s)
+            indels.append((vcf, len(vcf.ref) - 1))
+
+    while pending:
+        yield _filter_by_nearby_indels(options, pending.popleft(), indels)
+
+
+def _filter_by_nearby_indels(options, record, indels):
+    vcf, is_indel = record
+    distance = max(
+        options.min_distance_between_indels, options.min_distance_to_indels
+    )
+
+    # Retire indels too far upstream to affect this or any subsequent record
+    while indels and indels[0][0].pos + 1 + distance + indels[0][1] < vcf.pos:
+        indels.popleft()
+
+    if is_indel:
+        distance = options.min_distance_between_indels
+        if distance:
+            blacklisted = _get_indels_near_position(indels, vcf.pos + 1, distance)
             if vcf is not _select_best_indel(blacklisted):
-                _mark_as_filtered(vcf, "W:%i" % distance_between)
-        elif (vcf.alt != ".") and (vcf.pos in snp_blacklist):
+                _mark_as_filtered(vcf, "W:%i" % (distance,))
+    elif vcf.alt != ".":
+        distance = options.min_distance_to_indels
+        if distance and _get_indels_near_position(indels, vcf.pos, distance):
             # TODO: How to handle heterozygous SNPs near
-            _mark_as_filtered(vcf, "w:%i" % distance_to)
+            _mark_as_filtered(vcf, "w:%i" % (distance,))
+
+    return vcf
+
+
+def _get_indels_near_position(indels, position, distance):
+    """Returns the list of indels for which the position is either directly
+    covered by, or adjacent to the indel, given some arbitrary distance."""
+    result = []
+    for (vcf, length) in indels:
+        # Inclusive start/end positions for bases that should be blacklisted
+        # Note that vcf.pos is the base just before the insertion/deletion
+        if vcf.pos + 1 - distance <= position <= vcf.pos + 1 + distance + length:
+            result.append(vcf)
+
+    return result
 
 
 def _filter_by_properties(options, vcfs):
     """Filters a list of SNPs/indels based on the various properties recorded in
     the info column, and others. This mirrors most of the filtering carried out
-    by vcfutils.pl varFilter."""
+    by vcfutils.pl varFilter. The properties of all records are collected first,
+    after which each criterion is evaluated for the entire list of records."""
+    names = _get_filter_names(options)
+    columns = _collect_properties(vcfs)
+    quals, depths, mapping_quals, pv4s, alt_depths, ml_genotypes = columns
+    # Names of failed filters for each record, in the order they are applied
+    failed = [[] for _ in quals]
+
+    min_quality = options.min_quality
+    _add_filter(failed, names["q"], [qual < min_quality for qual in quals])
+
+    min_depth = options.min_read_depth
+    max_depth = options.max_read_depth
+    _add_filter(failed, names["d"], [min_depth > depth for depth in depths])
+    _add_filter(
+        failed,
+        names["D"],
+        [min_depth <= depth and max_depth < depth for depth in depths],
+    )
+
+    min_mapq = options.min_mapping_quality
+    _add_filter(
+        failed,
+        names["Q"],
+        [mapq is not None and mapq < min_mapq for mapq in mapping_quals],
+    )
+
+    pv4_thresholds = (
+        options.min_strand_bias,
+        options.min_baseq_bias,
+        options.min_mapq_bias,
+        options.min_end_distance_bias,
+    )
+    for (idx, threshold) in enumerate(pv4_thresholds):
+        _add_filter(
+            failed,
+            names[str(idx + 1)],
+            [pv4 is not None and pv4[idx] < threshold for pv4 in pv4s],
+        )
+
+    # The remaining criteria only apply to variants (ALT is not '.')
+    min_alt_bases = options.min_num_alt_bases
+    _add_filter(
+        failed,
+        names["a"],
+        [depth is not None and depth < min_alt_bases for depth in alt_depths],
+    )
+
+    if not options.keep_ambigious_genotypes:
+        # No most likely genotype
+        _add_filter(
+            failed,
+            names["k"],
+            [genotype == ("N", "N") for genotype in ml_genotypes],
+        )
+
+    homozygous_chromosomes = options.homozygous_chromosome
+    _add_filter(
+        failed,
+        names["HET"],
+        [
+            genotype is not None
+            and genotype[0] != genotype[1]
+            and vcf.contig in homozygous_chromosomes
+            for (vcf, genotype) in zip(vcfs, ml_genotypes)
+        ],
+    )
+
+    for (vcf, filters) in zip(vcfs, failed):
+        if filters:
+            _mark_as_filtered_by(vcf, filters)
+
+
+def _collect_properties(vcfs):
+    """Collects the properties used by '_filter_by_properties' into one list per
+    property; properties not applicable to or missing for a record are None."""
+    quals = []
+    depths = []
+    mapping_quals = []
+    pv4s = []
+    alt_depths = []
+    ml_genotypes = []
+
     for vcf in vcfs:
-        if float(vcf.qual) < options.min_quality:
-            _mark_as_filtered(vcf, "q:%i" % options.min_quality)
-
-        properties = {}
-        for field in vcf.info.split(";"):
-            if "=" in field:
-                key, value = field.split("=")
-            else:
-                key, value = field, None
-            properties[key] = value
-
-        read_depth = float(properties["DP"])
-        if options.min_read_depth > read_depth:
-            _mark_as_filtered(vcf, "d:%i" % options.min_read_depth)
-        elif options.max_read_depth < read_depth:
-            _mark_as_filtered(vcf, "D:%i" % options.max_read_depth)
-
-        if "MQ" in properties:
-            if float(properties["MQ"]) < options.min_mapping_quality:
-                _mark_as_filtered(vcf, "Q:%i" % options.min_mapping_quality)
-
-        if "PV4" in properties:
-            pv4 = [float(value) for value in properties["PV4"].split(",")]
-            if pv4[0] < options.min_strand_bias:
-                _mark_as_filtered(vcf, "1:%e" % options.min_strand_bias)
-            if pv4[1] < options.min_baseq_bias:
-                _mark_as_filtered(vcf, "2:%e" % options.min_baseq_bias)
-            if pv4[2] < options.min_mapq_bias:
-                _mark_as_filtered(vcf, "3:%e" % options.min_mapq_bias)
-            if pv4[3] < options.min_end_distance_bias:
-                _mark_as_filtered(vcf, "4:%e" % options.min_end_distance_bias)
+        quals.append(float(vcf.qual))
+
+        properties = _get_properties(vcf)
+        depths.append(float(properties["DP"]))
+
+        mapq = properties.get("MQ")
+        mapping_quals.append(None if mapq is None else float(mapq))
+
+        pv4 = properties.get("PV4")
+        pv4s.append(None if pv4 is None else _get_values(pv4, float))
 
         if vcf.alt != ".":
-            ref_fw, ref_rev, alt_fw, alt_rev = map(int, properties["DP4"].split(","))
-            if (alt_fw + alt_rev) < options.min_num_alt_bases:
-                _mark_as_filtered(vcf, "a:%i" % options.min_num_alt_bases)
+            _, _, alt_fw, alt_rev = _get_values(properties["DP4"], int)
+            alt_depths.append(alt_fw + alt_rev)
+            ml_genotypes.append(vcfwrap.get_ml_genotype(vcf))
+        else:
+            alt_depths.append(None)
+            ml_genotypes.append(None)
 
-            ml_genotype = vcfwrap.get_ml_genotype(vcf)
-            if (ml_genotype == ("N", "N")) and not options.keep_ambigious_genotypes:
-                # No most likely genotype
-                _mark_as_filtered(vcf, "k")
+    return quals, depths, mapping_quals, pv4s, alt_depths, ml_genotypes
 
-            if ml_genotype[0] != ml_genotype[1]:
-                if vcf.contig in options.homozygous_chromosome:
-                    _mark_as_filtered(vcf, "HET")
 
+def _add_filter(failed, filter_name, mask):
+    for (filters, is_filtered) in zip(failed, mask):
+        if is_filtered:
+            filters.append(filter_name)
 
-def _filter_chunk(options, chunk):
-    at_end = False
-    if chunk[-1] is None:
-        at_end = True
-        chunk.pop()
 
-    _filter_by_indels(options, chunk)
+def _get_properties(vcf):
+    """Returns the INFO fields of a VCF record; for records read using
+    pysam.VariantFile, values are decoded by htslib when accessed."""
+    if isinstance(vcf, vcfwrap.VariantRecord):
+        return vcf.info
+
+    properties = {}
+    for field in vcf.info.split(";"):
+        if "=" in field:
+            key, value = field.split("=")
+        else:
+            key, value = field, None
+        properties[key] = value
+
+    return properties
+
+
+def _get_values(value, func):
+    if isinstance(value, str):
+        return [func(item) for item in value.split(",")]
+
+    # Values decoded by htslib are already of the expected type
+    return value
+
+
+def _filter_chunk(options, chunk):
     _filter_by_properties(options, chunk)
 
-    if at_end:
-        chunk.append(None)
-    return chunk
+    for vcf in chunk:
+        if vcf.filter == ".":
+            vcf.filter = "PASS"
+
+        yield vcf
 
 
 def _mark_as_filtered(vcf, filter_name):
@@ -340,3 +435,16 @@ def _mark_as_filtered(vcf, filter_name):
     elif filter_name not in vcf.filter.split(";"):
         vcf.filter += ";" + filter_name
         return True
+
+
+def _mark_as_filtered_by(vcf, filter_names):
+    """Equivalent to calling '_mark_as_filtered' for each (unique) filter name."""
+    if vcf.filter in (".", "PASS"):
+        vcf.filter = ";".join(filter_names)
+    else:
+        filters = vcf.filter.split(";")
+        for filter_name in filter_names:
+            if filter_name not in filters:
+                filters.append(filter_name)
+
+        vcf.filter = ";".join(filters)
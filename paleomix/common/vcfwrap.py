@@ -26,6 +26,39 @@ the VCF data-structures from pysam."""
 import collections
 
 
+class VariantRecord:
+    """Wraps a pysam.VariantRecord read using pysam.VariantFile, providing the
+    same fields as the records returned by pysam.asVCF. INFO and FORMAT fields
+    are decoded by htslib on demand, and the 'filter' field is written back to
+    the wrapped record using 'update_filter'."""
+
+    __slots__ = ("record", "contig", "pos", "ref", "alt", "qual", "filter")
+
+    def __init__(self, record):
+        alts = record.alts
+        filters = record.filter.keys()
+
+        self.record = record
+        self.contig = record.chrom
+        # 0-based position, as with pysam.asVCF
+        self.pos = record.start
+        self.ref = record.ref
+        self.alt = ",".join(alts) if alts else "."
+        self.qual = record.qual
+        self.filter = ";".join(filters) if filters else "."
+
+    @property
+    def info(self):
+        return self.record.info
+
+    def update_filter(self):
+        filters = self.record.filter
+        filters.clear()
+        if self.filter != ".":
+            for name in self.filter.split(";"):
+                filters.add(name)
+
+
 Indel = collections.namedtuple(
     "Indel", ["in_reference", "pos", "prefix", "what", "postfix"]
 )
@@ -87,7 +120,10 @@ def get_ml_genotype(vcf, sample=0):
     genotypes.extend(vcf.ref.split(","))
     genotypes.extend(vcf.alt.split(","))
 
-    PL = list(map(int, get_format(vcf, sample)["PL"].split(",")))
+    if isinstance(vcf, VariantRecord):
+        PL = list(vcf.record.samples[sample]["PL"])
+    else:
+        PL = list(map(int, get_format(vcf, sample)["PL"].split(",")))
 
     if len(PL) == len(genotypes):
         ploidy = 1
@@ -99,11 +135,12 @@ def get_ml_genotype(vcf, sample=0):
             )
         ploidy = 2
 
-    if PL.count(min(PL)) > 1:
+    lowest_pl = min(PL)
+    if PL.count(lowest_pl) > 1:
         # No single most likely genotype
         return ("N", "N")
 
-    most_likely = min(range(len(PL)), key=PL.__getitem__)
+    most_likely = PL.index(lowest_pl)
     if ploidy == 1:
         prefix = postfix = most_likely
     else:
@@ -0,0 +1,857 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Executors used by Pypeline to run nodes.
+
+The LocalExecutor runs nodes using a pool of processes on the local host, and
+is used by default. The RemoteExecutor runs nodes using worker processes (see
+paleomix.worker) that connect to the pipeline via TCP, and that may therefore be
+run on other hosts. This requires that all files, including temporary files,
+are located on a file-system shared between the hosts.
+
+Workers report the number of threads and the amount of memory that they make
+available and send heartbeats at regular intervals. Nodes running on workers
+that disconnect or that stop sending heartbeats are reported as having failed
+with a WorkerLostError, allowing them to be run again.
+
+The BatchExecutor submits nodes as jobs to a SLURM batch scheduler, using job
+arrays to submit runable nodes with identical resource requirements at once.
+As with the RemoteExecutor, files must be located on a shared file-system.
+"""
+import errno
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from multiprocessing.connection import Listener
+
+from paleomix.node import NodeError, NodeUnhandledException
+
+
+# Interval in seconds between heartbeats sent by workers
+HEARTBEAT_INTERVAL = 10
+# Workers are considered lost if nothing has been received for this many seconds
+HEARTBEAT_TIMEOUT = 60
+# Max number of tasks per job array; SLURM rejects arrays larger than MaxArraySize,
+# which defaults to 1001 (i.e. task IDs 0 to 1000)
+MAX_ARRAY_SIZE = 1000
+
+
+class WorkerLostError(RuntimeError):
+    """Raised for nodes that were running on a worker that has been lost."""
+
+
+class Executor:
+    """Base class for executors used by Pypeline to run nodes. Nodes are started
+    by calling 'submit' for each node, after checking that there is capacity for
+    the node using 'can_run'; finished nodes are collected using 'get_finished'.
+    """
+
+    def start(self):
+        """Called before any nodes are submitted."""
+
+    def can_run(self, node):
+        """Returns true if the node can be started now, based on the number of
+        threads and the amount of memory that it uses.
+        """
+        raise NotImplementedError()
+
+    def submit(self, key, node, config):
+        """Starts running a node, identified by 'key', after 'can_run' returned
+        true for that node.
+        """
+        raise NotImplementedError()
+
+    def get_finished(self, blocking):
+        """Returns a tuple of (key, result) for a node that has finished, where
+        'result.get()' re-raises any exception raised while running the node.
+
+        If 'blocking' is true, the function waits until a node has finished or
+        until the capacity of the executor has changed. (None, None) is returned
+        in the latter case, if an interrupt occurred, and if 'blocking' is false
+        and no nodes have finished.
+        """
+        raise NotImplementedError()
+
+    def wait(self):
+        """Waits until the capacity of the executor may have changed; called if
+        no nodes are running and none of the runable nodes could be started.
+        """
+
+    def close(self):
+        """Waits for running nodes to finish and releases resources."""
+
+    def terminate(self):
+        """Terminates any running nodes and releases resources."""
+
+
+class LocalExecutor(Executor):
+    """Runs nodes using a local pool of (at most) 'max_threads' processes. Nodes
+    are started as long as the total number of threads and amount of memory used
+    does not exceed 'max_threads' and 'max_memory'. Nodes that use more than this
+    are only started if no other nodes (using threads or memory) are running.
+    """
+
+    def __init__(self, max_threads=1, max_memory=math.inf):
+        if max_threads < 1:
+            raise ValueError("Max threads must be >= 1")
+        elif max_memory < 1:
+            raise ValueError("Max memory must be >= 1")
+
+        self._max_threads = max_threads
+        self._max_memory = max_memory
+        self._idle_threads = max_threads
+        self._idle_memory = max_memory
+        self._running = {}
+        self._queue = None
+        self._pool = None
+
+    def start(self):
+        self._queue = multiprocessing.Queue()
+        self._pool = multiprocessing.Pool(
+            self._max_threads, _init_worker, (self._queue,)
+        )
+
+    def can_run(self, node):
+        threads, memory = self._get_resources(node)
+
+        return threads <= self._idle_threads and memory <= self._idle_memory
+
+    def submit(self, key, node, config):
+        threads, memory = self._get_resources(node)
+        self._idle_threads -= threads
+        self._idle_memory -= memory
+
+        result = self._pool.apply_async(_call_run, args=(key, node, config))
+        self._running[key] = (node, result)
+
+    def get_finished(self, blocking):
+        """See Executor.get_finished; worker processes signal that a node has
+        finished by placing the key of the node in a queue, so no polling is
+        required.
+        """
+        try:
+            key = self._queue.get(blocking)
+        except IOError as error:
+            # User pressed ctrl-c (SIGINT), or similar event
+            if error.errno != errno.EINTR:
+                raise
+            return None, None
+        except queue.Empty:
+            return None, None
+
+        node, result = self._running.pop(key)
+        threads, memory = self._get_resources(node)
+        self._idle_threads += threads
+        self._idle_memory += memory
+
+        return key, result
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _get_resources(self, node):
+        return min(node.threads, self._max_threads), min(node.memory, self._max_memory)
+
+
+class RemoteExecutor(Executor):
+    """Runs nodes using workers connecting to 'address', a (host, port) tuple,
+    and authenticated using 'authkey' (a bytes object). Nodes are started on the
+    worker with the most idle threads, among workers with enough idle threads and
+    memory to run the node. As with the LocalExecutor, nodes using more threads /
+    memory than any worker has are only run on idle workers.
+    """
+
+    def __init__(self, address, authkey, timeout=HEARTBEAT_TIMEOUT):
+        self._address = address
+        self._authkey = authkey
+        self._timeout = timeout
+        self._logger = logging.getLogger(__name__)
+
+        # Protects the list of workers and their running nodes, which are modified
+        # by the threads handling individual workers
+        self._lock = threading.Lock()
+        self._workers = []
+        # Queue of (key, result) for finished nodes and (None, None) for changes
+        # in capacity (workers connecting or disconnecting)
+        self._events = queue.Queue()
+        self._listener = None
+        # Worker selected by the last call to 'can_run'
+        self._selected = (None, None)
+
+    @property
+    def address(self):
+        """The (host, port) that the executor listens on; the port is only known
+        once the executor has been started, if the port was specified as 0.
+        """
+        if self._listener is not None:
+            return self._listener.address
+
+        return self._address
+
+    def start(self):
+        self._listener = Listener(self._address, authkey=self._authkey)
+        self._logger.info("Waiting for workers on %s:%i", *self._listener.address)
+
+        thread = threading.Thread(target=self._accept_workers, daemon=True)
+        thread.start()
+
+    def can_run(self, node):
+        worker = self._select_worker(node)
+        self._selected = (node, worker)
+
+        return worker is not None
+
+    def submit(self, key, node, config):
+        selected_node, worker = self._selected
+        if selected_node is not node:
+            worker = self._select_worker(node)
+        self._selected = (None, None)
+
+        if worker is None:
+            raise ValueError("No worker can run node %s" % (node,))
+
+        with self._lock:
+            # The worker may have disconnected since it was selected
+            is_connected = worker in self._workers
+            if is_connected:
+                worker.start_node(key, node)
+
+        if is_connected:
+            try:
+                worker.send(("run", key, node, config))
+                return
+            except OSError:
+                worker.close()
+
+            with self._lock:
+                # Otherwise the node is reported by the thread handling this worker
+                is_connected = worker in self._workers
+                if not is_connected:
+                    worker.lost_node(key)
+
+        if not is_connected:
+            message = "worker %s was lost before node could be started" % (worker,)
+            self._events.put((key, _Result(WorkerLostError(message))))
+
+    def get_finished(self, blocking):
+        try:
+            return self._events.get(blocking)
+        except queue.Empty:
+            return None, None
+
+    def wait(self):
+        self._events.put(self._events.get())
+
+    def close(self):
+        self._shutdown(("shutdown",))
+
+    def terminate(self):
+        self._shutdown(("terminate",))
+
+    def _select_worker(self, node):
+        selected = None
+        with self._lock:
+            for worker in self._workers:
+                if worker.can_run(node):
+                    if selected is None or worker.idle_threads > selected.idle_threads:
+                        selected = worker
+
+        return selected
+
+    def _shutdown(self, message):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+        with self._lock:
+            workers = list(self._workers)
+
+        for worker in workers:
+            try:
+                worker.send(message)
+            except OSError:
+                pass
+            worker.close()
+
+    def _accept_workers(self):
+        while True:
+            listener = self._listener
+            if listener is None:
+                break
+
+            try:
+                conn = listener.accept()
+            except multiprocessing.AuthenticationError as error:
+                self._logger.warning("Rejected worker: %s", error)
+                continue
+            except (EOFError, OSError):
+                # Either the listener was closed or the worker disconnected
+                continue
+
+            thread = threading.Thread(
+                target=self._handle_worker, args=(conn,), daemon=True
+            )
+            thread.start()
+
+    def _handle_worker(self, conn):
+        worker = None
+        try:
+            if not conn.poll(self._timeout):
+                raise WorkerLostError("no response from worker")
+
+            command, info = conn.recv()
+            if command != "hello":
+                raise WorkerLostError("unexpected message %r" % (command,))
+
+            worker = _RemoteWorker(conn, **info)
+            self._logger.info(
+                "Worker %s connected with %i threads and %s memory",
+                worker,
+                worker.threads,
+                "unlimited" if worker.memory == math.inf else worker.memory,
+            )
+
+            with self._lock:
+                self._workers.append(worker)
+            self._events.put((None, None))
+
+            while conn.poll(self._timeout):
+                message = conn.recv()
+                if message[0] == "finished":
+                    _, key, error = message
+                    with self._lock:
+                        worker.finish_node(key)
+                    self._events.put((key, _Result(error)))
+                elif message[0] != "heartbeat":
+                    raise WorkerLostError("unexpected message %r" % (message[0],))
+
+            raise WorkerLostError("no heartbeat for %i seconds" % (self._timeout,))
+        except (EOFError, OSError, WorkerLostError) as error:
+            if worker is not None:
+                self._logger.warning("Lost worker %s: %s", worker, error)
+        finally:
+            conn.close()
+            if worker is not None:
+                with self._lock:
+                    self._workers.remove(worker)
+                    lost_nodes = worker.lost_nodes()
+
+                for key in lost_nodes:
+                    message = "worker %s was lost while running node" % (worker,)
+                    self._events.put((key, _Result(WorkerLostError(message))))
+                self._events.put((None, None))
+
+
+class BatchExecutor(Executor):
+    """Runs nodes as jobs submitted to a SLURM batch scheduler using 'sbatch'.
+    Nodes are submitted with the number of threads used as the number of CPUs per
+    task and with the estimated memory usage (if any) as the memory requested.
+    Runable nodes with identical requirements are submitted as job arrays of at
+    most 'max_array_size' tasks, and at most 'max_jobs' nodes are queued/running
+    at once.
+
+    Nodes and their results are exchanged via files in 'root', which must be
+    located on a file-system shared with the compute nodes. Result files are
+    checked every 'poll_interval' seconds, while 'squeue' is run for all jobs at
+    once every 'queue_interval' seconds, in order to detect jobs that ended
+    without reporting a result (e.g. jobs killed for exceeding limits).
+    """
+
+    def __init__(
+        self,
+        root,
+        max_jobs=100,
+        max_array_size=MAX_ARRAY_SIZE,
+        options=(),
+        poll_interval=5,
+        queue_interval=60,
+        sbatch="sbatch",
+        squeue="squeue",
+        scancel="scancel",
+    ):
+        if max_jobs < 1:
+            raise ValueError("Max jobs must be >= 1")
+        elif max_array_size < 1:
+            raise ValueError("Max array size must be >= 1")
+
+        self._root = root
+        self._max_jobs = max_jobs
+        self._max_array_size = max_array_size
+        self._options = tuple(options)
+        self._poll_interval = poll_interval
+        self._queue_interval = queue_interval
+        self._sbatch = sbatch
+        self._squeue = squeue
+        self._scancel = scancel
+        self._logger = logging.getLogger(__name__)
+
+        # Nodes submitted by Pypeline, but not yet submitted to the scheduler
+        self._pending = []
+        # Dictionary of key -> _BatchTask for nodes submitted to the scheduler
+        self._running = {}
+        # List of (key, result) for finished nodes
+        self._finished = []
+        self._last_poll = -math.inf
+        self._last_queue = time.monotonic()
+
+    def can_run(self, node):
+        return len(self._pending) + len(self._running) < self._max_jobs
+
+    def submit(self, key, node, config):
+        # Nodes are submitted in batches, once Pypeline waits for nodes to finish
+        self._pending.append((key, node, config))
+
+    def get_finished(self, blocking):
+        self._submit_pending()
+
+        if not self._finished and self._running:
+            delay = self._last_poll + self._poll_interval - time.monotonic()
+            if delay <= 0 or blocking:
+                if delay > 0:
+                    time.sleep(delay)
+
+                self._poll()
+
+        if self._finished:
+            return self._finished.pop(0)
+
+        return None, None
+
+    def terminate(self):
+        self._pending.clear()
+        if self._running:
+            job_ids = sorted(set(task.job_id for task in self._running.values()))
+            self._running.clear()
+
+            self._logger.info("Cancelling %i batch job(s)", len(job_ids))
+            try:
+                subprocess.run(
+                    [self._scancel] + job_ids,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            except OSError as error:
+                self._logger.error("Error cancelling batch jobs: %s", error)
+
+    def _submit_pending(self):
+        # Nodes with identical resource requirements are submitted as one array
+        groups = {}
+        for key, node, config in self._pending:
+            resources = (node.threads, node.memory)
+            groups.setdefault(resources, []).append((key, node, config))
+        self._pending.clear()
+
+        for (threads, memory), tasks in sorted(groups.items()):
+            for start in range(0, len(tasks), self._max_array_size):
+                chunk = tasks[start : start + self._max_array_size]
+                self._submit_array(threads, memory, chunk)
+
+    def _submit_array(self, threads, memory, tasks):
+        os.makedirs(self._root, exist_ok=True)
+        dirname = tempfile.mkdtemp(prefix="array.", dir=self._root)
+        for idx, (_, node, config) in enumerate(tasks):
+            with open(os.path.join(dirname, "%i.pickle" % (idx,)), "wb") as handle:
+                pickle.dump((node, config), handle, pickle.HIGHEST_PROTOCOL)
+
+        command = [
+            self._sbatch,
+            "--parsable",
+            "--job-name=paleomix",
+            "--array=0-%i" % (len(tasks) - 1,),
+            "--cpus-per-task=%i" % (threads,),
+            "--output=%s" % (os.path.join(dirname, "%a.log"),),
+        ]
+
+        if memory:
+            command.append("--mem=%iM" % (math.ceil(memory / 1024 ** 2),))
+
+        command.extend(self._options)
+        command.append(
+            "--wrap=%s -m paleomix.executors %s"
+            % (shlex.quote(sys.executable), shlex.quote(dirname))
+        )
+
+        try:
+            proc = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+        except OSError as error:
+            message = "could not run %r: %s" % (self._sbatch, error)
+        else:
+            # Output is either 'job_id' or 'job_id;cluster'
+            job_id = proc.stdout.strip().split(";")[0]
+            if not proc.returncode and job_id.isdigit():
+                self._logger.debug(
+                    "Submitted batch job %s with %i task(s)", job_id, len(tasks)
+                )
+
+                for idx, (key, _, _) in enumerate(tasks):
+                    self._running[key] = _BatchTask(dirname, job_id, idx)
+                return
+
+            message = "%r failed with return-code %i: %s" % (
+                self._sbatch,
+                proc.returncode,
+                proc.stderr.strip() or proc.stdout.strip(),
+            )
+
+        shutil.rmtree(dirname)
+        error = NodeError("Error submitting batch job; %s" % (message,))
+        for key, _, _ in tasks:
+            self._finished.append((key, _Result(error)))
+
+    def _poll(self):
+        self._last_poll = time.monotonic()
+
+        # Results are checked using one directory listing per job array
+        results = {}
+        for dirname in set(task.dirname for task in self._running.values()):
+            with os.scandir(dirname) as it:
+                results[dirname] = frozenset(entry.name for entry in it)
+
+        unknown_tasks = {}
+        for key, task in self._running.items():
+            if os.path.basename(task.result_file) in results[task.dirname]:
+                self._finished.append((key, task.get_result()))
+            else:
+                unknown_tasks[key] = task
+
+        for key, _ in self._finished:
+            self._running.pop(key, None)
+
+        if self._last_queue + self._queue_interval <= self._last_poll:
+            self._check_queue(unknown_tasks)
+
+        self._cleanup()
+
+    def _check_queue(self, tasks):
+        self._last_queue = time.monotonic()
+        if not tasks:
+            return
+
+        active = self._get_active_jobs(set(task.job_id for task in tasks.values()))
+        if active is None:
+            return
+
+        for key, task in tasks.items():
+            if (task.job_id, task.index) in active or (task.job_id, None) in active:
+                continue
+            # The job may have finished after the result files were checked
+            elif os.path.exists(task.result_file):
+                self._finished.append((key, task.get_result()))
+            else:
+                message = "batch job %s_%i ended without reporting a result; see %r"
+                error = NodeError(message % (task.job_id, task.index, task.log_file))
+                self._finished.append((key, _Result(error)))
+
+            self._running.pop(key)
+
+    def _get_active_jobs(self, job_ids):
+        """Returns a set of (job_id, task_id) for queued/running tasks in the
+        specified job arrays, with a task_id of None for tasks whose IDs are not
+        listed individually (pending tasks). Returns None if 'squeue' failed.
+        """
+        command = [
+            self._squeue,
+            "--noheader",
+            "--format=%A %a",
+            "--jobs=%s" % (",".join(sorted(job_ids)),),
+        ]
+
+        try:
+            proc = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+        except OSError as error:
+            self._logger.warning("Could not run %r: %s", self._squeue, error)
+            return None
+
+        if proc.returncode:
+            # squeue fails if none of the jobs are known, i.e. if all have ended
+            if "invalid job id" in proc.stderr.lower():
+                return frozenset()
+
+            self._logger.warning("Error running %r: %s", self._squeue, proc.stderr)
+            return None
+
+        active = set()
+        for line in proc.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                job_id, task_id = fields
+                active.add((job_id, int(task_id) if task_id.isdigit() else None))
+
+        return active
+
+    def _cleanup(self):
+        # Files for failed nodes are kept, to allow the user to inspect the logs
+        for key, result in self._finished:
+            if not isinstance(result, _BatchResult) or result.error is not None:
+                continue
+
+            task = result.task
+            for filename in (task.node_file, task.result_file, task.log_file):
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass
+
+            try:
+                os.rmdir(task.dirname)
+            except OSError:
+                pass  # Other tasks in the array have not finished/failed
+
+
+class _BatchTask:
+    """A node submitted as task 'index' in the job array 'job_id'."""
+
+    def __init__(self, dirname, job_id, index):
+        self.dirname = dirname
+        self.job_id = job_id
+        self.index = index
+
+    @property
+    def node_file(self):
+        return os.path.join(self.dirname, "%i.pickle" % (self.index,))
+
+    @property
+    def result_file(self):
+        return os.path.join(self.dirname, "%i.result" % (self.index,))
+
+    @property
+    def log_file(self):
+        return os.path.join(self.dirname, "%i.log" % (self.index,))
+
+    def get_result(self):
+        try:
+            with open(self.result_file, "rb") as handle:
+                error = pickle.load(handle)
+        except (OSError, pickle.UnpicklingError, EOFError) as error:
+            message = "could not read result of batch job %s_%i: %s"
+            error = NodeError(message % (self.job_id, self.index, error))
+
+        return _BatchResult(self, error)
+
+
+class _RemoteWorker:
+    """Book-keeping for a connected worker; access must be protected by a lock,
+    except for the 'send' and 'close' functions."""
+
+    def __init__(self, conn, host, threads, memory=None):
+        self.host = host
+        self.threads = threads
+        self.memory = math.inf if memory is None else memory
+        self.idle_threads = self.threads
+        self.idle_memory = self.memory
+
+        self._conn = conn
+        self._send_lock = threading.Lock()
+        self._running = {}
+
+    def can_run(self, node):
+        threads, memory = self._get_resources(node)
+
+        return threads <= self.idle_threads and memory <= self.idle_memory
+
+    def start_node(self, key, node):
+        threads, memory = self._get_resources(node)
+        self.idle_threads -= threads
+        self.idle_memory -= memory
+        self._running[key] = node
+
+    def finish_node(self, key):
+        threads, memory = self._get_resources(self._running.pop(key))
+        self.idle_threads += threads
+        self.idle_memory += memory
+
+    def lost_node(self, key):
+        self._running.pop(key, None)
+
+    def lost_nodes(self):
+        keys = list(self._running)
+        self._running.clear()
+
+        return keys
+
+    def send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+    def close(self):
+        self._conn.close()
+
+    def _get_resources(self, node):
+        return min(node.threads, self.threads), min(node.memory, self.memory)
+
+    def __str__(self):
+        return self.host
+
+
+class _Result:
+    """Result of a node run by a worker; mimics multiprocessing.AsyncResult."""
+
+    def __init__(self, error=None):
+        self._error = error
+
+    def get(self):
+        if self._error is not None:
+            raise self._error
+
+
+class _BatchResult(_Result):
+    """Result of a node run as a batch job."""
+
+    def __init__(self, task, error=None):
+        _Result.__init__(self, error)
+        self.task = task
+
+    @property
+    def error(self):
+        return self._error
+
+
+def get_authkey():
+    """Returns the key used to authenticate workers, taken from the environment
+    variable PALEOMIX_WORKER_KEY; raises ValueError if the variable is not set."""
+    value = os.environ.get("PALEOMIX_WORKER_KEY")
+    if not value:
+        raise ValueError(
+            "The PALEOMIX_WORKER_KEY environment variable must be set to a secret "
+            "value, shared by the pipeline and by workers"
+        )
+
+    return value.encode("utf-8")
+
+
+def parse_address(value):
+    """Parses an address in the form HOST:PORT, returning a (host, port) tuple."""
+    host, sep, port = value.rpartition(":")
+    if not (sep and port.isdigit()):
+        raise ValueError("invalid address %r; expected HOST:PORT" % (value,))
+
+    return host or "0.0.0.0", int(port)
+
+
+def run_node(node, config):
+    """Runs a node, ensuring that the exception raised on failure can be sent to
+    the main process; it is not possible to pickle bound functions (node.run)."""
+    try:
+        return node.run(config)
+    except NodeError:
+        raise
+    except Exception:
+        message = "Unhandled error running Node:\n\n%s" % (traceback.format_exc(),)
+
+        raise NodeUnhandledException(message)
+
+
+def _init_worker(queue):
+    """Init function for subprocesses created by multiprocessing.Pool: Ensures
+    that KeyboardInterrupts only occur in the main process, allowing us to do
+    proper cleanup.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # This is a workaround to avoid having to use multiprocessing.Manager
+    # to create the Queue objects; this is needed because the Manager class
+    # creates it own process, which inherits the signal-handlers of the main
+    # process, causing some rather odd behavior when the user causes a SIGINT.
+    _call_run.queue = queue
+
+
+def _call_run(key, node, config):
+    """Wrapper function, required in order to call Node.run() in subprocesses."""
+    try:
+        return run_node(node, config)
+    finally:
+        # See comment in _init_worker
+        _call_run.queue.put(key)
+
+
+def run_batch_task(dirname, index):
+    """Runs the node stored in a job array folder created by a BatchExecutor, and
+    writes any error raised by the node to the corresponding result file."""
+    task = _BatchTask(dirname, None, index)
+    with open(task.node_file, "rb") as handle:
+        node, config = pickle.load(handle)
+
+    error = None
+    try:
+        run_node(node, config)
+    except NodeError as error_:
+        error = error_
+
+    try:
+        data = pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        # The error could not be pickled; send a description instead
+        data = pickle.dumps(NodeUnhandledException(str(error)))
+
+    # The result file is written atomically, since it is polled by the executor
+    temp_file = task.result_file + ".tmp"
+    with open(temp_file, "wb") as handle:
+        handle.write(data)
+    os.rename(temp_file, task.result_file)
+
+    return 0 if error is None else 1
+
+
+def main(argv):
+    if len(argv) != 1:
+        sys.stderr.write("Usage: python -m paleomix.executors ARRAY_DIR\n")
+        return 1
+
+    index = int(os.environ["SLURM_ARRAY_TASK_ID"])
+
+    return run_batch_task(argv[0], index)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
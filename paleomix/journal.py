@@ -0,0 +1,306 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Append-only journal of files generated by nodes.
+
+The journal records the mtime and size of the output files of every node that
+has completed successfully, allowing the state of these files to be determined
+on subsequent runs without checking every file up front. This greatly reduces
+the time needed to start a pipeline on slow (e.g. networked) file-systems.
+
+If checksums are enabled, the journal also records digests of the input files
+used to generate the output files of each node. Nodes whose input files have
+newer timestamps than their output files are then only considered outdated if
+the content of those input files has changed, for example allowing reference
+sequences to be copied or touched without having to re-run the pipeline.
+
+Each line in the journal is a JSON list, either ["+", path, mtime, size] for a
+file written by a node, ["-", path] for a file that is about to be replaced, or
+["=", [path, ...], [[input, digest], ...]] for the digests of the input files
+used to generate a set of files. Later lines take precedence over earlier lines.
+Since the journal only serves to avoid checking files / re-running nodes
+needlessly, entries may be lost (e.g. due to a crash while writing to the
+journal) without affecting correctness.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+
+from paleomix.common.fileutils import make_dirs, move_file
+
+
+# Files larger than this are digested by sampling blocks evenly across the file
+_DIGEST_MAX_FULL_SIZE = 1024 ** 3
+_DIGEST_BLOCK_SIZE = 1024 ** 2
+_DIGEST_SAMPLED_BLOCKS = 256
+
+
+class Journal:
+    # The journal is compacted when loaded if it contains more than this many
+    # lines per currently valid entry
+    _MAX_LINES_PER_ENTRY = 4
+
+    def __init__(self, filename, checksums=False):
+        self._filename = os.path.abspath(filename)
+        self._checksums = checksums
+        self._cwd = os.getcwd()
+        self._logger = logging.getLogger(__name__)
+        self._entries = {}
+        # Digests of the input files used to generate each (output) file
+        self._input_digests = {}
+        # Digests calculated during this run, keyed by (path, mtime, size)
+        self._digest_cache = {}
+        self._handle = None
+
+        nlines = self._load()
+        if nlines > self._MAX_LINES_PER_ENTRY * max(1, len(self._entries)):
+            self._compact()
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def checksums(self):
+        return self._checksums
+
+    def get_mtime(self, filename):
+        """Returns the recorded mtime of a file, or None if no (valid) record of
+        the file exists in the journal.
+        """
+        entry = self._entries.get(self._abspath(filename))
+        if entry is not None:
+            return entry[0]
+
+        return None
+
+    def get_stat(self, filename):
+        """Returns the recorded (mtime, size) of a file, or None if no (valid)
+        record of the file exists in the journal.
+        """
+        return self._entries.get(self._abspath(filename))
+
+    def record(self, filenames, input_files=()):
+        """Records the current mtime and size of a set of files; this should be
+        called once the files have been generated by a node. If checksums are
+        enabled, digests of the 'input_files' used to generate these files are
+        also recorded.
+        """
+        lines = []
+        filenames = [self._abspath(filename) for filename in filenames]
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+                self._entries.pop(filename, None)
+                lines.append(["-", filename])
+            else:
+                self._entries[filename] = (stat.st_mtime, stat.st_size)
+                lines.append(["+", filename, stat.st_mtime, stat.st_size])
+
+        if self._checksums and filenames and input_files:
+            digests = {}
+            for input_file in input_files:
+                digest = self._get_digest(input_file)
+                if digest is not None:
+                    digests[self._abspath(input_file)] = digest
+
+            for filename in filenames:
+                self._input_digests[filename] = digests
+            lines.append(["=", filenames, sorted(digests.items())])
+
+        self._write(lines)
+
+    def discard(self, filenames):
+        """Removes files from the journal; this should be called before the files
+        are modified / replaced, as recorded values may otherwise be incorrect.
+        """
+        lines = []
+        for filename in filenames:
+            filename = self._abspath(filename)
+            if self._entries.pop(filename, None) is not None:
+                lines.append(["-", filename])
+                self._input_digests.pop(filename, None)
+            elif self._input_digests.pop(filename, None) is not None:
+                lines.append(["-", filename])
+
+        self._write(lines)
+
+    def inputs_unchanged(self, input_files, output_files):
+        """Returns true if checksums are enabled and the content of every input
+        file is unchanged since the output files were generated, based on the
+        digests recorded for those output files. Note that this may require
+        reading (part of) every input file.
+        """
+        if not (self._checksums and output_files):
+            return False
+
+        for output_file in output_files:
+            digests = self._input_digests.get(self._abspath(output_file))
+            if digests is None:
+                return False
+
+            for input_file in input_files:
+                expected = digests.get(self._abspath(input_file))
+                if expected is None or expected != self._get_digest(input_file):
+                    return False
+
+        return True
+
+    def validate(self, filenames):
+        """Checks that the files recorded in the journal are unchanged, removing
+        any entries for files that have changed. Returns the files that were
+        removed from the journal, if any.
+        """
+        changed_files = []
+        for filename in filenames:
+            entry = self._entries.get(self._abspath(filename))
+            if entry is not None:
+                try:
+                    stat = os.stat(filename)
+                    current = (stat.st_mtime, stat.st_size)
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+                    current = None
+
+                if current != entry:
+                    changed_files.append(filename)
+
+        self.discard(changed_files)
+
+        return changed_files
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _get_digest(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return None
+
+        key = (self._abspath(filename), stat.st_mtime, stat.st_size)
+        digest = self._digest_cache.get(key)
+        if digest is None:
+            self._logger.debug("Calculating digest for %r", filename)
+            digest = self._digest_cache[key] = file_digest(filename)
+
+        return digest
+
+    def _abspath(self, filename):
+        # os.path.abspath is avoided, since it calls os.getcwd for every path
+        return os.path.normpath(os.path.join(self._cwd, filename))
+
+    def _write(self, lines):
+        if not lines:
+            return
+
+        if self._handle is None:
+            make_dirs(os.path.dirname(self._filename))
+            self._handle = open(self._filename, "a")
+
+        # Each line is written in full, to limit interleaving with other writers
+        for line in lines:
+            self._handle.write(json.dumps(line) + "\n")
+        self._handle.flush()
+
+    def _load(self):
+        nlines = 0
+        try:
+            with open(self._filename) as handle:
+                for nlines, line in enumerate(handle, start=1):
+                    try:
+                        record = json.loads(line)
+                        if record[0] == "+":
+                            _, filename, mtime, size = record
+                            self._entries[filename] = (mtime, size)
+                        elif record[0] == "-":
+                            self._entries.pop(record[1], None)
+                            self._input_digests.pop(record[1], None)
+                        elif record[0] == "=":
+                            _, filenames, digests = record
+                            digests = dict(digests)
+                            for filename in filenames:
+                                self._input_digests[filename] = digests
+                    except (ValueError, IndexError, TypeError):
+                        # Partially written line, e.g. due to a crash
+                        self._logger.warning(
+                            "Ignoring malformed line %i in journal %r",
+                            nlines,
+                            self._filename,
+                        )
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+        return nlines
+
+    def _compact(self):
+        self._logger.info("Compacting journal %r", self._filename)
+        temp_filename = "%s.%i.tmp" % (self._filename, os.getpid())
+        with open(temp_filename, "w") as handle:
+            for (filename, (mtime, size)) in sorted(self._entries.items()):
+                handle.write(json.dumps(["+", filename, mtime, size]) + "\n")
+
+            # Files generated together share the same dictionary of digests
+            groups = {}
+            for (filename, digests) in sorted(self._input_digests.items()):
+                groups.setdefault(id(digests), (digests, []))[1].append(filename)
+
+            for (digests, filenames) in groups.values():
+                record = ["=", filenames, sorted(digests.items())]
+                handle.write(json.dumps(record) + "\n")
+
+        move_file(temp_filename, self._filename)
+
+
+def file_digest(filename):
+    """Returns a hex digest of the content of a file. Files larger than 1 GiB
+    are digested by sampling blocks spaced evenly across the file, in addition
+    to the size of the file, in order to limit the cost for large (e.g. BAM)
+    files; changes to such files may therefore in rare cases go undetected.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        hasher.update(str(size).encode("ascii"))
+
+        if size <= _DIGEST_MAX_FULL_SIZE:
+            for block in iter(lambda: handle.read(_DIGEST_BLOCK_SIZE), b""):
+                hasher.update(block)
+        else:
+            step = (size - _DIGEST_BLOCK_SIZE) // (_DIGEST_SAMPLED_BLOCKS - 1)
+            for idx in range(_DIGEST_SAMPLED_BLOCKS):
+                handle.seek(idx * step)
+                hasher.update(handle.read(_DIGEST_BLOCK_SIZE))
+
+    return hasher.hexdigest()
@@ -40,12 +40,16 @@ _COMMANDS = {
     "zonkey:db": "paleomix.pipelines.zonkey.build_db",
     "zonkey:mito": "paleomix.pipelines.zonkey.build_mito",
     "zonkey:tped": "paleomix.pipelines.zonkey.build_tped",
+    # Worker for running pipeline tasks on other hosts
+    "worker": "paleomix.worker",
     # BAM file tools
+    "bam_stats": "paleomix.tools.bam_stats.combined",
     "cleanup": "paleomix.tools.cleanup",
     "coverage": "paleomix.tools.coverage",
     "depths": "paleomix.tools.depths",
     # VCF/etc. tools
     "gtf_to_bed": "paleomix.tools.gtf_to_bed",
+    "rmdup": "paleomix.tools.rmdup",
     "rmdup_collapsed": "paleomix.tools.rmdup_collapsed",
     "vcf_filter": "paleomix.tools.vcf_filter",
     "vcf_to_fasta": "paleomix.tools.vcf_to_fasta",
@@ -64,12 +68,19 @@ Pipelines:
     paleomix phylo            -- Pipeline for genotyping and phylogenetic
                                  inference from BAMs.
     paleomix zonkey           -- Pipeline for detecting F1 (equine) hybrids.
+    paleomix worker           -- Run tasks for a pipeline started with the
+                                 --listen option, possibly on another host.
 
 BAM/SAM tools:
+    paleomix bam_stats        -- Calculate coverage and/or depth histograms for
+                                 reference sequences and any number of sets of
+                                 regions of interest, in a single pass.
     paleomix coverage         -- Calculate coverage across reference sequences
                                  or regions of interest.
     paleomix depths           -- Calculate depth histograms across reference
                                  sequences or regions of interest.
+    paleomix rmdup            -- Merges BAM files and filters PCR duplicates
+                                 for single-end and paired-end reads.
     paleomix rmdup_collapsed  -- Filters PCR duplicates for collapsed paired-
                                  ended reads generated by the AdapterRemoval
                                  tool.
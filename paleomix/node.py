@@ -47,7 +47,24 @@ class NodeUnhandledException(NodeError):
     pass
 
 
+class NodeChainError(NodeError):
+    """Raised by NodeChain.run() if a node failed; 'completed' is the number of
+    nodes that were run successfully before 'error' was raised by the next node."""
+
+    def __init__(self, error, completed):
+        NodeError.__init__(self, error, completed)
+        self.error = error
+        self.completed = completed
+
+    def __str__(self):
+        return str(self.error)
+
+
 class Node:
+    # Nodes that are cheap to run (e.g. indexing or validating a file) may be run
+    # right after a node that they depend on, as part of the same task; see Pypeline
+    lightweight = False
+
     def __init__(
         self,
         description=None,
@@ -58,6 +75,7 @@ class Node:
         auxiliary_files=(),
         requirements=(),
         dependencies=(),
+        memory=0,
     ):
 
         if not isinstance(description, _DESC_TYPES):
@@ -74,6 +92,8 @@ class Node:
         self.requirements = self._validate_requirements(requirements)
 
         self.threads = self._validate_nthreads(threads)
+        # Estimated peak memory usage in bytes; 0 if unknown or negligible
+        self.memory = self._validate_memory(memory)
         self.dependencies = self._collect_nodes(dependencies)
 
         # If there are no input files, the node cannot be re-run based on
@@ -176,6 +196,7 @@ class Node:
             "PATH             = %r" % (os.environ.get("PATH", ""),),
             "Node             = %s" % (str(self),),
             "Threads          = %i" % (self.threads,),
+            "Memory           = %i" % (self.memory,),
             "Input files      = %s" % (_fmt(self.input_files),),
             "Output files     = %s" % (_fmt(self.output_files),),
             "Auxiliary files  = %s" % (_fmt(self.auxiliary_files),),
@@ -250,9 +271,54 @@ class Node:
             )
         return threads
 
+    @classmethod
+    def _validate_memory(cls, memory):
+        if not isinstance(memory, int):
+            raise TypeError(
+                "'memory' must be a non-negative integer, not a %s" % (type(memory),)
+            )
+        elif memory < 0:
+            raise ValueError(
+                "'memory' must be a non-negative integer, not %i" % (memory,)
+            )
+        return memory
+
+
+class NodeChain:
+    """A sequence of nodes that are run one after the other as a single task, where
+    each node depends only on nodes that are done or that precede it in the chain.
+    Nodes are still run individually, each using its own temporary folder, and
+    the chain stops at the first node that fails (see NodeChainError).
+
+    The chain uses the max number of threads and the max amount of memory used by
+    any of its nodes, and may thus be passed to executors in place of a node.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = tuple(nodes)
+        if not self.nodes:
+            raise ValueError("NodeChain must contain at least one node")
+
+        self.threads = max(node.threads for node in self.nodes)
+        self.memory = max(node.memory for node in self.nodes)
+
+    def run(self, config):
+        for idx, node in enumerate(self.nodes):
+            try:
+                node.run(config)
+            except NodeError as error:
+                raise NodeChainError(error, idx)
+
+    def __str__(self):
+        return "<Chain: %s>" % (", ".join(map(str, self.nodes)),)
+
 
 class CommandNode(Node):
-    def __init__(self, command, description=None, threads=1, dependencies=()):
+    def __init__(
+        self, command, description=None, threads=1, dependencies=(), memory=None
+    ):
+        """If 'memory' is not set, the memory usage declared by the command is used.
+        """
         Node.__init__(
             self,
             description=description,
@@ -263,6 +329,7 @@ class CommandNode(Node):
             requirements=command.requirements,
             threads=threads,
             dependencies=dependencies,
+            memory=command.memory if memory is None else memory,
         )
 
         self._command = command
@@ -21,9 +21,13 @@
 # SOFTWARE.
 #
 import collections
+import concurrent.futures
 import errno
+import heapq
+import itertools
 import logging
 import os
+import time
 
 import paleomix.common.versions as versions
 
@@ -33,6 +37,11 @@ from paleomix.common.utilities import safe_coerce_to_frozenset
 
 # Max number of error messages of each type
 _MAX_ERROR_MESSAGES = 10
+# Max number of threads used to check the state of files
+_MAX_STAT_THREADS = 8
+# Min number of files for which states are prefetched when the state of a node
+# changes; listing (large) directories costs more than checking a few files
+_MIN_PREFETCH_FILES = 64
 
 
 class FileStatusCache:
@@ -41,15 +50,79 @@ class FileStatusCache:
     operation (e.g. refreshing all states / manually setting the state of a
     node) to avoid relying on the filesystem staying consistant for long
     periods of time.
+
+    If a journal is given (see paleomix.journal), then the mtimes of files
+    recorded in the journal are used instead of checking the files themselves.
+
+    The number of stat / scandir calls made and the time spent on these are
+    recorded in the 'stat_calls', 'scandir_calls', and 'elapsed' attributes.
     """
 
-    def __init__(self):
+    def __init__(self, journal=None, max_threads=_MAX_STAT_THREADS):
         self._stat_cache = {}
+        self._journal = journal
+        self._max_threads = max_threads
+
+        self.stat_calls = 0
+        self.scandir_calls = 0
+        self.elapsed = 0.0
+
+    def prefetch(self, fpaths):
+        """Collects the state of multiple files at once, instead of one file at a
+        time. Files are grouped by directory and each directory is listed once,
+        only stat'ing files that are actually present. Directories are processed
+        using up to 'max_threads' threads, which greatly reduces the time taken on
+        high-latency file-systems (e.g. NFS / Lustre).
+        """
+        start = time.monotonic()
+        directories = collections.defaultdict(list)
+        for fpath in fpaths:
+            if fpath not in self._stat_cache:
+                if self._journal is not None:
+                    stat = self._journal.get_stat(fpath)
+                    if stat is not None:
+                        self._stat_cache[fpath] = stat
+                        continue
+
+                dirname, basename = os.path.split(fpath)
+                # Paths with trailing slashes are left for _get_state
+                if basename:
+                    directories[dirname].append((basename, fpath))
+
+        results = map(_scan_directory, directories.items())
+        if self._max_threads > 1 and len(directories) > 1:
+            nthreads = min(self._max_threads, len(directories))
+            with concurrent.futures.ThreadPoolExecutor(nthreads) as executor:
+                results = list(executor.map(_scan_directory, directories.items()))
+
+        for stats, stat_calls in results:
+            self._stat_cache.update(stats)
+            self.stat_calls += stat_calls
+        self.scandir_calls += len(directories)
+        self.elapsed += time.monotonic() - start
 
     def files_exist(self, fpaths):
         """Returns true if all paths listed in fpaths exist."""
         return all((self._get_state(fpath) is not None) for fpath in fpaths)
 
+    def get_mtime(self, fpath):
+        """Returns the mtime of a path, or None if the path does not exist."""
+        return self._get_state(fpath)
+
+    def get_size(self, fpath):
+        """Returns the size of a path, or None if the path does not exist."""
+        stat = self._get_stat(fpath)
+
+        return None if stat is None else stat[1]
+
+    def get_sizes(self):
+        """Returns a dictionary of the sizes of all paths checked so far."""
+        return {
+            fpath: stat[1]
+            for (fpath, stat) in self._stat_cache.items()
+            if stat is not None
+        }
+
     def missing_files(self, fpaths):
         """Returns a list of paths in fpaths that do not exist."""
         return [fpath for fpath in fpaths if (self._get_state(fpath) is None)]
@@ -62,6 +135,9 @@ class FileStatusCache:
         The function also returns true if any files are missing, as this would
         indicate either the 'output' files or both the 'input' and 'output'
         files would need to be rebuilt.
+
+        If the journal records checksums, then the 'output' files are only
+        considered outdated if the content of the 'input' files has changed.
         """
         input_timestamps = []
         if not self._get_states(input_files, input_timestamps):
@@ -71,7 +147,12 @@ class FileStatusCache:
         if not self._get_states(output_files, output_timestamps):
             return True
 
-        return max(input_timestamps) > min(output_timestamps)
+        if max(input_timestamps) <= min(output_timestamps):
+            return False
+        elif self._journal is not None:
+            return not self._journal.inputs_unchanged(input_files, output_files)
+
+        return True
 
     def _get_states(self, filenames, dst):
         """Collects the mtimes for a set of filenames, returning true if all
@@ -88,14 +169,23 @@ class FileStatusCache:
 
     def _get_state(self, fpath):
         """Returns the mtime of a path, or None if the path does not exist."""
+        stat = self._get_stat(fpath)
+
+        return None if stat is None else stat[0]
+
+    def _get_stat(self, fpath):
+        """Returns the (mtime, size) of a path, or None if it does not exist."""
         if fpath not in self._stat_cache:
-            try:
-                mtime = os.path.getmtime(fpath)
-            except OSError as error:
-                if error.errno != errno.ENOENT:
-                    raise
-                mtime = None
-            self._stat_cache[fpath] = mtime
+            stat = None
+            if self._journal is not None:
+                stat = self._journal.get_stat(fpath)
+
+            if stat is None:
+                start = time.monotonic()
+                stat = _get_stat(fpath)
+                self.stat_calls += 1
+                self.elapsed += time.monotonic() - start
+            self._stat_cache[fpath] = stat
         return self._stat_cache[fpath]
 
 
@@ -110,13 +200,26 @@ class NodeGraph:
     def __init__(self, nodes, cache_factory=FileStatusCache):
         self._cache_factory = cache_factory
         self._states = {}
+        # Heap of (-priority, counter, node) for nodes in the RUNABLE state; entries
+        # for nodes that are no longer runable are discarded lazily
+        self._runable_queue = []
+        # Maps RUNABLE nodes to the counter of their current entry in the heap
+        self._runable = {}
+        self._runable_counter = itertools.count()
+        self._priorities = {}
+        # Maps nodes to a list of the number of dependencies in each state
+        self._dependency_states = {}
+        # Sizes of files checked when states were last refreshed
+        self._file_sizes = {}
 
         nodes = safe_coerce_to_frozenset(nodes)
 
         self._logger = logging.getLogger(__name__)
-        self._reverse_dependencies = collections.defaultdict(set)
-        self._collect_reverse_dependencies(nodes, self._reverse_dependencies, set())
-        self._intersections = {}
+        # Nodes are stored in topological order (dependencies before dependants)
+        self._reverse_dependencies = self._collect_reverse_dependencies(nodes)
+        self._topological_order = {
+            node: idx for (idx, node) in enumerate(self._reverse_dependencies)
+        }
         self._top_nodes = [
             node
             for (node, rev_deps) in self._reverse_dependencies.items()
@@ -143,34 +246,92 @@ class NodeGraph:
         if state == old_state:
             return
 
-        self._states[node] = state
+        self._assign_state(node, state)
+        self._runable.pop(node, None)
         self._notify_state_observers(node, old_state, state)
+        self._update_dependants(node)
 
-        intersections = self._calculate_intersections(node)
-
-        # Not all nodes may need to be updated, but we still need to
-        # traverse the "graph" (using the intersection counts) in order
-        # to ensure that all nodes that need to be updated are updated.
-        requires_update = dict.fromkeys(intersections, False)
-        for dependency in self._reverse_dependencies[node]:
-            requires_update[dependency] = True
-
+    def requeue_node(self, node):
+        """Re-determines the state of a RUNNING node that did not finish, e.g.
+        because the worker running it was lost. Unless the output files of the
+        node have been created in the mean time, the node becomes RUNABLE.
+        """
+        if self._states[node] != NodeGraph.RUNNING:
+            raise ValueError("Only running nodes can be requeued: %s" % (node,))
+
+        self._update_node_state(node, self._cache_factory())
+        self._update_dependants(node)
+
+    def _update_dependants(self, node):
+        """Updates the state of nodes depending on a node, following a change in
+        the state of that node."""
+        # Dependants are updated in topological order, so that the states of all
+        # dependencies have been updated before a node is updated. Only nodes with
+        # dependencies that changed state are updated.
+        order = self._topological_order
+        queue = []
+        queued = set()
+        for dependant in self._reverse_dependencies[node]:
+            heapq.heappush(queue, (order[dependant], dependant))
+            queued.add(dependant)
+
+        # Nodes are likely to be checked for having been completed
         cache = self._cache_factory()
-        while any(requires_update.values()):
-            for (node, count) in tuple(intersections.items()):
-                if not count:
-                    has_changed = False
-                    if requires_update[node]:
-                        old_state = self._states.pop(node)
-                        new_state = self._update_node_state(node, cache)
-                        has_changed |= new_state != old_state
-
-                    for dependency in self._reverse_dependencies[node]:
-                        intersections[dependency] -= 1
-                        requires_update[dependency] |= has_changed
-
-                    intersections.pop(node)
-                    requires_update.pop(node)
+        output_files = _collect_output_files(queued)
+        if len(output_files) >= _MIN_PREFETCH_FILES:
+            cache.prefetch(output_files)
+        while queue:
+            _, node = heapq.heappop(queue)
+
+            old_state = self._states[node]
+            if old_state == NodeGraph.RUNNING:
+                # Nodes run together with a dependency (see Pypeline) are left as is
+                continue
+
+            self._runable.pop(node, None)
+            if self._update_node_state(node, cache) != old_state:
+                for dependant in self._reverse_dependencies[node]:
+                    if dependant not in queued:
+                        heapq.heappush(queue, (order[dependant], dependant))
+                        queued.add(dependant)
+
+    def get_dependants(self, node):
+        """Returns the set of nodes that directly depend on a node."""
+        return frozenset(self._reverse_dependencies[node])
+
+    def has_runable_nodes(self):
+        """Returns true if one or more nodes are in the RUNABLE state."""
+        return bool(self._runable)
+
+    def iter_runable_nodes(self):
+        """Yields nodes in the RUNABLE state, in order of decreasing priority and
+        otherwise in the order in which they became runable. The states of nodes
+        must not be changed until the iterator has been exhausted or closed.
+        """
+        queue = self._runable_queue
+        popped = []
+        try:
+            while queue:
+                entry = heapq.heappop(queue)
+                _, counter, node = entry
+                if self._runable.get(node) == counter:
+                    popped.append(entry)
+                    yield node
+        finally:
+            for entry in popped:
+                heapq.heappush(queue, entry)
+
+    def set_priorities(self, priorities):
+        """Sets the priorities of nodes, given as a dictionary of nodes to numbers;
+        runable nodes with higher priorities are returned first by the function
+        'iter_runable_nodes'. Nodes not in the dictionary have priority 0.
+        """
+        self._priorities = dict(priorities)
+        self._runable_queue = [
+            (-self._priorities.get(node, 0), counter, node)
+            for (node, counter) in self._runable.items()
+        ]
+        heapq.heapify(self._runable_queue)
 
     def __iter__(self):
         """Returns a graph of nodes."""
@@ -179,15 +340,40 @@ class NodeGraph:
     def iterflat(self):
         return iter(self._reverse_dependencies)
 
+    def get_file_size(self, filename):
+        """Returns the size of an input/output file as of the last time that node
+        states were refreshed, or None if the file did not exist. This allows file
+        sizes to be used without checking every file again.
+        """
+        return self._file_sizes.get(filename)
+
     def refresh_states(self):
-        states = {}
         cache = self._cache_factory()
-        for (node, state) in self._states.items():
+        cache.prefetch(_collect_files(self._reverse_dependencies))
+
+        old_states = self._states
+        self._states = {}
+        self._dependency_states = {
+            node: [0] * self.NUMBER_OF_STATES for node in self._reverse_dependencies
+        }
+        self._runable = {}
+        self._runable_queue = []
+        for (node, state) in old_states.items():
             if state in (self.ERROR, self.RUNNING):
-                states[node] = state
-        self._states = states
+                self._assign_state(node, state)
+
+        # Nodes are visited in topological order, so dependencies are updated first
         for node in self._reverse_dependencies:
-            self._update_node_state(node, cache)
+            if node not in self._states:
+                self._update_node_state(node, cache)
+
+        self._file_sizes = cache.get_sizes()
+        self._logger.debug(
+            "Checked files using %i stat and %i scandir calls in %.2fs",
+            cache.stat_calls,
+            cache.scandir_calls,
+            cache.elapsed,
+        )
 
     def _notify_state_observers(self, node, _old_state, new_state):
         if new_state == self.RUNNING:
@@ -195,34 +381,30 @@ class NodeGraph:
         elif new_state == self.DONE:
             self._logger.info("Finished node %s", node)
 
-    def _calculate_intersections(self, for_node):
-        def count_nodes(node, counts):
-            for node in self._reverse_dependencies[node]:
-                if node in counts:
-                    counts[node] += 1
-                else:
-                    counts[node] = 1
-                    count_nodes(node, counts)
-            return counts
-
-        if for_node not in self._intersections:
-            counts = count_nodes(for_node, {})
-            for dependency in self._reverse_dependencies[for_node]:
-                counts[dependency] -= 1
-            self._intersections[for_node] = counts
+    def _assign_state(self, node, state):
+        """Sets the state of a node, updating the counts of dependency states for
+        the nodes that depend on it."""
+        old_state = self._states.get(node)
+        self._states[node] = state
 
-        return dict(self._intersections[for_node])
+        if state != old_state:
+            for dependant in self._reverse_dependencies[node]:
+                counts = self._dependency_states[dependant]
+                if old_state is not None:
+                    counts[old_state] -= 1
+                counts[state] += 1
 
     def _update_node_state(self, node, cache):
-        if node in self._states:
-            return self._states[node]
-
-        # Update sub-nodes before checking for fixed states
-        dependency_states = set((NodeGraph.DONE,))
-        for dependency in node.dependencies:
-            dependency_states.add(self._update_node_state(dependency, cache))
+        """Determines the state of a node, based on the states of its dependencies
+        (which must have been determined beforehand) and on its files."""
+        # The "worst" state of any dependency, or DONE if there are no dependencies
+        state = NodeGraph.DONE
+        counts = self._dependency_states[node]
+        for dependency_state in range(self.NUMBER_OF_STATES - 1, state, -1):
+            if counts[dependency_state]:
+                state = dependency_state
+                break
 
-        state = max(dependency_states)
         if state == NodeGraph.DONE:
             if not self.is_done(node, cache):
                 state = NodeGraph.RUNABLE
@@ -247,7 +429,12 @@ class NodeGraph:
                 state = NodeGraph.OUTDATED
             else:
                 state = NodeGraph.QUEUED
-        self._states[node] = state
+        self._assign_state(node, state)
+
+        if state == NodeGraph.RUNABLE:
+            counter = self._runable[node] = next(self._runable_counter)
+            priority = self._priorities.get(node, 0)
+            heapq.heappush(self._runable_queue, (-priority, counter, node))
 
         return state
 
@@ -419,6 +606,8 @@ class NodeGraph:
 
     @classmethod
     def _collect_dependencies(cls, nodes, dependencies):
+        """Collects the (recursive) dependencies of nodes, which must be given in
+        topological order (dependencies first)."""
         for node in nodes:
             if node not in dependencies:
                 subnodes = node.dependencies
@@ -426,8 +615,6 @@ class NodeGraph:
                     dependencies[node] = frozenset()
                     continue
 
-                cls._collect_dependencies(subnodes, dependencies)
-
                 collected = set(subnodes)
                 for subnode in subnodes:
                     collected.update(dependencies[subnode])
@@ -436,18 +623,49 @@ class NodeGraph:
         return dependencies
 
     @classmethod
-    def _collect_reverse_dependencies(cls, lst, rev_dependencies, processed):
-        for node in lst:
-            if node not in processed:
-                processed.add(node)
+    def _collect_reverse_dependencies(cls, nodes):
+        """Returns a dict of nodes to the set of nodes that depend on them; nodes
+        are added to the dict in topological order (dependencies first).
+        """
+        rev_dependencies = {}
+        for node in nodes:
+            if node in rev_dependencies:
+                continue
+
+            # Iterative depth-first search, to avoid recursion limits for deep graphs
+            stack = [(node, iter(node.dependencies))]
+            while stack:
+                current, dependencies = stack[-1]
+                for dependency in dependencies:
+                    if dependency not in rev_dependencies:
+                        stack.append((dependency, iter(dependency.dependencies)))
+                        break
+                else:
+                    stack.pop()
+                    if current not in rev_dependencies:
+                        rev_dependencies[current] = set()
+                        for dependency in current.dependencies:
+                            rev_dependencies[dependency].add(current)
 
-                # Initialize default-dict
-                rev_dependencies[node]
+        return rev_dependencies
 
-                subnodes = node.dependencies
-                for dependency in subnodes:
-                    rev_dependencies[dependency].add(node)
-                cls._collect_reverse_dependencies(subnodes, rev_dependencies, processed)
+
+def _collect_files(nodes):
+    """Returns the set of input and output files of a set of nodes."""
+    filenames = _collect_output_files(nodes)
+    for node in nodes:
+        filenames.update(node.input_files)
+
+    return filenames
+
+
+def _collect_output_files(nodes):
+    """Returns the set of output files of a set of nodes."""
+    filenames = set()
+    for node in nodes:
+        filenames.update(node.output_files)
+
+    return filenames
 
 
 def _summarize_nodes(nodes):
@@ -455,3 +673,58 @@ def _summarize_nodes(nodes):
     if len(nodes) > 4:
         nodes = nodes[:5] + ["and %i more nodes" % len(nodes)]
     return nodes
+
+
+def _get_stat(fpath):
+    try:
+        stat = os.stat(fpath)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+        return None
+
+    return stat.st_mtime, stat.st_size
+
+
+def _scan_directory(item):
+    """Returns the (mtime, size) of a set of files in a directory, along with the
+    number of stat calls made. Files not present in the directory listing are not
+    stat'ed, unless they may differ from a listed file only by case (for
+    case-insensitive file-systems)."""
+    dirname, filenames = item
+    try:
+        with os.scandir(dirname or ".") as handle:
+            entries = {entry.name: entry for entry in handle}
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            # Errors (e.g. permissions) are reported when files are checked
+            return {}, 0
+
+        return {fpath: None for (_, fpath) in filenames}, 0
+
+    stats = {}
+    stat_calls = 0
+    folded_names = None
+    for basename, fpath in filenames:
+        entry = entries.get(basename)
+        if entry is not None:
+            stat_calls += 1
+            try:
+                stat = entry.stat()
+                stats[fpath] = (stat.st_mtime, stat.st_size)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                stats[fpath] = None
+        else:
+            if folded_names is None:
+                folded_names = set(name.casefold() for name in entries)
+
+            if basename.casefold() in folded_names:
+                stat_calls += 1
+                stats[fpath] = _get_stat(fpath)
+            else:
+                stats[fpath] = None
+
+    return stats, stat_calls
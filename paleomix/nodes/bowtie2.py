@@ -113,7 +113,11 @@ class Bowtie2Node(CommandNode):
         aln.set_option("--threads", max_threads)
 
         cleanup = _new_cleanup_command(
-            aln, output_file, reference, paired_end=input_file_1 and input_file_2
+            aln,
+            output_file,
+            reference,
+            paired_end=input_file_1 and input_file_2,
+            threads=max_threads,
         )
 
         apply_options(aln, mapping_options)
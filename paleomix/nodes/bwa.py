@@ -37,6 +37,10 @@ from paleomix.node import CommandNode, NodeError
 from paleomix.nodes.samtools import SAMTOOLS_VERSION
 
 
+# Estimated memory used by 'paleomix cleanup'; this is dominated by the buffer used
+# by 'samtools sort' (768M by default, divided between threads), plus 'cleanup' itself
+_CLEANUP_MEMORY = (768 + 256) * 1024 ** 2
+
 BWA_VERSION = versions.Requirement(
     call=("bwa",), search=r"Version: (\d+)\.(\d+)\.(\d+)", checks=versions.GE(0, 7, 9)
 )
@@ -224,7 +228,11 @@ class BWAAlgorithmNode(CommandNode):
         aln.set_option("-M")
 
         cleanup = _new_cleanup_command(
-            aln, output_file, reference, paired_end=input_file_1 and input_file_2
+            aln,
+            output_file,
+            reference,
+            paired_end=input_file_1 and input_file_2,
+            threads=threads,
         )
 
         apply_options(aln, mapping_options)
@@ -247,10 +255,12 @@ class BWAAlgorithmNode(CommandNode):
         )
 
 
-def _new_cleanup_command(stdin, output_file, reference, paired_end=False):
+def _new_cleanup_command(stdin, output_file, reference, paired_end=False, threads=1):
     convert = factory.new("cleanup")
     convert.set_option("--fasta", "%(IN_FASTA_REF)s")
     convert.set_option("--temp-prefix", "%(TEMP_OUT_PREFIX)s")
+    # Fix mates and update MD/NM tags in-process, instead of using samtools
+    convert.set_option("--in-process")
     convert.set_kwargs(
         IN_STDIN=stdin,
         IN_FASTA_REF=reference,
@@ -262,6 +272,12 @@ def _new_cleanup_command(stdin, output_file, reference, paired_end=False):
     if paired_end:
         convert.set_option("--paired-end")
 
+    if threads > 1:
+        # Threads are used for sorting and compressing the output
+        convert.set_option("--threads", threads)
+
+    convert.set_memory(_CLEANUP_MEMORY)
+
     return convert
 
 
@@ -25,13 +25,24 @@
 Each node is equivalent to a particular command:
     $ paleomix [...]
 """
-from paleomix.node import CommandNode, Node
+import os
+
+import pysam
+
+from paleomix.node import CommandNode, Node, NodeError
 from paleomix.atomiccmd.command import AtomicCmd
-from paleomix.atomiccmd.sets import ParallelCmds
+from paleomix.atomiccmd.sets import ParallelCmds, SequentialCmds
 from paleomix.atomiccmd.builder import (
     AtomicCmdBuilder,
     apply_options,
 )
+from paleomix.common.bedtools import (
+    BEDRecord,
+    cluster_bed_records,
+    read_bed_file,
+    sort_bed_by_bamfile,
+    split_bed_records,
+)
 from paleomix.common.fileutils import describe_files, reroot_path, move_file
 from paleomix.nodes.samtools import merge_bam_files_command, BCFTOOLS_VERSION
 
@@ -40,8 +51,16 @@ import paleomix.tools.factory as factory
 
 
 class CoverageNode(CommandNode):
+    lightweight = True
+
     def __init__(
-        self, target_name, input_file, output_file, regions_file=None, dependencies=()
+        self,
+        target_name,
+        input_file,
+        output_file,
+        regions_file=None,
+        threads=1,
+        dependencies=(),
     ):
         builder = factory.new("coverage")
         builder.add_value("%(IN_BAM)s")
@@ -53,11 +72,16 @@ class CoverageNode(CommandNode):
             builder.set_option("--regions-file", "%(IN_REGIONS)s")
             builder.set_kwargs(IN_REGIONS=regions_file)
 
+        if threads > 1:
+            # Multiple threads are only used if the BAM file is indexed
+            builder.set_option("--threads", threads)
+
         description = "<Coverage: %s -> '%s'>" % (input_file, output_file)
         CommandNode.__init__(
             self,
             command=builder.finalize(),
             description=description,
+            threads=threads,
             dependencies=dependencies,
         )
 
@@ -92,10 +116,9 @@ class DepthHistogramNode(CommandNode):
         output_file,
         prefix,
         regions_file=None,
+        threads=1,
         dependencies=(),
     ):
-        index_format = regions_file and prefix["IndexFormat"]
-
         builder = factory.new("depths")
         builder.add_value("%(IN_BAM)s")
         builder.add_value("%(OUT_FILE)s")
@@ -104,9 +127,14 @@ class DepthHistogramNode(CommandNode):
 
         if regions_file:
             builder.set_option("--regions-file", "%(IN_REGIONS)s")
-            builder.set_kwargs(
-                IN_REGIONS=regions_file, TEMP_IN_INDEX=input_file + index_format
-            )
+            builder.set_kwargs(IN_REGIONS=regions_file)
+
+        if threads > 1:
+            builder.set_option("--threads", threads)
+
+        # The index is required for ROIs and for processing regions in parallel
+        if regions_file or threads > 1:
+            builder.set_kwargs(IN_INDEX=input_file + prefix["IndexFormat"])
 
         description = "<DepthHistogram: %s -> '%s'>" % (input_file, output_file,)
 
@@ -114,27 +142,146 @@ class DepthHistogramNode(CommandNode):
             self,
             command=builder.finalize(),
             description=description,
+            threads=threads,
+            dependencies=dependencies,
+        )
+
+
+class BAMStatsNode(CommandNode):
+    """Calculates coverage tables and/or depth histograms for a BAM file in a
+    single pass; 'coverage' and 'depths' are lists of (regions_file, output_file)
+    tuples, where a regions_file of None corresponds to the entire genome.
+    """
+
+    def __init__(
+        self,
+        target_name,
+        input_file,
+        coverage=(),
+        depths=(),
+        index_file=None,
+        threads=1,
+        dependencies=(),
+    ):
+        coverage = list(coverage)
+        depths = list(depths)
+        if not (coverage or depths):
+            raise ValueError("No coverage or depths output files specified")
+
+        # Coverage is cheap to calculate compared to depth histograms
+        self.lightweight = not depths
+
+        builder = factory.new("bam_stats")
+        builder.set_option("--target-name", target_name)
+        builder.set_kwargs(IN_BAM=input_file)
+
+        output_files = []
+        for (kind, outputs) in (("coverage", coverage), ("depths", depths)):
+            for (regions_file, output_file) in outputs:
+                output_files.append(output_file)
+                out_key = "OUT_%s_%02i" % (kind.upper(), len(output_files))
+                builder.set_kwargs(**{out_key: output_file})
+
+                if regions_file is None:
+                    builder.set_option("--" + kind, "%%(%s)s" % (out_key,))
+                else:
+                    in_key = "IN_REGIONS_%02i" % (len(output_files),)
+                    builder.set_kwargs(**{in_key: regions_file})
+
+                    # Options taking two values are added as positional values
+                    builder.add_value("--%s-regions" % (kind,))
+                    builder.add_value("%%(%s)s" % (in_key,))
+                    builder.add_value("%%(%s)s" % (out_key,))
+
+        builder.add_value("%(IN_BAM)s")
+
+        if threads > 1:
+            builder.set_option("--threads", threads)
+
+        if index_file is not None:
+            builder.set_kwargs(IN_INDEX=index_file)
+
+        description = "<BAMStats: %s -> %s>" % (
+            input_file,
+            describe_files(output_files),
+        )
+
+        CommandNode.__init__(
+            self,
+            command=builder.finalize(),
+            description=description,
+            threads=threads,
             dependencies=dependencies,
         )
 
 
 class FilterCollapsedBAMNode(CommandNode):
     def __init__(
-        self, config, input_bams, output_bam, keep_dupes=True, dependencies=()
+        self,
+        config,
+        input_bams,
+        output_bam,
+        keep_dupes=True,
+        threads=1,
+        dependencies=(),
     ):
         merge = merge_bam_files_command(input_bams)
 
         builder = factory.new("rmdup_collapsed")
         builder.set_kwargs(IN_STDIN=merge, OUT_STDOUT=output_bam)
+        # Reads in very deep pile-ups are written to temporary files
+        builder.set_option("--temp-directory", "%(TEMP_DIR)s")
 
         if not keep_dupes:
             builder.set_option("--remove-duplicates")
 
+        if threads > 1:
+            # Threads are used to compress the output BAM file
+            builder.set_option("--threads", threads)
+
         description = "<FilterCollapsedBAM: %s>" % (describe_files(merge.input_files),)
         CommandNode.__init__(
             self,
             command=ParallelCmds([merge, builder.finalize()]),
             description=description,
+            threads=threads,
+            dependencies=dependencies,
+        )
+
+
+class FilterDuplicatesBAMNode(CommandNode):
+    """Merges BAM files and marks or removes PCR duplicates among single-end and
+    paired-end reads using 'paleomix rmdup'; alternative to Picard MarkDuplicates.
+    """
+
+    def __init__(
+        self,
+        config,
+        input_bams,
+        output_bam,
+        keep_dupes=True,
+        threads=1,
+        dependencies=(),
+    ):
+        builder = factory.new("rmdup")
+        builder.add_multiple_values(input_bams)
+        builder.set_kwargs(OUT_STDOUT=output_bam)
+        # Reads in very deep pile-ups are written to temporary files
+        builder.set_option("--temp-directory", "%(TEMP_DIR)s")
+
+        if not keep_dupes:
+            builder.set_option("--remove-duplicates")
+
+        if threads > 1:
+            # Threads are used to compress the output BAM file
+            builder.set_option("--threads", threads)
+
+        description = "<FilterDuplicatesBAM: %s>" % (describe_files(input_bams),)
+        CommandNode.__init__(
+            self,
+            command=builder.finalize(),
+            description=description,
+            threads=threads,
             dependencies=dependencies,
         )
 
@@ -144,24 +291,32 @@ class VCFFilterNode(CommandNode):
         vcffilter = factory.new("vcf_filter")
         vcffilter.add_value("%(IN_VCF)s")
 
+        # Records are written as BGZF compressed VCF using htslib
+        vcffilter.set_option("--output", "%(OUT_VCF)s")
+
         for contig in regions["HomozygousContigs"]:
             vcffilter.add_option("--homozygous-chromosome", contig)
-        vcffilter.set_kwargs(IN_VCF=infile, OUT_STDOUT=AtomicCmd.PIPE)
+        vcffilter.set_kwargs(IN_VCF=infile, OUT_VCF=outfile)
 
         apply_options(vcffilter, options)
 
-        bgzip = AtomicCmdBuilder(["bgzip"], IN_STDIN=vcffilter, OUT_STDOUT=outfile)
-
         description = "<VCFFilter: '%s' -> '%s'>" % (infile, outfile,)
         CommandNode.__init__(
             self,
             description=description,
-            command=ParallelCmds([vcffilter.finalize(), bgzip.finalize()]),
+            command=vcffilter.finalize(),
             dependencies=dependencies,
         )
 
 
 class GenotypeRegionsNode(CommandNode):
+    """Genotypes a BAM file using 'bcftools mpileup | bcftools call', either for
+    the regions in a BED file or for the entire genome. If more than one thread
+    is used, the regions (or contigs) are split into one shard per thread, each
+    of which is genotyped separately, after which the resulting VCFs are
+    concatenated in order using 'bcftools concat'.
+    """
+
     def __init__(
         self,
         reference,
@@ -170,47 +325,171 @@ class GenotypeRegionsNode(CommandNode):
         outfile,
         mpileup_options={},
         bcftools_options={},
+        threads=1,
         dependencies=(),
     ):
-        mpileup = AtomicCmdBuilder(
-            ("bcftools", "mpileup", "%(IN_BAMFILE)s"),
-            IN_BAMFILE=infile,
-            IN_INTERVALS=bedfile,
-            OUT_STDOUT=AtomicCmd.PIPE,
-            CHECK_VERSION=BCFTOOLS_VERSION,
-        )
-
-        # Ignore read-groups for pileup
-        mpileup.add_option("--ignore-RG")
-        # Reference sequence (FASTA)
-        mpileup.add_option("--fasta-ref", reference)
-        # Output compressed VCF
-        mpileup.add_option("--output-type", "u")
-
-        if bedfile:
-            mpileup.set_option("--regions-file", "%(IN_INTERVALS)s")
-
-        apply_options(mpileup, mpileup_options)
-
-        genotype = AtomicCmdBuilder(
-            ("bcftools", "call", "-"),
-            IN_STDIN=mpileup,
-            IN_BAMFILE=infile,
-            OUT_STDOUT=outfile,
-            CHECK_VERSION=BCFTOOLS_VERSION,
-        )
-
-        genotype.set_option("--output-type", "z")
-
-        apply_options(genotype, bcftools_options)
+        self._infile = infile
+        self._bedfile = bedfile
+        self._shards = []
+
+        if threads > 1:
+            pipelines = []
+            concat = AtomicCmdBuilder(
+                ("bcftools", "concat"),
+                IN_BAMFILE=infile,
+                OUT_STDOUT=outfile,
+                CHECK_VERSION=BCFTOOLS_VERSION,
+            )
+            concat.set_option("--output-type", "z")
+            # Threads are used to compress the output VCF
+            concat.set_option("--threads", threads)
+
+            for idx in range(threads):
+                regions_file = "shard_%02i.bed" % (idx,)
+                shard_file = "shard_%02i.bcf" % (idx,)
+                self._shards.append(regions_file)
+
+                pipelines.append(
+                    _genotype_command(
+                        reference=reference,
+                        infile=infile,
+                        bedfile=bedfile,
+                        mpileup_options=mpileup_options,
+                        bcftools_options=bcftools_options,
+                        regions_file=regions_file,
+                        # Shards are written as compressed BCF, for fast merging
+                        output_type="b",
+                        TEMP_OUT_STDOUT=shard_file,
+                    )
+                )
+
+                key = "TEMP_IN_SHARD_%02i" % (idx,)
+                concat.add_value("%%(%s)s" % (key,))
+                concat.set_kwargs(**{key: shard_file})
+
+            command = SequentialCmds([ParallelCmds(pipelines), concat.finalize()])
+        else:
+            command = _genotype_command(
+                reference=reference,
+                infile=infile,
+                bedfile=bedfile,
+                mpileup_options=mpileup_options,
+                bcftools_options=bcftools_options,
+                OUT_STDOUT=outfile,
+            )
 
         CommandNode.__init__(
             self,
             description="<GenotypeRegions: '%s' -> '%s'>" % (infile, outfile,),
-            command=ParallelCmds([mpileup.finalize(), genotype.finalize()]),
+            command=command,
+            threads=threads,
             dependencies=dependencies,
         )
 
+    def _setup(self, config, temp):
+        CommandNode._setup(self, config, temp)
+
+        if self._shards:
+            regions = _split_genotyping_regions(
+                self._infile, self._bedfile, len(self._shards)
+            )
+
+            for (filename, shard) in zip(self._shards, regions):
+                if not shard:
+                    raise NodeError(
+                        "Cannot genotype %r using %i threads; regions cover "
+                        "fewer than %i bases"
+                        % (self._infile, len(self._shards), len(self._shards))
+                    )
+
+                with open(os.path.join(temp, filename), "w") as handle:
+                    for record in shard:
+                        handle.write(
+                            "%s\t%i\t%i\n" % (record.contig, record.start, record.end)
+                        )
+
+    def _teardown(self, config, temp):
+        for filename in self._shards:
+            os.remove(os.path.join(temp, filename))
+
+        CommandNode._teardown(self, config, temp)
+
+
+def _genotype_command(
+    reference,
+    infile,
+    bedfile,
+    mpileup_options,
+    bcftools_options,
+    regions_file=None,
+    output_type="z",
+    **kwargs
+):
+    """Returns a 'bcftools mpileup | bcftools call' command. If 'regions_file' is
+    set, the pileup is restricted to the regions in this (temporary) file,
+    otherwise to the regions in 'bedfile', if set. Remaining keyword arguments
+    are used to specify the output of 'bcftools call'."""
+    mpileup = AtomicCmdBuilder(
+        ("bcftools", "mpileup", "%(IN_BAMFILE)s"),
+        IN_BAMFILE=infile,
+        IN_INTERVALS=bedfile,
+        OUT_STDOUT=AtomicCmd.PIPE,
+        CHECK_VERSION=BCFTOOLS_VERSION,
+    )
+
+    # Ignore read-groups for pileup
+    mpileup.add_option("--ignore-RG")
+    # Reference sequence (FASTA)
+    mpileup.add_option("--fasta-ref", reference)
+    # Output compressed VCF
+    mpileup.add_option("--output-type", "u")
+
+    if regions_file is not None:
+        mpileup.set_option("--regions-file", "%(TEMP_IN_REGIONS)s")
+        mpileup.set_kwargs(TEMP_IN_REGIONS=regions_file)
+    elif bedfile:
+        mpileup.set_option("--regions-file", "%(IN_INTERVALS)s")
+
+    apply_options(mpileup, mpileup_options)
+
+    genotype = AtomicCmdBuilder(
+        ("bcftools", "call", "-"),
+        IN_STDIN=mpileup,
+        IN_BAMFILE=infile,
+        CHECK_VERSION=BCFTOOLS_VERSION,
+        **kwargs
+    )
+
+    genotype.set_option("--output-type", output_type)
+
+    apply_options(genotype, bcftools_options)
+
+    return ParallelCmds([mpileup.finalize(), genotype.finalize()])
+
+
+def _split_genotyping_regions(bamfile, bedfile, count):
+    """Splits the regions in a BED file, or the contigs in a BAM file, into
+    'count' shards covering roughly the same number of bases, ordered by the
+    position in the BAM file; overlapping regions are merged to ensure that each
+    site is only genotyped once."""
+    with pysam.AlignmentFile(bamfile) as handle:
+        contigs = dict(zip(handle.references, handle.lengths))
+        if bedfile is None:
+            regions = []
+            for (contig, length) in contigs.items():
+                record = BEDRecord()
+                record._fields = [contig, 0, length]
+                regions.append(record)
+        else:
+            # Contigs not in the BAM file cannot be genotyped
+            regions = [
+                record for record in read_bed_file(bedfile) if record.contig in contigs
+            ]
+            sort_bed_by_bamfile(handle, regions)
+            regions = [region for (region, _) in cluster_bed_records(regions)]
+
+    return split_bed_records(regions, count)
+
 
 class BuildRegionsNode(CommandNode):
     def __init__(self, infile, bedfile, outfile, padding, options={}, dependencies=()):
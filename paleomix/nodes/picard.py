@@ -50,6 +50,8 @@ class PicardNode(CommandNode):
 
 
 class ValidateBAMNode(PicardNode):
+    lightweight = True
+
     def __init__(
         self,
         config,
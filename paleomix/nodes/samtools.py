@@ -96,6 +96,8 @@ class TabixIndexNode(CommandNode):
 class FastaIndexNode(CommandNode):
     """Indexed a FASTA file using 'samtools faidx'."""
 
+    lightweight = True
+
     def __init__(self, infile, dependencies=()):
         self._infile = infile
         cmd_faidx = AtomicCmd(
@@ -131,6 +133,8 @@ class FastaIndexNode(CommandNode):
 class BAMIndexNode(CommandNode):
     """Indexed a BAM file using 'samtools index'."""
 
+    lightweight = True
+
     def __init__(self, infile, index_format=".bai", dependencies=()):
         if index_format == ".bai":
             samtools_call = ["samtools", "index", "%(IN_BAM)s", "%(OUT_IDX)s"]
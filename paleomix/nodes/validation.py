@@ -21,13 +21,20 @@
 # SOFTWARE.
 #
 import collections
+import heapq
 import os
 import re
 
 import pysam
 
 from paleomix.node import CommandNode, Node, NodeError
-from paleomix.common.fileutils import describe_files, make_dirs
+from paleomix.common.fileutils import (
+    describe_files,
+    make_dirs,
+    move_file,
+    reroot_path,
+    swap_ext,
+)
 from paleomix.common.utilities import chain_sorted
 from paleomix.common.sequences import reverse_complement
 from paleomix.tools import factory
@@ -140,6 +147,42 @@ class ValidateFASTAFilesNode(Node):
             pass
 
 
+class ValidateBAMFileNode(Node):
+    """Validates a BAM file sorted by coordinates, and writes a log file if no
+    errors were found (see 'check_bam_file'). This only covers the properties of
+    BAM files that the pipelines rely on, and is therefore much faster than (but
+    not as thorough as) Picard ValidateSamFile.
+    """
+
+    lightweight = True
+
+    def __init__(self, input_bam, input_index=None, output_log=None, dependencies=()):
+        self._input_bam = input_bam
+        self._input_index = input_index
+        self._output_log = output_log or swap_ext(input_bam, ".validated")
+
+        input_files = [input_bam]
+        if input_index is not None:
+            input_files.append(input_index)
+
+        Node.__init__(
+            self,
+            description="<Validate BAM: '%s'>" % (input_bam,),
+            input_files=input_files,
+            output_files=self._output_log,
+            dependencies=dependencies,
+        )
+
+    def _run(self, _config, temp):
+        check_bam_file(self._input_bam, self._input_index)
+
+        temp_log = reroot_path(temp, self._output_log)
+        with open(temp_log, "w") as handle:
+            handle.write("No errors found\n")
+
+        move_file(temp_log, self._output_log)
+
+
 def check_bam_files(input_files, err_func):
     handles = []
     try:
@@ -248,6 +291,161 @@ def _key_by_tid_pos(record):
     return (record[0].tid, record[0].pos)
 
 
+def check_bam_file(filename, index_filename=None):
+    """Checks that a BAM file is not truncated, that reads are sorted by
+    coordinates, that mapped reads have CIGAR strings and are located within
+    their contig, and that mate information is consistent for pairs where both
+    mates are present; missing mates are not considered errors, as mates may be
+    filtered during mapping. If an index is specified, it is also checked that the
+    index matches the BAM file. Raises a NodeError if any check fails.
+    """
+    try:
+        with pysam.AlignmentFile(filename, index_filename=index_filename) as handle:
+            handle.check_truncation()
+
+            counts = _check_bam_records(filename, handle)
+            if index_filename is not None:
+                _check_bam_index(filename, index_filename, handle, *counts)
+    except OSError as error:
+        # htslib rejects malformed records, including CIGAR strings that do not
+        # match the length of the sequence, when reading the BAM file
+        raise NodeError("Invalid BAM file %r: %s" % (filename, error))
+
+
+def _check_bam_records(filename, handle):
+    lengths = handle.lengths
+    nreferences = len(lengths)
+    # Number of mapped / unmapped reads per contig, for comparison with the index
+    mapped = [0] * nreferences
+    unmapped = [0] * nreferences
+    nocoordinate = 0
+    # Paired reads for which the mate has not yet been seen, and a heap of the
+    # positions at which these mates are expected, used to discard missing mates
+    pending_mates = {}
+    expected_mates = []
+
+    last_key = (0, 0)
+    for record in handle.fetch(until_eof=True):
+        flag = record.flag
+        reference_id = record.reference_id
+        if reference_id < 0:
+            # Unmapped reads without coordinates are placed last
+            key = (nreferences, -1)
+            nocoordinate += 1
+        else:
+            key = (reference_id, record.reference_start)
+            if flag & 0x4:
+                unmapped[reference_id] += 1
+            else:
+                mapped[reference_id] += 1
+                _check_bam_alignment(filename, record, lengths[reference_id])
+
+        if key < last_key:
+            raise _bam_record_error(filename, record, "Reads not sorted by coordinates")
+        last_key = key
+
+        while expected_mates and expected_mates[0][0] < key:
+            _, name = heapq.heappop(expected_mates)
+            pending_mates.pop(name, None)
+
+        if flag & 0x1 and not flag & 0x900:
+            name = record.query_name
+            mate = pending_mates.pop(name, None)
+            if mate is not None:
+                _check_bam_mates(filename, mate, record)
+                continue
+
+            next_reference_id = record.next_reference_id
+            if next_reference_id < 0:
+                mate_key = (nreferences, -1)
+            else:
+                mate_key = (next_reference_id, record.next_reference_start)
+
+            # Mates expected before this read are missing, which is not an error
+            if mate_key >= key:
+                pending_mates[name] = (
+                    reference_id,
+                    record.reference_start,
+                    flag,
+                    record.next_reference_id,
+                    record.next_reference_start,
+                    record.cigarstring,
+                    record.get_tag("MC") if record.has_tag("MC") else None,
+                )
+                heapq.heappush(expected_mates, (mate_key, name))
+
+    return mapped, unmapped, nocoordinate
+
+
+def _check_bam_alignment(filename, record, reference_length):
+    if not record.cigartuples:
+        raise _bam_record_error(filename, record, "Mapped read has no CIGAR string")
+    elif record.reference_start < 0 or record.reference_end > reference_length:
+        raise _bam_record_error(
+            filename, record, "Read aligned outside of reference sequence"
+        )
+
+
+def _check_bam_mates(filename, mate, record):
+    (mate_id, mate_start, mate_flag, next_id, next_start, mate_cigar, mate_mc) = mate
+
+    flag = record.flag
+    if (next_id, next_start) != (record.reference_id, record.reference_start):
+        message = "Mate position does not match position of mate"
+    elif (record.next_reference_id, record.next_reference_start) != (
+        mate_id,
+        mate_start,
+    ):
+        message = "Mate position does not match position of mate"
+    elif (mate_flag >> 1) & 0x14 != flag & 0x14:
+        message = "Mate unmapped/reverse flags do not match flags of mate"
+    elif (flag >> 1) & 0x14 != mate_flag & 0x14:
+        message = "Mate unmapped/reverse flags do not match flags of mate"
+    elif sorted((mate_flag & 0xC0, flag & 0xC0)) != [0x40, 0x80]:
+        message = "Mates are not flagged as mate 1 and mate 2"
+    elif mate_mc is not None and mate_mc != record.cigarstring:
+        message = "Mate CIGAR (MC) tag does not match CIGAR of mate"
+    elif record.has_tag("MC") and record.get_tag("MC") != mate_cigar:
+        message = "Mate CIGAR (MC) tag does not match CIGAR of mate"
+    else:
+        return
+
+    raise _bam_record_error(filename, record, message)
+
+
+def _check_bam_index(filename, index_filename, handle, mapped, unmapped, nocoordinate):
+    try:
+        statistics = handle.get_index_statistics()
+    except (AttributeError, ValueError) as error:
+        raise NodeError(
+            "Invalid BAM index: %s\n    Filename = %r\n    Index = %r"
+            % (error, filename, index_filename)
+        )
+
+    expected = {name: (0, 0) for name in handle.references}
+    for (contig, nmapped, nunmapped, _) in statistics:
+        expected[contig] = (nmapped, nunmapped)
+
+    observed = dict(zip(handle.references, zip(mapped, unmapped)))
+    if observed != expected or handle.nocoordinate != nocoordinate:
+        raise NodeError(
+            "BAM index does not match BAM file; the index may be outdated\n"
+            "    Filename = %r\n    Index = %r" % (filename, index_filename)
+        )
+
+
+def _bam_record_error(filename, record, message):
+    if record.reference_id < 0:
+        position = "*"
+    else:
+        position = "%s:%i" % (record.reference_name, record.reference_start + 1)
+
+    return NodeError(
+        "Invalid BAM file: %s\n    Filename = %r\n    Read = %r\n    Position = %s"
+        % (message, filename, record.query_name, position)
+    )
+
+
 def check_fasta_file(filename):
     with open(filename) as handle:
         namecache = {}
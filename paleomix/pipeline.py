@@ -20,33 +20,181 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 #
-import errno
+import concurrent.futures
+import contextlib
+import functools
 import logging
-import multiprocessing
+import math
 import os
 import signal
-import traceback
-
-from queue import Empty
+import time
 
 import paleomix.common.logging
 
-from paleomix.node import Node, NodeError, NodeUnhandledException
+from paleomix.executors import LocalExecutor, WorkerLostError
+from paleomix.node import Node, NodeChain, NodeChainError
 from paleomix.nodegraph import FileStatusCache, NodeGraph, NodeGraphError
 from paleomix.common.text import padded_table
 from paleomix.common.utilities import safe_coerce_to_tuple
 from paleomix.common.versions import VersionRequirementError
 
 
+# Max number of nodes run together as a single task; see Pypeline._build_chain
+_MAX_CHAIN_LENGTH = 8
+# Max number of lower priority nodes considered for backfilling, per attempt to
+# start new tasks; see Pypeline._start_new_tasks
+_MAX_BACKFILL_CANDIDATES = 100
+
+
+class PriorityPolicy:
+    """Base-class for scheduling policies; calling the policy returns a dictionary
+    of nodes to priorities (see NodeGraph.set_priorities). The base-class assigns
+    the same priority to all nodes, so that nodes are run in the order in which
+    they become runable.
+    """
+
+    def __call__(self, nodegraph):
+        return {}
+
+    def node_started(self, node):
+        """Called when a node is started."""
+
+    def node_finished(self, node, succeeded):
+        """Called when a node has finished running; returns true if priorities
+        should be re-calculated.
+        """
+        return False
+
+    def estimate_remaining(self, node):
+        """Returns the estimated remaining runtime in seconds of a node that is
+        running or runable, or None if no estimate can be made. Estimates are used
+        to start lower priority nodes while a higher priority node is waiting for
+        resources (see Pypeline._start_new_tasks).
+        """
+        return None
+
+
+class CriticalPathPriority(PriorityPolicy):
+    """Prioritizes nodes by the estimated cost of the most expensive path from a
+    node to the end of the pipeline, so that nodes on the critical path are run
+    before nodes that are not (e.g. BWA before a validation step).
+
+    Costs are estimated from the size of the input files of a node, where the
+    size of files generated by the pipeline is estimated from the inputs of the
+    node generating them. Once nodes of a given class have finished running, the
+    observed runtimes are used to scale the costs of remaining nodes of that class.
+    """
+
+    # Fixed cost added to all nodes, corresponding to 10 MB of input data
+    _OVERHEAD = 10 * 1024 ** 2
+
+    def __init__(self):
+        self._node_sizes = {}
+        self._start_times = {}
+        # Total runtime and size (plus overhead) of finished nodes by class
+        self._history = {}
+        # Runtime per byte across all finished nodes, or None if none have finished
+        self._default_rate = None
+
+    def __call__(self, nodegraph):
+        nodes = _topological_sort(nodegraph.iterflat())
+        self._node_sizes = self._estimate_input_sizes(nodegraph, nodes)
+
+        default_rate = self._default_rate or 1.0
+
+        downstream = {}
+        priorities = {}
+        # Dependants are processed before their dependencies
+        for node in reversed(nodes):
+            cost = self._estimate_cost(node, default_rate)
+
+            priority = priorities[node] = cost + downstream.get(node, 0)
+            for dependency in node.dependencies:
+                downstream[dependency] = max(downstream.get(dependency, 0), priority)
+
+        return priorities
+
+    def node_started(self, node):
+        self._start_times[node] = time.time()
+
+    def node_finished(self, node, succeeded):
+        runtime = time.time() - self._start_times.pop(node)
+        if not succeeded:
+            return False
+
+        key = type(node)
+        is_new = key not in self._history
+        history = self._history.setdefault(key, [0.0, 0])
+        history[0] += runtime
+        history[1] += self._node_sizes.get(node, 0) + self._OVERHEAD
+
+        total_runtime = sum(value for (value, _) in self._history.values())
+        total_size = sum(size for (_, size) in self._history.values())
+        self._default_rate = total_runtime / total_size
+
+        return is_new
+
+    def estimate_remaining(self, node):
+        """See PriorityPolicy.estimate_remaining; estimates are only made once
+        one or more nodes have finished, since costs are otherwise not in seconds.
+        """
+        if self._default_rate is None:
+            return None
+
+        estimate = self._estimate_cost(node, self._default_rate)
+        start_time = self._start_times.get(node)
+        if start_time is not None:
+            estimate -= time.time() - start_time
+
+        return max(0.0, estimate)
+
+    def _estimate_cost(self, node, default_rate):
+        runtime, size = self._history.get(type(node), (None, None))
+        rate = runtime / size if size else default_rate
+
+        return rate * (self._node_sizes.get(node, 0) + self._OVERHEAD)
+
+    def _estimate_input_sizes(self, nodegraph, nodes):
+        producers = {}
+        for node in nodes:
+            for filename in node.output_files:
+                producers[filename] = node
+
+        sizes = {}
+        for node in nodes:
+            size = 0
+            for filename in node.input_files:
+                producer = producers.get(filename)
+                if producer is None:
+                    # Sizes are collected when the states of files are checked
+                    size += nodegraph.get_file_size(filename) or 0
+                else:
+                    # Output is assumed to be proportional to the input
+                    size += sizes[producer] // len(producer.output_files)
+
+            sizes[node] = size
+
+        return sizes
+
+
 class Pypeline:
-    def __init__(self, config):
+    def __init__(
+        self, config, priority=None, journal=None, executor=None, fuse_nodes=True
+    ):
         self._nodes = []
         self._config = config
+        self._priority = CriticalPathPriority() if priority is None else priority
+        # Optional journal of completed files; see paleomix.journal
+        self._journal = journal
+        # Executor used to run nodes; by default a LocalExecutor is created by 'run'
+        self._executor = executor
+        # Run lightweight nodes together with the node they depend on; see Node
+        self._fuse_nodes = fuse_nodes
         self._logger = logging.getLogger(__name__)
         # Set if a keyboard-interrupt (SIGINT) has been caught
         self._interrupted = False
-        self._queue = multiprocessing.Queue()
-        self._pool = None
+        # The executor used by the currently running pipeline
+        self._active_executor = None
 
     def add_nodes(self, *nodes):
         for subnodes in safe_coerce_to_tuple(nodes):
@@ -55,18 +203,31 @@ class Pypeline:
                     raise TypeError("Node object expected, recieved %s" % repr(node))
                 self._nodes.append(node)
 
-    def run(self, max_threads=1, dry_run=False):
+    def run(self, max_threads=1, dry_run=False, max_memory=None):
+        """Runs the pipeline using at most 'max_threads' threads and, if set, at most
+        'max_memory' bytes of memory, based on the memory usage declared by nodes.
+        These limits are ignored if an executor was passed to the constructor.
+        """
         if max_threads < 1:
             raise ValueError("Max threads must be >= 1")
+        elif max_memory is not None and max_memory < 1:
+            raise ValueError("Max memory must be >= 1")
+
+        cache_factory = FileStatusCache
+        if self._journal is not None:
+            cache_factory = functools.partial(FileStatusCache, journal=self._journal)
 
         try:
-            nodegraph = NodeGraph(self._nodes)
+            nodegraph = NodeGraph(self._nodes, cache_factory)
         except NodeGraphError as error:
             self._logger.error(error)
             return False
 
+        executor = self._executor
         for node in nodegraph.iterflat():
-            if node.threads > max_threads:
+            if executor is not None:
+                break
+            elif node.threads > max_threads:
                 message = (
                     "Node(s) use more threads than the max allowed; "
                     "the pipeline may therefore use more than the "
@@ -75,95 +236,324 @@ class Pypeline:
                 self._logger.warn(message)
                 break
 
+        if max_memory is not None and executor is None:
+            for node in nodegraph.iterflat():
+                if node.memory > max_memory:
+                    self._logger.warning(
+                        "Node(s) use more memory than the max allowed; such nodes "
+                        "are only run when no other memory intensive nodes are "
+                        "running.\n"
+                    )
+                    break
+        else:
+            max_memory = math.inf
+
         if dry_run:
             self._summarize_pipeline(nodegraph)
             self._logger.info("Dry run done")
 
             result = True
         else:
-            self._pool = multiprocessing.Pool(max_threads, _init_worker, (self._queue,))
+            nodegraph.set_priorities(self._priority(nodegraph))
+
+            if executor is None:
+                executor = LocalExecutor(max_threads, max_memory)
+
+            self._active_executor = executor
+            executor.start()
             old_handler = signal.signal(signal.SIGINT, self._sigint_handler)
 
             try:
-                result = self._run(nodegraph, max_threads)
+                result = self._run(nodegraph, executor)
             finally:
                 signal.signal(signal.SIGINT, old_handler)
+                self._active_executor = None
+
+                if self._journal is not None:
+                    self._journal.close()
 
         for filename in paleomix.common.logging.get_logfiles():
             self._logger.info("Log-file written to %r", filename)
 
         return result
 
-    def _run(self, nodegraph, max_threads):
-        # Dictionary of nodes -> async-results
+    def _run(self, nodegraph, executor):
+        # Dictionary of keys -> tuples of running nodes
         running = {}
-        # Set of remaining nodes to be run
-        remaining = set(nodegraph.iterflat())
+        # Files recorded in the journal are checked in the background
+        verification = self._start_journal_verification(nodegraph)
 
         is_ok = True
-        while running or (remaining and not self._interrupted):
-            is_ok &= self._poll_running_nodes(running, nodegraph, self._queue)
+        while True:
+            while running or (nodegraph.has_runable_nodes() and not self._interrupted):
+                started = False
+                if not self._interrupted:  # Prevent starting of new nodes
+                    started = self._start_new_tasks(running, nodegraph, executor)
+
+                if running:
+                    is_ok &= self._poll_running_nodes(running, nodegraph, executor)
+                elif not (started or self._interrupted):
+                    # No resources available (e.g. no workers connected)
+                    executor.wait()
+
+                if verification is not None and verification.done():
+                    self._finish_journal_verification(nodegraph, verification, is_ok)
+                    verification = None
+
+            if verification is None or self._interrupted:
+                break
 
-            if not self._interrupted:  # Prevent starting of new nodes
-                self._start_new_tasks(
-                    remaining, running, nodegraph, max_threads, self._pool
-                )
+            # Wait for the verification, since it may result in more nodes to run
+            self._finish_journal_verification(nodegraph, verification, is_ok)
+            verification = None
 
-        self._pool.close()
-        self._pool.join()
+        executor.close()
         self._summarize_pipeline(nodegraph)
 
         return is_ok
 
-    def _start_new_tasks(self, remaining, running, nodegraph, max_threads, pool):
+    def _start_journal_verification(self, nodegraph):
+        """Records the output files of finished nodes that are missing from the
+        journal, and starts checking the files already recorded in the journal in
+        a background thread. This is done since recorded files are otherwise only
+        checked when used by a node, so that deleted or modified files would go
+        unnoticed if all nodes depending on those files were done.
+        """
+        if self._journal is None:
+            return None
+
+        expected = {}
+        for node in nodegraph.iterflat():
+            if nodegraph.get_node_state(node) == nodegraph.DONE:
+                unrecorded = []
+                for filename in node.output_files:
+                    mtime = self._journal.get_mtime(filename)
+                    if mtime is None:
+                        unrecorded.append(filename)
+                    else:
+                        expected[filename] = mtime
+
+                # Allows the journal to be used with existing projects
+                self._journal.record(unrecorded)
+
+        if not expected:
+            return None
+
+        self._logger.debug("Checking %i file(s) recorded in journal", len(expected))
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        verification = pool.submit(_find_changed_files, expected)
+        # The thread is cleaned up once the verification has finished
+        pool.shutdown(wait=False)
+
+        return verification
+
+    def _finish_journal_verification(self, nodegraph, verification, refresh):
+        """Removes files found to have changed from the journal, and refreshes the
+        states of nodes if 'refresh' is true.
+        """
+        # Files may have been replaced since they were checked
+        changed_files = self._journal.validate(verification.result())
+        if changed_files:
+            self._logger.warning(
+                "%i file(s) changed since being recorded in the journal, e.g. %r",
+                len(changed_files),
+                changed_files[0],
+            )
+
+            if refresh:
+                self._logger.info("Refreshing node states")
+                nodegraph.refresh_states()
+
+    def _start_new_tasks(self, running, nodegraph, executor):
+        """Starts runable nodes in order of priority, as long as the executor has
+        resources available for the next node; if the next node requires more
+        threads/memory than is available, then the resources are reserved for that
+        node, to prevent it from being starved by smaller nodes.
+
+        Lower priority nodes are however started (backfilled) if they are expected
+        to finish before any running task, and therefore cannot delay the node for
+        which resources are reserved. This requires estimates of runtimes from the
+        priority policy. Returns false if no nodes were started (or states
+        refreshed) due to lack of resources.
+        """
         started_nodes = []
-        idle_processes = max_threads - sum(
-            node.threads for (node, _) in running.values()
-        )
+        # Set of started nodes, used when selecting nodes to run in chains
+        started_set = set()
+        changed_files = []
+        # Time (in seconds) until the first running task is expected to finish,
+        # once a node has been blocked due to lack of resources
+        backfill_window = None
+        backfill_candidates = 0
+        with contextlib.closing(nodegraph.iter_runable_nodes()) as runable:
+            for node in runable:
+                if backfill_window is not None:
+                    backfill_candidates += 1
+                    if backfill_candidates > _MAX_BACKFILL_CANDIDATES:
+                        break
+
+                    estimate = self._priority.estimate_remaining(node)
+                    if estimate is None or estimate > backfill_window:
+                        continue
+
+                if not executor.can_run(node):
+                    if backfill_window is None:
+                        if node.threads == 1 and not node.memory:
+                            break  # No other nodes can be run either
+
+                        backfill_window = self._estimate_backfill_window(running)
+                        if backfill_window is None:
+                            break
 
-        if not idle_processes:
-            return False
+                    continue
 
-        for node in remaining:
-            if not running or (idle_processes >= node.threads):
-                state = nodegraph.get_node_state(node)
-                if state == nodegraph.RUNABLE:
-                    key = id(node)
-                    proc_args = (key, node, self._config)
-                    running[key] = (node, pool.apply_async(_call_run, args=proc_args))
-                    started_nodes.append(node)
-
-                    nodegraph.set_node_state(node, nodegraph.RUNNING)
-                    idle_processes -= node.threads
-                elif state in (nodegraph.DONE, nodegraph.ERROR):
-                    started_nodes.append(node)
-            elif idle_processes <= 0:
-                break
+                # Files recorded in the journal are assumed to be unchanged until
+                # used, at which point they are checked and the graph refreshed
+                if self._journal is not None:
+                    changed_files = self._journal.validate(node.input_files)
+                    if changed_files:
+                        break
+
+                    self._journal.discard(node.output_files)
+
+                nodes = (node,)
+                task = node
+                # Backfilled nodes are not fused, as that would extend their runtime
+                if self._fuse_nodes and backfill_window is None:
+                    nodes = self._build_chain(node, nodegraph, started_set)
+                    if len(nodes) > 1:
+                        task = NodeChain(nodes)
+                        if not executor.can_run(task):
+                            nodes = (node,)
+                            task = node
+                            # Re-selects resources for the node (see RemoteExecutor)
+                            executor.can_run(node)
+
+                if self._journal is not None:
+                    for follower in nodes[1:]:
+                        self._journal.discard(follower.output_files)
+
+                key = id(task)
+                executor.submit(key, task, self._config)
+                running[key] = nodes
+                started_nodes.extend(nodes)
+                started_set.update(nodes)
 
         for node in started_nodes:
-            remaining.remove(node)
+            nodegraph.set_node_state(node, nodegraph.RUNNING)
+            self._priority.node_started(node)
+
+        if changed_files:
+            self._logger.warning(
+                "%i file(s) changed since being recorded in the journal, e.g. %r; "
+                "refreshing node states",
+                len(changed_files),
+                changed_files[0],
+            )
+            nodegraph.refresh_states()
+
+        return bool(started_nodes or changed_files)
+
+    def _estimate_backfill_window(self, running):
+        """Returns the estimated time in seconds until the first running task
+        finishes, or None if no tasks are running or if no estimate can be made.
+        """
+        window = None
+        for nodes in running.values():
+            remaining = 0.0
+            for node in nodes:
+                estimate = self._priority.estimate_remaining(node)
+                if estimate is None:
+                    return None
+
+                remaining += estimate
+
+            if window is None or remaining < window:
+                window = remaining
 
-    def _poll_running_nodes(self, running, nodegraph, queue):
+        return window
+
+    def _build_chain(self, node, nodegraph, started_set):
+        """Returns a tuple of the node followed by (lightweight) nodes that depend
+        on it and that can be run right after it, as part of the same task. This
+        avoids the overhead of scheduling each of these nodes separately and allows
+        them to benefit from the input files being cached by the OS. A dependant is
+        only added if it is not run in parallel with other nodes, i.e. if all its
+        other dependencies are done, and if its input files are unchanged.
+        """
+        chain = [node]
+        in_chain = set(chain)
+        while len(chain) < _MAX_CHAIN_LENGTH:
+            candidates = []
+            for dependant in nodegraph.get_dependants(chain[-1]):
+                if (
+                    dependant.lightweight
+                    and dependant not in started_set
+                    and nodegraph.get_node_state(dependant)
+                    in (nodegraph.QUEUED, nodegraph.OUTDATED)
+                ):
+                    for dependency in dependant.dependencies:
+                        if dependency not in in_chain and (
+                            nodegraph.get_node_state(dependency) != nodegraph.DONE
+                        ):
+                            break
+                    else:
+                        candidates.append(dependant)
+
+            if not candidates:
+                break
+
+            # Dependants are picked in a consistent order, if there are several
+            dependant = min(candidates, key=str)
+            if self._journal is not None:
+                produced = set()
+                for dependency in chain:
+                    produced.update(dependency.output_files)
+
+                if self._journal.validate(dependant.input_files - produced):
+                    break  # Changes are handled once the node is started normally
+
+            chain.append(dependant)
+            in_chain.add(dependant)
+
+        return tuple(chain)
+
+    def _poll_running_nodes(self, running, nodegraph, executor):
+        """Waits for a running task to finish, and then processes the nodes of that
+        task and of any other tasks that have finished in the mean time. Returns
+        false if any of these nodes failed.
+        """
         error_happened = False
-        blocking = False
+        blocking = True
 
         while running and not error_happened:
-            node, proc = self._get_finished_node(queue, running, blocking)
-            if not node:
-                if blocking:
-                    break
+            key, result = executor.get_finished(blocking)
+            if key is None:
+                break
 
-                blocking = True
-                continue
+            # Collect any other nodes that have finished, without blocking
+            blocking = False
+            nodes = running.pop(key)
+            # Number of nodes (run in order) that finished successfully
+            completed = len(nodes)
 
             try:
                 # Re-raise exceptions from the node-process
-                proc.get()
+                result.get()
             except (KeyboardInterrupt, SystemExit):
                 raise
+            except WorkerLostError as error:
+                for node in nodes:
+                    self._logger.warning("Re-queuing node %s: %s", node, error)
+                    self._priority.node_finished(node, False)
+                    nodegraph.requeue_node(node)
+                continue
             except Exception as errors:
-                nodegraph.set_node_state(node, nodegraph.ERROR)
+                if isinstance(errors, NodeChainError):
+                    completed, errors = errors.completed, errors.error
+                else:
+                    completed = 0
 
+                node = nodes[completed]
                 message = [
                     str(node),
                     "  Error (%r) occurred running command:" % (type(errors).__name__),
@@ -176,8 +566,21 @@ class Pypeline:
                 self._logger.error("\n".join(message))
                 error_happened = True
 
-            if not error_happened:
-                nodegraph.set_node_state(node, nodegraph.DONE)
+            for idx, node in enumerate(nodes):
+                succeeded = idx < completed
+                if self._priority.node_finished(node, succeeded):
+                    nodegraph.set_priorities(self._priority(nodegraph))
+
+                if succeeded:
+                    if self._journal is not None:
+                        self._journal.record(node.output_files, node.input_files)
+
+                    nodegraph.set_node_state(node, nodegraph.DONE)
+                elif idx == completed:
+                    nodegraph.set_node_state(node, nodegraph.ERROR)
+                else:
+                    # Nodes following the failed node were not run
+                    nodegraph.requeue_node(node)
 
         return not error_happened
 
@@ -320,29 +723,9 @@ class Pypeline:
                 "again to force termination.\n"
             )
         else:
-            self._pool.terminate()
+            self._active_executor.terminate()
             raise signal.default_int_handler(signum, frame)
 
-    @classmethod
-    def _get_finished_node(cls, queue, running, blocking):
-        """Returns a tuple containing a node that has finished running
-        and it's async-result, or None for both if no such node could
-        be found (and blocking is False), or if an interrupt occured
-        while waiting for a node to finish.
-
-        If blocking is True, the function will timeout after 0.1s.
-        """
-        try:
-            key = queue.get(blocking, 0.1)
-            return running.pop(key)
-        except IOError as error:
-            # User pressed ctrl-c (SIGINT), or similar event
-            if error.errno != errno.EINTR:
-                raise
-        except Empty:
-            pass
-        return None, None
-
     def _summarize_pipeline(self, nodegraph):
         states = [0] * nodegraph.NUMBER_OF_STATES
         for node in nodegraph.iterflat():
@@ -364,31 +747,39 @@ class Pypeline:
             self._logger.warning("Errors were detected while running pipeline")
 
 
-def _init_worker(queue):
-    """Init function for subprocesses created by multiprocessing.Pool: Ensures
-    that KeyboardInterrupts only occur in the main process, allowing us to do
-    proper cleanup.
+def _find_changed_files(expected):
+    """Returns the files whose mtimes differ from those given in 'expected', a
+    dictionary of filenames to mtimes; files are checked a folder at a time.
     """
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    # This is a workaround to avoid having to use multiprocessing.Manager
-    # to create the Queue objects; this is needed because the Manager class
-    # creates it own process, which inherits the signal-handlers of the main
-    # process, causing some rather odd behavior when the user causes a SIGINT.
-    _call_run.queue = queue
-
-
-def _call_run(key, node, config):
-    """Wrapper function, required in order to call Node.run()
-    in subprocesses, since it is not possible to pickle
-    bound functions (e.g. self.run)"""
-    try:
-        return node.run(config)
-    except NodeError:
-        raise
-    except Exception:
-        message = "Unhandled error running Node:\n\n%s" % (traceback.format_exc(),)
-
-        raise NodeUnhandledException(message)
-    finally:
-        # See comment in _init_worker
-        _call_run.queue.put(key)
+    cache = FileStatusCache()
+    cache.prefetch(expected)
+
+    return [
+        filename
+        for (filename, mtime) in expected.items()
+        if cache.get_mtime(filename) != mtime
+    ]
+
+
+def _topological_sort(nodes):
+    """Returns a list of nodes in which all nodes come after their dependencies."""
+    result = []
+    visited = set()
+    for node in nodes:
+        if node in visited:
+            continue
+
+        visited.add(node)
+        stack = [(node, iter(node.dependencies))]
+        while stack:
+            current, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency not in visited:
+                    visited.add(dependency)
+                    stack.append((dependency, iter(dependency.dependencies)))
+                    break
+            else:
+                stack.pop()
+                result.append(current)
+
+    return result
@@ -28,6 +28,7 @@ import paleomix.common.logging
 
 from paleomix.resources import add_copy_example_command
 from paleomix.common.argparse import ArgumentParser
+from paleomix.common.utilities import parse_size
 
 
 _DEFAULT_CONFIG_FILES = [
@@ -106,6 +107,63 @@ def add_run_command(subparsers):
         default=max(2, multiprocessing.cpu_count()),
         help="Max number of threads to use in total [%(default)s]",
     )
+    group.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=None,
+        help="Max amount of memory to use in total, e.g. '64G'; only nodes that "
+        "declare an estimated memory usage (e.g. Picard tools and the samtools sort "
+        "step following mapping) are taken into account. By default, memory usage "
+        "is not limited",
+    )
+    group.add_argument(
+        "--use-journal",
+        default=False,
+        action="store_true",
+        help="Record the files generated by the pipeline in a journal in the "
+        "destination folder, and use this journal to determine the state of these "
+        "files when the pipeline is restarted, instead of checking every file up "
+        "front. Recorded files are checked once they are needed by a task "
+        "[Default: off]",
+    )
+    group.add_argument(
+        "--use-checksums",
+        default=False,
+        action="store_true",
+        help="Record checksums of the input files used by each task in the journal "
+        "(implies --use-journal). Tasks are then only re-run if the contents of "
+        "input files have changed, rather than if their timestamps have changed, "
+        "e.g. due to files being copied or touched [Default: off]",
+    )
+    group.add_argument(
+        "--listen",
+        metavar="HOST:PORT",
+        default=None,
+        help="Run tasks using 'paleomix worker' processes connecting to this "
+        "address, instead of running tasks locally. Workers may run on other hosts, "
+        "but all files (including temporary files) must be located on a shared "
+        "file-system. The environment variable PALEOMIX_WORKER_KEY must be set to "
+        "the same secret value for the pipeline and for workers",
+    )
+    group.add_argument(
+        "--batch-jobs",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Run tasks as jobs submitted to a SLURM batch scheduler using 'sbatch', "
+        "with at most N jobs queued/running at once, instead of running tasks "
+        "locally. As with --listen, all files must be located on a shared "
+        "file-system",
+    )
+    group.add_argument(
+        "--batch-option",
+        dest="batch_options",
+        metavar="OPTION",
+        action="append",
+        default=[],
+        help="May be specified one or more times with options to be passed to "
+        "'sbatch' when using --batch-jobs, e.g. --batch-option=--partition=long",
+    )
     group.add_argument(
         "--adapterremoval-max-threads",
         type=int,
@@ -124,6 +182,38 @@ def add_run_command(subparsers):
         default=1,
         help="Max number of threads to use per BWA instance [%(default)s]",
     )
+    group.add_argument(
+        "--rmdup-collapsed-max-threads",
+        type=int,
+        default=1,
+        help="Max number of threads to use per 'paleomix rmdup_collapsed' instance, "
+        "when filtering PCR duplicates among collapsed reads, and per 'paleomix "
+        "rmdup' instance, if --native-rmdup is used [%(default)s]",
+    )
+    group.add_argument(
+        "--native-rmdup",
+        default=False,
+        action="store_true",
+        help="Filter PCR duplicates among non-collapsed reads using 'paleomix rmdup' "
+        "instead of Picard MarkDuplicates. The BAM files for each lane are merged "
+        "and PCR duplicates are identified in a single pass, without running the "
+        "JVM [default: off]",
+    )
+    group.add_argument(
+        "--validate-with-picard",
+        default=False,
+        action="store_true",
+        help="Validate BAM files using Picard ValidateSamFile instead of the "
+        "built-in validation, which checks sort order, mate information, CIGAR "
+        "strings, and indexes, but which is less thorough [default: off]",
+    )
+    group.add_argument(
+        "--depths-max-threads",
+        type=int,
+        default=1,
+        help="Max number of threads to use when building depth histograms for "
+        "each final BAM file [%(default)s]",
+    )
 
     group = parser.add_argument_group("Required paths")
     group.add_argument(
@@ -22,6 +22,7 @@
 #
 from paleomix.nodes.picard import ValidateBAMNode
 from paleomix.nodes.samtools import BAMIndexNode
+from paleomix.nodes.validation import ValidateBAMFileNode
 
 
 def index_and_validate_bam(config, prefix, node, log_file=None, create_index=True):
@@ -32,6 +33,14 @@ def index_and_validate_bam(config, prefix, node, log_file=None, create_index=Tru
         )
         (index_file,) = node.output_files
 
+    if not config.validate_with_picard:
+        return ValidateBAMFileNode(
+            input_bam=input_file,
+            input_index=index_file,
+            output_log=log_file,
+            dependencies=node,
+        )
+
     ignored_checks = [
         # Ignored since we may filter out misses and low-quality hits during
         # mapping, which leads to a large proportion of missing PE mates.
@@ -57,7 +66,7 @@ def _get_input_files(node, index_format):
     input_filename = None
     for filename in node.output_files:
         if filename.lower().endswith(index_format):
-            index_filename = True
+            index_filename = filename
         elif filename.lower().endswith(".bam"):
             input_filename = filename
 
@@ -31,7 +31,7 @@ from paleomix.nodes.mapdamage import (
     MapDamageRescaleNode,
 )
 from paleomix.pipelines.ngs.nodes import index_and_validate_bam
-from paleomix.nodes.commands import FilterCollapsedBAMNode
+from paleomix.nodes.commands import FilterCollapsedBAMNode, FilterDuplicatesBAMNode
 from paleomix.nodes.validation import DetectInputDuplicationNode
 
 
@@ -106,6 +106,8 @@ class Library:
 
     def _remove_pcr_duplicates(self, config, prefix, bams, strategy):
         rmdup_cls = {"collapsed": FilterCollapsedBAMNode, "normal": MarkDuplicatesNode}
+        if config.native_rmdup:
+            rmdup_cls["normal"] = FilterDuplicatesBAMNode
 
         keep_duplicates = False
         if isinstance(strategy, str) and (strategy.lower() == "mark"):
@@ -114,13 +116,18 @@ class Library:
         results = {}
         for (key, files_and_nodes) in bams.items():
             output_filename = self.folder + ".rmdup.%s.bam" % key
-            node = rmdup_cls[key](
-                config=config,
-                input_bams=list(files_and_nodes.keys()),
-                output_bam=output_filename,
-                keep_dupes=keep_duplicates,
-                dependencies=list(files_and_nodes.values()),
-            )
+            parameters = {
+                "config": config,
+                "input_bams": list(files_and_nodes.keys()),
+                "output_bam": output_filename,
+                "keep_dupes": keep_duplicates,
+                "dependencies": list(files_and_nodes.values()),
+            }
+
+            if rmdup_cls[key] is not MarkDuplicatesNode:
+                parameters["threads"] = config.rmdup_collapsed_max_threads
+
+            node = rmdup_cls[key](**parameters)
 
             # Indexing is required if we wish to calulate per-region statistics
             validated_node = index_and_validate_bam(
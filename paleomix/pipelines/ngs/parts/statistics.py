@@ -25,7 +25,7 @@ import collections
 
 from paleomix.common.fileutils import swap_ext
 
-from paleomix.nodes.commands import CoverageNode, MergeCoverageNode, DepthHistogramNode
+from paleomix.nodes.commands import BAMStatsNode, MergeCoverageNode
 from paleomix.pipelines.ngs.parts.summary import SummaryTableNode
 
 
@@ -64,22 +64,30 @@ def _build_summary_node(config, makefile, target, coverage):
 def _build_depth(config, target, prefixes):
     nodes = []
     for prefix in target.prefixes:
-        for (roi_name, roi_filename) in _get_roi(prefix, name_prefix="."):
-            ((input_file, dependencies),) = prefix.bams.items()
+        ((input_file, dependencies),) = prefix.bams.items()
 
+        # Depth histograms for the genome and for all ROIs are built in one pass
+        outputs = []
+        for (roi_name, roi_filename) in _get_roi(prefix, name_prefix="."):
             output_filename = "%s.%s%s.depths" % (target.name, prefix.name, roi_name)
             output_fpath = os.path.join(config.destination, output_filename)
-
-            nodes.append(
-                DepthHistogramNode(
-                    target_name=target.name,
-                    input_file=input_file,
-                    prefix=prefixes[prefix.name],
-                    regions_file=roi_filename,
-                    output_file=output_fpath,
-                    dependencies=dependencies,
-                )
+            outputs.append((roi_filename, output_fpath))
+
+        # The index is required to process regions in parallel
+        index_file = None
+        if config.depths_max_threads > 1:
+            index_file = input_file + prefixes[prefix.name]["IndexFormat"]
+
+        nodes.append(
+            BAMStatsNode(
+                target_name=target.name,
+                input_file=input_file,
+                depths=outputs,
+                index_file=index_file,
+                threads=config.depths_max_threads,
+                dependencies=dependencies,
             )
+        )
 
     return nodes
 
@@ -123,7 +131,10 @@ def _build_coverage(config, target, make_summary):
         )
 
     all_nodes = []
-    all_nodes.extend(files_and_nodes.values())
+    for node in files_and_nodes.values():
+        # Nodes produce the coverage tables for all ROIs in a prefix
+        if node not in all_nodes:
+            all_nodes.append(node)
     all_nodes.extend(merged_nodes)
 
     coverage["Nodes"] = tuple(all_nodes)
@@ -139,51 +150,49 @@ def _build_coverage_nodes(target):
 
     cache = {}
     for prefix in target.prefixes:
-        for (roi_name, roi_filename) in _get_roi(prefix):
-            prefix_label = _get_prefix_label(prefix.name, roi_name)
-
-            for sample in prefix.samples:
-                for library in sample.libraries:
-                    key = (prefix_label, target.name, sample.name, library.name)
-
-                    for lane in library.lanes:
-                        for bams in lane.bams.values():
-                            bams = _build_coverage_nodes_cached(
-                                bams, target.name, roi_name, roi_filename, cache
-                            )
-
-                            coverage["Lanes"][key].update(bams)
-
-                    bams = _build_coverage_nodes_cached(
-                        library.bams, target.name, roi_name, roi_filename, cache
-                    )
-                    coverage["Libraries"][key].update(bams)
+        roi = _get_roi(prefix)
+
+        for sample in prefix.samples:
+            for library in sample.libraries:
+                keys = []
+                for (roi_name, _) in roi:
+                    prefix_label = _get_prefix_label(prefix.name, roi_name)
+                    keys.append((prefix_label, target.name, sample.name, library.name))
+
+                for lane in library.lanes:
+                    for bams in lane.bams.values():
+                        _build_coverage_nodes_cached(
+                            coverage["Lanes"], keys, bams, target.name, roi, cache
+                        )
+
+                _build_coverage_nodes_cached(
+                    coverage["Libraries"], keys, library.bams, target.name, roi, cache
+                )
     return coverage
 
 
-def _build_coverage_nodes_cached(
-    files_and_nodes, target_name, roi_name, roi_filename, cache
-):
-    output_ext = ".coverage"
-    if roi_name:
-        output_ext = ".%s.coverage" % roi_name
-
-    coverages = {}
+def _build_coverage_nodes_cached(into, keys, files_and_nodes, target_name, roi, cache):
     for (input_filename, node) in files_and_nodes.items():
-        output_filename = swap_ext(input_filename, output_ext)
+        # Coverage for the genome and for all ROIs is calculated in one pass
+        outputs = []
+        for (roi_name, roi_filename) in roi:
+            output_ext = ".coverage"
+            if roi_name:
+                output_ext = ".%s.coverage" % roi_name
+
+            outputs.append((roi_filename, swap_ext(input_filename, output_ext)))
 
-        cache_key = (roi_filename, input_filename)
+        cache_key = (input_filename, tuple(outputs))
         if cache_key not in cache:
-            cache[cache_key] = CoverageNode(
-                input_file=input_filename,
-                output_file=output_filename,
+            cache[cache_key] = BAMStatsNode(
                 target_name=target_name,
-                regions_file=roi_filename,
+                input_file=input_filename,
+                coverage=outputs,
                 dependencies=node,
             )
 
-        coverages[output_filename] = cache[cache_key]
-    return coverages
+        for (key, (_, output_filename)) in zip(keys, outputs):
+            into[key][output_filename] = cache[cache_key]
 
 
 def _get_roi(prefix, name_prefix=""):
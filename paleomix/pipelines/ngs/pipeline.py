@@ -30,6 +30,13 @@ import paleomix.common.logging
 import paleomix.resources
 import paleomix.yaml
 
+from paleomix.executors import (
+    BatchExecutor,
+    RemoteExecutor,
+    get_authkey,
+    parse_address,
+)
+from paleomix.journal import Journal
 from paleomix.pipeline import Pypeline
 from paleomix.nodes.samtools import FastaIndexNode
 from paleomix.nodes.bwa import BWAIndexNode
@@ -186,8 +193,36 @@ def run(config, pipeline_variant):
         logger.error("Insufficient permissions for temp root: %r", config.temp_root)
         return 1
 
-    # Init worker-threads before reading in any more data
-    pipeline = Pypeline(config)
+    journal = None
+    if config.use_journal or config.use_checksums:
+        journal = Journal(
+            os.path.join(config.destination, ".paleomix.journal"),
+            checksums=config.use_checksums,
+        )
+
+    executor = None
+    if config.listen is not None and config.batch_jobs is not None:
+        logger.error("--listen and --batch-jobs cannot be used together")
+        return 1
+    elif config.batch_jobs is not None:
+        try:
+            executor = BatchExecutor(
+                root=os.path.join(config.temp_root, "batch"),
+                max_jobs=config.batch_jobs,
+                options=config.batch_options,
+            )
+        except ValueError as error:
+            logger.error("Invalid --batch-jobs option: %s", error)
+            return 1
+    elif config.listen is not None:
+        try:
+            address = parse_address(config.listen)
+            executor = RemoteExecutor(address, get_authkey())
+        except ValueError as error:
+            logger.error("Invalid --listen option: %s", error)
+            return 1
+
+    pipeline = Pypeline(config, journal=journal, executor=executor)
 
     try:
         makefiles = read_makefiles(config.makefiles, pipeline_variant)
@@ -228,7 +263,11 @@ def run(config, pipeline_variant):
         return 0
 
     logger.info("Running BAM pipeline")
-    if not pipeline.run(dry_run=config.dry_run, max_threads=config.max_threads):
+    if not pipeline.run(
+        dry_run=config.dry_run,
+        max_threads=config.max_threads,
+        max_memory=config.max_memory,
+    ):
         return 1
 
     return 0
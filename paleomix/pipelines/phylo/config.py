@@ -73,6 +73,14 @@ def build_parser():
         type=int,
         help="Maximum number of threads to use for each instance of ExaML [%(default)s]",
     )
+    group.add_argument(
+        "--genotyping-max-threads",
+        default=1,
+        type=int,
+        help="Maximum number of threads to use when genotyping a BAM file; regions "
+        "are split into one shard per thread, which are genotyped in parallel "
+        "[%(default)s]",
+    )
     group.add_argument(
         "--max-threads",
         type=int,
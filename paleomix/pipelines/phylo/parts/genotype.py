@@ -163,6 +163,7 @@ def build_genotyping_nodes_cached(options, genotyping, sample, regions, dependen
         outfile=calls,
         mpileup_options=genotyping["MPileup"],
         bcftools_options=genotyping["BCFTools"],
+        threads=options.genotyping_max_threads,
         dependencies=dependencies,
     )
 
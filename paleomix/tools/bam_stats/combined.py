@@ -0,0 +1,405 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Calculates coverage tables and/or depth histograms for a BAM file, for the
+entire genome and for any number of BED files with regions of interest, using a
+single pass over the BAM file. The resulting tables are identical to those
+generated by the 'coverage' and 'depths' commands.
+"""
+import collections
+import copy
+import logging
+import sys
+
+import paleomix.tools.coverage as coverage
+import paleomix.tools.depths as depths
+
+from paleomix.common.bamfiles import BAMRegionsIter
+from paleomix.common.bedtools import BEDSweep, sort_bed_by_bamfile
+
+from paleomix.tools.bam_stats.common import (
+    BAMStatsError,
+    build_parser,
+    collect_bed_regions,
+    finalize_arguments,
+    get_end_position,
+    map_regions,
+    process_bam_file,
+)
+
+
+# Region for which depths are counted; ROIs are clipped to the current window
+_Region = collections.namedtuple("_Region", ("name", "start", "end"))
+
+
+##############################################################################
+##############################################################################
+
+
+class _GenomeCoverage:
+    """Collects coverage statistics for entire contigs (see 'coverage')."""
+
+    # Coverage is tallied per read, so there are no pending sites to count
+    advance = None
+
+    def __init__(self, handle, args):
+        self.result = {}
+        self._lengths = handle.lengths
+        self._template = coverage.build_region_template(args, handle)
+        self._collapse = handle.nreferences > args.max_contigs
+        self._table = None
+        self._end = None
+
+    def start_region(self, region):
+        name = "<Genome>" if self._collapse else region.name
+        self._table = coverage.get_region_table(self.result, name, self._template)
+        self._end = self._lengths[region.tid]
+
+    def add_record(self, record, readgroup, end, owned):
+        # Reads are only counted in the window in which they start
+        if owned:
+            table = self._table.get(readgroup)
+            if table is None:
+                # Unknown readgroups are treated as missing readgroups
+                table = self._table[None]
+
+            coverage.process_record(table, record, record.flag, 0, self._end)
+
+    def finish_region(self):
+        pass
+
+
+class _RegionsCoverage:
+    """Collects coverage statistics for regions of interest (see 'coverage').
+    Reads are counted once for every region they overlap."""
+
+    def __init__(self, handle, args):
+        self.result = {}
+        self._template = coverage.build_region_template(args, handle)
+        self._regions = _group_by_contig(args.regions)
+        self._sweep = None
+
+    def start_region(self, region):
+        rois = self._regions.get(region.name, ())
+        self._sweep = BEDSweep(roi for roi in rois if roi.end > region.start)
+
+    def advance(self, position):
+        # Retiring regions limits the number of regions checked for each read
+        self._sweep.retire(position)
+
+    def add_record(self, record, readgroup, end, owned):
+        # Reads are only counted in the window in which they start
+        if owned:
+            for roi in self._sweep.overlapping(record.pos, end):
+                table = coverage.get_region_table(self.result, roi.name, self._template)
+                subtable = table.get(readgroup)
+                if subtable is None:
+                    # Unknown readgroups are treated as missing readgroups
+                    subtable = table[None]
+
+                coverage.process_record(
+                    subtable, record, record.flag, roi.start, roi.end
+                )
+
+    def finish_region(self):
+        pass
+
+
+class _GenomeDepths:
+    """Collects depth histograms for entire contigs (see 'depths')."""
+
+    def __init__(self, handle, args):
+        self.result = depths.build_totals_dict(args, handle)
+        self._rg_to_smlbid, self._smlbid_to_smlb = depths.build_rg_to_smlbid_keys(
+            args, handle
+        )
+        self._collapse = handle.nreferences > args.max_contigs
+        self._mapping = None
+
+    def start_region(self, region):
+        name = "<Genome>" if self._collapse else region.name
+        region = _Region(name, region.start, region.end)
+        self._mapping = depths.MappingToTotals(
+            self.result, region, self._smlbid_to_smlb
+        )
+
+    def advance(self, position):
+        self._mapping.process_counts(position)
+
+    def add_record(self, record, readgroup, end, owned):
+        key = _get_smlbid(self._rg_to_smlbid, readgroup)
+        for (start, end) in depths.get_aligned_blocks(record):
+            self._mapping.add_block(key, start, end)
+
+    def finish_region(self):
+        self._mapping.process_counts(float("inf"))
+        self._mapping.finalize()
+
+
+class _RegionsDepths:
+    """Collects depth histograms for regions of interest (see 'depths')."""
+
+    def __init__(self, handle, args):
+        self.result = depths.build_totals_dict(args, handle)
+        self._rg_to_smlbid, self._smlbid_to_smlb = depths.build_rg_to_smlbid_keys(
+            args, handle
+        )
+        self._regions = _group_by_contig(args.regions)
+        self._sweep = None
+        self._mapping = None
+
+    def start_region(self, region):
+        rois = []
+        for roi in self._regions.get(region.name, ()):
+            # Sites are counted in the window in which they are located
+            start = max(roi.start, region.start)
+            end = min(roi.end, region.end)
+            if start < end:
+                rois.append(_Region(roi.name, start, end))
+
+        # Only reads overlapping regions of interest need to be counted
+        self._sweep = BEDSweep(rois)
+        self._mapping = depths.MappingToRegions(
+            self.result, rois, self._smlbid_to_smlb
+        )
+
+    def advance(self, position):
+        self._sweep.retire(position)
+        self._mapping.process_counts(position)
+
+    def add_record(self, record, readgroup, end, owned):
+        if self._sweep.overlapping(record.pos, end):
+            key = _get_smlbid(self._rg_to_smlbid, readgroup)
+            for (start, end) in depths.get_aligned_blocks(record):
+                self._mapping.add_block(key, start, end)
+
+    def finish_region(self):
+        self._mapping.process_counts(float("inf"))
+        self._mapping.finalize()
+
+
+_COLLECTORS = {
+    ("coverage", False): _GenomeCoverage,
+    ("coverage", True): _RegionsCoverage,
+    ("depths", False): _GenomeDepths,
+    ("depths", True): _RegionsDepths,
+}
+
+
+def _group_by_contig(regions):
+    regions_by_contig = collections.defaultdict(list)
+    for region in regions:
+        regions_by_contig[region.contig].append(region)
+
+    return dict(regions_by_contig)
+
+
+def _get_smlbid(rg_to_smlbid, readgroup):
+    key = rg_to_smlbid.get(readgroup)
+    if key is None:
+        # Unknown readgroups are treated as missing readgroups
+        key = rg_to_smlbid[None]
+
+    return key
+
+
+##############################################################################
+##############################################################################
+
+
+def process_regions(handle, args, regions, timer):
+    collectors = []
+    for (kind, stats_args) in args.statistics:
+        collector = _COLLECTORS[(kind, bool(stats_args.regions))]
+        collectors.append(collector(handle, stats_args))
+
+    get_readgroup = args.get_readgroup_func
+    add_record_funcs = [collector.add_record for collector in collectors]
+    advancing = [collector.advance for collector in collectors if collector.advance]
+    # End positions are only needed to match reads against ROIs
+    any_regions = any(stats_args.regions for (_, stats_args) in args.statistics)
+
+    last_tid = 0
+    for region in BAMRegionsIter(handle, regions):
+        if region.name is None:
+            # Trailing unmapped reads
+            break
+
+        for collector in collectors:
+            collector.start_region(region)
+
+        last_pos = 0
+        for (position, records) in region:
+            # Contigs may be split into windows (see 'map_regions'), in which
+            # case reads belong to the window in which they start
+            owned = position >= region.start
+
+            for advance in advancing:
+                advance(position)
+
+            for record in records:
+                readgroup = get_readgroup(record)
+                end = get_end_position(record) if any_regions else None
+                for add_record in add_record_funcs:
+                    add_record(record, readgroup, end, owned)
+
+                if owned:
+                    timer.increment(read=record)
+
+            if (region.tid, position) < (last_tid, last_pos):
+                raise BAMStatsError("Input BAM file is unsorted")
+
+            last_pos = position
+            last_tid = region.tid
+
+        for collector in collectors:
+            collector.finish_region()
+
+    return [collector.result for collector in collectors]
+
+
+def write_coverage_table(handle, args, results):
+    counts = {}
+    template = coverage.build_region_template(args, handle)
+    for partial_counts in results:
+        coverage.merge_region_tables(counts, partial_counts, template)
+
+    coverage.print_table(args, handle, counts)
+
+
+def write_depths_table(handle, args, results):
+    totals = depths.build_totals_dict(args, handle)
+    for partial_totals in results:
+        depths.merge_totals(totals, partial_totals)
+
+    depths.exclude_missing_readgroups(args, totals)
+    depths.print_table(handle, args, totals)
+
+
+def process_file(handle, args):
+    for (_, stats_args) in args.statistics:
+        sort_bed_by_bamfile(handle, stats_args.regions)
+
+    try:
+        results = map_regions(handle, args, process_regions)
+    except BAMStatsError as error:
+        sys.stderr.write("ERROR: %s\n" % (error,))
+        return 1
+
+    for (idx, (kind, stats_args)) in enumerate(args.statistics):
+        partial_results = [result[idx] for result in results]
+        if kind == "coverage":
+            write_coverage_table(handle, stats_args, partial_results)
+        else:
+            write_depths_table(handle, stats_args, partial_results)
+
+    return 0
+
+
+##############################################################################
+##############################################################################
+
+
+def parse_arguments(argv):
+    prog = "paleomix bam_stats"
+    usage = "%s [options] sorted.bam --coverage out.coverage" % (prog,)
+    parser = build_parser(prog, usage)
+
+    parser.add_argument(
+        "--coverage",
+        metavar="OUTPUT",
+        help="Write coverage table for the entire genome to OUTPUT",
+    )
+    parser.add_argument(
+        "--coverage-regions",
+        nargs=2,
+        default=[],
+        action="append",
+        metavar=("BED", "OUTPUT"),
+        help="Write coverage table for regions of interest in BED to OUTPUT; "
+        "may be specified any number of times",
+    )
+    parser.add_argument(
+        "--depths",
+        metavar="OUTPUT",
+        help="Write depth histogram for the entire genome to OUTPUT",
+    )
+    parser.add_argument(
+        "--depths-regions",
+        nargs=2,
+        default=[],
+        action="append",
+        metavar=("BED", "OUTPUT"),
+        help="Write depth histogram for regions of interest in BED to OUTPUT; "
+        "may be specified any number of times",
+    )
+
+    args = parser.parse_args(argv)
+
+    args.outputs = []
+    for kind in ("coverage", "depths"):
+        filename = getattr(args, kind)
+        if filename is not None:
+            args.outputs.append((kind, None, filename))
+
+        for (bed_file, filename) in getattr(args, kind + "_regions"):
+            args.outputs.append((kind, bed_file, filename))
+
+    if not args.outputs:
+        parser.error("No output files specified")
+
+    finalize_arguments(parser, args, [filename for (_, _, filename) in args.outputs])
+
+    return args
+
+
+def main(argv):
+    log = logging.getLogger(__name__)
+    args = parse_arguments(argv)
+    args.regions = None
+
+    bed_files = {}
+    statistics = []
+    for (kind, bed_file, filename) in args.outputs:
+        stats_args = copy.copy(args)
+        stats_args.outfile = filename
+        if bed_file is not None:
+            if bed_file not in bed_files:
+                try:
+                    bed_files[bed_file] = collect_bed_regions(bed_file)
+                except ValueError as error:
+                    log.error("Failed to parse BED file %r: %s", bed_file, error)
+                    return 1
+
+            stats_args.regions = bed_files[bed_file]
+
+        statistics.append((kind, stats_args))
+    args.statistics = statistics
+
+    return process_bam_file(process_file, args)
+
+
+##############################################################################
+##############################################################################
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -22,13 +22,30 @@
 #
 import argparse
 import collections
+import functools
+import multiprocessing
 import os
 import logging
 
 import pysam
 
-from paleomix.common.bedtools import read_bed_file, sort_bed_by_bamfile
+from paleomix.common.bamfiles import BAMRegionsIter
+from paleomix.common.bedtools import (
+    BEDRecord,
+    cluster_bed_records,
+    read_bed_file,
+    sort_bed_by_bamfile,
+)
 from paleomix.common.fileutils import swap_ext
+from paleomix.common.timer import BAMTimer
+
+
+# Max number of bases processed by each job when using multiple threads
+_MAX_JOB_SIZE = 10000000
+# Min number of jobs per thread, to even out differences in runtime between jobs
+_MIN_JOBS_PER_THREAD = 4
+# Regions of interest separated by fewer bases than this are read using one fetch
+_MAX_REGION_DISTANCE = 1000
 
 
 class BAMStatsError(RuntimeError):
@@ -79,25 +96,15 @@ def collect_bed_regions(filename):
     return regions
 
 
-def parse_arguments(argv, ext):
-    prog = "paleomix %s" % (ext.strip("."),)
-    usage = "%s [options] sorted.bam [out%s]" % (prog, ext)
+def build_parser(prog, usage):
+    """Returns a parser with the options shared by BAM statistics commands."""
     parser = argparse.ArgumentParser(prog=prog, usage=usage)
-
     parser.add_argument(
         "infile",
         metavar="BAM",
         help="Filename of a sorted BAM file. If set to '-' "
         "the file is read from STDIN.",
     )
-    parser.add_argument(
-        "outfile",
-        metavar="OUTPUT",
-        nargs="?",
-        help="Filename of output table; defaults to name of "
-        "the input BAM with a '%s' extension. If "
-        "set to '-' the table is printed to STDOUT." % (ext,),
-    )
     parser.add_argument(
         "--target-name",
         default=None,
@@ -105,15 +112,6 @@ def parse_arguments(argv, ext):
         help="Name used for 'Target' column; defaults to the "
         "filename of the BAM file.",
     )
-    parser.add_argument(
-        "--regions-file",
-        default=None,
-        dest="regions_fpath",
-        help="BED file containing regions of interest; %s "
-        "is calculated only for these grouping by the "
-        "name used in the BED file, or the contig name "
-        "if no name has been specified for a record." % (ext.strip("."),),
-    )
     parser.add_argument(
         "--max-contigs",
         default=100,
@@ -133,6 +131,14 @@ def parse_arguments(argv, ext):
         "if readgroup information is missing or partial "
         "[default: %(default)s]",
     )
+    parser.add_argument(
+        "--threads",
+        default=1,
+        type=int,
+        help="Number of processes used to process the BAM file; the genome (or "
+        "list of regions) is split across processes, which requires that the BAM "
+        "file is indexed [default: %(default)s]",
+    )
     parser.add_argument(
         "--overwrite-output",
         default=False,
@@ -142,9 +148,14 @@ def parse_arguments(argv, ext):
         "already exists.",
     )
 
-    args = parser.parse_args(argv)
-    if not args.outfile:
-        args.outfile = swap_ext(args.infile, ext)
+    return parser
+
+
+def finalize_arguments(parser, args, outfiles):
+    """Validates arguments parsed using a parser from 'build_parser', and sets
+    default values that depend on other arguments."""
+    if args.threads < 1:
+        parser.error("--threads must be at least 1, not %i" % (args.threads,))
 
     if args.ignore_readgroups:
         args.get_readgroup_func = _get_readgroup_ignored
@@ -157,11 +168,42 @@ def parse_arguments(argv, ext):
         else:
             args.target_name = os.path.basename(args.infile)
 
-    if os.path.exists(args.outfile) and not args.overwrite_output:
-        parser.error(
-            "Destination filename already exists (%r); use option "
-            "--overwrite-output to allow overwriting of this file." % (args.outfile,)
-        )
+    for filename in outfiles:
+        if os.path.exists(filename) and not args.overwrite_output:
+            parser.error(
+                "Destination filename already exists (%r); use option "
+                "--overwrite-output to allow overwriting of this file." % (filename,)
+            )
+
+
+def parse_arguments(argv, ext):
+    prog = "paleomix %s" % (ext.strip("."),)
+    usage = "%s [options] sorted.bam [out%s]" % (prog, ext)
+    parser = build_parser(prog, usage)
+
+    parser.add_argument(
+        "outfile",
+        metavar="OUTPUT",
+        nargs="?",
+        help="Filename of output table; defaults to name of "
+        "the input BAM with a '%s' extension. If "
+        "set to '-' the table is printed to STDOUT." % (ext,),
+    )
+    parser.add_argument(
+        "--regions-file",
+        default=None,
+        dest="regions_fpath",
+        help="BED file containing regions of interest; %s "
+        "is calculated only for these grouping by the "
+        "name used in the BED file, or the contig name "
+        "if no name has been specified for a record." % (ext.strip("."),),
+    )
+
+    args = parser.parse_args(argv)
+    if not args.outfile:
+        args.outfile = swap_ext(args.infile, ext)
+
+    finalize_arguments(parser, args, [args.outfile])
 
     return args
 
@@ -177,6 +219,15 @@ def main_wrapper(process_func, argv, ext):
             log.error("Failed to parse BED file %r: %s", args.regions_fpath, error)
             return 1
 
+    return process_bam_file(process_func, args)
+
+
+def process_bam_file(process_func, args):
+    """Opens the BAM file 'args.infile', checks that it is coordinate sorted,
+    and calls 'process_func(handle, args)'. Any regions in 'args.regions' are
+    sorted to match the order of contigs in the BAM file.
+    """
+    log = logging.getLogger(__name__)
     log.info("Opening %r", args.infile)
     with pysam.AlignmentFile(args.infile) as handle:
         sort_order = handle.header.get("HD", {}).get("SO")
@@ -194,6 +245,126 @@ def main_wrapper(process_func, argv, ext):
         return process_func(handle, args)
 
 
+def map_regions(handle, args, func):
+    """Calls 'func(handle, args, regions, timer)' for the regions of interest,
+    or the entire BAM file if 'regions' is None, and returns a list of results.
+
+    If more than one thread is requested, and the BAM file is indexed, then
+    the regions of interest or the genome are split into jobs that are run in
+    parallel, each producing a partial result. Contigs are split into windows,
+    such that the name of each region is that of the contig. Functions must
+    therefore ensure that reads overlapping multiple windows are only counted
+    once, while reads overlapping multiple regions of interest are counted for
+    each region (as when run without threads).
+    """
+    log = logging.getLogger(__name__)
+    timer = BAMTimer(handle, step=1000000)
+
+    results = []
+    if args.threads > 1 and args.infile != "-" and handle.has_index():
+        jobs = split_regions(args, handle)
+        log.info("Processing %i jobs using %i threads", len(jobs), args.threads)
+
+        worker = functools.partial(_run_job, func, args)
+        with multiprocessing.Pool(args.threads) as pool:
+            for (result, count) in pool.imap_unordered(worker, jobs):
+                timer.increment(count)
+                results.append(result)
+    else:
+        if args.threads > 1:
+            log.warning("BAM file is not indexed; using 1 thread")
+
+        results.append(func(handle, args, args.regions, timer))
+
+    timer.finalize()
+
+    return results
+
+
+def split_regions(args, handle):
+    """Splits the regions of interest, or the genome if no regions were given,
+    into lists of regions, to be processed by jobs of roughly equal size. ROIs
+    are never split, while contigs are split into windows named after the contig.
+    """
+    if args.regions:
+        total_size = sum(region.end - region.start for region in args.regions)
+    else:
+        total_size = sum(handle.lengths)
+
+    size = total_size // (args.threads * _MIN_JOBS_PER_THREAD)
+    size = max(1, min(_MAX_JOB_SIZE, size))
+
+    regions = args.regions
+    if not regions:
+        regions = []
+        for (contig, length) in zip(handle.references, handle.lengths):
+            for start in range(0, length, size):
+                end = min(length, start + size)
+                line = "%s\t%i\t%i\t%s" % (contig, start, end, contig)
+                regions.append(BEDRecord(line).freeze())
+
+    jobs = []
+    job = []
+    job_size = 0
+    for region in regions:
+        job.append(region)
+        job_size += region.end - region.start
+
+        if job_size >= size:
+            jobs.append(job)
+            job = []
+            job_size = 0
+
+    if job:
+        jobs.append(job)
+
+    return jobs
+
+
+def iterate_regions(handle, regions):
+    """Iterates over a BAM file using 'BAMRegionsIter', yielding a tuple of
+    (region, rois) for each contig or for each cluster of nearby regions of
+    interest (see 'cluster_bed_records'). Every cluster is read once, and the
+    regions of interest in that cluster are returned as a list of BEDRecords,
+    to be assigned reads or sites using a BEDSweep. If no regions are given,
+    'rois' is None.
+    """
+    if not regions:
+        for region in BAMRegionsIter(handle):
+            yield (region, None)
+    else:
+        clusters = cluster_bed_records(regions, _MAX_REGION_DISTANCE)
+        bam_regions = BAMRegionsIter(handle, [region for (region, _) in clusters])
+
+        for ((_, rois), region) in zip(clusters, bam_regions):
+            yield (region, rois)
+
+
+def get_end_position(record):
+    """Returns the end position of a record, as used by htslib to determine if
+    a record overlaps a region (e.g. when using 'fetch')."""
+    return record.pos + (record.reference_length or 1)
+
+
+def _run_job(func, args, regions):
+    timer = _RecordCounter()
+    with pysam.AlignmentFile(args.infile) as handle:
+        result = func(handle, args, regions, timer)
+
+    return result, timer.count
+
+
+class _RecordCounter:
+    """Counts records in place of BAMTimer in worker processes."""
+
+    def __init__(self):
+        self.count = 0
+
+    def increment(self, count=1, read=None):
+        self.count += count
+        return self
+
+
 def _get_readgroup(record):
     try:
         return record.get_tag("RG")
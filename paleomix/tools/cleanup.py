@@ -34,9 +34,15 @@ as there may not be any hits in an entire lane. For example, the following
 command will not work:
 $ samtools view -H INPUT.BAM | samtools view -Sbu -
 
+By default, mate information is fixed using 'samtools fixmate' and MD/NM tags
+are updated using 'samtools calmd'. With --in-process, both steps are instead
+carried out by this script, such that only 'samtools sort' is run as a separate
+process, with MD and NM tags calculated while writing the final, sorted BAM.
 """
-import sys
 import argparse
+import itertools
+import operator
+import sys
 
 import pysam
 
@@ -49,6 +55,17 @@ import paleomix.common.procs as processes
 # no assumptions can if 0x1 is not set, per the SAM specification (see below).
 _SE_FLAGS_MASK = ~(0x2 | 0x8 | 0x20 | 0x40 | 0x80)
 
+# CIGAR operations consuming reference bases (M, D, N, =, and X)
+_CIGAR_CONSUMES_REFERENCE = frozenset((0, 2, 3, 7, 8))
+# Tags that are not meaningful for unmapped reads, and removed by fixmate
+_UNMAPPED_TAGS = ("NM", "MD", "CG", "SM")
+
+_GET_QUERY_NAME = operator.attrgetter("query_name")
+
+# Memory used by 'samtools sort' (in MB); this is the default for a single thread and
+# is divided between threads, since 'samtools sort' allocates this much per thread
+_SORT_MEMORY = 768
+
 
 def _set_sort_order(header):
     """Updates a BAM header to indicate coordinate sorting."""
@@ -119,6 +136,201 @@ def _cleanup_record(record):
     return record
 
 
+def _get_end_position(record):
+    """Returns the end position of an alignment, as calculated by htslib."""
+    end = record.reference_end
+    if end is None:
+        # Alignments without CIGAR operations are treated as spanning 1 bp
+        return record.pos + 1
+
+    return end
+
+
+def _sanitize_record(record, lengths):
+    """Corrects invalid or inconsistent alignment fields (see samtools fixmate
+    --sanitize); alignments extending past the end of the contig are trimmed."""
+    if record.tid < 0:
+        record.pos = -1
+        record.flag |= 0x4
+
+    if not record.flag & 0x4:
+        length = lengths[record.tid]
+        if record.pos < 0:
+            record.flag |= 0x4
+        elif record.pos >= length:
+            record.flag |= 0x4
+            record.tid = -1
+            record.pos = -1
+        elif _get_end_position(record) > length:
+            _trim_record(record, length)
+
+    if record.flag & 0x4:
+        if record.cigartuples:
+            record.cigartuples = None
+        record.mapq = 0
+
+        for tag in _UNMAPPED_TAGS:
+            if record.has_tag(tag):
+                record.set_tag(tag, None)
+    else:
+        # Merge adjacent operations of the same kind and remove empty operations
+        cigar = []
+        for (op, length) in record.cigartuples or ():
+            if cigar and cigar[-1][0] == op:
+                cigar[-1] = (op, cigar[-1][1] + length)
+            elif length:
+                cigar.append((op, length))
+
+        if cigar != record.cigartuples:
+            record.cigartuples = cigar
+
+
+def _trim_record(record, end):
+    """Trims an alignment such that it ends at or before 'end', by converting
+    trailing CIGAR operations to soft clipping."""
+    cigar = record.cigartuples
+    position = record.pos
+    for (idx, (op, length)) in enumerate(cigar):
+        if op in _CIGAR_CONSUMES_REFERENCE:
+            position += length
+            if position > end:
+                break
+    else:
+        return
+
+    if position - length < end:
+        # Split the operation crossing the end of the contig
+        trimmed = cigar[:idx] + [(op, end - position + length), (4, position - end)]
+    else:
+        # Operation starting at the end of the contig
+        record.flag = (record.flag | 0x4) & ~0x2
+        return
+
+    for (op, length) in cigar[idx + 1 :]:
+        if op == 5:
+            trimmed.append((op, length))
+        else:
+            trimmed[-1] = (4, trimmed[-1][1] + length)
+
+    record.cigartuples = trimmed
+
+
+def _fix_mates(records, lengths):
+    """Fixes mate information for records grouped by name, equivalent to running
+    'samtools fixmate' without options. Records are returned in the same order."""
+    for (_, template) in itertools.groupby(records, _GET_QUERY_NAME):
+        template = list(template)
+        for record in template:
+            _sanitize_record(record, lengths)
+
+        _fix_template(template)
+
+        yield from template
+
+
+def _fix_template(records):
+    first = first_end = None
+    paired = False
+    # Primary alignments of mate 1 and mate 2, used for supplementary alignments
+    primary = [None, None]
+    for record in records:
+        flag = record.flag
+        if flag & 0x900:
+            # Secondary (0x100) or supplementary (0x800) alignment
+            continue
+
+        end = 0 if flag & 0x4 else _get_end_position(record)
+        primary[bool(flag & 0x80)] = record
+
+        if first is None:
+            first, first_end = record, end
+        else:
+            # Any additional primary alignments are treated as mates of the first
+            _fix_mate_pair(first, first_end, record, end)
+            paired = True
+
+    if first is not None and not paired:
+        # Unpaired primary alignment
+        first.rnext = -1
+        first.pnext = -1
+        first.tlen = 0
+        # Unset 0x2 (properly aligned) and 0x20 (next mate reverse)
+        first.flag &= ~0x22
+
+    for record in records:
+        flag = record.flag
+        if flag & 0x800 and flag & 0x1:
+            mate = primary[not flag & 0x80]
+            if mate is not None:
+                _sync_mate_info(mate, record)
+                _sync_mate_tags(mate, record)
+
+
+def _fix_mate_pair(record_1, end_1, record_2, end_2):
+    record_1.flag |= 0x1
+    record_2.flag |= 0x1
+
+    # Unmapped reads are placed with their mapped mate
+    for (src, dst) in ((record_1, record_2), (record_2, record_1)):
+        if dst.flag & 0x4 and not src.flag & 0x4:
+            dst.tid = src.tid
+            dst.pos = src.pos
+
+    _sync_mate_info(record_1, record_2)
+    _sync_mate_info(record_2, record_1)
+    _sync_mate_tags(record_1, record_2)
+    _sync_mate_tags(record_2, record_1)
+
+    # Flags 0x4 (unmapped) and 0x8 (next mate unmapped)
+    if (
+        record_1.tid == record_2.tid
+        and not record_1.flag & 0xC
+        and not record_2.flag & 0xC
+    ):
+        pos_1 = end_1 if record_1.flag & 0x10 else record_1.pos
+        pos_2 = end_2 if record_2.flag & 0x10 else record_2.pos
+
+        record_1.tlen = pos_2 - pos_1
+        record_2.tlen = pos_1 - pos_2
+    else:
+        record_1.tlen = record_2.tlen = 0
+
+    if not _is_plausibly_properly_paired(record_1, end_1, record_2, end_2):
+        record_1.flag &= ~0x2
+        record_2.flag &= ~0x2
+
+
+def _sync_mate_info(src, dst):
+    dst.rnext = src.tid
+    dst.pnext = src.pos
+
+    # Set or unset 0x20 (next mate reverse) and set 0x8 (next mate unmapped)
+    dst.flag = (dst.flag & ~0x20) | ((src.flag & 0x10) << 1) | ((src.flag & 0x4) << 1)
+
+
+def _sync_mate_tags(src, dst):
+    if not src.flag & 0x4:
+        # Mapping quality of the mate
+        dst.set_tag("MQ", src.mapq, "i")
+
+    if not (src.flag & 0x4 and dst.flag & 0x4):
+        # CIGAR string of the mate
+        dst.set_tag("MC", src.cigarstring or "*", "Z")
+
+
+def _is_plausibly_properly_paired(record_1, end_1, record_2, end_2):
+    if (record_1.flag | record_2.flag) & 0x4 or record_1.tid != record_2.tid:
+        return False
+
+    pos_1 = end_1 if record_1.flag & 0x10 else record_1.pos
+    pos_2 = end_2 if record_2.flag & 0x10 else record_2.pos
+    if pos_1 > pos_2:
+        record_1, record_2 = record_2, record_1
+
+    # The leftmost mate must be on the forward strand, and the other on the reverse
+    return not record_1.flag & 0x10 and record_2.flag & 0x10
+
+
 def _filter_record(args, record):
     """Returns True if the record should be filtered (excluded), based on the
     --exclude-flags and --require-flags options. Certain flags are ignored when
@@ -139,6 +351,44 @@ def _filter_record(args, record):
     return False
 
 
+def _build_header(args, header):
+    """Returns a copy of a BAM header marked as sorted (under the assumption that
+    'samtools sort' is to be run on the output), with PG and RG tags updated as
+    specified in the commandline arguments 'args'.
+    """
+    header = dict(header)
+    _set_sort_order(header)
+    _set_pg_tags(header, args.update_pg_tag)
+    if args.rg_id is not None:
+        _set_rg_tags(header, args.rg_id, args.rg)
+
+    return header
+
+
+def _cleanup_records(args, records):
+    """Cleans up and filters records according to the filters specified in the
+    commandline arguments 'args', yielding the records that pass the filters.
+    """
+    filter_by_flag = bool(args.exclude_flags or args.require_flags)
+    for record in records:
+        # Ensure that the properties make sense before filtering
+        record = _cleanup_record(record)
+
+        if not record.is_unmapped and (record.mapq < args.min_quality):
+            continue
+        elif filter_by_flag and _filter_record(args, record):
+            continue
+
+        if args.rg_id is not None:
+            # Ensure that only one RG tag is set
+            tags = record.get_tags(with_value_type=True)
+            tags = [tag for tag in tags if tag[0] != "RG"]
+            tags.append(("RG", args.rg_id, "Z"))
+            record.set_tags(tags)
+
+        yield record
+
+
 def _cleanup_unmapped(args):
     """Reads a BAM (or SAM, if cleanup_sam is True) file from STDIN, and
     filters reads according to the filters specified in the commandline
@@ -147,37 +397,94 @@ def _cleanup_unmapped(args):
     assumption that 'samtools sort' is to be run on the output) and PG tags are
     updated if specified in the args.
     """
-
-    filter_by_flag = bool(args.exclude_flags or args.require_flags)
     with pysam.AlignmentFile("-") as input_handle:
-        header = dict(input_handle.header)
-        _set_sort_order(header)
-        _set_pg_tags(header, args.update_pg_tag)
-        if args.rg_id is not None:
-            _set_rg_tags(header, args.rg_id, args.rg)
+        header = _build_header(args, input_handle.header)
 
         with pysam.AlignmentFile("-", "wbu", header=header) as output_handle:
-            for record in input_handle:
-                # Ensure that the properties make sense before filtering
-                record = _cleanup_record(record)
-
-                if not record.is_unmapped and (record.mapq < args.min_quality):
-                    continue
-                elif filter_by_flag and _filter_record(args, record):
-                    continue
-
-                if args.rg_id is not None:
-                    # Ensure that only one RG tag is set
-                    tags = record.get_tags(with_value_type=True)
-                    tags = [tag for tag in tags if tag[0] != "RG"]
-                    tags.append(("RG", args.rg_id, "Z"))
-                    record.set_tags(tags)
-
+            for record in _cleanup_records(args, input_handle):
                 output_handle.write(record)
 
     return 0
 
 
+def _run_in_process_pipeline(args):
+    """Fixes mate information (for PE reads) and cleans up reads in this process,
+    followed by a single 'samtools sort', the output of which is written to STDOUT
+    with MD and NM tags updated in this process (if --fasta is set).
+    """
+    command = _build_sort_command(args)
+    # Uncompressed output is read back in order to update MD and NM tags
+    sort_stdout = None if args.fasta is None else processes.PIPE
+
+    proc = processes.open_proc(command, stdin=processes.PIPE, stdout=sort_stdout)
+
+    try:
+        with pysam.AlignmentFile("-") as input_handle:
+            header = _build_header(args, input_handle.header)
+
+            records = iter(input_handle)
+            if args.paired_end:
+                records = _fix_mates(records, input_handle.lengths)
+
+            with pysam.AlignmentFile(proc.stdin, "wbu", header=header) as sort_handle:
+                for record in _cleanup_records(args, records):
+                    sort_handle.write(record)
+
+        # 'samtools sort' only starts writing once all input has been read
+        proc.stdin.close()
+
+        if args.fasta is not None:
+            # Update NM and MD tags using the htslib-based calmd bundled with pysam,
+            # reading directly from 'samtools sort' and writing BAM (-b) to STDOUT;
+            # -Q disables warnings for changed tags, as these are kept in memory
+            calmd_args = _build_calmd_options(args) + ["-Q"]
+            calmd_args.append("/dev/fd/%i" % (proc.stdout.fileno(),))
+            calmd_args.append(args.fasta)
+
+            pysam.calmd(*calmd_args, catch_stdout=False)
+            proc.stdout.close()
+
+        return int(any(processes.join_procs([proc])))
+    except Exception:
+        proc.terminate()
+        raise
+
+
+def _build_sort_command(args):
+    """Returns 'samtools sort' command writing BAM to STDOUT; the output is only
+    compressed if 'samtools sort' is the last step, i.e. if --fasta is not set.
+    """
+    command = ["samtools", "sort", "-O", "bam", "-T", args.temp_prefix]
+    if args.threads > 1:
+        command.extend(("-@", str(args.threads)))
+
+    sort_memory = args.sort_memory
+    if sort_memory is None and args.threads > 1:
+        sort_memory = "%iM" % (max(1, _SORT_MEMORY // args.threads),)
+
+    if sort_memory is not None:
+        command.extend(("-m", sort_memory))
+
+    if args.fasta is not None:
+        command.extend(("-l", "0"))
+    elif args.compression_level is not None:
+        command.extend(("-l", str(args.compression_level)))
+
+    return command
+
+
+def _build_calmd_options(args):
+    """Returns options for 'samtools calmd' writing compressed BAM to STDOUT."""
+    options = ["-b"]
+    if args.threads > 1:
+        options.extend(("-@", str(args.threads)))
+
+    if args.compression_level is not None:
+        options.extend(("--output-fmt-option", "level=%i" % (args.compression_level,)))
+
+    return options
+
+
 def _build_wrapper_command(args):
     bam_cleanup = paleomix.tools.factory.new("cleanup")
     if args.fasta is not None:
@@ -200,6 +507,7 @@ def _build_wrapper_command(args):
 def _run_cleanup_pipeline(args):
     bam_cleanup = _build_wrapper_command(args)
     commands = []
+    procs = []
 
     try:
         if args.paired_end:
@@ -210,16 +518,15 @@ def _run_cleanup_pipeline(args):
         # hits where the mate-unmapped flag is incorrect, which 'fixmate' fixes.
         commands.append(bam_cleanup + ["cleanup"])
 
-        # Sort by coordinates and output uncompressed BAM
-        commands.append(
-            ["samtools", "sort", "-l", "0", "-O", "bam", "-T", args.temp_prefix]
-        )
+        # Sort by coordinates and output uncompressed BAM, unless this is the last step
+        commands.append(_build_sort_command(args))
 
         # Update NM and MD tags; output BAM (-b) to stdout
         if args.fasta is not None:
-            commands.append(["samtools", "calmd", "-b", "-", args.fasta])
+            commands.append(
+                ["samtools", "calmd"] + _build_calmd_options(args) + ["-", args.fasta]
+            )
 
-        procs = []
         last_out = sys.stdin
         for cmd in commands:
             proc_stdout = None if cmd is commands[-1] else processes.PIPE
@@ -230,7 +537,7 @@ def _run_cleanup_pipeline(args):
 
         return int(any(processes.join_procs(procs)))
     except Exception:
-        for proc in procs.values():
+        for proc in procs:
             proc.terminate()
         raise
 
@@ -287,6 +594,37 @@ def parse_args(argv):
         "updating of mate information [Default: off]",
     )
 
+    parser.add_argument(
+        "--in-process",
+        default=False,
+        action="store_true",
+        help="If enabled, mate information is fixed and MD/NM tags are calculated "
+        "by this command, instead of by running 'samtools fixmate' and 'samtools "
+        "calmd'; only 'samtools sort' is run as a separate process [Default: off]",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads used by 'samtools sort' and 'samtools calmd' for "
+        "sorting and compressing the output [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--sort-memory",
+        default=None,
+        help="Maximum memory used per thread by 'samtools sort', e.g. '512M'; by "
+        "default %iM is divided between all threads" % (_SORT_MEMORY,),
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=None,
+        choices=range(10),
+        metavar="LEVEL",
+        help="Compression level (0-9) of the output BAM file; by default the "
+        "default compression level of samtools is used",
+    )
+
     parser.add_argument(
         "--update-pg-tag",
         default=[],
@@ -324,4 +662,7 @@ def main(argv):
         raise NotImplementedError("Unexpected command %r" % (args.command,))
 
     sys.stderr.write("Reading SAM file from STDIN\n")
+    if args.in_process:
+        return _run_in_process_pipeline(args)
+
     return _run_cleanup_pipeline(args)
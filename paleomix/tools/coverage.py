@@ -23,14 +23,17 @@
 import sys
 import copy
 
+from paleomix.common.bedtools import BEDSweep
 from paleomix.common.utilities import get_in, set_in
-from paleomix.common.timer import BAMTimer
-from paleomix.common.bamfiles import BAMRegionsIter
 
 from paleomix.tools.bam_stats.common import (
+    BAMStatsError,
     collect_readgroups,
     collect_references,
+    get_end_position,
+    iterate_regions,
     main_wrapper,
+    map_regions,
 )
 from paleomix.tools.bam_stats.coverage import ReadGroup, write_table
 
@@ -57,6 +60,13 @@ def get_region_table(counts, region, template):
     return subtable
 
 
+def merge_region_tables(counts, partial_counts, template):
+    for (region, partial_subtable) in partial_counts.items():
+        subtable = get_region_table(counts, region, template)
+        for (key, readgroup) in partial_subtable.items():
+            subtable[key].add(readgroup)
+
+
 ##############################################################################
 ##############################################################################
 
@@ -107,7 +117,7 @@ def print_table(args, handle, counts):
 ##############################################################################
 
 
-def process_record(subtable, record, flags, region):
+def process_record(subtable, record, flags, start, end):
     qname = record.qname
     if qname.startswith("M_") or qname.startswith("MT_"):
         subtable.Collapsed += 1
@@ -119,9 +129,6 @@ def process_record(subtable, record, flags, region):
         subtable.SE += 1
 
     position = record.pos
-    start = region.start
-    end = region.end
-
     for (cigar, num) in record.cigar:
         left = min(max(position, start), end)
         right = min(max(position + num, start), end)
@@ -139,42 +146,99 @@ def process_record(subtable, record, flags, region):
             position += num
 
 
-def process_file(handle, args):
-    timer = BAMTimer(handle, step=1000000)
-
+def process_regions(handle, args, regions, timer):
     counts = {}
     last_tid = 0
     region_template = build_region_template(args, handle)
-    for region in BAMRegionsIter(handle, args.regions):
+    for region in regions or ():
+        get_region_table(counts, region.name, region_template)
+
+    for (region, rois) in iterate_regions(handle, regions):
         if region.name is None:
             # Trailing unmapped reads
             break
 
-        name = region.name
-        if not args.regions and (handle.nreferences > args.max_contigs):
-            name = "<Genome>"
-
-        last_pos = 0
-        region_table = get_region_table(counts, name, region_template)
-        for (position, records) in region:
-            for record in records:
-                readgroup = args.get_readgroup_func(record)
-                readgroup_table = region_table.get(readgroup)
-                if readgroup_table is None:
-                    # Unknown readgroups are treated as missing readgroups
-                    readgroup_table = region_table[None]
+        if rois is None:
+            name = region.name
+            if handle.nreferences > args.max_contigs:
+                name = "<Genome>"
 
-                process_record(readgroup_table, record, record.flag, region)
-                timer.increment(read=record)
+            region_table = get_region_table(counts, name, region_template)
+            positions = _process_contig(handle, args, region, region_table, timer)
+        else:
+            positions = _process_rois(args, region, rois, counts, timer)
 
+        last_pos = 0
+        for position in positions:
             if (region.tid, position) < (last_tid, last_pos):
-                sys.stderr.write("ERROR: Input BAM file is unsorted\n")
-                return 1
+                raise BAMStatsError("Input BAM file is unsorted")
 
             last_pos = position
             last_tid = region.tid
 
-    timer.finalize()
+    return counts
+
+
+def _process_contig(handle, args, region, region_table, timer):
+    # Contigs may be split into windows (see 'map_regions'), in which case
+    # reads are only counted in the window in which they start
+    min_position, end = region.start, handle.lengths[region.tid]
+
+    for (position, records) in region:
+        if position < min_position:
+            continue
+
+        for record in records:
+            readgroup = args.get_readgroup_func(record)
+            readgroup_table = _get_readgroup_table(region_table, readgroup)
+            process_record(readgroup_table, record, record.flag, 0, end)
+            timer.increment(read=record)
+
+        yield position
+
+
+def _process_rois(args, region, rois, counts, timer):
+    sweep = BEDSweep(rois)
+    for (position, records) in region:
+        # Retiring regions limits the number of regions checked for each read
+        sweep.retire(position)
+
+        for record in records:
+            # Reads are counted once for every region they overlap
+            rois = sweep.overlapping(position, get_end_position(record))
+            if rois:
+                flags = record.flag
+                readgroup = args.get_readgroup_func(record)
+
+                for roi in rois:
+                    readgroup_table = _get_readgroup_table(counts[roi.name], readgroup)
+                    process_record(readgroup_table, record, flags, roi.start, roi.end)
+
+            timer.increment(read=record)
+
+        yield position
+
+
+def _get_readgroup_table(region_table, readgroup):
+    readgroup_table = region_table.get(readgroup)
+    if readgroup_table is None:
+        # Unknown readgroups are treated as missing readgroups
+        readgroup_table = region_table[None]
+
+    return readgroup_table
+
+
+def process_file(handle, args):
+    try:
+        results = map_regions(handle, args, process_regions)
+    except BAMStatsError as error:
+        sys.stderr.write("ERROR: %s\n" % (error,))
+        return 1
+
+    counts = {}
+    region_template = build_region_template(args, handle)
+    for partial_counts in results:
+        merge_region_tables(counts, partial_counts, region_template)
 
     print_table(args, handle, counts)
 
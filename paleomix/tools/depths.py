@@ -21,16 +21,16 @@
 # SOFTWARE.
 #
 import sys
-import itertools
 import collections
 
-from paleomix.common.timer import BAMTimer
-from paleomix.common.bamfiles import BAMRegionsIter
-
+from paleomix.common.bedtools import BEDSweep
 from paleomix.tools.bam_stats.common import (
+    BAMStatsError,
     collect_references,
     collect_readgroups,
+    iterate_regions,
     main_wrapper,
+    map_regions,
 )
 
 
@@ -45,6 +45,9 @@ _MAX_DEPTH = 200
 _MAX_CACHE_SIZE = 10000
 
 
+# Region of interest and the mapping to which its sites are counted
+_CachedRegion = collections.namedtuple("_CachedRegion", ("start", "end", "mapping"))
+
 # Header prepended to output tables
 _HEADER = """# Columns:
 #   Contig:   Contig, chromosome, or feature for which a depth histogram was
@@ -68,36 +71,83 @@ _HEADER = """# Columns:
 
 
 class MappingToTotals:
+    """Accumulates depths for a single region. Rather than counting every base
+    of every read, aligned blocks are recorded as the positions at which the
+    depth of a sample/library changes; the depths are then constant between
+    consecutive changes, allowing entire stretches of sites to be processed as
+    one, once no further reads can start in that stretch.
+    """
+
     def __init__(self, totals, region, smlbid_to_smlb):
-        self._region = region
+        # Region bounds are cached, as accessing BEDRecord properties is slow
+        self._region_start = region.start
+        self._region_end = region.end
         self._map_by_smlbid, self._totals_src_and_dst = self._build_mappings(
             totals, region.name, smlbid_to_smlb
         )
         self._cache = collections.defaultdict(int)
-
-    def process_counts(self, counts, last_pos, cur_pos):
-        start = self._region.start
-        end = self._region.end
-
-        # Pileups tends to contain identical stretches, so
-        # try to avoid repeated lookups by aggregating these
-        repeats = 1
-        last_count = None
-        while counts and (last_pos < cur_pos):
-            count = counts.popleft()
-            if start <= last_pos < end:
-                if count == last_count:
-                    repeats += 1
-                else:
-                    if last_count is not None:
-                        self._cache[tuple(last_count)] += repeats
-                    last_count = count
-                    repeats = 1
-            last_pos += 1
-
-        if last_count is not None:
-            self._cache[tuple(last_count)] += repeats
-
+        self._init_depths(smlbid_to_smlb)
+
+    def _init_depths(self, smlbid_to_smlb):
+        # Depth for each sample/library following the change at self._last_pos
+        self._depths = [0] * len(smlbid_to_smlb)
+        self._last_pos = 0
+        # Pending changes in depth as a list of (smlbid, delta) for each position
+        self._changes = {}
+        # The first position that may have pending changes, and past the last such
+        self._next_pos = 0
+        self._end_pos = 0
+
+    def add_block(self, smlbid, start, end):
+        """Records an aligned block covering the (0-based) sites start .. end - 1"""
+        changes = self._changes
+        if not changes:
+            # Skip past sites not covered by any reads
+            self._next_pos = start
+
+        changes.setdefault(start, []).append((smlbid, 1))
+        changes.setdefault(end, []).append((smlbid, -1))
+        if end >= self._end_pos:
+            self._end_pos = end + 1
+
+    def process_counts(self, cur_pos):
+        """Processes sites up to (but not including) 'cur_pos'; no blocks may be
+        added before this position afterwards."""
+        changes = self._changes
+        if not changes:
+            return
+
+        depths = self._depths
+        count_sites = self._count_sites
+
+        # Changes are always within a read-length of each other, so checking
+        # every (covered) site is cheaper than maintaining a sorted queue
+        last_pos = self._last_pos
+        end_pos = min(cur_pos, self._end_pos)
+        for position in range(self._next_pos, end_pos):
+            deltas = changes.pop(position, None)
+            if deltas is not None:
+                # Depths are constant from the last change up to this change
+                if any(depths):
+                    count_sites(last_pos, position, tuple(depths))
+
+                for (smlbid, delta) in deltas:
+                    depths[smlbid] += delta
+                last_pos = position
+
+        self._last_pos = last_pos
+        self._next_pos = end_pos
+
+        self._flush_cache()
+
+    def _count_sites(self, start, end, count):
+        """Counts the sites start .. end - 1, all of which have the given depths."""
+        start = max(start, self._region_start)
+        end = min(end, self._region_end)
+        if start < end:
+            self._cache[count] += end - start
+
+    def _flush_cache(self):
         if len(self._cache) > _MAX_CACHE_SIZE:
             self.finalize()
 
@@ -162,6 +212,46 @@ class MappingToTotals:
         return tuple(mapping)
 
 
+class MappingToRegions(MappingToTotals):
+    """Accumulates depths for a cluster of (possibly overlapping) regions, sorted
+    by position. Depths are tracked once for the entire cluster, after which each
+    stretch of sites with constant depths is counted towards every region that
+    it overlaps. Regions with the same name share the same rows in the output
+    table and are therefore counted together.
+    """
+
+    def __init__(self, totals, regions, smlbid_to_smlb):
+        self._mappings = {}
+        cached_regions = []
+        for region in regions:
+            mapping = self._mappings.get(region.name)
+            if mapping is None:
+                mapping = MappingToTotals(totals, region, smlbid_to_smlb)
+                self._mappings[region.name] = mapping
+
+            cached_regions.append(_CachedRegion(region.start, region.end, mapping))
+
+        self._sweep = BEDSweep(cached_regions)
+        self._init_depths(smlbid_to_smlb)
+
+    def _count_sites(self, start, end, count):
+        sweep = self._sweep
+        sweep.retire(start)
+
+        for (region_start, region_end, mapping) in sweep.overlapping(start, end):
+            # Sites are clipped to the region, which is known to overlap them
+            nsites = min(end, region_end) - max(start, region_start)
+            mapping._cache[count] += nsites
+
+    def _flush_cache(self):
+        for mapping in self._mappings.values():
+            mapping._flush_cache()
+
+    def finalize(self):
+        for mapping in self._mappings.values():
+            mapping.finalize()
+
+
 ##############################################################################
 ##############################################################################
 
@@ -296,23 +386,42 @@ def build_totals_dict(args, handle):
     return totals
 
 
-def count_bases(args, counts, record, rg_to_smlbid, template):
-    for _ in range(record.alen - len(counts)):
-        counts.append(list(template))
+def count_bases(args, mapping, record, rg_to_smlbid):
+    key = _get_smlbid(args, record, rg_to_smlbid)
+    for (start, end) in get_aligned_blocks(record):
+        mapping.add_block(key, start, end)
+
 
+def _get_smlbid(args, record, rg_to_smlbid):
+    """Returns the sample/library ID of a record (see 'build_rg_to_smlbid_keys')."""
     key = rg_to_smlbid.get(args.get_readgroup_func(record))
     if key is None:
         # Unknown readgroups are treated as missing readgroups
         key = rg_to_smlbid[None]
 
-    index = 0
+    return key
+
+
+def get_aligned_blocks(record):
+    """Returns a list of (start, end) tuples for blocks of aligned bases."""
+    blocks = []
+    # Adjacent blocks (e.g. separated by insertions) are merged into one
+    start = end = position = record.pos
     for (cigar, count) in record.cigar:
         if cigar in (0, 7, 8):
-            for counter in itertools.islice(counts, index, index + count):
-                counter[key] += 1
-            index += count
+            if position != end:
+                if start != end:
+                    blocks.append((start, end))
+                start = position
+            position += count
+            end = position
         elif cigar in (2, 3, 6):
-            index += count
+            position += count
+
+    if start != end:
+        blocks.append((start, end))
+
+    return blocks
 
 
 def build_rg_to_smlbid_keys(args, handle):
@@ -338,53 +447,105 @@ def build_rg_to_smlbid_keys(args, handle):
     return rg_to_lbsmid, lbsmid_to_smlb
 
 
-def process_file(handle, args):
-    timer = BAMTimer(handle, step=1000000)
+def exclude_missing_readgroups(args, totals):
+    """Excludes counts for reads with no read-groups, if none such were seen."""
+    if not args.ignore_readgroups:
+        for (key, _, _), value in totals.items():
+            if key == "<NA>" and value:
+                break
+        else:
+            for key in list(totals):
+                if key[0] == "<NA>":
+                    totals.pop(key)
+
 
+def merge_totals(totals, partial_totals):
+    """Adds counts from a dictionary of totals (see 'build_totals_dict') to
+    another, taking into account that keys may share the same counts."""
+    merged = set()
+    for (key, counts) in totals.items():
+        if id(counts) not in merged:
+            merged.add(id(counts))
+            for (depth, count) in partial_totals[key].items():
+                counts[depth] += count
+
+
+def process_regions(handle, args, regions, timer):
     last_tid = 0
     totals = build_totals_dict(args, handle)
     rg_to_smlbid, smlbid_to_smlb = build_rg_to_smlbid_keys(args, handle)
-    template = [0] * len(smlbid_to_smlb)
 
-    for region in BAMRegionsIter(handle, args.regions):
+    for (region, rois) in iterate_regions(handle, regions):
         if region.name is None:
             # Trailing unmapped reads
             break
-        elif not args.regions and (handle.nreferences > args.max_contigs):
-            region.name = "<Genome>"
-
-        last_pos = 0
-        counts = collections.deque()
-        mapping = MappingToTotals(totals, region, smlbid_to_smlb)
-        for (position, records) in region:
-            mapping.process_counts(counts, last_pos, position)
+        elif rois is None:
+            if handle.nreferences > args.max_contigs:
+                region.name = "<Genome>"
 
-            for record in records:
-                timer.increment(read=record)
-                count_bases(args, counts, record, rg_to_smlbid, template)
+            mapping = MappingToTotals(totals, region, smlbid_to_smlb)
+            positions = _process_contig(args, region, mapping, rg_to_smlbid, timer)
+        else:
+            positions = _process_rois(
+                args, region, rois, totals, rg_to_smlbid, smlbid_to_smlb, timer
+            )
 
+        last_pos = 0
+        for position in positions:
             if (region.tid, position) < (last_tid, last_pos):
-                sys.stderr.write("ERROR: Input BAM file is unsorted\n")
-                return 1
+                raise BAMStatsError("Input BAM file is unsorted")
 
             last_pos = position
             last_tid = region.tid
 
-        # Process columns in region after last read
-        mapping.process_counts(counts, last_pos, float("inf"))
-        mapping.finalize()
-    timer.finalize()
+    return totals
 
-    if not args.ignore_readgroups:
-        # Exclude counts for reads with no read-groups, if none such were seen
-        for (key, _, _), value in totals.items():
-            if key == "<NA>" and value:
-                break
-        else:
-            for key in list(totals):
-                if key[0] == "<NA>":
-                    totals.pop(key)
 
+def _process_contig(args, region, mapping, rg_to_smlbid, timer):
+    for (position, records) in region:
+        mapping.process_counts(position)
+
+        for record in records:
+            # Reads overlapping multiple windows (see 'map_regions') are only
+            # counted towards progress in the window in which they start
+            if position >= region.start:
+                timer.increment(read=record)
+            count_bases(args, mapping, record, rg_to_smlbid)
+
+        yield position
+
+    # Process columns in region after last read
+    mapping.process_counts(float("inf"))
+    mapping.finalize()
+
+
+def _process_rois(args, region, rois, totals, rg_to_smlbid, smlbid_to_smlb, timer):
+    mapping = MappingToRegions(totals, rois, smlbid_to_smlb)
+    for (position, records) in region:
+        mapping.process_counts(position)
+
+        for record in records:
+            timer.increment(read=record)
+            count_bases(args, mapping, record, rg_to_smlbid)
+
+        yield position
+
+    mapping.process_counts(float("inf"))
+    mapping.finalize()
+
+
+def process_file(handle, args):
+    try:
+        results = map_regions(handle, args, process_regions)
+    except BAMStatsError as error:
+        sys.stderr.write("ERROR: %s\n" % (error,))
+        return 1
+
+    totals = build_totals_dict(args, handle)
+    for partial_totals in results:
+        merge_totals(totals, partial_totals)
+
+    exclude_missing_readgroups(args, totals)
     print_table(handle, args, totals)
 
     return 0
@@ -0,0 +1,353 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""paleomix rmdup [options] in_1.bam [in_2.bam ...] > out.bam
+
+The rmdup command merges one or more BAM files sorted by coordinates, and marks
+or filters PCR duplicates among the merged reads in the same pass, using the
+approach of 'paleomix rmdup_collapsed'. Unlike rmdup_collapsed, reads are not
+assumed to represent complete templates, and PCR duplicates are instead
+identified similarly to Picard MarkDuplicates:
+
+Single-end reads and reads with unmapped mates are considered duplicates if
+they share the same (unclipped) 5' position and orientation. Paired reads are
+considered duplicates if both mates share the same (unclipped) 5' positions and
+orientations, where the 5' position of the mate is determined using the mate
+CIGAR (MC) tag, as set by 'samtools fixmate' and 'paleomix cleanup'. The best
+read is selected as in rmdup_collapsed; for pairs, only the mate encountered
+first in the merged files is considered, and the other mate is marked the same
+as that mate. Unlike Picard, single-end reads are only compared to other
+single-end reads.
+
+Unmapped reads (0x4), secondary alignments (0x100), reads that failed QC
+(0x200), and chimeric alignments (0x800), as identified using the BAM record
+flags, are not filtered, but simply written to the output.
+
+By default, filtered reads are flagged using the "duplicate" flag (0x400), and
+written to the output. Use the --remove-duplicates command-line option to
+instead remove these records from the output.
+"""
+import contextlib
+import heapq
+import random
+import re
+import sys
+
+from argparse import ArgumentParser
+
+import pysam
+
+from paleomix.tools.rmdup_collapsed import (
+    add_to_group,
+    clipped_bases_at_front,
+    process,
+    unclipped_alignment_coordinates,
+)
+
+
+_FILTERED_FLAGS = 0x4  # Unmapped
+_FILTERED_FLAGS |= 0x100  # Secondary alignment
+_FILTERED_FLAGS |= 0x200  # Failed QC
+_FILTERED_FLAGS |= 0x800  # Chimeric alignment
+
+# Mask used to identify PE reads (0x1) with mapped mates (0x8)
+_PAIRED_MASK = 0x1 | 0x8
+# Mask used to identify primary alignments
+_NOT_PRIMARY = 0x100 | 0x800
+
+_CIGAR_OPERATIONS = "MIDNSHP=X"
+_CIGAR_REGEX = re.compile(r"(\d+)([MIDNSHP=X])")
+# CIGAR operations consuming reference bases (M, D, N, =, and X)
+_CIGAR_CONSUMES_REFERENCE = frozenset((0, 2, 3, 7, 8))
+
+# Default max number of reads kept in memory while waiting to be written
+_MAX_CACHED_READS = 100000
+
+
+class MateTracker:
+    """Identifies PCR duplicates among single-end and paired reads. Only the mate
+    of each pair that is encountered first is used when identifying duplicates,
+    and the other mate is marked the same as the first mate. Methods are used with
+    'paleomix.tools.rmdup_collapsed.process'.
+    """
+
+    def __init__(self):
+        # Duplicate status of first mates, for which the other mate is pending
+        self._first_mates = {}
+
+    def process_read(self, duplicates_by_alignment, read):
+        flag = read.flag
+        if flag & _FILTERED_FLAGS:
+            return (None, 0)
+
+        is_paired = flag & _PAIRED_MASK == 0x1
+        if is_paired and not is_first_mate(read):
+            # The status of this read is determined by the status of the first mate
+            return (None, 0)
+
+        alignment = read_five_prime_end(read)
+        end = last_start_position(alignment, read.infer_read_length())
+
+        if is_paired:
+            mate_alignment = mate_five_prime_end(read)
+            mate_end = last_start_position(mate_alignment, read.infer_read_length())
+
+            # The order of mates in the key must not depend on which is seen first
+            alignment = (min(alignment, mate_alignment), max(alignment, mate_alignment))
+            end = min(end, mate_end)
+
+        return add_to_group(duplicates_by_alignment, read, alignment, end)
+
+    def write_read(self, args, out, read, group, index):
+        flag = read.flag
+        if group is not None:
+            if group.best is None:
+                group.select_best_read()
+
+            read.is_duplicate = index != group.best
+            if flag & _PAIRED_MASK == 0x1:
+                self._first_mates[read.query_name] = read.is_duplicate
+        elif flag & _PAIRED_MASK == 0x1 and not flag & _NOT_PRIMARY:
+            is_duplicate = self._first_mates.pop(read.query_name, None)
+            if is_duplicate is not None:
+                read.is_duplicate = is_duplicate
+
+        if not (args.remove_duplicates and read.is_duplicate):
+            out.write(read)
+
+
+class MergedFiles:
+    """Iterates over the reads in one or more BAM files sorted by coordinates,
+    yielding reads sorted by coordinates; as for AlignmentFile objects, iterating
+    over the files continues from the last read returned.
+    """
+
+    def __init__(self, handles):
+        self.header = merge_headers([handle.header for handle in handles])
+        self._reads = heapq.merge(*handles, key=_get_sort_key)
+
+    def __iter__(self):
+        return self._reads
+
+
+def merge_headers(headers):
+    """Merges the headers of BAM files, which must contain the same reference
+    sequences. Read-groups, programs, and comments are combined, and programs
+    with conflicting IDs are renamed, similar to 'samtools merge'. Returns the
+    merged header as a dict.
+    """
+    merged = headers[0].to_dict()
+    sequences = _get_sequences(merged)
+    read_groups = {value["ID"]: value for value in merged.get("RG", ())}
+    programs = {value["ID"]: value for value in merged.get("PG", ())}
+    comments = set(merged.get("CO", ()))
+
+    for header in headers[1:]:
+        header = header.to_dict()
+        if _get_sequences(header) != sequences:
+            raise ValueError("BAM files contain different reference sequences")
+
+        for read_group in header.get("RG", ()):
+            existing = read_groups.get(read_group["ID"])
+            if existing is None:
+                read_groups[read_group["ID"]] = read_group
+                merged.setdefault("RG", []).append(read_group)
+            elif existing != read_group:
+                raise ValueError("Conflicting read-groups %r" % (read_group["ID"],))
+
+        renamed = {}
+        for program in header.get("PG", ()):
+            program = dict(program)
+            if "PP" in program:
+                program["PP"] = renamed.get(program["PP"], program["PP"])
+
+            if programs.get(program["ID"]) == program:
+                continue
+
+            program_id = program["ID"]
+            for idx in range(1, len(programs) + 2):
+                if program_id not in programs:
+                    break
+
+                program_id = "%s-%i" % (program["ID"], idx)
+
+            renamed[program["ID"]] = program_id
+            program["ID"] = program_id
+            programs[program_id] = program
+            merged.setdefault("PG", []).append(program)
+
+        for comment in header.get("CO", ()):
+            if comment not in comments:
+                comments.add(comment)
+                merged.setdefault("CO", []).append(comment)
+
+    return merged
+
+
+def is_first_mate(read):
+    """Returns true if a paired read is encountered before its mate in a BAM file
+    sorted by coordinates; for mates mapped to the same position, the first mate
+    is assumed to be encountered first.
+    """
+    position = (read.reference_id, read.reference_start)
+    mate_position = (read.next_reference_id, read.next_reference_start)
+    if position != mate_position:
+        return position < mate_position
+
+    return read.is_read1
+
+
+def read_five_prime_end(read):
+    """Returns the (reference ID, orientation, unclipped 5' position) of a read."""
+    reference_id, is_reverse, start, end = unclipped_alignment_coordinates(read)
+
+    return (reference_id, is_reverse, end if is_reverse else start)
+
+
+def mate_five_prime_end(read):
+    """Returns the (reference ID, orientation, unclipped 5' position) of the mate
+    of a read, using the mate CIGAR (MC) tag. If the MC tag is not set, the mate is
+    assumed to have no clipped bases, and the position of reverse mates is taken to
+    be their alignment start.
+    """
+    is_reverse = read.mate_is_reverse
+    position = read.next_reference_start
+    if read.has_tag("MC"):
+        cigartuples = [
+            (_CIGAR_OPERATIONS.index(operation), int(length))
+            for (length, operation) in _CIGAR_REGEX.findall(read.get_tag("MC"))
+        ]
+
+        if is_reverse:
+            for (operation, length) in cigartuples:
+                if operation in _CIGAR_CONSUMES_REFERENCE:
+                    position += length
+
+            position += clipped_bases_at_front(reversed(cigartuples))
+        else:
+            position -= clipped_bases_at_front(cigartuples)
+
+    return (read.next_reference_id, is_reverse, position)
+
+
+def last_start_position(alignment, read_length):
+    """Returns the last (reference ID, position) at which a read with the given
+    5' end may start; for forward reads, this assumes that duplicates have no more
+    clipped bases than the length of the current read.
+    """
+    reference_id, is_reverse, position = alignment
+    if not is_reverse:
+        position += read_length
+
+    return (reference_id, position)
+
+
+def _get_sequences(header):
+    return [(value["SN"], value["LN"]) for value in header.get("SQ", ())]
+
+
+def _get_sort_key(read):
+    # Unmapped reads without coordinates (-1, -1) are placed last
+    reference_id = read.reference_id
+
+    return (reference_id < 0, reference_id, read.reference_start)
+
+
+def parse_args(argv):
+    parser = ArgumentParser(usage=__doc__)
+    parser.add_argument(
+        "input",
+        nargs="+",
+        help="One or more BAM files sorted by coordinates.",
+    )
+    parser.add_argument(
+        "--remove-duplicates",
+        help="Remove duplicates from output; by default "
+        "duplicates are only flagged (flag = 0x400).",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-cached-reads",
+        default=_MAX_CACHED_READS,
+        type=int,
+        help="Max number of reads kept in memory while waiting for PCR duplicates "
+        "to be identified; additional reads are written to temporary files. This "
+        "limits memory usage in regions with very deep coverage [%(default)s].",
+    )
+    parser.add_argument(
+        "--temp-directory",
+        default=None,
+        help="Directory in which to write temporary files; defaults to the "
+        "system temporary directory.",
+    )
+    parser.add_argument(
+        "--threads",
+        default=1,
+        type=int,
+        help="Number of threads used to compress the output BAM file "
+        "[%(default)s].",
+    )
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="Seed used for randomly selecting representative "
+        "reads when no reads have quality scores assigned"
+        "[default: initialized using system time].",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    # Initialize seed used when selecting among reads without quality scores
+    random.seed(args.seed)
+
+    if sys.stdout.isatty():
+        sys.stderr.write("STDOUT is a terminal, terminating!\n")
+        return 1
+
+    with contextlib.ExitStack() as stack:
+        handles = []
+        for filename in args.input:
+            handles.append(stack.enter_context(pysam.AlignmentFile(filename, "rb")))
+
+        try:
+            infile = MergedFiles(handles)
+        except ValueError as error:
+            sys.stderr.write("ERROR: %s\n" % (error,))
+            return 1
+
+        outfile = stack.enter_context(
+            pysam.AlignmentFile("-", "wb", header=infile.header, threads=args.threads)
+        )
+
+        tracker = MateTracker()
+
+        return process(args, infile, outfile, tracker.process_read, tracker.write_read)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
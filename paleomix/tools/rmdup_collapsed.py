@@ -19,10 +19,16 @@ using the BAM record flags, are not filtered, but simply written to the output.
 By default, filtered reads are flagged using the "duplicate" flag (0x400), and
 written to the output. Use the --remove-duplicates command-line option to
 instead remove these records from the output.
+
+Reads are kept in memory until all possible duplicates have been seen; in
+regions with very deep coverage, reads beyond the number set using the
+--max-cached-reads option are instead written to temporary files.
 """
 import collections
+import os
 import random
 import sys
+import tempfile
 
 from argparse import ArgumentParser
 
@@ -39,32 +45,69 @@ _CIGAR_SOFTCLIP = 4
 _CIGAR_HARDCLIP = 5
 
 
-def read_quality(read):
-    qualities = read.query_alignment_qualities
-    if qualities is None:
-        # Generate value in range (-1; 0]
-        return -random.random()
+# Default max number of reads kept in memory while waiting to be written
+_MAX_CACHED_READS = 100000
 
-    return sum(qualities)
 
+class DuplicateGroup:
+    """Reads sharing the same (unclipped) alignment. Rather than keeping every
+    read in memory until the best read can be selected, duplicates are recorded
+    as (cigar, quality, copy number) tuples, and the index of each read in the
+    group is used to determine if it is a duplicate once the best read has been
+    selected. The first read is kept as is, as most reads have no duplicates.
+    """
 
-def copy_number(read):
-    # has_tag is faster than try/except, since most reads lack the tag.
-    if read.has_tag("XP"):
-        return read.get_tag("XP")
+    def __init__(self, alignment, read, end):
+        self.alignment = alignment
+        # Last position (reference ID, position) at which reads in this group may
+        # start; the group is complete once reads past this position have been read
+        self.end = end
+        self._first_read = read
+        self._reads = None
+        # Index of the best read and the total number of copies, once selected
+        self.best = None
+        self.copies = None
+
+    def add_read(self, read):
+        """Records a duplicate read and returns its index in the group."""
+        if self._reads is None:
+            self._reads = [self._describe_read(self._first_read)]
+            self._first_read = None
+
+        self._reads.append(self._describe_read(read))
+
+        return len(self._reads) - 1
+
+    def select_best_read(self):
+        if self._reads is None:
+            self.best, self.copies = 0, 1
+        else:
+            self.best, self.copies = select_best_read(self._reads)
 
-    return 0
+        # Reads are no longer needed, and may be numerous in pile-ups
+        self._first_read = self._reads = None
 
+    @classmethod
+    def _describe_read(cls, read):
+        # has_tag is faster than try/except, since most reads lack the tag.
+        copies = read.get_tag("XP") if read.has_tag("XP") else 0
+        # Reads lacking qualities are assigned a random quality when selecting
+        # the best read (see 'select_best_read')
+        qualities = read.query_alignment_qualities
+        quality = None if qualities is None else sum(qualities)
 
-def mark_duplicate_reads(reads):
-    """Identifies the best read from a set of PCR duplicates, and marks all
-    other reads as duplicates. The best read is selected by quality, among the
-    reads sharing the most common CIGAR string.
+        return (tuple(read.cigartuples), quality, copies)
+
+
+def select_best_read(reads):
+    """Identifies the best read from a set of PCR duplicates, represented as
+    (cigar, quality, copy number) tuples, and returns the index of that read
+    and the total number of copies. The best read is selected by quality, among
+    the reads sharing the most common CIGAR string.
     """
     by_cigar = collections.defaultdict(list)
-    for read in reads:
-        key = tuple(read.cigartuples)
-        by_cigar[key].append(read)
+    for (index, (cigar, quality, copies)) in enumerate(reads):
+        by_cigar[cigar].append((index, quality, copies))
 
     # Select the most common CIGAR strings, favoring simple CIGARs
     best_count, best_cigar_len = max(
@@ -74,55 +117,120 @@ def mark_duplicate_reads(reads):
 
     best_read = None
     best_quality = -1
-    copies = len(reads)
+    total_copies = len(reads)
 
     for cigar, candidates in by_cigar.items():
         if len(cigar) == best_cigar_len and len(candidates) == best_count:
-            for read in candidates:
-                copies += copy_number(read)
-                quality = read_quality(read)
+            for (index, quality, copies) in candidates:
+                total_copies += copies
+                if quality is None:
+                    # Generate value in range (-1; 0]
+                    quality = -random.random()
 
                 if quality > best_quality:
-                    best_read = read
+                    best_read = index
                     best_quality = quality
         else:
-            copies += sum(copy_number(read) for read in candidates)
+            total_copies += sum(copies for (_, _, copies) in candidates)
 
-    best_read.set_tag("XP", copies, "i")
-    for read in reads:
-        read.is_duplicate = read is not best_read
+    return best_read, total_copies
 
 
-def write_read(args, out, read_and_alignment, duplicates_by_alignment):
-    read, alignment = read_and_alignment
-    if alignment is not None:
-        duplicates = duplicates_by_alignment.pop(alignment)
+class SpillQueue:
+    """First-in-first-out queue of reads stored in temporary, uncompressed BAM
+    files in 'temp_dir', using the given header; used to limit the number of
+    reads kept in memory.
+    """
 
-        if len(duplicates) > 1:
-            # Select the best read and mark the others as duplicates.
-            mark_duplicate_reads(duplicates)
-        else:
-            duplicates[0].is_duplicate = False
-            duplicates[0].set_tag("XP", 1, "i")
+    def __init__(self, header, temp_dir=None):
+        self._header = header
+        self._temp_dir = temp_dir
+        self._files = collections.deque()
+
+    def append(self, read):
+        files = self._files
+        if not (files and files[-1].writable):
+            files.append(_SpillFile(self._header, self._temp_dir))
+
+        files[-1].append(read)
+
+    def popleft(self):
+        files = self._files
+        read = files[0].popleft()
+        if not files[0]:
+            files.popleft()
+
+        return read
+
+    def close(self):
+        """Removes any temporary files; the queue must not be used afterwards."""
+        while self._files:
+            self._files.popleft().close()
+
+
+class _SpillFile:
+    """Temporary BAM file used by SpillQueue; reads may be appended until the
+    first read is popped, after which reads are read back in the same order."""
+
+    def __init__(self, header, temp_dir):
+        handle, self._filename = tempfile.mkstemp(suffix=".bam", dir=temp_dir)
+        os.close(handle)
+
+        self._handle = pysam.AlignmentFile(self._filename, "wbu", header=header)
+        self._count = 0
+        self.writable = True
+
+    def append(self, read):
+        self._handle.write(read)
+        self._count += 1
+
+    def popleft(self):
+        if self.writable:
+            self._handle.close()
+            self._handle = pysam.AlignmentFile(self._filename, "rb", check_sq=False)
+            self.writable = False
+
+        read = next(self._handle)
+        self._count -= 1
+        if not self._count:
+            self.close()
+
+        return read
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+            os.remove(self._filename)
+
+    def __len__(self):
+        return self._count
+
+
+def write_read(args, out, read, group, index):
+    if group is not None:
+        if group.best is None:
+            group.select_best_read()
+
+        read.is_duplicate = index != group.best
+        if index == group.best:
+            read.set_tag("XP", group.copies, "i")
 
     if not (args.remove_duplicates and read.is_duplicate):
         out.write(read)
 
 
-def can_write_read(read_and_alignment, current_position):
+def can_write_read(read_group_and_index, current_position):
     """Returns true if the first read in the cache can safely be written. This
     will be the case if the read was not the first in a set of reads with the
     same alignment, or if the current position has gone beyond the last base
     covered in that alignment.
     """
-    _, alignment = read_and_alignment
-    if alignment is None:
+    _, group, index = read_group_and_index
+    if group is None or index:
         return True
 
-    current_ref_id, current_ref_start = current_position
-    alignment_ref_id, _, _, alignment_ref_end = alignment
-
-    return alignment_ref_id != current_ref_id or alignment_ref_end < current_ref_start
+    return group.end < current_position
 
 
 def clipped_bases_at_front(cigartuples):
@@ -149,28 +257,62 @@ def unclipped_alignment_coordinates(read):
     return (read.reference_id, read.is_reverse, start, end)
 
 
-def process_aligned_read(cache, duplicates_by_alignment, read):
-    """Processes an aligned read, either pairing it with an existing read, or
-    creating a new alignment block to track copies of this copies.
+def add_to_group(duplicates_by_alignment, read, alignment, end):
+    """Adds a read to the group of reads with the given alignment, creating a new
+    group if there are no previous reads with this alignment. Returns the group
+    of reads with this alignment and the index of the read in the group.
     """
-    alignment = unclipped_alignment_coordinates(read)
-
-    try:
-        duplicates_by_alignment[alignment].append(read)
-        cache.append((read, None))
-    except KeyError:
+    group = duplicates_by_alignment.get(alignment)
+    if group is None:
         # No previous reads with matching alignment; this read will
         # serve to track any other reads with the same alignment.
-        duplicates_by_alignment[alignment] = [read]
-        cache.append((read, alignment))
+        group = DuplicateGroup(alignment, read, end)
+        duplicates_by_alignment[alignment] = group
+
+        return (group, 0)
+
+    return (group, group.add_read(read))
+
+
+def process_aligned_read(duplicates_by_alignment, read):
+    """Processes a read, either pairing it with an existing read, or creating a
+    new alignment block to track copies of this read, if the read is an aligned,
+    collapsed read. Returns the group of reads with this alignment and the index
+    of the read in the group, or (None, 0) for reads that are not considered
+    when identifying PCR duplicates (see _FILTERED_FLAGS).
+    """
+    if read.flag & _FILTERED_FLAGS:
+        return (None, 0)
+
+    alignment = unclipped_alignment_coordinates(read)
+    ref_id, _, _, end = alignment
+
+    return add_to_group(duplicates_by_alignment, read, alignment, (ref_id, end))
 
 
 def is_trailing_unmapped_read(read):
     return read.is_unmapped and read.reference_id == -1 and read.reference_start == -1
 
 
-def process(args, infile, outfile):
+def process(args, infile, outfile, process_read=process_aligned_read, write=write_read):
+    """Marks or removes duplicates among reads in 'infile', writing reads to
+    'outfile'. Reads are grouped using 'process_read' (see 'process_aligned_read'),
+    and written using 'write' (see 'write_read'), once the best read in each group
+    of duplicates has been identified.
+    """
+    spill_queue = SpillQueue(infile.header, args.temp_directory)
+    try:
+        return _process(args, infile, outfile, spill_queue, process_read, write)
+    finally:
+        spill_queue.close()
+
+
+def _process(args, infile, outfile, spill_queue, process_read, write):
+    # Reads waiting to be written as (read, group, index in group) tuples. Reads
+    # past the max number of cached reads are stored in 'spill_queue' instead
     cache = collections.deque()
+    cached_reads = 0
+    max_cached_reads = args.max_cached_reads
     duplicates_by_alignment = {}
     last_position = (0, 0)
     read_num = 1
@@ -186,19 +328,40 @@ def process(args, infile, outfile):
                 )
                 return 1
 
-            cache.append((read, None))
+            cache.append((read, None, 0))
             break
-        elif read.flag & _FILTERED_FLAGS:
-            cache.append((read, None))
+
+        group, index = process_read(duplicates_by_alignment, read)
+
+        if cached_reads < max_cached_reads:
+            cache.append((read, group, index))
+            cached_reads += 1
         else:
-            process_aligned_read(cache, duplicates_by_alignment, read)
+            spill_queue.append(read)
+            cache.append((None, group, index))
 
         last_position = current_position
         while cache and can_write_read(cache[0], current_position):
-            write_read(args, outfile, cache.popleft(), duplicates_by_alignment)
+            read, group, index = cache.popleft()
+            if read is None:
+                read = spill_queue.popleft()
+            else:
+                cached_reads -= 1
+
+            if group is not None and not index:
+                duplicates_by_alignment.pop(group.alignment)
+
+            write(args, outfile, read, group, index)
 
     while cache:
-        write_read(args, outfile, cache.popleft(), duplicates_by_alignment)
+        read, group, index = cache.popleft()
+        if read is None:
+            read = spill_queue.popleft()
+
+        if group is not None and not index:
+            duplicates_by_alignment.pop(group.alignment)
+
+        write(args, outfile, read, group, index)
 
     assert not duplicates_by_alignment, duplicates_by_alignment
 
@@ -230,6 +393,27 @@ def parse_args(argv):
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "--max-cached-reads",
+        default=_MAX_CACHED_READS,
+        type=int,
+        help="Max number of reads kept in memory while waiting for PCR duplicates "
+        "to be identified; additional reads are written to temporary files. This "
+        "limits memory usage in regions with very deep coverage [%(default)s].",
+    )
+    parser.add_argument(
+        "--temp-directory",
+        default=None,
+        help="Directory in which to write temporary files; defaults to the "
+        "system temporary directory.",
+    )
+    parser.add_argument(
+        "--threads",
+        default=1,
+        type=int,
+        help="Number of threads used to compress / decompress BAM files "
+        "[%(default)s].",
+    )
     parser.add_argument(
         "--seed",
         default=None,
@@ -255,8 +439,10 @@ def main(argv):
         sys.stderr.write("STDOUT is a terminal, terminating!\n")
         return 1
 
-    with pysam.AlignmentFile(args.input, "rb") as infile:
-        with pysam.AlignmentFile("-", "wb", template=infile) as outfile:
+    with pysam.AlignmentFile(args.input, "rb", threads=args.threads) as infile:
+        with pysam.AlignmentFile(
+            "-", "wb", template=infile, threads=args.threads
+        ) as outfile:
             return process(args, infile, outfile)
 
     return 0
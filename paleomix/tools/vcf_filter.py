@@ -28,6 +28,7 @@ import pysam
 
 import paleomix
 import paleomix.common.vcffilter as vcffilter
+import paleomix.common.vcfwrap as vcfwrap
 
 from paleomix.common.fileutils import open_ro
 
@@ -56,6 +57,42 @@ def _read_files(args):
                     print(line.decode("utf-8"), end="")
 
 
+def _read_variant_files(args, handles):
+    header = handles[0].header
+    for handle in handles:
+        for record in handle:
+            if handle.header is not header:
+                record.translate(header)
+
+            if args.reset_filter:
+                record.filter.clear()
+
+            yield vcfwrap.VariantRecord(record)
+
+
+def _filter_variant_files(args):
+    handles = []
+    try:
+        for filename in args.filenames or ["-"]:
+            handles.append(pysam.VariantFile(filename))
+
+        # Filters are added to the header used for reading, so that these can be
+        # added to records without translating the records to a new header
+        header = handles[0].header
+        for (key, description) in sorted(vcffilter.describe_filters(args).items()):
+            if key not in header.filters:
+                header.filters.add(key, None, None, description)
+
+        mode = "wb" if args.output.lower().endswith(".bcf") else "wz"
+        with pysam.VariantFile(args.output, mode, header=header) as output:
+            for vcf in vcffilter.filter_vcfs(args, _read_variant_files(args, handles)):
+                vcf.update_filter()
+                output.write(vcf.record)
+    finally:
+        for handle in handles:
+            handle.close()
+
+
 def main(argv):
     parser = argparse.ArgumentParser(prog="paleomix vcf_filter")
 
@@ -81,12 +118,25 @@ def main(argv):
         "added to these.",
     )
 
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="Write filtered records to FILE as a BGZF compressed VCF file, or as a "
+        "BCF file if FILE ends with '.bcf'. Input files are read using htslib and "
+        "may be VCF or BCF files, optionally BGZF compressed. If not set, records "
+        "are written to STDOUT as uncompressed VCF",
+    )
+
     vcffilter.add_varfilter_options(parser)
     args = parser.parse_args(argv)
 
     if (not args.filenames or "-" in args.filenames) and sys.stdin.isatty():
         parser.error("STDIN is a terminal, terminating!")
 
+    if args.output is not None:
+        _filter_variant_files(args)
+        return 0
+
     try:
         for vcf in vcffilter.filter_vcfs(args, _read_files(args)):
             print(vcf)
@@ -48,13 +48,12 @@ import pysam
 import paleomix.common.vcfwrap as vcfwrap
 import paleomix.common.text as text
 import paleomix.common.sequences as sequences
-import paleomix.common.utilities as utilities
 
 from paleomix.common.bedtools import BEDRecord
 
 
 # Max number of positions to keep in memory / genotype at once
-_SEQUENCE_CHUNK = 1024 * 1024  # 1kbp
+_SEQUENCE_CHUNK = 1024 * 1024  # 1Mbp
 # Number of columns per line in FASTA sequences
 _FASTA_COLUMNS = 60
 
@@ -66,17 +65,33 @@ _VCF_DICT = re.compile("##(.*)=<(.*)>")
 # Utility functions
 
 
-def flush_fasta(sequence):
+def flush_fasta(sequence, remainder=""):
     """Takes a FASTA sequence as a string, fragments it into lines of exactly
-    _FASTA_COLUMNS chars (e.g. 60), and prints all complete lines. The final
-    incomplete line (if any) is returned.
+    _FASTA_COLUMNS chars (e.g. 60), and prints all complete lines in a single
+    write. The 'remainder' is an incomplete line returned by a previous call,
+    which is completed using the start of 'sequence'. The final incomplete line
+    (if any) is returned.
 
     """
-    for seq_frag in utilities.fragment(_FASTA_COLUMNS, sequence):
-        if len(seq_frag) < _FASTA_COLUMNS:
-            return seq_frag
-        print(seq_frag)
-    return ""
+    lines = []
+    start = 0
+    if remainder:
+        start = _FASTA_COLUMNS - len(remainder)
+        if len(sequence) < start:
+            return remainder + sequence
+
+        lines.append(remainder + sequence[:start])
+
+    end = len(sequence) - (len(sequence) - start) % _FASTA_COLUMNS
+    for offset in range(start, end, _FASTA_COLUMNS):
+        lines.append(sequence[offset : offset + _FASTA_COLUMNS])
+
+    if lines:
+        # Trailing empty line to terminate the last line
+        lines.append("")
+        sys.stdout.write("\n".join(lines))
+
+    return sequence[end:]
 
 
 def split_beds(beds, size=_SEQUENCE_CHUNK):
@@ -100,16 +115,74 @@ def split_beds(beds, size=_SEQUENCE_CHUNK):
 # Genotyping functions
 
 
-def add_snp(options, snp, position, sequence):
+class ConsensusBuffer:
+    """Consensus sequence for a region, consisting of one base per position,
+    stored as a bytearray, and a sparse overlay of positions replaced by zero
+    (deletions) or more (insertions) bases. Positions are relative to the start
+    of the buffer.
+    """
+
+    __slots__ = ("_sequence", "_edits")
+
+    def __init__(self, length):
+        self._sequence = bytearray(b"N") * length
+        # Position -> replacement string for positions affected by indels
+        self._edits = {}
+
+    def set_base(self, position, value):
+        if len(value) == 1:
+            self._sequence[position] = ord(value)
+            # Previously added base(s) are replaced
+            if self._edits:
+                self._edits.pop(position, None)
+        else:
+            self._edits[position] = value
+
+    def insert(self, position, what):
+        """Appends the sequence 'what' following the base at 'position'."""
+        current = self._edits.get(position)
+        if current is None:
+            current = chr(self._sequence[position])
+
+        self._edits[position] = current + what
+
+    def delete(self, start, end):
+        """Removes the bases from 'start' to 'end' (past-the-end)."""
+        for position in range(start, end):
+            self._edits[position] = ""
+
+    def to_string(self, start, end):
+        """Returns the consensus sequence from 'start' to 'end' (past-the-end),
+        excluding any bases inserted after the last position."""
+        sequence = self._sequence
+        edits = sorted(key for key in self._edits if start <= key < end)
+        if not edits:
+            return sequence[start:end].decode("latin-1")
+
+        fragments = []
+        for position in edits:
+            fragments.append(sequence[start:position].decode("latin-1"))
+            fragments.append(self._edits[position])
+            start = position + 1
+        fragments.append(sequence[start:end].decode("latin-1"))
+
+        if edits[-1] == end - 1:
+            # Discard insertions after the last position
+            fragments[-2] = fragments[-2][:1]
+
+        return "".join(fragments)
+
+
+def add_snp(options, snp, position, consensus):
     if snp.alt != ".":
         genotype = "".join(vcfwrap.get_ml_genotype(snp, options.nth_sample))
         encoded = sequences.encode_genotype(genotype)
     else:
         encoded = snp.ref
-    sequence[position] = encoded
+    consensus.set_base(position, encoded)
 
 
-def add_indel(options, bed, indel, sequence):
+def add_indel(options, bed, indel, consensus):
     if indel.alt == ".":
         return
 
@@ -139,8 +212,7 @@ def add_indel(options, bed, indel, sequence):
                 # Non-codon sized overlap with area of interest
                 return
 
-        for position in range(del_start, del_end):
-            sequence[position - start] = ""
+        consensus.delete(del_start - start, del_end - start)
     elif (len(indel.what) % 3 == 0) or not options.whole_codon_indels_only:
         # parse_indel assumes that the insertion is always the first possible
         # base when multiple positions are possible. As a consequence, the
@@ -151,7 +223,7 @@ def add_indel(options, bed, indel, sequence):
         # It is assumed that the insertion (_) happened thus:
         #  interpretation = A_TTT
         if indel.pos >= start:
-            sequence[indel.pos - start] += indel.what
+            consensus.insert(indel.pos - start, indel.what)
 
 
 def filter_vcfs(genotype, contig, start, end):
@@ -169,25 +241,18 @@ def build_region(options, genotype, bed):
     start = max(0, bed.start - options.padding)
 
     indels = []
-    sequence = ["N"] * (bed.end - start)
+    consensus = ConsensusBuffer(bed.end - start)
     for vcf in filter_vcfs(genotype, bed.contig, start, bed.end):
         if vcfwrap.is_indel(vcf):
             indels.append(vcf)
         else:
-            add_snp(options, vcf, vcf.pos - start, sequence)
+            add_snp(options, vcf, vcf.pos - start, consensus)
 
     if not options.ignore_indels:
         for vcf in indels:
-            add_indel(options, bed, vcf, sequence)
-
-    offset = bed.start - start
-    length = bed.end - bed.start
-    truncated = sequence[offset : offset + length]
-
-    # Discard insertions after the last position
-    truncated[-1] = truncated[-1][:1]
+            add_indel(options, bed, vcf, consensus)
 
-    return "".join(truncated)
+    return consensus.to_string(bed.start - start, bed.end - start)
 
 
 def build_regions(options, genotype, beds, reverse_compl):
@@ -224,7 +289,7 @@ def genotype_genes(options, intervals, genotype):
 
             sequence = ""
             for fragment in fragments:
-                sequence = flush_fasta(sequence + fragment)
+                sequence = flush_fasta(fragment, sequence)
 
             if sequence:
                 print(sequence)
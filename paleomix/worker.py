@@ -0,0 +1,237 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Worker process for running pipeline tasks on other hosts.
+
+Workers connect to a pipeline started with the --listen option and run tasks on
+behalf of that pipeline, until the pipeline terminates. The pipeline and workers
+must share a file-system, and both must have the PALEOMIX_WORKER_KEY environment
+variable set to the same (secret) value, which is used to authenticate workers.
+
+    $ export PALEOMIX_WORKER_KEY=secret
+    $ paleomix worker HOST:PORT --threads 16 --max-memory 64G
+"""
+import argparse
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import sys
+import threading
+import time
+
+from multiprocessing.connection import Client
+
+from paleomix.common.utilities import parse_size
+from paleomix.executors import HEARTBEAT_INTERVAL, get_authkey, parse_address, run_node
+from paleomix.node import NodeUnhandledException
+
+
+class Worker:
+    """Runs nodes received from a pipeline listening at 'address', using at most
+    'threads' threads and 'memory' bytes of memory (None for no limit). Workers
+    may be started before the pipeline, in which case they attempt to connect for
+    up to 'connect_timeout' seconds."""
+
+    def __init__(
+        self,
+        address,
+        authkey,
+        threads,
+        memory=None,
+        heartbeat=HEARTBEAT_INTERVAL,
+        connect_timeout=60,
+    ):
+        self._address = address
+        self._authkey = authkey
+        self._threads = threads
+        self._memory = memory
+        self._heartbeat = heartbeat
+        self._connect_timeout = connect_timeout
+        self._logger = logging.getLogger(__name__)
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Runs nodes until the pipeline closes the connection or is done; returns
+        true if the pipeline shut down normally."""
+        self._conn = self._connect()
+        self._logger.info("Connected to pipeline at %s:%i", *self._address)
+        self._send(
+            (
+                "hello",
+                {
+                    "host": "%s:%i" % (socket.gethostname(), os.getpid()),
+                    "threads": self._threads,
+                    "memory": self._memory,
+                },
+            )
+        )
+
+        heartbeat = threading.Thread(target=self._send_heartbeats, daemon=True)
+        heartbeat.start()
+
+        # Running nodes are terminated along with the worker (see finally clause)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, _handle_sigterm)
+
+        pool = multiprocessing.Pool(self._threads, _init_worker)
+        shutdown = False
+        try:
+            while True:
+                message = self._conn.recv()
+                if message[0] == "run":
+                    _, key, node, config = message
+                    self._logger.info("Running node %s", node)
+                    pool.apply_async(
+                        run_node,
+                        args=(node, config),
+                        callback=functools.partial(self._finished, key),
+                        error_callback=functools.partial(self._failed, key),
+                    )
+                elif message[0] == "shutdown":
+                    shutdown = True
+                    break
+                elif message[0] == "terminate":
+                    break
+                else:
+                    raise ValueError("Unexpected message %r" % (message[0],))
+        except (EOFError, OSError) as error:
+            self._logger.error("Lost connection to pipeline: %s", error)
+        finally:
+            self._stopped.set()
+            if shutdown:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+            self._conn.close()
+
+        return shutdown
+
+    def _connect(self):
+        # The pipeline may not be listening yet, if workers are started first
+        deadline = time.monotonic() + self._connect_timeout
+        while True:
+            try:
+                return Client(self._address, authkey=self._authkey)
+            except ConnectionRefusedError:
+                if time.monotonic() >= deadline:
+                    raise
+
+                time.sleep(1)
+
+    def _finished(self, key, _value):
+        self._report(key, None)
+
+    def _failed(self, key, error):
+        self._report(key, error)
+
+    def _report(self, key, error):
+        try:
+            try:
+                self._send(("finished", key, error))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # The error could not be pickled; send a description instead
+                self._send(("finished", key, NodeUnhandledException(str(error))))
+        except OSError as error:
+            self._logger.error("Could not report finished node: %s", error)
+
+    def _send_heartbeats(self):
+        while not self._stopped.wait(self._heartbeat):
+            try:
+                self._send(("heartbeat",))
+            except OSError:
+                break
+
+    def _send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _handle_sigterm(signum, _frame):
+    sys.exit(-signum)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="paleomix worker",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__,
+    )
+    parser.add_argument(
+        "address",
+        type=parse_address,
+        help="Address (HOST:PORT) of the pipeline, as specified using --listen",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=max(2, multiprocessing.cpu_count()),
+        help="Max number of threads to use in total [%(default)s]",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=None,
+        help="Max amount of memory to use in total, e.g. '64G'; by default, memory "
+        "usage is not limited",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    logger = logging.getLogger(__name__)
+
+    try:
+        authkey = get_authkey()
+    except ValueError as error:
+        logger.error("%s", error)
+        return 1
+
+    worker = Worker(
+        address=args.address,
+        authkey=authkey,
+        threads=args.threads,
+        memory=args.max_memory,
+    )
+
+    try:
+        return 0 if worker.run() else 1
+    except (OSError, multiprocessing.AuthenticationError) as error:
+        logger.error("Could not connect to pipeline: %s", error)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -366,6 +366,26 @@ def test_builder__finalize__calls_atomiccmd():
     ]
 
 
+def test_builder__finalize__memory():
+    builder = AtomicCmdBuilder("echo", memory=1024)
+    assert builder.memory == 1024
+    assert builder.finalize().memory == 1024
+
+
+def test_builder__set_memory():
+    builder = AtomicCmdBuilder("echo")
+    assert builder.memory == 0
+    builder.set_memory(2048)
+    assert builder.finalize().memory == 2048
+
+
+def test_builder__set_memory__after_finalize():
+    builder = AtomicCmdBuilder("echo")
+    builder.finalize()
+    with pytest.raises(AtomicCmdBuilderError):
+        builder.set_memory(2048)
+
+
 ###############################################################################
 ###############################################################################
 # AtomicCmdBuilder: add_multiple_options
@@ -602,6 +622,26 @@ def test_java_builder__default__jre_options__Xmx():
     ]
 
 
+def test_java_builder__memory__default():
+    builder = AtomicJavaCmdBuilder("/path/Foo.jar")
+    assert builder.memory == (4 + 0.5) * 1024 ** 3
+
+
+def test_java_builder__memory__jre_options__Xmx():
+    builder = AtomicJavaCmdBuilder("/path/Foo.jar", jre_options=("-Xmx1024m",))
+    assert builder.memory == 1.5 * 1024 ** 3
+
+
+def test_java_builder__memory__jre_options__multiple_Xmx():
+    builder = AtomicJavaCmdBuilder("/path/Foo.jar", jre_options=("-Xmx1g", "-Xmx2g"))
+    assert builder.memory == 2.5 * 1024 ** 3
+
+
+def test_java_builder__memory__explicit():
+    builder = AtomicJavaCmdBuilder("/path/Foo.jar", memory=1024)
+    assert builder.memory == 1024
+
+
 ###############################################################################
 ###############################################################################
 # AtomicMPICmdBuilder
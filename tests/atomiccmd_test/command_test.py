@@ -103,6 +103,30 @@ def test_atomiccmd__set_cwd__temp_in_out(tmp_path, set_cwd, key):
     assert os.path.abspath(expected) == os.path.abspath(result)
 
 
+###############################################################################
+###############################################################################
+# Constructor: memory
+
+
+def test_atomiccmd__memory__default():
+    assert AtomicCmd("true").memory == 0
+
+
+def test_atomiccmd__memory():
+    assert AtomicCmd("true", memory=1024).memory == 1024
+
+
+def test_atomiccmd__memory__negative():
+    with pytest.raises(ValueError):
+        AtomicCmd("true", memory=-1)
+
+
+@pytest.mark.parametrize("value", ("1024", 1.5, None))
+def test_atomiccmd__memory__invalid_type(value):
+    with pytest.raises(TypeError):
+        AtomicCmd("true", memory=value)
+
+
 ###############################################################################
 ###############################################################################
 # Constructor: Paths / pipes
@@ -72,6 +72,18 @@ def test_atomicsets__properties(cls):
     )
 
 
+def test_parallel_commands__memory():
+    cmd_1 = AtomicCmd("true", memory=1024)
+    cmd_2 = AtomicCmd("true", memory=2048)
+    assert ParallelCmds([cmd_1, cmd_2]).memory == 3072
+
+
+def test_sequential_commands__memory():
+    cmd_1 = AtomicCmd("true", memory=1024)
+    cmd_2 = AtomicCmd("true", memory=2048)
+    assert SequentialCmds([cmd_1, cmd_2]).memory == 2048
+
+
 _NO_CLOBBERING_KWARGS = (
     ({"OUT_A": "/foo/out.txt"}, {"OUT_B": "/bar/out.txt"}),
     ({"OUT_A": "/foo/out.txt"}, {"TEMP_OUT_B": "out.txt"}),
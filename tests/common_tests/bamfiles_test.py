@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+from types import SimpleNamespace
+
+from paleomix.common.bamfiles import (
+    BAM_PCR_DUPLICATE,
+    BAM_READ_IS_UNMAPPED,
+    BAMRegionsIter,
+)
+
+
+class _Handle(list):
+    references = ("chr1", "chr2")
+    lengths = (1000, 2000)
+
+    def fetch(self, contig, start, end):
+        tid = self.gettid(contig)
+        return [
+            record
+            for record in self
+            if record.tid == tid and start <= record.pos < end
+        ]
+
+    def gettid(self, contig):
+        return self.references.index(contig)
+
+
+def _record(tid, pos, flag=0):
+    return SimpleNamespace(tid=tid, pos=pos, flag=flag)
+
+
+def _collect(regions):
+    return [
+        (
+            region.tid,
+            region.name,
+            region.start,
+            region.end,
+            [(position, list(records)) for (position, records) in region],
+        )
+        for region in regions
+    ]
+
+
+###############################################################################
+###############################################################################
+# BAMRegionsIter
+
+
+def test_bam_regions_iter__empty():
+    assert _collect(BAMRegionsIter(_Handle())) == []
+
+
+def test_bam_regions_iter__contigs_and_positions():
+    records = [_record(0, 5), _record(0, 5), _record(0, 7), _record(1, 3)]
+
+    assert _collect(BAMRegionsIter(_Handle(records))) == [
+        (0, "chr1", 0, 1000, [(5, records[:2]), (7, records[2:3])]),
+        (1, "chr2", 0, 2000, [(3, records[3:])]),
+    ]
+
+
+def test_bam_regions_iter__unmapped_reads():
+    records = [_record(0, 5), _record(-1, -1)]
+
+    assert _collect(BAMRegionsIter(_Handle(records), exclude_flags=0)) == [
+        (0, "chr1", 0, 1000, [(5, records[:1])]),
+        (-1, None, 0, None, [(-1, records[1:])]),
+    ]
+
+
+def test_bam_regions_iter__excluded_flags():
+    records = [
+        _record(0, 5, BAM_PCR_DUPLICATE),
+        _record(0, 5),
+        _record(0, 7, BAM_READ_IS_UNMAPPED),
+        _record(1, 3, BAM_PCR_DUPLICATE),
+    ]
+
+    assert _collect(BAMRegionsIter(_Handle(records))) == [
+        (0, "chr1", 0, 1000, [(5, records[1:2])]),
+    ]
+
+
+def test_bam_regions_iter__no_excluded_flags():
+    records = [_record(0, 5, BAM_PCR_DUPLICATE), _record(0, 5)]
+
+    assert _collect(BAMRegionsIter(_Handle(records), exclude_flags=0)) == [
+        (0, "chr1", 0, 1000, [(5, records)]),
+    ]
+
+
+def test_bam_regions_iter__regions():
+    records = [_record(0, 5), _record(0, 50, BAM_PCR_DUPLICATE), _record(1, 30)]
+    regions = [
+        SimpleNamespace(contig="chr1", start=0, end=100, name="A"),
+        SimpleNamespace(contig="chr2", start=10, end=20, name="B"),
+        SimpleNamespace(contig="chr2", start=20, end=40, name="C"),
+    ]
+
+    assert _collect(BAMRegionsIter(_Handle(records), regions)) == [
+        (0, "A", 0, 100, [(5, records[:1])]),
+        (1, "B", 10, 20, []),
+        (1, "C", 20, 40, [(30, records[2:])]),
+    ]
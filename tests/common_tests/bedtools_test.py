@@ -27,8 +27,11 @@ import pytest
 from paleomix.common.bedtools import (
     BEDError,
     BEDRecord,
+    BEDSweep,
+    cluster_bed_records,
     merge_bed_records,
     pad_bed_records,
+    split_bed_records,
 )
 
 ###############################################################################
@@ -400,6 +403,141 @@ def test_merge_records__complex_example__unsorted():
     ]
 
 
+
+###############################################################################
+# cluster_bed_records
+
+
+def test_cluster_records__empty_sequences():
+    assert cluster_bed_records(()) == []
+
+
+def test_cluster_records__overlapping_records():
+    records = [
+        _new_bed_record("chr1", 10, 20, "a"),
+        _new_bed_record("chr1", 15, 30, "b"),
+        _new_bed_record("chr1", 16, 18, "c"),
+        _new_bed_record("chr1", 30, 40, "d"),
+        _new_bed_record("chr1", 41, 50, "e"),
+    ]
+
+    assert cluster_bed_records(records) == [
+        (_new_bed_record("chr1", 10, 40, "chr1"), records[:4]),
+        (_new_bed_record("chr1", 41, 50, "chr1"), records[4:]),
+    ]
+
+
+def test_cluster_records__max_distance():
+    records = [
+        _new_bed_record("chr1", 10, 20, "a"),
+        _new_bed_record("chr1", 25, 30, "b"),
+        _new_bed_record("chr1", 36, 40, "c"),
+    ]
+
+    assert cluster_bed_records(records, max_distance=5) == [
+        (_new_bed_record("chr1", 10, 30, "chr1"), records[:2]),
+        (_new_bed_record("chr1", 36, 40, "chr1"), records[2:]),
+    ]
+
+
+def test_cluster_records__contigs_not_combined():
+    records = [_new_bed_record("chr1", 10, 20, "a"), _new_bed_record("chr2", 5, 30)]
+
+    assert cluster_bed_records(records, max_distance=100) == [
+        (_new_bed_record("chr1", 10, 20, "chr1"), records[:1]),
+        (_new_bed_record("chr2", 5, 30, "chr2"), records[1:]),
+    ]
+
+
+###############################################################################
+# split_bed_records
+
+
+def test_split_records__empty_sequences():
+    assert split_bed_records((), 2) == [[], []]
+
+
+def test_split_records__single_list():
+    records = [_new_bed_record("chr1", 10, 20), _new_bed_record("chr2", 5, 30)]
+
+    assert split_bed_records(records, 1) == [records]
+
+
+def test_split_records__records_split_at_boundaries():
+    records = [_new_bed_record("chr1", 10, 20), _new_bed_record("chr2", 5, 35)]
+
+    assert split_bed_records(records, 3) == [
+        [_new_bed_record("chr1", 10, 20), _new_bed_record("chr2", 5, 8)],
+        [_new_bed_record("chr2", 8, 21)],
+        [_new_bed_record("chr2", 21, 35)],
+    ]
+
+
+def test_split_records__records_not_split_unless_needed():
+    records = [_new_bed_record("chr1", 0, 10), _new_bed_record("chr2", 0, 10)]
+
+    assert split_bed_records(records, 2) == [[records[0]], [records[1]]]
+
+
+def test_split_records__fewer_bases_than_lists():
+    records = [_new_bed_record("chr1", 10, 12)]
+
+    assert split_bed_records(records, 3) == [
+        [],
+        [_new_bed_record("chr1", 10, 11)],
+        [_new_bed_record("chr1", 11, 12)],
+    ]
+
+
+def test_split_records__invalid_count():
+    with pytest.raises(ValueError):
+        split_bed_records([_new_bed_record("chr1", 10, 12)], 0)
+
+
+###############################################################################
+# BEDSweep
+
+
+def test_bed_sweep__overlapping():
+    records = [
+        _new_bed_record("chr1", 10, 20, "a"),
+        _new_bed_record("chr1", 0, 100, "b"),
+        _new_bed_record("chr1", 15, 16, "c"),
+    ]
+    sweep = BEDSweep(records)
+
+    assert sweep.overlapping(0, 10) == (records[1],)
+    assert sweep.overlapping(5, 16) == (records[1], records[0], records[2])
+    assert sweep.overlapping(16, 25) == (records[1], records[0])
+    assert sweep.overlapping(100, 200) == ()
+
+
+def test_bed_sweep__retire():
+    records = [
+        _new_bed_record("chr1", 10, 20, "a"),
+        _new_bed_record("chr1", 12, 14, "b"),
+        _new_bed_record("chr1", 30, 40, "c"),
+    ]
+    sweep = BEDSweep(records)
+
+    assert sweep.overlapping(0, 11) == (records[0],)
+    assert sweep.retire(12) == ()
+    assert sweep.retire(14) == (records[1],)
+    assert sweep.overlapping(14, 20) == (records[0],)
+    assert sweep.retire(20) == (records[0],)
+    assert sweep.retire(float("inf")) == (records[2],)
+    assert sweep.overlapping(50, 60) == ()
+
+
+def test_bed_sweep__duplicate_records():
+    records = [_new_bed_record("chr1", 10, 20, "a"), _new_bed_record("chr1", 10, 20)]
+    sweep = BEDSweep(records)
+
+    result = sweep.overlapping(0, 15)
+    assert result == tuple(records)
+    assert result[0] is records[0] and result[1] is records[1]
+
+
 def _new_bed_record(*args):
     record = BEDRecord()
     record._fields = list(args)
@@ -116,6 +116,38 @@ def test_try_cast__list_to_int():
     assert utils.try_cast([1, 2, 3], int) == [1, 2, 3]
 
 
+###############################################################################
+###############################################################################
+# Tests for 'parse_size'
+
+
+_PARSE_SIZE_VALUES = (
+    ("0", 0),
+    ("1024", 1024),
+    ("1k", 1024),
+    ("1K", 1024),
+    ("768M", 768 * 1024 ** 2),
+    ("4g", 4 * 1024 ** 3),
+    ("2T", 2 * 1024 ** 4),
+)
+
+
+@pytest.mark.parametrize("value, expected", _PARSE_SIZE_VALUES)
+def test_parse_size(value, expected):
+    assert utils.parse_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ("", "G", "-1G", "1.5G", "4X", "4GB"))
+def test_parse_size__invalid_values(value):
+    with pytest.raises(ValueError):
+        utils.parse_size(value)
+
+
+def test_parse_size__non_string():
+    with pytest.raises(TypeError):
+        utils.parse_size(4096)
+
+
 ###############################################################################
 ###############################################################################
 # Tests for 'set_in'
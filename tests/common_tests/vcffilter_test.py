@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import random
+
+from types import SimpleNamespace
+
+import pytest
+
+from paleomix.common.vcffilter import _filter_by_indels
+
+
+def _options(distance_to=3, distance_between=10):
+    return SimpleNamespace(
+        min_distance_to_indels=distance_to,
+        min_distance_between_indels=distance_between,
+    )
+
+
+def _vcf(pos, ref="A", alt="G", qual=30, contig="chr1"):
+    info = "INDEL;DP=10" if len(ref) != len(alt) else "DP=10"
+
+    return SimpleNamespace(
+        contig=contig, pos=pos, ref=ref, alt=alt, qual=str(qual), info=info, filter="."
+    )
+
+
+def _indel(pos, ref="A", alt="AC", qual=30, contig="chr1"):
+    return _vcf(pos, ref, alt, qual, contig)
+
+
+def _filter(vcfs, distance_to=3, distance_between=10):
+    options = _options(distance_to, distance_between)
+    return [vcf.filter for vcf in _filter_by_indels(options, vcfs)]
+
+
+def _filter_naively(vcfs, distance_to=3, distance_between=10):
+    """Filters records by comparing each record with every indel on the contig."""
+    result = []
+    for vcf in vcfs:
+        filters = "."
+        indels = [
+            indel
+            for indel in vcfs
+            if "INDEL" in indel.info and indel.contig == vcf.contig
+        ]
+
+        def _near(position, distance):
+            return [
+                indel
+                for indel in indels
+                if indel.pos + 1 - distance
+                <= position
+                <= indel.pos + distance + len(indel.ref)
+            ]
+
+        if "INDEL" in vcf.info:
+            if distance_between:
+                nearby = _near(vcf.pos + 1, distance_between)
+                best = max(nearby, key=lambda indel: (float(indel.qual), -indel.pos))
+                if best is not vcf:
+                    filters = "W:%i" % (distance_between,)
+        elif vcf.alt != "." and distance_to and _near(vcf.pos, distance_to):
+            filters = "w:%i" % (distance_to,)
+
+        result.append(filters)
+
+    return result
+
+
+###############################################################################
+###############################################################################
+
+
+def test_filter_by_indels__no_records():
+    assert _filter([]) == []
+
+
+def test_filter_by_indels__snps_only():
+    assert _filter([_vcf(10), _vcf(11), _vcf(12, alt=".")]) == [".", ".", "."]
+
+
+def test_filter_by_indels__snps_near_indel():
+    vcfs = [_vcf(7), _vcf(8), _indel(10, ref="ACG", alt="A"), _vcf(16), _vcf(17)]
+
+    assert _filter(vcfs) == [".", "w:3", ".", "w:3", "."]
+
+
+def test_filter_by_indels__non_variant_sites_ignored():
+    vcfs = [_vcf(9, alt="."), _indel(10), _vcf(11, alt=".")]
+
+    assert _filter(vcfs) == [".", ".", "."]
+
+
+def test_filter_by_indels__best_indel_retained():
+    vcfs = [_indel(10, qual=20), _indel(15, qual=40), _indel(20, qual=30)]
+
+    assert _filter(vcfs) == ["W:10", ".", "W:10"]
+
+
+def test_filter_by_indels__ties_broken_by_position():
+    vcfs = [_indel(10), _indel(15), _indel(15, "A", "AT")]
+
+    assert _filter(vcfs) == [".", "W:10", "W:10"]
+
+
+def test_filter_by_indels__distance_of_zero_disables_filters():
+    vcfs = [_vcf(9), _indel(10, qual=20), _indel(11, qual=40)]
+
+    assert _filter(vcfs, 0, 0) == [".", ".", "."]
+
+
+def test_filter_by_indels__contigs_filtered_separately():
+    vcfs = [
+        _indel(10, qual=20),
+        _indel(12, qual=40, contig="chr2"),
+        _vcf(13, contig="chr2"),
+    ]
+
+    assert _filter(vcfs) == [".", ".", "w:3"]
+
+
+def test_filter_by_indels__existing_filters_retained():
+    vcfs = [_vcf(10), _indel(12)]
+    vcfs[0].filter = "q:30"
+
+    assert _filter(vcfs) == ["q:30;w:3", "."]
+
+
+@pytest.mark.parametrize("distances", ((3, 10), (0, 10), (5, 0), (20, 50)))
+def test_filter_by_indels__random_records(distances):
+    rng = random.Random(12345)
+    vcfs = []
+    for contig in ("chr1", "chr2"):
+        pos = 0
+        for _ in range(500):
+            pos += rng.randrange(4)
+            if rng.random() < 0.3:
+                ref, alt = rng.choice((("A", "AC"), ("ACGT", "A"), ("ACG", "A,AC")))
+                vcfs.append(_indel(pos, ref, alt, rng.choice((10, 20)), contig))
+            else:
+                vcfs.append(_vcf(pos, alt=rng.choice(("G", ".")), contig=contig))
+
+    expected = _filter_naively(vcfs, *distances)
+
+    assert _filter(vcfs, *distances) == expected
+    assert expected.count(".") < len(vcfs)
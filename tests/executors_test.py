@@ -0,0 +1,670 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import json
+import math
+import multiprocessing
+import os
+import socket
+import sys
+import textwrap
+import time
+import types
+
+from multiprocessing.connection import Client
+
+import pytest
+
+from paleomix.executors import (
+    BatchExecutor,
+    LocalExecutor,
+    RemoteExecutor,
+    WorkerLostError,
+    get_authkey,
+    parse_address,
+)
+from paleomix.node import Node, NodeError
+from paleomix.pipeline import Pypeline
+from paleomix.worker import Worker
+
+
+_AUTHKEY = b"secret"
+
+
+class _TouchNode(Node):
+    def __init__(self, filename, threads=1, memory=0, sleep=0, dependencies=()):
+        self._filename = filename
+        self._sleep = sleep
+        Node.__init__(
+            self,
+            # Any existing file may be used as input
+            input_files=(__file__,),
+            output_files=(filename,),
+            threads=threads,
+            memory=memory,
+            dependencies=dependencies,
+        )
+
+    def _run(self, _config, _temp):
+        time.sleep(self._sleep)
+        with open(self._filename, "w"):
+            pass
+
+    def _teardown(self, _config, _temp):
+        pass
+
+
+class _FailingNode(Node):
+    def _run(self, _config, _temp):
+        raise NodeError("node failed")
+
+
+class _CrashingNode(Node):
+    def _run(self, _config, _temp):
+        os._exit(1)
+
+
+class _FakePool:
+    def apply_async(self, *_args, **_kwargs):
+        pass
+
+
+def _config(tmp_path):
+    return types.SimpleNamespace(temp_root=str(tmp_path))
+
+
+def _wait_for_node(executor, timeout=30):
+    """Returns the next (key, result) for a finished node, skipping other events."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        key, result = executor.get_finished(False)
+        if key is not None:
+            return key, result
+        time.sleep(0.01)
+
+    raise AssertionError("timeout while waiting for node")
+
+
+def _wait_for(func, timeout=30):
+    deadline = time.time() + timeout
+    while not func():
+        assert time.time() < deadline, "timeout while waiting for condition"
+        time.sleep(0.01)
+
+
+###############################################################################
+###############################################################################
+# parse_address / get_authkey
+
+
+def test_parse_address():
+    assert parse_address("example.com:1234") == ("example.com", 1234)
+    assert parse_address(":1234") == ("0.0.0.0", 1234)
+
+
+@pytest.mark.parametrize("value", ("example.com", "example.com:", "host:port"))
+def test_parse_address__invalid(value):
+    with pytest.raises(ValueError):
+        parse_address(value)
+
+
+def test_get_authkey(monkeypatch):
+    monkeypatch.setenv("PALEOMIX_WORKER_KEY", "secret")
+
+    assert get_authkey() == b"secret"
+
+
+def test_get_authkey__not_set(monkeypatch):
+    monkeypatch.delenv("PALEOMIX_WORKER_KEY", raising=False)
+
+    with pytest.raises(ValueError):
+        get_authkey()
+
+
+###############################################################################
+###############################################################################
+# LocalExecutor
+
+
+def test_local_executor__invalid_limits():
+    with pytest.raises(ValueError):
+        LocalExecutor(max_threads=0)
+    with pytest.raises(ValueError):
+        LocalExecutor(max_memory=0)
+
+
+def test_local_executor__run_nodes(tmp_path):
+    node_1 = _TouchNode(str(tmp_path / "file_1"))
+    node_2 = _FailingNode()
+
+    executor = LocalExecutor(max_threads=2)
+    executor.start()
+    try:
+        for node in (node_1, node_2):
+            assert executor.can_run(node)
+            executor.submit(id(node), node, _config(tmp_path))
+
+        results = dict(executor.get_finished(True) for _ in range(2))
+    finally:
+        executor.close()
+
+    results[id(node_1)].get()
+    with pytest.raises(NodeError):
+        results[id(node_2)].get()
+    assert (tmp_path / "file_1").exists()
+
+
+def test_local_executor__capacity(tmp_path):
+    node_1 = _TouchNode(str(tmp_path / "file_1"), threads=2, memory=4)
+    node_2 = _TouchNode(str(tmp_path / "file_2"), threads=2)
+    node_3 = _TouchNode(str(tmp_path / "file_3"), threads=1, memory=8)
+
+    executor = LocalExecutor(max_threads=3, max_memory=10)
+    executor.start()
+    try:
+        executor.submit(id(node_1), node_1, _config(tmp_path))
+        assert not executor.can_run(node_2)
+        assert not executor.can_run(node_3)
+
+        assert executor.get_finished(True)[0] == id(node_1)
+        assert executor.can_run(node_2)
+        assert executor.can_run(node_3)
+    finally:
+        executor.close()
+
+
+def test_local_executor__oversized_nodes_run_alone(tmp_path):
+    node_1 = _TouchNode(str(tmp_path / "file_1"), threads=8, memory=16)
+    node_2 = _TouchNode(str(tmp_path / "file_2"))
+
+    executor = LocalExecutor(max_threads=2, max_memory=4)
+    executor._pool = _FakePool()
+
+    assert executor.can_run(node_1)
+    executor.submit(id(node_1), node_1, None)
+    assert not executor.can_run(node_2)
+
+
+###############################################################################
+###############################################################################
+# RemoteExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = RemoteExecutor(("127.0.0.1", 0), _AUTHKEY, timeout=5)
+    executor.start()
+    yield executor
+    executor.terminate()
+
+
+def _start_worker(executor, threads, memory=None):
+    worker = Worker(executor.address, _AUTHKEY, threads, memory, heartbeat=0.1)
+    process = multiprocessing.Process(target=worker.run)
+    process.start()
+
+    return process
+
+
+def _connected_threads(executor):
+    return sorted(worker.threads for worker in executor._workers)
+
+
+def test_remote_executor__no_workers(executor):
+    assert not executor.can_run(_TouchNode("/missing"))
+    assert executor.get_finished(False) == (None, None)
+
+
+def test_remote_executor__run_nodes(executor, tmp_path):
+    processes = [_start_worker(executor, 1), _start_worker(executor, 2)]
+    _wait_for(lambda: _connected_threads(executor) == [1, 2])
+
+    nodes = [_TouchNode(str(tmp_path / ("file_%i" % (idx,)))) for idx in range(3)]
+    for node in nodes:
+        assert executor.can_run(node)
+        executor.submit(id(node), node, _config(tmp_path))
+
+    # All threads are in use
+    assert not executor.can_run(_TouchNode(str(tmp_path / "file")))
+
+    results = dict(_wait_for_node(executor) for _ in nodes)
+    for node in nodes:
+        results[id(node)].get()
+        assert os.path.exists(node._filename)
+
+    executor.close()
+    for process in processes:
+        process.join(10)
+        assert process.exitcode == 0
+
+
+def test_remote_executor__failed_nodes(executor, tmp_path):
+    process = _start_worker(executor, 1)
+    _wait_for(lambda: _connected_threads(executor) == [1])
+
+    node = _FailingNode()
+    assert executor.can_run(node)
+    executor.submit(id(node), node, _config(tmp_path))
+
+    key, result = _wait_for_node(executor)
+    assert key == id(node)
+    with pytest.raises(NodeError, match="node failed"):
+        result.get()
+
+    executor.close()
+    process.join(10)
+
+
+def test_remote_executor__capacity(executor, tmp_path):
+    process = _start_worker(executor, 4, memory=8)
+    _wait_for(lambda: _connected_threads(executor) == [4])
+
+    node_1 = _TouchNode(str(tmp_path / "file_1"), threads=2, memory=6, sleep=1)
+    node_2 = _TouchNode(str(tmp_path / "file_2"), threads=1, memory=4)
+    node_3 = _TouchNode(str(tmp_path / "file_3"), threads=2, memory=2)
+
+    assert executor.can_run(node_1)
+    executor.submit(id(node_1), node_1, _config(tmp_path))
+    assert not executor.can_run(node_2)
+    assert executor.can_run(node_3)
+
+    executor.close()
+    process.join(10)
+
+
+def test_remote_executor__lost_worker(executor, tmp_path):
+    process = _start_worker(executor, 1)
+    _wait_for(lambda: _connected_threads(executor) == [1])
+
+    node = _TouchNode(str(tmp_path / "file"), sleep=60)
+    executor.submit(id(node), node, _config(tmp_path))
+    process.terminate()
+    process.join(10)
+
+    key, result = _wait_for_node(executor)
+    assert key == id(node)
+    with pytest.raises(WorkerLostError):
+        result.get()
+    assert _connected_threads(executor) == []
+
+
+def test_remote_executor__worker_lost_before_submit(executor, tmp_path):
+    process = _start_worker(executor, 1)
+    _wait_for(lambda: _connected_threads(executor) == [1])
+
+    node = _TouchNode(str(tmp_path / "file"))
+    assert executor.can_run(node)
+    process.terminate()
+    process.join(10)
+    _wait_for(lambda: _connected_threads(executor) == [])
+
+    executor.submit(id(node), node, _config(tmp_path))
+
+    key, result = _wait_for_node(executor)
+    assert key == id(node)
+    with pytest.raises(WorkerLostError):
+        result.get()
+
+
+def test_remote_executor__missing_heartbeats(tmp_path):
+    executor = RemoteExecutor(("127.0.0.1", 0), _AUTHKEY, timeout=0.5)
+    executor.start()
+    try:
+        # Connection that never sends heartbeats
+        conn = Client(executor.address, authkey=_AUTHKEY)
+        conn.send(("hello", {"host": "silent", "threads": 1, "memory": None}))
+        _wait_for(lambda: _connected_threads(executor) == [1])
+
+        node = _TouchNode(str(tmp_path / "file"))
+        executor.submit(id(node), node, _config(tmp_path))
+
+        key, result = _wait_for_node(executor)
+        assert key == id(node)
+        with pytest.raises(WorkerLostError):
+            result.get()
+        assert _connected_threads(executor) == []
+        conn.close()
+    finally:
+        executor.terminate()
+
+
+def test_remote_executor__wrong_authkey(executor):
+    with pytest.raises(multiprocessing.AuthenticationError):
+        Client(executor.address, authkey=b"wrong key")
+
+    assert _connected_threads(executor) == []
+
+
+def test_remote_executor__memory_reported(executor):
+    conn = Client(executor.address, authkey=_AUTHKEY)
+    conn.send(("hello", {"host": "worker", "threads": 2, "memory": None}))
+    _wait_for(lambda: _connected_threads(executor) == [2])
+
+    (worker,) = executor._workers
+    assert worker.memory == math.inf
+    conn.close()
+
+
+def test_remote_executor__pypeline(tmp_path):
+    # Workers are started before the pipeline starts listening
+    with socket.socket() as handle:
+        handle.bind(("127.0.0.1", 0))
+        address = handle.getsockname()
+
+    processes = []
+    for threads in (1, 2):
+        worker = Worker(address, _AUTHKEY, threads, heartbeat=0.1)
+        processes.append(multiprocessing.Process(target=worker.run))
+        processes[-1].start()
+
+    class _Executor(RemoteExecutor):
+        def start(self):
+            super().start()
+            # Otherwise the pipeline may finish before the second worker connects,
+            # which then keeps retrying until its connection timeout
+            _wait_for(lambda: _connected_threads(self) == [1, 2])
+
+    nodes = [_TouchNode(str(tmp_path / ("file_%i" % (idx,)))) for idx in range(4)]
+    merged = _TouchNode(str(tmp_path / "merged"), threads=2, dependencies=nodes)
+
+    pipeline = Pypeline(
+        config=_config(tmp_path),
+        executor=_Executor(address, _AUTHKEY, timeout=30),
+    )
+    pipeline.add_nodes(merged)
+
+    try:
+        assert pipeline.run()
+        assert (tmp_path / "merged").exists()
+        for process in processes:
+            process.join(30)
+            assert process.exitcode == 0
+    finally:
+        for process in processes:
+            if process.exitcode is None:
+                process.terminate()
+
+
+###############################################################################
+###############################################################################
+# BatchExecutor
+
+# Minimal stand-in for sbatch / squeue / scancel; tasks are run as local processes
+_FAKE_SLURM = """
+import json, os, signal, subprocess, sys
+
+STATE = {state!r}
+os.environ["PYTHONPATH"] = {pythonpath!r}
+
+
+def parse(argv):
+    return dict(arg[2:].split("=", 1) for arg in argv if "=" in arg)
+
+
+def load_jobs():
+    jobs = {{}}
+    for name in os.listdir(STATE):
+        if name.isdigit():
+            with open(os.path.join(STATE, name)) as handle:
+                jobs[name] = json.load(handle)
+    return jobs
+
+
+def is_alive(pid):
+    try:
+        with open("/proc/%i/stat" % (pid,)) as handle:
+            return handle.read().split(")")[-1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+def sbatch(argv):
+    with open(os.path.join(STATE, "sbatch.log"), "a") as handle:
+        handle.write(json.dumps(argv) + "\\n")
+    if os.path.exists(os.path.join(STATE, "fail")):
+        sys.stderr.write("sbatch: error: invalid partition\\n")
+        return 1
+
+    args = parse(argv)
+    job_id = str(len(load_jobs()) + 1)
+    first, last = map(int, args["array"].split("-"))
+    pids = {{}}
+    for task_id in range(first, last + 1):
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task_id))
+        with open(args["output"].replace("%a", str(task_id)), "w") as log:
+            proc = subprocess.Popen(
+                ["sh", "-c", args["wrap"]],
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        pids[task_id] = proc.pid
+
+    with open(os.path.join(STATE, job_id), "w") as handle:
+        json.dump(pids, handle)
+    print(job_id)
+
+
+def squeue(argv):
+    job_ids = parse(argv)["jobs"].split(",")
+    jobs = load_jobs()
+    lines = []
+    for job_id in job_ids:
+        for task_id, pid in sorted(jobs.get(job_id, {{}}).items()):
+            if is_alive(pid):
+                lines.append("%s %s" % (job_id, task_id))
+    if not lines:
+        sys.stderr.write("slurm_load_jobs error: Invalid job id specified\\n")
+        return 1
+    print("\\n".join(lines))
+
+
+def scancel(argv):
+    jobs = load_jobs()
+    with open(os.path.join(STATE, "scancel.log"), "a") as handle:
+        handle.write(json.dumps(argv) + "\\n")
+    for job_id in argv:
+        for pid in jobs[job_id].values():
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+sys.exit({{"sbatch": sbatch, "squeue": squeue, "scancel": scancel}}[{command!r}](
+    sys.argv[1:]
+))
+"""
+
+
+@pytest.fixture
+def slurm(tmp_path):
+    state = tmp_path / "slurm"
+    state.mkdir()
+
+    commands = {}
+    for command in ("sbatch", "squeue", "scancel"):
+        filename = tmp_path / command
+        with filename.open("w") as handle:
+            handle.write("#!%s\n" % (sys.executable,))
+            handle.write(
+                textwrap.dedent(
+                    _FAKE_SLURM.format(
+                        state=str(state),
+                        pythonpath=os.pathsep.join(sys.path),
+                        command=command,
+                    )
+                )
+            )
+        filename.chmod(0o755)
+        commands[command] = str(filename)
+
+    return types.SimpleNamespace(state=state, commands=commands)
+
+
+def _batch_executor(tmp_path, slurm, **kwargs):
+    kwargs.setdefault("poll_interval", 0.01)
+    kwargs.setdefault("queue_interval", 0.01)
+    kwargs.update(slurm.commands)
+
+    return BatchExecutor(str(tmp_path / "jobs"), **kwargs)
+
+
+def _sbatch_calls(slurm):
+    with (slurm.state / "sbatch.log").open() as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_batch_executor__invalid_limits(tmp_path):
+    with pytest.raises(ValueError):
+        BatchExecutor(str(tmp_path), max_jobs=0)
+    with pytest.raises(ValueError):
+        BatchExecutor(str(tmp_path), max_array_size=0)
+
+
+def test_batch_executor__run_nodes(tmp_path, slurm):
+    nodes = [
+        _TouchNode(str(tmp_path / "file_1")),
+        _TouchNode(str(tmp_path / "file_2")),
+        _TouchNode(str(tmp_path / "file_3"), threads=2, memory=3 * 1024 ** 3),
+    ]
+
+    executor = _batch_executor(tmp_path, slurm, options=["--partition=test"])
+    for node in nodes:
+        assert executor.can_run(node)
+        executor.submit(id(node), node, _config(tmp_path))
+
+    results = dict(_wait_for_node(executor) for _ in nodes)
+    for node in nodes:
+        results[id(node)].get()
+        assert os.path.exists(node._filename)
+
+    # Nodes with identical resource requirements are submitted as an array
+    (call_1, call_2) = _sbatch_calls(slurm)
+    assert "--array=0-1" in call_1
+    assert "--cpus-per-task=1" in call_1
+    assert not any(arg.startswith("--mem=") for arg in call_1)
+    assert "--array=0-0" in call_2
+    assert "--cpus-per-task=2" in call_2
+    assert "--mem=3072M" in call_2
+    assert "--partition=test" in call_2
+
+    # Files for successful nodes are removed
+    assert not os.listdir(str(tmp_path / "jobs"))
+
+
+def test_batch_executor__failed_node(tmp_path, slurm):
+    node = _FailingNode()
+
+    executor = _batch_executor(tmp_path, slurm)
+    executor.submit(id(node), node, _config(tmp_path))
+
+    key, result = _wait_for_node(executor)
+    assert key == id(node)
+    with pytest.raises(NodeError, match="node failed"):
+        result.get()
+
+    # Logs are kept for failed nodes
+    (dirname,) = os.listdir(str(tmp_path / "jobs"))
+    assert os.path.exists(str(tmp_path / "jobs" / dirname / "0.log"))
+
+
+def test_batch_executor__crashed_job(tmp_path, slurm):
+    node = _CrashingNode()
+
+    executor = _batch_executor(tmp_path, slurm)
+    executor.submit(id(node), node, _config(tmp_path))
+
+    key, result = _wait_for_node(executor)
+    assert key == id(node)
+    with pytest.raises(NodeError, match="ended without reporting a result"):
+        result.get()
+
+
+def test_batch_executor__submission_failed(tmp_path, slurm):
+    (slurm.state / "fail").touch()
+    node = _TouchNode(str(tmp_path / "file_1"))
+
+    executor = _batch_executor(tmp_path, slurm)
+    executor.submit(id(node), node, _config(tmp_path))
+
+    key, result = executor.get_finished(False)
+    assert key == id(node)
+    with pytest.raises(NodeError, match="invalid partition"):
+        result.get()
+    assert not os.listdir(str(tmp_path / "jobs"))
+
+
+def test_batch_executor__max_array_size(tmp_path, slurm):
+    nodes = [_TouchNode(str(tmp_path / ("file_%i" % (idx,)))) for idx in range(5)]
+
+    executor = _batch_executor(tmp_path, slurm, max_array_size=2)
+    for node in nodes:
+        executor.submit(id(node), node, _config(tmp_path))
+
+    results = dict(_wait_for_node(executor) for _ in nodes)
+    assert set(results) == set(map(id, nodes))
+
+    arrays = []
+    for call in _sbatch_calls(slurm):
+        arrays.extend(arg for arg in call if arg.startswith("--array="))
+    assert arrays == ["--array=0-1", "--array=0-1", "--array=0-0"]
+
+
+def test_batch_executor__max_jobs(tmp_path, slurm):
+    node_1 = _TouchNode(str(tmp_path / "file_1"))
+    node_2 = _TouchNode(str(tmp_path / "file_2"))
+
+    executor = _batch_executor(tmp_path, slurm, max_jobs=1)
+    executor.submit(id(node_1), node_1, _config(tmp_path))
+    assert not executor.can_run(node_2)
+
+    assert _wait_for_node(executor)[0] == id(node_1)
+    assert executor.can_run(node_2)
+
+
+def test_batch_executor__terminate(tmp_path, slurm):
+    node = _TouchNode(str(tmp_path / "file_1"), sleep=60)
+
+    executor = _batch_executor(tmp_path, slurm)
+    executor.submit(id(node), node, _config(tmp_path))
+    assert executor.get_finished(False) == (None, None)
+    executor.terminate()
+
+    with (slurm.state / "scancel.log").open() as handle:
+        assert [json.loads(line) for line in handle] == [["1"]]
+    assert executor.get_finished(False) == (None, None)
+
+
+def test_batch_executor__pypeline(tmp_path, slurm):
+    nodes = [_TouchNode(str(tmp_path / ("file_%i" % (idx,)))) for idx in range(4)]
+    merged = _TouchNode(str(tmp_path / "merged"), threads=2, dependencies=nodes)
+
+    pipeline = Pypeline(
+        config=_config(tmp_path), executor=_batch_executor(tmp_path, slurm),
+    )
+    pipeline.add_nodes(merged)
+
+    assert pipeline.run()
+    assert (tmp_path / "merged").exists()
+    assert len(_sbatch_calls(slurm)) == 2
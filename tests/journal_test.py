@@ -0,0 +1,296 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import json
+import os
+
+import paleomix.journal
+
+from paleomix.journal import Journal, file_digest
+
+
+def _touch(path, mtime=None, content=b""):
+    path.write_bytes(content)
+    if mtime is not None:
+        os.utime(str(path), (mtime, mtime))
+
+    return str(path)
+
+
+def _read_lines(journal):
+    with open(journal.filename) as handle:
+        return [json.loads(line) for line in handle]
+
+
+###############################################################################
+###############################################################################
+# Journal: recording files
+
+
+def test_journal__empty(tmp_path):
+    journal = Journal(str(tmp_path / "journal"))
+
+    assert journal.get_mtime(str(tmp_path / "file")) is None
+    assert not (tmp_path / "journal").exists()
+
+
+def test_journal__record_files(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000, content=b"abc")
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename])
+    journal.close()
+
+    assert journal.get_mtime(filename) == 1000
+    assert _read_lines(journal) == [["+", filename, 1000, 3]]
+
+
+def test_journal__record_missing_file(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename])
+    os.unlink(filename)
+    journal.record([filename])
+    journal.close()
+
+    assert journal.get_mtime(filename) is None
+    assert _read_lines(journal)[-1] == ["-", filename]
+
+
+def test_journal__relative_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal("journal")
+    journal.record(["file"])
+
+    assert journal.filename == str(tmp_path / "journal")
+    assert journal.get_mtime("file") == 1000
+    assert journal.get_mtime(filename) == 1000
+    assert journal.get_mtime("./subdir/../file") == 1000
+
+
+def test_journal__creates_missing_directory(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "subdir" / "journal"))
+    journal.record([filename])
+    journal.close()
+
+    assert _read_lines(journal) == [["+", filename, 1000, 0]]
+
+
+def test_journal__discard(tmp_path):
+    filename_1 = _touch(tmp_path / "file_1", mtime=1000)
+    filename_2 = _touch(tmp_path / "file_2", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename_1])
+    journal.discard([filename_1, filename_2])
+    journal.close()
+
+    assert journal.get_mtime(filename_1) is None
+    # Only files actually recorded in the journal are written as removed
+    assert _read_lines(journal)[1:] == [["-", filename_1]]
+
+
+###############################################################################
+###############################################################################
+# Journal: validating files
+
+
+def test_journal__validate__unchanged(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename])
+
+    assert journal.validate([filename]) == []
+    assert journal.get_mtime(filename) == 1000
+
+
+def test_journal__validate__unrecorded_files_ignored(tmp_path):
+    filename = str(tmp_path / "file")
+    journal = Journal(str(tmp_path / "journal"))
+
+    assert journal.validate([filename]) == []
+
+
+def test_journal__validate__changed_mtime(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename])
+    _touch(tmp_path / "file", mtime=2000)
+
+    assert journal.validate([filename]) == [filename]
+    assert journal.get_mtime(filename) is None
+
+
+def test_journal__validate__changed_size(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename])
+    _touch(tmp_path / "file", mtime=1000, content=b"abc")
+
+    assert journal.validate([filename]) == [filename]
+
+
+def test_journal__validate__missing_file(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename])
+    os.unlink(filename)
+
+    assert journal.validate([filename]) == [filename]
+
+
+###############################################################################
+###############################################################################
+# Journal: loading journals
+
+
+def test_journal__load(tmp_path):
+    filename_1 = _touch(tmp_path / "file_1", mtime=1000)
+    filename_2 = _touch(tmp_path / "file_2", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([filename_1, filename_2])
+    journal.discard([filename_1])
+    journal.close()
+
+    journal = Journal(str(tmp_path / "journal"))
+    assert journal.get_mtime(filename_1) is None
+    assert journal.get_mtime(filename_2) == 2000
+
+
+def test_journal__load__malformed_lines_ignored(tmp_path):
+    filename = str(tmp_path / "file")
+    with (tmp_path / "journal").open("w") as handle:
+        handle.write(json.dumps(["+", filename, 1000, 0]) + "\n")
+        handle.write('["+", "/foo\n')
+
+    journal = Journal(str(tmp_path / "journal"))
+    assert journal.get_mtime(filename) == 1000
+    assert journal.get_mtime("/foo") is None
+
+
+def test_journal__load__compacted(tmp_path):
+    filename = _touch(tmp_path / "file", mtime=1000)
+    journal = Journal(str(tmp_path / "journal"))
+    for _ in range(10):
+        journal.record([filename])
+    journal.close()
+
+    journal = Journal(str(tmp_path / "journal"))
+    assert journal.get_mtime(filename) == 1000
+    assert _read_lines(journal) == [["+", filename, 1000, 0]]
+
+
+###############################################################################
+###############################################################################
+# Journal: checksums
+
+
+def test_journal__checksums__disabled(tmp_path):
+    input_file = _touch(tmp_path / "input", mtime=1000)
+    output_file = _touch(tmp_path / "output", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record([output_file], [input_file])
+    journal.close()
+
+    assert not journal.checksums
+    assert not journal.inputs_unchanged([input_file], [output_file])
+    assert all(line[0] == "+" for line in _read_lines(journal))
+
+
+def test_journal__checksums__unchanged_inputs(tmp_path):
+    input_file = _touch(tmp_path / "input", mtime=1000, content=b"ACGT")
+    output_file = _touch(tmp_path / "output", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"), checksums=True)
+    journal.record([output_file], [input_file])
+    _touch(tmp_path / "input", mtime=3000, content=b"ACGT")
+
+    assert journal.inputs_unchanged([input_file], [output_file])
+
+
+def test_journal__checksums__changed_inputs(tmp_path):
+    input_file = _touch(tmp_path / "input", mtime=1000, content=b"ACGT")
+    output_file = _touch(tmp_path / "output", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"), checksums=True)
+    journal.record([output_file], [input_file])
+    _touch(tmp_path / "input", mtime=3000, content=b"ACGA")
+
+    assert not journal.inputs_unchanged([input_file], [output_file])
+
+
+def test_journal__checksums__unrecorded_inputs(tmp_path):
+    input_file_1 = _touch(tmp_path / "input_1", mtime=1000)
+    input_file_2 = _touch(tmp_path / "input_2", mtime=1000)
+    output_file = _touch(tmp_path / "output", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"), checksums=True)
+    journal.record([output_file], [input_file_1])
+
+    assert not journal.inputs_unchanged([input_file_1, input_file_2], [output_file])
+
+
+def test_journal__checksums__discarded_outputs(tmp_path):
+    input_file = _touch(tmp_path / "input", mtime=1000)
+    output_file = _touch(tmp_path / "output", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"), checksums=True)
+    journal.record([output_file], [input_file])
+    journal.discard([output_file])
+
+    assert not journal.inputs_unchanged([input_file], [output_file])
+
+
+def test_journal__checksums__load_and_compact(tmp_path):
+    input_file = _touch(tmp_path / "input", mtime=1000, content=b"ACGT")
+    output_file_1 = _touch(tmp_path / "output_1", mtime=2000)
+    output_file_2 = _touch(tmp_path / "output_2", mtime=2000)
+    journal = Journal(str(tmp_path / "journal"), checksums=True)
+    for _ in range(10):
+        journal.record([output_file_1, output_file_2], [input_file])
+    journal.close()
+
+    journal = Journal(str(tmp_path / "journal"), checksums=True)
+    assert journal.inputs_unchanged([input_file], [output_file_1, output_file_2])
+    assert _read_lines(journal)[2:] == [
+        ["=", [output_file_1, output_file_2], [[input_file, file_digest(input_file)]]]
+    ]
+
+
+def test_file_digest__content(tmp_path):
+    assert file_digest(_touch(tmp_path / "a", content=b"ACGT")) == file_digest(
+        _touch(tmp_path / "b", mtime=1000, content=b"ACGT")
+    )
+    assert file_digest(_touch(tmp_path / "a", content=b"ACGT")) != file_digest(
+        _touch(tmp_path / "b", content=b"ACGA")
+    )
+
+
+def test_file_digest__sampled(tmp_path, monkeypatch):
+    monkeypatch.setattr(paleomix.journal, "_DIGEST_MAX_FULL_SIZE", 16)
+    monkeypatch.setattr(paleomix.journal, "_DIGEST_BLOCK_SIZE", 4)
+    monkeypatch.setattr(paleomix.journal, "_DIGEST_SAMPLED_BLOCKS", 3)
+
+    # Blocks are sampled at offsets 0, 8, and 16
+    digest = file_digest(_touch(tmp_path / "a", content=b"AAAA" * 5))
+    # Changes outside sampled blocks are not detected
+    unsampled_change = b"AAAACCCCAAAACCCCAAAA"
+    assert digest == file_digest(_touch(tmp_path / "b", content=unsampled_change))
+    sampled_change = b"AAAAAAAAGAAAAAAAAAAA"
+    assert digest != file_digest(_touch(tmp_path / "c", content=sampled_change))
+    assert digest != file_digest(_touch(tmp_path / "d", content=b"AAAA" * 6))
@@ -23,6 +23,8 @@
 import os
 import random
 
+import pickle
+
 from unittest.mock import call, Mock
 
 import pytest
@@ -30,6 +32,8 @@ import pytest
 from paleomix.atomiccmd.command import AtomicCmd
 from paleomix.node import (
     Node,
+    NodeChain,
+    NodeChainError,
     CommandNode,
     NodeError,
     NodeUnhandledException,
@@ -85,6 +89,7 @@ def _build_cmd_mock(
         requirements=frozenset(requirements),
         expected_temp_files=frozenset(map(os.path.basename, output_files)),
         optional_temp_files=frozenset(optional_temp_files),
+        memory=0,
     )
     cmd.join.return_value = return_codes
 
@@ -235,6 +240,35 @@ def test_constructor__threads_invalid_type(cls, nthreads):
         cls(threads=nthreads)
 
 
+###############################################################################
+###############################################################################
+# *Node: Constructor tests: memory
+
+
+@pytest.mark.parametrize("cls", _NODE_TYPES)
+@pytest.mark.parametrize("memory", (0, 1024))
+def test_constructor__memory(cls, memory):
+    node = cls(memory=memory)
+    assert node.memory == memory
+
+
+def test_constructor__memory__default():
+    assert Node().memory == 0
+
+
+@pytest.mark.parametrize("cls", _NODE_TYPES)
+def test_constructor__memory_invalid_range(cls):
+    with pytest.raises(ValueError):
+        cls(memory=-1)
+
+
+@pytest.mark.parametrize("cls", _NODE_TYPES)
+@pytest.mark.parametrize("memory", ("1", {}, 2.7))
+def test_constructor__memory_invalid_type(cls, memory):
+    with pytest.raises(TypeError):
+        cls(memory=memory)
+
+
 ###############################################################################
 ###############################################################################
 # Node: Run
@@ -396,6 +430,7 @@ _SIMPLE_CMD_MOCK = Mock(
     executables=_EXEC_FILES,
     auxiliary_files=_AUX_FILES,
     requirements=_REQUIREMENTS,
+    memory=1024,
 )
 _SIMPLE_CMD_NODE = CommandNode(command=_SIMPLE_CMD_MOCK, dependencies=_SIMPLE_DEPS)
 
@@ -429,6 +464,15 @@ def test_commandnode_constructor__dependencies__default():
     assert cmd_mock.dependencies == frozenset()
 
 
+def test_commandnode_constructor__memory__default():
+    assert _SIMPLE_CMD_NODE.memory == 1024
+
+
+def test_commandnode_constructor__memory():
+    cmd_mock = CommandNode(command=_SIMPLE_CMD_MOCK, memory=4096)
+    assert cmd_mock.memory == 4096
+
+
 ###############################################################################
 ###############################################################################
 # CommandNode: run
@@ -634,3 +678,65 @@ def test_commandnode_teardown__extra_files_in_temp(tmp_path):
         node._teardown(None, tmp_path)
     assert temp_files_before == set(os.listdir(tmp_path))
     assert dest_files_before == set(os.listdir(destination))
+
+
+###############################################################################
+###############################################################################
+# NodeChain
+
+
+def test_node_chain__empty():
+    with pytest.raises(ValueError):
+        NodeChain(())
+
+
+def test_node_chain__resources():
+    chain = NodeChain([Node(threads=2), Node(memory=1024), Node()])
+
+    assert chain.threads == 2
+    assert chain.memory == 1024
+
+
+class _RecordingNode(Node):
+    def __init__(self, name, calls, error=None):
+        Node.__init__(self, description=name)
+        self._calls = calls
+        self._error = error
+
+    def _run(self, _config, _temp):
+        self._calls.append(str(self))
+        if self._error is not None:
+            raise self._error
+
+
+def test_node_chain__run__order(tmp_path):
+    calls = []
+    nodes = [_RecordingNode("node_1", calls), _RecordingNode("node_2", calls)]
+    NodeChain(nodes).run(Mock(temp_root=tmp_path))
+
+    assert calls == ["node_1", "node_2"]
+    # Each node uses (and removes) its own temporary folder
+    assert not os.listdir(tmp_path)
+
+
+def test_node_chain__run__stops_on_error(tmp_path):
+    calls = []
+    nodes = [
+        _RecordingNode("node_1", calls),
+        _RecordingNode("node_2", calls, NodeError("failed")),
+        _RecordingNode("node_3", calls),
+    ]
+
+    with pytest.raises(NodeChainError, match="failed") as error:
+        NodeChain(nodes).run(Mock(temp_root=tmp_path))
+
+    assert error.value.completed == 1
+    assert isinstance(error.value.error, NodeError)
+    assert calls == ["node_1", "node_2"]
+
+
+def test_node_chain_error__pickle():
+    error = pickle.loads(pickle.dumps(NodeChainError(NodeError("failed"), 2)))
+
+    assert str(error) == "failed"
+    assert error.completed == 2
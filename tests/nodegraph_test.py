@@ -24,6 +24,10 @@ import os
 
 from unittest.mock import Mock
 
+import pytest
+
+from paleomix.journal import Journal
+from paleomix.node import Node
 from paleomix.nodegraph import NodeGraph, FileStatusCache
 
 
@@ -116,3 +120,330 @@ def test_nodegraph_is_outdated__updates(tmp_path):
     assert not NodeGraph.is_outdated(my_node, FileStatusCache())
     my_node = Mock(input_files=(younger_file,), output_files=(older_file,),)
     assert NodeGraph.is_outdated(my_node, FileStatusCache())
+
+
+def test_file_status_cache__journal_used_for_recorded_files(tmp_path):
+    older_file = create_test_file(_TIMESTAMP_1, tmp_path, "older_file")
+    younger_file = create_test_file(_TIMESTAMP_2, tmp_path, "younger_file")
+    journal = Journal(os.path.join(tmp_path, "journal"))
+    journal.record([younger_file])
+    os.unlink(younger_file)
+
+    cache = FileStatusCache(journal=journal)
+    # Recorded files are assumed to be unchanged; other files are checked
+    assert cache.files_exist([younger_file])
+    assert not cache.are_files_outdated([older_file], [younger_file])
+    assert cache.missing_files([older_file, younger_file + ".missing"]) == [
+        younger_file + ".missing"
+    ]
+
+
+def test_file_status_cache__journal_checksums(tmp_path):
+    input_file = create_test_file(_TIMESTAMP_1, tmp_path, "input")
+    output_file = create_test_file(_TIMESTAMP_1, tmp_path, "output")
+    journal = Journal(os.path.join(tmp_path, "journal"), checksums=True)
+    journal.record([output_file], [input_file])
+
+    # Newer input files are only considered outdated if their content changed
+    os.utime(input_file, (_TIMESTAMP_2, _TIMESTAMP_2))
+    assert not FileStatusCache(journal=journal).are_files_outdated(
+        [input_file], [output_file]
+    )
+
+    with open(input_file, "w") as handle:
+        handle.write("ACGT")
+    os.utime(input_file, (_TIMESTAMP_2, _TIMESTAMP_2))
+    assert FileStatusCache(journal=journal).are_files_outdated(
+        [input_file], [output_file]
+    )
+
+
+def test_file_status_cache__prefetch(tmp_path):
+    existing_file = create_test_file(_TIMESTAMP_1, tmp_path, "file")
+    missing_file = os.path.join(tmp_path, "missing")
+
+    cache = FileStatusCache()
+    cache.prefetch([existing_file, missing_file])
+
+    # Only files that exist are stat'ed
+    assert (cache.stat_calls, cache.scandir_calls) == (1, 1)
+    assert cache.missing_files([existing_file, missing_file]) == [missing_file]
+    assert not cache.are_files_outdated([existing_file], [existing_file])
+    assert (cache.stat_calls, cache.scandir_calls) == (1, 1)
+
+
+def test_file_status_cache__prefetch__sizes(tmp_path):
+    existing_file = os.path.join(tmp_path, "file")
+    with open(existing_file, "wb") as handle:
+        handle.write(b"12345")
+    missing_file = os.path.join(tmp_path, "missing")
+
+    cache = FileStatusCache()
+    cache.prefetch([existing_file, missing_file])
+
+    # Sizes are collected together with mtimes
+    assert cache.get_size(existing_file) == 5
+    assert cache.get_size(missing_file) is None
+    assert cache.get_sizes() == {existing_file: 5}
+    assert (cache.stat_calls, cache.scandir_calls) == (1, 1)
+
+
+def test_nodegraph_file_sizes(tmp_path):
+    (node,) = _build_chain(tmp_path, 1)
+    graph = NodeGraph([node])
+
+    assert graph.get_file_size(os.path.join(tmp_path, "input")) == 0
+    assert graph.get_file_size(os.path.join(tmp_path, "output_0")) is None
+
+
+def test_file_status_cache__prefetch__missing_directory(tmp_path):
+    missing_file = os.path.join(tmp_path, "missing", "file")
+
+    cache = FileStatusCache()
+    cache.prefetch([missing_file])
+
+    assert cache.missing_files([missing_file]) == [missing_file]
+    assert (cache.stat_calls, cache.scandir_calls) == (0, 1)
+
+
+def test_file_status_cache__prefetch__relative_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    create_test_file(_TIMESTAMP_1, tmp_path, "file")
+
+    cache = FileStatusCache()
+    cache.prefetch(["file", "missing"])
+
+    assert cache.missing_files(["file", "missing"]) == ["missing"]
+    assert (cache.stat_calls, cache.scandir_calls) == (1, 1)
+
+
+def test_file_status_cache__prefetch__multiple_directories(tmp_path):
+    filenames = []
+    for idx in range(10):
+        os.mkdir(os.path.join(tmp_path, str(idx)))
+        filenames.append(create_test_file(_TIMESTAMP_1 + idx, tmp_path, str(idx), "a"))
+        filenames.append(os.path.join(tmp_path, str(idx), "b"))
+
+    cache = FileStatusCache(max_threads=4)
+    cache.prefetch(filenames)
+
+    assert (cache.stat_calls, cache.scandir_calls) == (10, 10)
+    assert cache.missing_files(filenames) == filenames[1::2]
+    assert cache.are_files_outdated(filenames[-2:-1], filenames[:1])
+
+
+def test_file_status_cache__prefetch__journal(tmp_path):
+    filename = create_test_file(_TIMESTAMP_1, tmp_path, "file")
+    journal = Journal(os.path.join(tmp_path, "journal"))
+    journal.record([filename])
+
+    cache = FileStatusCache(journal=journal)
+    cache.prefetch([filename])
+
+    assert cache.files_exist([filename])
+    assert (cache.stat_calls, cache.scandir_calls) == (0, 0)
+
+
+###############################################################################
+###############################################################################
+# NodeGraph: runable nodes
+
+
+def _build_chain(tmp_path, length):
+    nodes = []
+    input_file = create_test_file(_TIMESTAMP_1, tmp_path, "input")
+    for idx in range(length):
+        output_file = os.path.join(tmp_path, "output_%i" % (idx,))
+        nodes.append(
+            Node(
+                input_files=(input_file,),
+                output_files=(output_file,),
+                dependencies=nodes[-1:],
+            )
+        )
+        input_file = output_file
+
+    return nodes
+
+
+def test_nodegraph_runable__initial_state(tmp_path):
+    node_1, node_2 = _build_chain(tmp_path, 2)
+    graph = NodeGraph([node_2])
+
+    assert graph.has_runable_nodes()
+    assert list(graph.iter_runable_nodes()) == [node_1]
+    assert graph.get_node_state(node_2) == NodeGraph.QUEUED
+
+
+def test_nodegraph_runable__running_nodes_are_not_runable(tmp_path):
+    (node,) = _build_chain(tmp_path, 1)
+    graph = NodeGraph([node])
+    graph.set_node_state(node, NodeGraph.RUNNING)
+
+    assert not graph.has_runable_nodes()
+    assert list(graph.iter_runable_nodes()) == []
+
+
+def test_nodegraph_runable__dependants_become_runable(tmp_path):
+    node_1, node_2, node_3 = _build_chain(tmp_path, 3)
+    graph = NodeGraph([node_3])
+    graph.set_node_state(node_1, NodeGraph.RUNNING)
+    graph.set_node_state(node_1, NodeGraph.DONE)
+
+    assert list(graph.iter_runable_nodes()) == [node_2]
+    assert graph.get_node_state(node_3) == NodeGraph.QUEUED
+
+
+def test_nodegraph_runable__errors_are_not_runable(tmp_path):
+    node_1, node_2 = _build_chain(tmp_path, 2)
+    graph = NodeGraph([node_2])
+    graph.set_node_state(node_1, NodeGraph.ERROR)
+
+    assert not graph.has_runable_nodes()
+    assert graph.get_node_state(node_2) == NodeGraph.ERROR
+
+
+def test_nodegraph_runable__done_nodes_are_not_runable(tmp_path):
+    _, node_2 = _build_chain(tmp_path, 2)
+    create_test_file(_TIMESTAMP_2, tmp_path, "output_0")
+    graph = NodeGraph([node_2])
+
+    assert list(graph.iter_runable_nodes()) == [node_2]
+
+
+###############################################################################
+###############################################################################
+# NodeGraph: propagation of states
+
+
+def test_nodegraph_propagation__errors(tmp_path):
+    node_1, node_2, node_3 = _build_chain(tmp_path, 3)
+    graph = NodeGraph([node_3])
+    graph.set_node_state(node_1, NodeGraph.ERROR)
+
+    assert graph.get_node_state(node_2) == NodeGraph.ERROR
+    assert graph.get_node_state(node_3) == NodeGraph.ERROR
+
+
+def test_nodegraph_propagation__few_files_not_prefetched(tmp_path):
+    node_1, node_2 = _build_chain(tmp_path, 2)
+    caches = []
+
+    def _cache_factory():
+        caches.append(FileStatusCache())
+        return caches[-1]
+
+    graph = NodeGraph([node_2], _cache_factory)
+    graph.set_node_state(node_1, NodeGraph.RUNNING)
+    caches.clear()
+    create_test_file(_TIMESTAMP_2, tmp_path, "output_0")
+    graph.set_node_state(node_1, NodeGraph.DONE)
+
+    # A single file is checked directly instead of listing the folder
+    assert graph.get_node_state(node_2) == NodeGraph.RUNABLE
+    assert sum(cache.scandir_calls for cache in caches) == 0
+
+
+def test_nodegraph_propagation__all_dependencies_done(tmp_path):
+    node_1, node_2 = _build_independent_nodes(tmp_path, 2)
+    node_3 = Node(
+        input_files=tuple(node_1.output_files | node_2.output_files),
+        output_files=(os.path.join(tmp_path, "merged"),),
+        dependencies=(node_1, node_2),
+    )
+    graph = NodeGraph([node_3])
+
+    graph.set_node_state(node_1, NodeGraph.RUNNING)
+    graph.set_node_state(node_1, NodeGraph.DONE)
+    assert graph.get_node_state(node_3) == NodeGraph.QUEUED
+
+    graph.set_node_state(node_2, NodeGraph.RUNNING)
+    graph.set_node_state(node_2, NodeGraph.DONE)
+    assert graph.get_node_state(node_3) == NodeGraph.RUNABLE
+
+
+def test_nodegraph_requeue_node(tmp_path):
+    node_1, node_2 = _build_chain(tmp_path, 2)
+    graph = NodeGraph([node_2])
+    graph.set_node_state(node_1, NodeGraph.RUNNING)
+    graph.requeue_node(node_1)
+
+    assert list(graph.iter_runable_nodes()) == [node_1]
+    assert graph.get_node_state(node_2) == NodeGraph.QUEUED
+
+
+def test_nodegraph_requeue_node__output_files_created(tmp_path):
+    node_1, node_2 = _build_chain(tmp_path, 2)
+    graph = NodeGraph([node_2])
+    graph.set_node_state(node_1, NodeGraph.RUNNING)
+    create_test_file(_TIMESTAMP_2, tmp_path, "output_0")
+    graph.requeue_node(node_1)
+
+    assert graph.get_node_state(node_1) == NodeGraph.DONE
+    assert list(graph.iter_runable_nodes()) == [node_2]
+
+
+def test_nodegraph_requeue_node__not_running(tmp_path):
+    (node,) = _build_chain(tmp_path, 1)
+    graph = NodeGraph([node])
+
+    with pytest.raises(ValueError):
+        graph.requeue_node(node)
+
+
+def test_nodegraph_propagation__deep_graph(tmp_path):
+    # Graphs deeper than the recursion limit must not cause RecursionErrors
+    nodes = _build_chain(tmp_path, 5000)
+    graph = NodeGraph(nodes[-1:])
+    assert list(graph.iter_runable_nodes()) == nodes[:1]
+
+    graph.set_node_state(nodes[0], NodeGraph.ERROR)
+    assert graph.get_node_state(nodes[-1]) == NodeGraph.ERROR
+
+
+def _build_independent_nodes(tmp_path, count):
+    input_file = create_test_file(_TIMESTAMP_1, tmp_path, "input")
+
+    return [
+        Node(
+            input_files=(input_file,),
+            output_files=(os.path.join(tmp_path, "output_%i" % (idx,)),),
+        )
+        for idx in range(count)
+    ]
+
+
+def test_nodegraph_runable__default_order(tmp_path):
+    nodes = _build_independent_nodes(tmp_path, 3)
+    graph = NodeGraph(nodes)
+
+    assert set(graph.iter_runable_nodes()) == set(nodes)
+
+
+def test_nodegraph_runable__priorities(tmp_path):
+    node_1, node_2, node_3 = _build_independent_nodes(tmp_path, 3)
+    graph = NodeGraph([node_1, node_2, node_3])
+    graph.set_priorities({node_1: 1, node_2: 3})
+
+    assert list(graph.iter_runable_nodes()) == [node_2, node_1, node_3]
+
+
+def test_nodegraph_runable__priorities_after_state_change(tmp_path):
+    node_1, node_2, node_3 = _build_independent_nodes(tmp_path, 3)
+    graph = NodeGraph([node_1, node_2, node_3])
+    graph.set_priorities({node_1: 1, node_2: 3})
+    graph.set_node_state(node_2, NodeGraph.RUNNING)
+
+    assert list(graph.iter_runable_nodes()) == [node_1, node_3]
+
+
+def test_nodegraph_runable__partial_iteration(tmp_path):
+    node_1, node_2, node_3 = _build_independent_nodes(tmp_path, 3)
+    graph = NodeGraph([node_1, node_2, node_3])
+    graph.set_priorities({node_1: 3, node_2: 2, node_3: 1})
+
+    runable = graph.iter_runable_nodes()
+    assert next(runable) == node_1
+    runable.close()
+
+    assert list(graph.iter_runable_nodes()) == [node_1, node_2, node_3]
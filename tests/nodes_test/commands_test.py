@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import pysam
+
+from paleomix.nodes.commands import GenotypeRegionsNode, _split_genotyping_regions
+
+
+def _write_bam(tmp_path):
+    filename = str(tmp_path / "input.bam")
+    header = {"SQ": [{"SN": "chr2", "LN": 1000}, {"SN": "chr1", "LN": 500}]}
+    with pysam.AlignmentFile(filename, "wb", header=header):
+        pass
+
+    return filename
+
+
+def _as_tuples(shards):
+    return [[(record.contig, record.start, record.end) for record in s] for s in shards]
+
+
+def test_split_genotyping_regions__entire_genome(tmp_path):
+    shards = _split_genotyping_regions(_write_bam(tmp_path), None, 2)
+
+    assert _as_tuples(shards) == [
+        [("chr2", 0, 750)],
+        [("chr2", 750, 1000), ("chr1", 0, 500)],
+    ]
+
+
+def test_split_genotyping_regions__regions_merged_and_sorted(tmp_path):
+    bedfile = tmp_path / "regions.bed"
+    bedfile.write_text(
+        "chr1\t100\t200\n"
+        "chr2\t50\t100\n"
+        "chr1\t150\t160\n"
+        "chr1\t120\t250\n"
+        "chrUn\t0\t100\n"
+    )
+
+    shards = _split_genotyping_regions(_write_bam(tmp_path), str(bedfile), 2)
+
+    assert _as_tuples(shards) == [
+        [("chr2", 50, 100), ("chr1", 100, 150)],
+        [("chr1", 150, 250)],
+    ]
+
+
+def test_genotype_regions_node__single_thread():
+    node = GenotypeRegionsNode("ref.fasta", "in.bam", "in.bed", "out.vcf.bgz")
+
+    assert node.threads == 1
+    assert "bcftools concat" not in str(node._command)
+    assert node.output_files == frozenset(["out.vcf.bgz"])
+
+
+def test_genotype_regions_node__multiple_threads():
+    node = GenotypeRegionsNode(
+        "ref.fasta", "in.bam", "in.bed", "out.vcf.bgz", threads=3
+    )
+
+    assert node.threads == 3
+    assert str(node._command).count("bcftools mpileup") == 3
+    assert "bcftools concat" in str(node._command)
+    assert node.input_files == frozenset(["in.bam", "in.bed"])
+    assert node.output_files == frozenset(["out.vcf.bgz"])
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import pysam
+import pytest
+
+from paleomix.node import NodeError
+from paleomix.nodes.validation import check_bam_file
+
+
+_HEADER = pysam.AlignmentHeader.from_dict(
+    {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 1000}],
+    }
+)
+
+
+def _read(name, pos, cigar="10M", flag=0, tid=0, length=None):
+    read = pysam.AlignedSegment(_HEADER)
+    read.query_name = name
+    read.reference_id = tid
+    read.reference_start = pos
+    read.cigarstring = cigar
+    read.flag = flag
+    length = read.infer_query_length() if length is None else length
+    read.query_sequence = "A" * length
+    read.query_qualities = [30] * length
+
+    return read
+
+
+def _pair(name, pos_1, pos_2, tid_2=0):
+    read_1 = _read(name, pos_1, flag=0x1 | 0x20 | 0x40)
+    read_2 = _read(name, pos_2, flag=0x1 | 0x10 | 0x80, tid=tid_2)
+
+    for (read, mate) in ((read_1, read_2), (read_2, read_1)):
+        read.next_reference_id = mate.reference_id
+        read.next_reference_start = mate.reference_start
+        read.set_tag("MC", mate.cigarstring)
+
+    return read_1, read_2
+
+
+def _unmapped(name):
+    read = pysam.AlignedSegment(_HEADER)
+    read.query_name = name
+    read.flag = 0x4
+    read.query_sequence = "A" * 10
+    read.query_qualities = [30] * 10
+
+    return read
+
+
+def _write_bam(tmp_path, reads, index=False):
+    filename = str(tmp_path / "test.bam")
+    with pysam.AlignmentFile(filename, "wb", header=_HEADER) as handle:
+        for read in reads:
+            handle.write(read)
+
+    if index:
+        pysam.index(filename)
+        return filename, filename + ".bai"
+
+    return filename
+
+
+def _good_reads():
+    pair_1 = _pair("pair1", 10, 100)
+    pair_2 = _pair("pair2", 50, 20, tid_2=1)
+
+    return [
+        pair_1[0],
+        _read("single", 20),
+        pair_2[0],
+        pair_1[1],
+        pair_2[1],
+        _unmapped("unmapped"),
+    ]
+
+
+###############################################################################
+###############################################################################
+
+
+def test_check_bam_file__valid_file(tmp_path):
+    check_bam_file(_write_bam(tmp_path, _good_reads()))
+
+
+def test_check_bam_file__valid_file_with_index(tmp_path):
+    check_bam_file(*_write_bam(tmp_path, _good_reads(), index=True))
+
+
+def test_check_bam_file__missing_mates_ignored(tmp_path):
+    pair_1 = _pair("pair1", 10, 100)
+    pair_2 = _pair("pair2", 20, 30)
+
+    check_bam_file(_write_bam(tmp_path, [pair_1[0], pair_2[1]]))
+
+
+def test_check_bam_file__unsorted(tmp_path):
+    filename = _write_bam(tmp_path, [_read("read1", 20), _read("read2", 10)])
+
+    with pytest.raises(NodeError, match="not sorted"):
+        check_bam_file(filename)
+
+
+def test_check_bam_file__unsorted_contigs(tmp_path):
+    filename = _write_bam(tmp_path, [_read("read1", 20, tid=1), _read("read2", 30)])
+
+    with pytest.raises(NodeError, match="not sorted"):
+        check_bam_file(filename)
+
+
+def test_check_bam_file__cigar_does_not_match_sequence(tmp_path):
+    filename = _write_bam(tmp_path, [_read("read1", 20, "10M", length=12)])
+
+    with pytest.raises(NodeError, match="Invalid BAM file"):
+        check_bam_file(filename)
+
+
+def test_check_bam_file__mapped_read_without_cigar(tmp_path):
+    read = _read("read1", 20)
+    read.cigartuples = None
+
+    with pytest.raises(NodeError, match="no CIGAR string"):
+        check_bam_file(_write_bam(tmp_path, [read]))
+
+
+def test_check_bam_file__read_outside_of_contig(tmp_path):
+    filename = _write_bam(tmp_path, [_read("read1", 995)])
+
+    with pytest.raises(NodeError, match="outside of reference"):
+        check_bam_file(filename)
+
+
+def test_check_bam_file__wrong_mate_position(tmp_path):
+    read_1, read_2 = _pair("pair1", 10, 100)
+    read_1.next_reference_start = 110
+
+    with pytest.raises(NodeError, match="Mate position"):
+        check_bam_file(_write_bam(tmp_path, [read_1, read_2]))
+
+
+def test_check_bam_file__wrong_mate_reverse_flag(tmp_path):
+    read_1, read_2 = _pair("pair1", 10, 100)
+    read_1.mate_is_reverse = False
+
+    with pytest.raises(NodeError, match="unmapped/reverse flags"):
+        check_bam_file(_write_bam(tmp_path, [read_1, read_2]))
+
+
+def test_check_bam_file__wrong_mate_numbers(tmp_path):
+    read_1, read_2 = _pair("pair1", 10, 100)
+    read_2.is_read1 = True
+    read_2.is_read2 = False
+
+    with pytest.raises(NodeError, match="mate 1 and mate 2"):
+        check_bam_file(_write_bam(tmp_path, [read_1, read_2]))
+
+
+def test_check_bam_file__wrong_mate_cigar(tmp_path):
+    read_1, read_2 = _pair("pair1", 10, 100)
+    read_1.set_tag("MC", "5S5M")
+
+    with pytest.raises(NodeError, match="MC"):
+        check_bam_file(_write_bam(tmp_path, [read_1, read_2]))
+
+
+def test_check_bam_file__outdated_index(tmp_path):
+    _, index = _write_bam(tmp_path, _good_reads(), index=True)
+    filename = _write_bam(tmp_path, _good_reads() + [_unmapped("unmapped2")])
+
+    with pytest.raises(NodeError, match="index does not match"):
+        check_bam_file(filename, index)
+
+
+def test_check_bam_file__truncated_file(tmp_path):
+    filename = _write_bam(tmp_path, _good_reads())
+    with open(filename, "rb") as handle:
+        data = handle.read()
+    with open(filename, "wb") as handle:
+        handle.write(data[:-28])
+
+    with pytest.raises(NodeError, match="Invalid BAM file"):
+        check_bam_file(filename)
@@ -0,0 +1,542 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import math
+import os
+import types
+
+from unittest.mock import Mock
+
+from paleomix.executors import Executor, LocalExecutor, WorkerLostError
+from paleomix.journal import Journal
+from paleomix.node import Node, NodeChain, NodeChainError, NodeError
+from paleomix.nodegraph import FileStatusCache, NodeGraph
+from paleomix.pipeline import CriticalPathPriority, PriorityPolicy, Pypeline
+
+
+def _node(tmp_path, name, size=0, input_files=(), dependencies=()):
+    filename = tmp_path / name
+    filename.write_bytes(b"x" * size)
+
+    return Node(
+        input_files=tuple(map(str, input_files)) or (str(filename),),
+        output_files=(str(tmp_path / (name + ".out")),),
+        dependencies=dependencies,
+    )
+
+
+def _graph(*nodes):
+    return NodeGraph(nodes)
+
+
+###############################################################################
+###############################################################################
+# PriorityPolicy
+
+
+def test_priority_policy__no_priorities(tmp_path):
+    node = _node(tmp_path, "node")
+    policy = PriorityPolicy()
+
+    assert policy(_graph(node)) == {}
+    assert not policy.node_finished(node, True)
+
+
+###############################################################################
+###############################################################################
+# CriticalPathPriority
+
+
+def test_critical_path__longest_path_first(tmp_path):
+    node_1 = _node(tmp_path, "node_1")
+    node_2 = _node(tmp_path, "node_2", dependencies=(node_1,))
+    node_3 = _node(tmp_path, "node_3", dependencies=(node_2,))
+    node_4 = _node(tmp_path, "node_4")
+
+    priorities = CriticalPathPriority()(_graph(node_1, node_2, node_3, node_4))
+
+    assert priorities[node_1] > priorities[node_2] > priorities[node_3]
+    assert priorities[node_3] == priorities[node_4]
+
+
+def test_critical_path__input_sizes(tmp_path):
+    node_1 = _node(tmp_path, "node_1", size=1024)
+    node_2 = _node(tmp_path, "node_2", size=2048)
+
+    priorities = CriticalPathPriority()(_graph(node_1, node_2))
+
+    assert priorities[node_1] < priorities[node_2]
+
+
+def test_critical_path__generated_input_sizes(tmp_path):
+    node_1 = _node(tmp_path, "node_1", size=1024)
+    node_2 = _node(
+        tmp_path, "node_2", input_files=node_1.output_files, dependencies=(node_1,)
+    )
+    node_3 = _node(tmp_path, "node_3")
+
+    priorities = CriticalPathPriority()(_graph(node_1, node_2, node_3))
+
+    assert priorities[node_2] > priorities[node_3]
+
+
+def test_critical_path__runtimes_recorded_per_class(tmp_path):
+    node_1 = _node(tmp_path, "node_1")
+    node_2 = _node(tmp_path, "node_2")
+    policy = CriticalPathPriority()
+    policy(_graph(node_1, node_2))
+
+    policy.node_started(node_1)
+    assert policy.node_finished(node_1, True)
+    policy.node_started(node_2)
+    assert not policy.node_finished(node_2, True)
+
+
+def test_critical_path__failed_nodes_not_recorded(tmp_path):
+    node = _node(tmp_path, "node")
+    policy = CriticalPathPriority()
+    policy(_graph(node))
+
+    policy.node_started(node)
+    assert not policy.node_finished(node, False)
+    policy.node_started(node)
+    assert policy.node_finished(node, True)
+
+
+def test_critical_path__estimate_remaining(tmp_path):
+    node_1 = _node(tmp_path, "node_1")
+    node_2 = _node(tmp_path, "node_2")
+    policy = CriticalPathPriority()
+    policy(_graph(node_1, node_2))
+
+    # Costs are not in seconds until some node has finished
+    assert policy.estimate_remaining(node_2) is None
+    policy.node_started(node_1)
+    policy.node_finished(node_1, True)
+    assert policy.estimate_remaining(node_2) >= 0
+
+
+###############################################################################
+###############################################################################
+# Pypeline: starting of nodes
+
+
+def _executor(max_threads=1, max_memory=math.inf):
+    executor = LocalExecutor(max_threads, max_memory)
+    executor._pool = Mock()
+
+    return executor
+
+
+def _start_new_tasks(nodes, max_threads, max_memory=math.inf):
+    nodegraph = NodeGraph(nodes)
+    nodegraph.set_priorities({node: -idx for (idx, node) in enumerate(nodes)})
+
+    running = {}
+    pipeline = Pypeline(config=None, priority=PriorityPolicy())
+    pipeline._start_new_tasks(running, nodegraph, _executor(max_threads, max_memory))
+
+    return [node for node in nodes if id(node) in running]
+
+
+def _sized_node(tmp_path, name, threads=1, memory=0):
+    (tmp_path / name).touch()
+
+    return Node(
+        input_files=(str(tmp_path / name),),
+        output_files=(str(tmp_path / (name + ".out")),),
+        threads=threads,
+        memory=memory,
+    )
+
+
+def test_pypeline__start_new_tasks__threads(tmp_path):
+    nodes = [_sized_node(tmp_path, "node_%i" % (idx,)) for idx in range(3)]
+
+    assert _start_new_tasks(nodes, max_threads=2) == nodes[:2]
+
+
+def test_pypeline__start_new_tasks__too_many_threads(tmp_path):
+    nodes = [_sized_node(tmp_path, "node_1", threads=4), _sized_node(tmp_path, "n_2")]
+
+    assert _start_new_tasks(nodes, max_threads=2) == nodes[:1]
+
+
+def test_pypeline__start_new_tasks__threads_reserved(tmp_path):
+    nodes = [
+        _sized_node(tmp_path, "node_1"),
+        _sized_node(tmp_path, "node_2", threads=2),
+        _sized_node(tmp_path, "node_3"),
+    ]
+
+    assert _start_new_tasks(nodes, max_threads=2) == nodes[:1]
+
+
+def test_pypeline__start_new_tasks__memory(tmp_path):
+    nodes = [_sized_node(tmp_path, "node_%i" % (idx,), memory=2) for idx in range(3)]
+
+    assert _start_new_tasks(nodes, max_threads=4, max_memory=5) == nodes[:2]
+
+
+def test_pypeline__start_new_tasks__too_much_memory(tmp_path):
+    nodes = [
+        _sized_node(tmp_path, "node_1", memory=8),
+        _sized_node(tmp_path, "node_2", memory=1),
+    ]
+
+    assert _start_new_tasks(nodes, max_threads=4, max_memory=4) == nodes[:1]
+
+
+def test_pypeline__start_new_tasks__unknown_memory(tmp_path):
+    nodes = [_sized_node(tmp_path, "node_%i" % (idx,)) for idx in range(3)]
+
+    assert _start_new_tasks(nodes, max_threads=4, max_memory=1) == nodes
+
+
+class _EstimatePolicy(PriorityPolicy):
+    def __init__(self, estimates):
+        self._estimates = estimates
+
+    def estimate_remaining(self, node):
+        return self._estimates.get(node)
+
+
+def _backfill(tmp_path, estimates):
+    running = _sized_node(tmp_path, "running")
+    blocked = _sized_node(tmp_path, "blocked", threads=2)
+    short = _sized_node(tmp_path, "short")
+    long = _sized_node(tmp_path, "long")
+    nodes = [blocked, long, short]
+
+    nodegraph = NodeGraph([running] + nodes)
+    nodegraph.set_priorities({node: -idx for (idx, node) in enumerate(nodes)})
+    nodegraph.set_node_state(running, nodegraph.RUNNING)
+
+    executor = _executor(max_threads=2)
+    executor.submit(id(running), running, None)
+    tasks = {id(running): (running,)}
+
+    names = {running: "running", blocked: "blocked", short: "short", long: "long"}
+    policy = _EstimatePolicy(
+        {node: estimates[name] for (node, name) in names.items() if name in estimates}
+    )
+
+    pipeline = Pypeline(config=None, priority=policy)
+    pipeline._start_new_tasks(tasks, nodegraph, executor)
+
+    return [names[nodes[0]] for nodes in tasks.values()]
+
+
+def test_pypeline__start_new_tasks__backfill(tmp_path):
+    estimates = {"running": 100, "blocked": 10, "short": 10, "long": 1000}
+
+    # Only nodes expected to finish before the running node are started
+    assert _backfill(tmp_path, estimates) == ["running", "short"]
+
+
+def test_pypeline__start_new_tasks__backfill__no_estimates(tmp_path):
+    estimates = {"blocked": 10, "short": 10, "long": 1000}
+
+    assert _backfill(tmp_path, estimates) == ["running"]
+
+
+class _FinishedExecutor(Executor):
+    def __init__(self, *results):
+        self._results = list(results)
+
+    def get_finished(self, blocking):
+        if self._results:
+            return self._results.pop(0)
+
+        return None, None
+
+
+class _LostResult:
+    def get(self):
+        raise WorkerLostError("worker lost")
+
+
+def test_pypeline__poll_running_nodes__lost_worker(tmp_path):
+    node = _sized_node(tmp_path, "node")
+    nodegraph = NodeGraph([node])
+    nodegraph.set_node_state(node, nodegraph.RUNNING)
+
+    running = {id(node): (node,)}
+    pipeline = Pypeline(config=None, priority=PriorityPolicy())
+    executor = _FinishedExecutor((id(node), _LostResult()))
+
+    assert pipeline._poll_running_nodes(running, nodegraph, executor)
+    assert not running
+    assert nodegraph.get_node_state(node) == nodegraph.RUNABLE
+
+
+def test_pypeline__start_new_tasks__no_capacity(tmp_path):
+    nodes = [_sized_node(tmp_path, "node")]
+    nodegraph = NodeGraph(nodes)
+
+    running = {}
+    pipeline = Pypeline(config=None, priority=PriorityPolicy())
+    executor = Mock(can_run=Mock(return_value=False))
+
+    assert not pipeline._start_new_tasks(running, nodegraph, executor)
+    assert not running
+    assert not executor.submit.called
+
+
+###############################################################################
+###############################################################################
+# Pypeline: fusing of nodes
+
+
+class _LightweightNode(Node):
+    lightweight = True
+
+
+def _chain(tmp_path, *node_types):
+    nodes = [_sized_node(tmp_path, "node_0")]
+    for idx, node_type in enumerate(node_types, start=1):
+        nodes.append(
+            node_type(
+                input_files=nodes[-1].output_files,
+                output_files=(str(tmp_path / ("node_%i.out" % (idx,))),),
+                dependencies=(nodes[-1],),
+            )
+        )
+
+    return nodes
+
+
+def _start_chain(nodes, fuse_nodes=True):
+    nodegraph = NodeGraph(nodes)
+    running = {}
+    executor = _executor()
+    pipeline = Pypeline(config=None, priority=PriorityPolicy(), fuse_nodes=fuse_nodes)
+    pipeline._start_new_tasks(running, nodegraph, executor)
+
+    return nodegraph, running, executor
+
+
+def test_pypeline__fuse_nodes(tmp_path):
+    nodes = _chain(tmp_path, _LightweightNode, _LightweightNode)
+    nodegraph, running, executor = _start_chain(nodes)
+
+    (task_nodes,) = running.values()
+    assert task_nodes == tuple(nodes)
+    for node in nodes:
+        assert nodegraph.get_node_state(node) == nodegraph.RUNNING
+
+    ((_, kwargs),) = executor._pool.apply_async.call_args_list
+    assert isinstance(kwargs["args"][1], NodeChain)
+
+
+def test_pypeline__fuse_nodes__stops_at_regular_node(tmp_path):
+    nodes = _chain(tmp_path, _LightweightNode, Node, _LightweightNode)
+    _, running, _ = _start_chain(nodes)
+
+    assert list(running.values()) == [tuple(nodes[:2])]
+
+
+def test_pypeline__fuse_nodes__disabled(tmp_path):
+    nodes = _chain(tmp_path, _LightweightNode)
+    nodegraph, running, _ = _start_chain(nodes, fuse_nodes=False)
+
+    assert list(running.values()) == [tuple(nodes[:1])]
+    assert nodegraph.get_node_state(nodes[1]) == nodegraph.QUEUED
+
+
+def test_pypeline__fuse_nodes__other_dependencies(tmp_path):
+    node_1 = _sized_node(tmp_path, "node_1")
+    node_2 = _sized_node(tmp_path, "node_2")
+    node_3 = _LightweightNode(
+        input_files=node_1.output_files | node_2.output_files,
+        output_files=(str(tmp_path / "node_3.out"),),
+        dependencies=(node_1, node_2),
+    )
+    nodegraph = NodeGraph([node_3])
+
+    running = {}
+    pipeline = Pypeline(config=None, priority=PriorityPolicy())
+    pipeline._start_new_tasks(running, nodegraph, _executor(max_threads=2))
+
+    # node_3 cannot be run after either node, as the other node is running
+    assert set(running.values()) == {(node_1,), (node_2,)}
+    assert nodegraph.get_node_state(node_3) == nodegraph.QUEUED
+
+
+class _FailedResult:
+    def __init__(self, error):
+        self._error = error
+
+    def get(self):
+        raise self._error
+
+
+def test_pypeline__fuse_nodes__failed_node(tmp_path):
+    nodes = _chain(tmp_path, _LightweightNode, _LightweightNode)
+    nodegraph, running, _ = _start_chain(nodes)
+    (tmp_path / "node_0.out").touch()
+
+    (key,) = running
+    error = NodeChainError(NodeError("failed"), 1)
+    executor = _FinishedExecutor((key, _FailedResult(error)))
+    pipeline = Pypeline(config=None, priority=PriorityPolicy())
+
+    assert not pipeline._poll_running_nodes(running, nodegraph, executor)
+    assert nodegraph.get_node_state(nodes[0]) == nodegraph.DONE
+    assert nodegraph.get_node_state(nodes[1]) == nodegraph.ERROR
+    assert nodegraph.get_node_state(nodes[2]) == nodegraph.ERROR
+
+
+def test_pypeline__fuse_nodes__lost_worker(tmp_path):
+    nodes = _chain(tmp_path, _LightweightNode)
+    nodegraph, running, _ = _start_chain(nodes)
+
+    (key,) = running
+    executor = _FinishedExecutor((key, _LostResult()))
+    pipeline = Pypeline(config=None, priority=PriorityPolicy())
+
+    assert pipeline._poll_running_nodes(running, nodegraph, executor)
+    assert nodegraph.get_node_state(nodes[0]) == nodegraph.RUNABLE
+    assert nodegraph.get_node_state(nodes[1]) == nodegraph.QUEUED
+
+
+class _TouchNode(Node):
+    def _run(self, _config, _temp):
+        for filename in self.output_files:
+            with open(filename, "w"):
+                pass
+
+
+class _LightweightTouchNode(_TouchNode):
+    lightweight = True
+
+
+def test_pypeline__fuse_nodes__run(tmp_path):
+    (tmp_path / "input").touch()
+    node_1 = _TouchNode(
+        input_files=(str(tmp_path / "input"),),
+        output_files=(str(tmp_path / "node_1.out"),),
+    )
+    node_2 = _LightweightTouchNode(
+        input_files=node_1.output_files,
+        output_files=(str(tmp_path / "node_2.out"),),
+        dependencies=(node_1,),
+    )
+
+    pipeline = Pypeline(config=types.SimpleNamespace(temp_root=str(tmp_path)))
+    pipeline.add_nodes(node_2)
+
+    assert pipeline.run()
+    assert (tmp_path / "node_2.out").exists()
+
+
+###############################################################################
+###############################################################################
+# Pypeline: journal
+
+
+def _journal_pipeline(tmp_path):
+    node_1 = _sized_node(tmp_path, "node_1")
+    (tmp_path / "node_1.out").touch()
+    node_2 = Node(
+        input_files=node_1.output_files,
+        output_files=(str(tmp_path / "node_2.out"),),
+        dependencies=(node_1,),
+    )
+
+    journal = Journal(str(tmp_path / "journal"))
+    journal.record(node_1.output_files)
+
+    return journal, node_1, node_2
+
+
+def _journal_graph(journal, node):
+    return NodeGraph([node], lambda: FileStatusCache(journal=journal))
+
+
+def test_pypeline__journal__unchanged_files(tmp_path):
+    journal, node_1, node_2 = _journal_pipeline(tmp_path)
+    nodegraph = _journal_graph(journal, node_2)
+
+    running = {}
+    pipeline = Pypeline(config=None, priority=PriorityPolicy(), journal=journal)
+    pipeline._start_new_tasks(running, nodegraph, _executor())
+
+    assert list(running) == [id(node_2)]
+    assert nodegraph.get_node_state(node_1) == nodegraph.DONE
+
+
+def test_pypeline__journal__changed_files(tmp_path):
+    journal, node_1, node_2 = _journal_pipeline(tmp_path)
+    nodegraph = _journal_graph(journal, node_2)
+    os.unlink(str(tmp_path / "node_1.out"))
+
+    running = {}
+    pipeline = Pypeline(config=None, priority=PriorityPolicy(), journal=journal)
+    pipeline._start_new_tasks(running, nodegraph, _executor())
+
+    # The changed file is removed from the journal and states refreshed
+    assert not running
+    assert journal.get_mtime(str(tmp_path / "node_1.out")) is None
+    assert nodegraph.get_node_state(node_1) == nodegraph.RUNABLE
+    assert nodegraph.get_node_state(node_2) == nodegraph.QUEUED
+
+
+def _touch_pipeline(tmp_path):
+    (tmp_path / "input").touch()
+    node = _TouchNode(
+        input_files=(str(tmp_path / "input"),),
+        output_files=(str(tmp_path / "output"),),
+    )
+
+    journal = Journal(str(tmp_path / "journal"))
+    pipeline = Pypeline(
+        config=types.SimpleNamespace(temp_root=str(tmp_path)), journal=journal
+    )
+    pipeline.add_nodes(node)
+
+    return pipeline, journal
+
+
+def test_pypeline__journal__deleted_output_files(tmp_path):
+    pipeline, _ = _touch_pipeline(tmp_path)
+    assert pipeline.run()
+
+    os.unlink(str(tmp_path / "output"))
+    pipeline, journal = _touch_pipeline(tmp_path)
+    assert journal.get_mtime(str(tmp_path / "output")) is not None
+
+    # The deleted file is detected and re-generated
+    assert pipeline.run()
+    assert (tmp_path / "output").exists()
+
+
+def test_pypeline__journal__existing_files_recorded(tmp_path):
+    (tmp_path / "input").touch()
+    (tmp_path / "output").touch()
+
+    pipeline, journal = _touch_pipeline(tmp_path)
+    assert journal.get_mtime(str(tmp_path / "output")) is None
+    assert pipeline.run()
+
+    _, journal = _touch_pipeline(tmp_path)
+    assert journal.get_mtime(str(tmp_path / "output")) is not None
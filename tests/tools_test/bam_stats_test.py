@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import random
+
+from types import SimpleNamespace
+
+import pysam
+import pytest
+
+import paleomix.tools.coverage as coverage
+import paleomix.tools.depths as depths
+
+from paleomix.common.bedtools import BEDRecord
+from paleomix.tools.bam_stats.combined import main as bam_stats_main
+from paleomix.tools.bam_stats.common import split_regions
+
+
+###############################################################################
+###############################################################################
+# split_regions
+
+
+def _handle(**lengths):
+    return SimpleNamespace(references=tuple(lengths), lengths=tuple(lengths.values()))
+
+
+def _regions(jobs):
+    return [[(r.contig, r.start, r.end, r.name) for r in job] for job in jobs]
+
+
+def test_split_regions__contigs_split_into_windows():
+    args = SimpleNamespace(regions=None, threads=2)
+    handle = _handle(chr1=20, chr2=12)
+
+    # 32 bp / (2 threads * 4 jobs per thread) = 4 bp per job
+    assert _regions(split_regions(args, handle)) == [
+        [("chr1", 0, 4, "chr1")],
+        [("chr1", 4, 8, "chr1")],
+        [("chr1", 8, 12, "chr1")],
+        [("chr1", 12, 16, "chr1")],
+        [("chr1", 16, 20, "chr1")],
+        [("chr2", 0, 4, "chr2")],
+        [("chr2", 4, 8, "chr2")],
+        [("chr2", 8, 12, "chr2")],
+    ]
+
+
+def test_split_regions__small_contigs_combined():
+    args = SimpleNamespace(regions=None, threads=1)
+    handle = _handle(chr1=6, chr2=1, chr3=1, chr4=4)
+
+    assert _regions(split_regions(args, handle)) == [
+        [("chr1", 0, 3, "chr1")],
+        [("chr1", 3, 6, "chr1")],
+        [("chr2", 0, 1, "chr2"), ("chr3", 0, 1, "chr3"), ("chr4", 0, 3, "chr4")],
+        [("chr4", 3, 4, "chr4")],
+    ]
+
+
+def test_split_regions__regions_not_split():
+    regions = [
+        BEDRecord("chr1\t0\t10\tA").freeze(),
+        BEDRecord("chr1\t20\t22\tB").freeze(),
+        BEDRecord("chr2\t5\t9\tA").freeze(),
+    ]
+    args = SimpleNamespace(regions=regions, threads=1)
+    handle = _handle(chr1=100, chr2=100)
+
+    assert _regions(split_regions(args, handle)) == [
+        [("chr1", 0, 10, "A")],
+        [("chr1", 20, 22, "B"), ("chr2", 5, 9, "A")],
+    ]
+
+
+###############################################################################
+###############################################################################
+# paleomix bam_stats
+
+_CIGARS = (
+    ((0, 20),),
+    ((4, 3), (0, 17)),
+    ((0, 8), (2, 2), (0, 12)),
+    ((0, 5), (1, 1), (0, 14)),
+    ((0, 6), (3, 15), (0, 14)),
+)
+
+
+def _write_bam(filename, nreads=500, seed=1234):
+    rng = random.Random(seed)
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 500}],
+        "RG": [
+            {"ID": "RG1", "SM": "Sample1", "LB": "Library1"},
+            {"ID": "RG2", "SM": "Sample1", "LB": "Library2"},
+        ],
+    }
+
+    positions = sorted((rng.randrange(2), rng.randrange(450)) for _ in range(nreads))
+    with pysam.AlignmentFile(filename, "wb", header=header) as handle:
+        for (idx, (tid, pos)) in enumerate(positions):
+            record = pysam.AlignedSegment(handle.header)
+            record.query_name = "read%i" % (idx,)
+            record.reference_id = tid
+            record.reference_start = pos
+            record.cigartuples = rng.choice(_CIGARS)
+            record.query_sequence = "A" * 20
+            record.flag = rng.choice((0, 0, 0, 0x10, 0x400))
+            record.set_tag("RG", rng.choice(("RG1", "RG2")))
+
+            handle.write(record)
+
+    pysam.index(filename)
+
+
+def _read_table(filename):
+    with open(filename) as handle:
+        return [line for line in handle if not line.startswith("#")]
+
+
+@pytest.mark.parametrize("threads", (1, 2))
+def test_bam_stats__matches_coverage_and_depths(tmp_path, threads):
+    in_bam = str(tmp_path / "in.bam")
+    _write_bam(in_bam)
+
+    # Overlapping regions, and a region covering an entire contig
+    in_bed = tmp_path / "in.bed"
+    in_bed.write_text("chr1\t10\t200\tA\nchr1\t100\t300\tB\nchr2\t0\t500\tC\n")
+    in_bed = str(in_bed)
+
+    expected = {}
+    for (tool, module) in (("coverage", coverage), ("depths", depths)):
+        for (key, options) in (("", []), ("_roi", ["--regions-file", in_bed])):
+            filename = str(tmp_path / ("expected%s.%s" % (key, tool)))
+            assert not module.main([in_bam, filename] + options)
+            expected[tool + key] = _read_table(filename)
+
+    observed = {key: str(tmp_path / ("observed_" + key)) for key in expected}
+    command = [in_bam, "--threads", str(threads)]
+    command += ["--coverage", observed["coverage"]]
+    command += ["--coverage-regions", in_bed, observed["coverage_roi"]]
+    command += ["--depths", observed["depths"]]
+    command += ["--depths-regions", in_bed, observed["depths_roi"]]
+    assert not bam_stats_main(command)
+
+    for (key, filename) in observed.items():
+        assert _read_table(filename) == expected[key], key
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import pysam
+
+from paleomix.tools.cleanup import (
+    _build_calmd_options,
+    _build_sort_command,
+    _fix_mates,
+    parse_args,
+)
+
+
+_HEADER = pysam.AlignmentHeader.from_dict(
+    {"SQ": [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 500}]}
+)
+_LENGTHS = _HEADER.lengths
+
+
+def _read(name, flag, tid=0, pos=100, cigar="10M", mapq=30, tags=()):
+    read = pysam.AlignedSegment(_HEADER)
+    read.query_name = name
+    read.flag = flag
+    read.reference_id = tid
+    read.reference_start = pos
+    read.mapping_quality = mapq
+    read.cigarstring = cigar
+    read.query_sequence = "A" * read.infer_query_length()
+    read.set_tags(list(tags))
+
+    return read
+
+
+def _fix(*reads):
+    return list(_fix_mates(iter(reads), _LENGTHS))
+
+
+###############################################################################
+###############################################################################
+# _fix_mates -- unpaired reads
+
+
+def test_fix_mates__unpaired_read():
+    read = _read("r", 0x1 | 0x2 | 0x20 | 0x40)
+    read.next_reference_id = 1
+    read.next_reference_start = 300
+    read.template_length = 200
+
+    assert _fix(read) == [read]
+    assert read.flag == 0x1 | 0x40
+    assert (read.next_reference_id, read.next_reference_start) == (-1, -1)
+    assert read.template_length == 0
+
+
+def test_fix_mates__unmapped_read_cleared():
+    read = _read("r", 0x4, tags=[("NM", 0), ("MD", "10"), ("XA", "foo")])
+    _fix(read)
+
+    assert read.cigarstring is None
+    assert read.mapping_quality == 0
+    assert read.get_tags() == [("XA", "foo")]
+
+
+def test_fix_mates__read_past_end_of_contig_unmapped():
+    read = _read("r", 0, tid=1, pos=500)
+    _fix(read)
+
+    assert read.is_unmapped
+    assert (read.reference_id, read.reference_start) == (-1, -1)
+
+
+def test_fix_mates__read_overlapping_end_of_contig_trimmed():
+    read = _read("r", 0, tid=1, pos=495, cigar="2S3M1I4M2S")
+    _fix(read)
+
+    assert not read.is_unmapped
+    assert read.cigarstring == "2S3M1I2M4S"
+
+
+def test_fix_mates__cigar_operations_merged():
+    read = _read("r", 0, cigar="3M2M0I5M")
+    _fix(read)
+
+    assert read.cigarstring == "10M"
+
+
+###############################################################################
+###############################################################################
+# _fix_mates -- paired reads
+
+
+def test_fix_mates__proper_pair():
+    mate_1 = _read("r", 0x1 | 0x2 | 0x40, pos=100, mapq=20)
+    mate_2 = _read("r", 0x1 | 0x2 | 0x10 | 0x80, pos=200, cigar="5M2D5M", mapq=30)
+
+    assert _fix(mate_1, mate_2) == [mate_1, mate_2]
+    assert mate_1.flag == 0x1 | 0x2 | 0x20 | 0x40
+    assert mate_2.flag == 0x1 | 0x2 | 0x10 | 0x80
+    assert (mate_1.next_reference_id, mate_1.next_reference_start) == (0, 200)
+    assert (mate_2.next_reference_id, mate_2.next_reference_start) == (0, 100)
+    assert (mate_1.template_length, mate_2.template_length) == (112, -112)
+    assert mate_1.get_tags() == [("MQ", 30), ("MC", "5M2D5M")]
+    assert mate_2.get_tags() == [("MQ", 20), ("MC", "10M")]
+
+
+def test_fix_mates__improper_pair():
+    mate_1 = _read("r", 0x1 | 0x2 | 0x40, pos=100)
+    mate_2 = _read("r", 0x1 | 0x2 | 0x80, pos=200)
+    _fix(mate_1, mate_2)
+
+    assert not (mate_1.is_proper_pair or mate_2.is_proper_pair)
+    assert (mate_1.template_length, mate_2.template_length) == (100, -100)
+
+
+def test_fix_mates__mates_on_different_contigs():
+    mate_1 = _read("r", 0x1 | 0x40, tid=0, pos=100)
+    mate_2 = _read("r", 0x1 | 0x10 | 0x80, tid=1, pos=200)
+    mate_2.template_length = 100
+    _fix(mate_1, mate_2)
+
+    assert (mate_1.next_reference_id, mate_1.next_reference_start) == (1, 200)
+    assert (mate_1.template_length, mate_2.template_length) == (0, 0)
+
+
+def test_fix_mates__unmapped_mate_placed_with_mapped_mate():
+    mate_1 = _read("r", 0x1 | 0x40 | 0x10, tid=0, pos=100)
+    mate_2 = _read("r", 0x1 | 0x4 | 0x80, tid=1, pos=300, tags=[("NM", 1)])
+    _fix(mate_1, mate_2)
+
+    assert mate_1.flag == 0x1 | 0x8 | 0x10 | 0x40
+    assert mate_2.flag == 0x1 | 0x4 | 0x20 | 0x80
+    assert (mate_2.reference_id, mate_2.reference_start) == (0, 100)
+    assert (mate_2.next_reference_id, mate_2.next_reference_start) == (0, 100)
+    assert mate_1.get_tags() == [("MC", "*")]
+    assert mate_2.get_tags() == [("MQ", 30), ("MC", "10M")]
+
+
+def test_fix_mates__supplementary_alignments():
+    mate_1 = _read("r", 0x1 | 0x40, pos=100)
+    secondary = _read("r", 0x1 | 0x40 | 0x100, tid=1, pos=10)
+    supplementary = _read("r", 0x1 | 0x40 | 0x800, tid=1, pos=20)
+    mate_2 = _read("r", 0x1 | 0x10 | 0x80, pos=200, mapq=40)
+
+    reads = [mate_1, secondary, supplementary, mate_2]
+    assert _fix(*reads) == reads
+    assert (secondary.next_reference_id, secondary.next_reference_start) == (-1, -1)
+    assert not secondary.has_tag("MQ")
+    assert supplementary.flag == 0x1 | 0x20 | 0x40 | 0x800
+    assert (supplementary.next_reference_id, supplementary.next_reference_start) == (
+        0,
+        200,
+    )
+    assert supplementary.get_tags() == [("MQ", 40), ("MC", "10M")]
+
+
+def test_fix_mates__templates_grouped_by_name():
+    read_1 = _read("r1", 0x1 | 0x40, pos=100)
+    read_2 = _read("r2", 0x1 | 0x10 | 0x80, pos=200)
+    _fix(read_1, read_2)
+
+    assert read_1.next_reference_id == read_2.next_reference_id == -1
+    assert not read_1.has_tag("MC")
+
+
+###############################################################################
+###############################################################################
+# _build_sort_command / _build_calmd_options
+
+
+def _args(*argv):
+    return parse_args(["--temp-prefix", "prefix"] + list(argv))
+
+
+def test_build_sort_command__defaults():
+    assert _build_sort_command(_args()) == [
+        "samtools",
+        "sort",
+        "-O",
+        "bam",
+        "-T",
+        "prefix",
+    ]
+
+
+def test_build_sort_command__threads_and_memory():
+    command = _build_sort_command(_args("--threads", "4"))
+    assert command[6:] == ["-@", "4", "-m", "192M"]
+
+    command = _build_sort_command(_args("--threads", "4", "--sort-memory", "1G"))
+    assert command[6:] == ["-@", "4", "-m", "1G"]
+
+
+def test_build_sort_command__compression_level():
+    command = _build_sort_command(_args("--compression-level", "9"))
+    assert command[6:] == ["-l", "9"]
+
+    # Output is left uncompressed if read by 'samtools calmd'
+    command = _build_sort_command(_args("--compression-level", "9", "--fasta", "x"))
+    assert command[6:] == ["-l", "0"]
+
+
+def test_build_calmd_options():
+    assert _build_calmd_options(_args()) == ["-b"]
+    assert _build_calmd_options(
+        _args("--threads", "2", "--compression-level", "1")
+    ) == ["-b", "-@", "2", "--output-fmt-option", "level=1"]
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import collections
+import random
+
+from types import SimpleNamespace
+
+import pytest
+
+from paleomix.tools.depths import (
+    MappingToRegions,
+    MappingToTotals,
+    count_bases,
+    merge_totals,
+)
+
+
+###############################################################################
+###############################################################################
+# MappingToTotals / count_bases
+
+_CIGARS = (
+    ((0, 10),),
+    ((4, 2), (0, 8)),
+    ((0, 3), (2, 2), (0, 5)),
+    ((0, 4), (1, 1), (0, 5)),
+    ((0, 2), (3, 20), (7, 3), (8, 1)),
+)
+
+
+def _count_depths(reads, start=0, end=1000, nlibraries=1):
+    totals = {}
+    for (sm_key, lb_key) in (("*", "*"), ("SM", "*"), ("SM", "LB")):
+        for key in ("*", "chr1"):
+            totals[(sm_key, lb_key, key)] = collections.defaultdict(int)
+
+    args = SimpleNamespace(get_readgroup_func=lambda record: record.rg)
+    rg_to_smlbid = {None: 0}
+    smlbid_to_smlb = [("SM", "LB")]
+    for idx in range(1, nlibraries):
+        rg_to_smlbid[idx] = idx
+        smlbid_to_smlb.append(("SM", "LB"))
+
+    region = SimpleNamespace(name="chr1", start=start, end=end)
+    mapping = MappingToTotals(totals, region, smlbid_to_smlb)
+    for record in reads:
+        mapping.process_counts(record.pos)
+        count_bases(args, mapping, record, rg_to_smlbid)
+    mapping.process_counts(float("inf"))
+    mapping.finalize()
+
+    return dict(totals[("SM", "LB", "chr1")])
+
+
+def _count_depths_naively(reads, start=0, end=1000):
+    depths = collections.Counter()
+    for record in reads:
+        position = record.pos
+        for (cigar, count) in record.cigar:
+            if cigar in (0, 7, 8):
+                for offset in range(position, position + count):
+                    if start <= offset < end:
+                        depths[offset] += 1
+                position += count
+            elif cigar in (2, 3, 6):
+                position += count
+
+    return dict(collections.Counter(depths.values()))
+
+
+def _read(pos, cigar=((0, 10),), rg=None):
+    return SimpleNamespace(pos=pos, cigar=cigar, rg=rg)
+
+
+def test_count_depths__no_reads():
+    assert _count_depths([]) == {}
+
+
+def test_count_depths__single_read():
+    assert _count_depths([_read(5)]) == {1: 10}
+
+
+def test_count_depths__overlapping_reads():
+    reads = [_read(5), _read(5), _read(10)]
+
+    assert _count_depths(reads) == {2: 5, 3: 5, 1: 5}
+
+
+def test_count_depths__adjacent_reads():
+    assert _count_depths([_read(5), _read(15)]) == {1: 20}
+
+
+@pytest.mark.parametrize("cigar", _CIGARS)
+def test_count_depths__cigar(cigar):
+    reads = [_read(3, cigar), _read(5, cigar)]
+
+    assert _count_depths(reads) == _count_depths_naively(reads)
+
+
+def test_count_depths__reads_clipped_to_region():
+    reads = [_read(0), _read(5), _read(12)]
+
+    assert _count_depths(reads, start=4, end=15) == {1: 3, 2: 8}
+
+
+def test_count_depths__libraries_counted_together():
+    reads = [_read(5, rg=None), _read(5, rg=1), _read(10, rg=2)]
+
+    assert _count_depths(reads, nlibraries=3) == {2: 5, 3: 5, 1: 5}
+
+
+def test_count_depths__random_reads():
+    rng = random.Random(12345)
+    positions = sorted(rng.randrange(500) for _ in range(200))
+    reads = [_read(pos, rng.choice(_CIGARS)) for pos in positions]
+
+    assert _count_depths(reads, 50, 450) == _count_depths_naively(reads, 50, 450)
+
+
+###############################################################################
+###############################################################################
+# MappingToRegions
+
+
+def _count_region_depths(reads, regions):
+    totals = {}
+    for key in ("*", "A", "B"):
+        totals[("*", "*", key)] = collections.defaultdict(int)
+        totals[("SM", "*", key)] = totals[("*", "*", key)]
+        totals[("SM", "LB", key)] = totals[("*", "*", key)]
+
+    args = SimpleNamespace(get_readgroup_func=lambda record: record.rg)
+    regions = [SimpleNamespace(name=name, start=s, end=e) for (name, s, e) in regions]
+    mapping = MappingToRegions(totals, regions, [("SM", "LB")])
+    for record in reads:
+        mapping.process_counts(record.pos)
+        count_bases(args, mapping, record, {None: 0})
+    mapping.process_counts(float("inf"))
+    mapping.finalize()
+
+    return {key: dict(totals[("SM", "LB", key)]) for key in ("A", "B")}
+
+
+def test_count_region_depths__no_regions():
+    assert _count_region_depths([_read(5)], []) == {"A": {}, "B": {}}
+
+
+def test_count_region_depths__sites_outside_regions_ignored():
+    reads = [_read(0), _read(5), _read(12)]
+
+    assert _count_region_depths(reads, [("A", 4, 15)]) == {
+        "A": {1: 3, 2: 8},
+        "B": {},
+    }
+
+
+def test_count_region_depths__overlapping_regions_counted_separately():
+    reads = [_read(0), _read(5), _read(12)]
+    regions = [("A", 4, 15), ("B", 0, 8), ("A", 6, 7)]
+
+    assert _count_region_depths(reads, regions) == {
+        "A": {1: 3, 2: 9},
+        "B": {1: 5, 2: 3},
+    }
+
+
+def test_count_region_depths__random_reads():
+    rng = random.Random(12345)
+    positions = sorted(rng.randrange(500) for _ in range(200))
+    reads = [_read(pos, rng.choice(_CIGARS)) for pos in positions]
+    regions = [("A", 50, 200), ("B", 100, 300), ("A", 250, 450)]
+
+    expected_a = collections.Counter(_count_depths_naively(reads, 50, 200))
+    expected_a.update(_count_depths_naively(reads, 250, 450))
+
+    assert _count_region_depths(reads, regions) == {
+        "A": dict(expected_a),
+        "B": _count_depths_naively(reads, 100, 300),
+    }
+
+
+###############################################################################
+###############################################################################
+# merge_totals
+
+
+def test_merge_totals__shared_counts_merged_once():
+    def _totals(counts):
+        totals = {("SM", "LB", "*"): counts, ("SM", "LB", "chr1"): counts}
+        totals[("SM", "*", "*")] = collections.defaultdict(int, counts)
+        return totals
+
+    totals = _totals(collections.defaultdict(int, {1: 2}))
+    merge_totals(totals, _totals(collections.defaultdict(int, {1: 1, 2: 3})))
+
+    assert totals == {
+        ("SM", "LB", "*"): {1: 3, 2: 3},
+        ("SM", "LB", "chr1"): {1: 3, 2: 3},
+        ("SM", "*", "*"): {1: 3, 2: 3},
+    }
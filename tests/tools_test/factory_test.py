@@ -93,7 +93,10 @@ FACTORY_COMMANDS = (
         "gtf_to_bed",
         "usage: paleomix gtf_to_bed [options] in.gtf out_prefix [in.scaffolds]",
     ),
-    ("vcf_filter", "usage: paleomix vcf_filter [-h] [--version] [--reset-filter]"),
+    (
+        "vcf_filter",
+        "usage: paleomix vcf_filter [-h] [--version] [--reset-filter] [--output FILE]",
+    ),
     (
         "vcf_to_fasta",
         "usage: paleomix vcf_to_fasta [options] --genotype in.vcf --intervals in.bed",
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import random
+
+import pysam
+import pytest
+
+from paleomix.tools.rmdup_collapsed import (
+    SpillQueue,
+    parse_args,
+    process,
+    select_best_read,
+)
+
+
+_HEADER = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "chr1", "LN": 1000}]})
+
+
+class _BAM:
+    """Minimal stand-in for a pysam.AlignmentFile; as for AlignmentFile objects,
+    iterating over the file continues from the last read returned."""
+
+    header = _HEADER
+
+    def __init__(self, reads=()):
+        self.reads = list(reads)
+        self._reads = iter(self.reads)
+
+    def __iter__(self):
+        return self._reads
+
+    def write(self, read):
+        self.reads.append(read)
+
+
+def _read(name, pos, cigar=((0, 10),), quality=30, flag=0):
+    read = pysam.AlignedSegment(_HEADER)
+    read.query_name = name
+    read.reference_id = 0
+    read.reference_start = pos
+    read.cigartuples = cigar
+    read.flag = flag
+    read.query_sequence = "A" * read.infer_query_length()
+    read.query_qualities = [quality] * read.infer_query_length()
+
+    return read
+
+
+def _summarize(reads):
+    return [
+        (
+            read.query_name,
+            read.is_duplicate,
+            read.get_tag("XP") if read.has_tag("XP") else None,
+        )
+        for read in reads
+    ]
+
+
+###############################################################################
+###############################################################################
+# select_best_read
+
+
+def test_select_best_read__single_read():
+    assert select_best_read([(((0, 10),), 10, 0)]) == (0, 1)
+
+
+def test_select_best_read__best_quality():
+    reads = [(((0, 10),), 10, 0), (((0, 10),), 30, 0), (((0, 10),), 20, 0)]
+
+    assert select_best_read(reads) == (1, 3)
+
+
+def test_select_best_read__most_common_cigar():
+    cigar_1 = ((0, 10),)
+    cigar_2 = ((0, 5), (2, 1), (0, 5))
+    reads = [(cigar_1, 10, 0), (cigar_2, 30, 0), (cigar_1, 20, 0)]
+
+    assert select_best_read(reads) == (2, 3)
+
+
+def test_select_best_read__simplest_cigar():
+    cigar_1 = ((0, 5), (2, 1), (0, 5))
+    cigar_2 = ((0, 11),)
+    reads = [(cigar_1, 30, 0), (cigar_2, 10, 0)]
+
+    assert select_best_read(reads) == (1, 2)
+
+
+def test_select_best_read__copy_numbers():
+    reads = [(((0, 10),), 10, 3), (((0, 10),), 30, 0), (((0, 5),), 20, 2)]
+
+    assert select_best_read(reads) == (1, 8)
+
+
+def test_select_best_read__missing_qualities():
+    reads = [(((0, 10),), None, 0), (((0, 10),), None, 0)]
+
+    assert select_best_read(reads) in ((0, 2), (1, 2))
+
+
+###############################################################################
+###############################################################################
+# SpillQueue
+
+
+def test_spill_queue__reads_returned_in_order(tmp_path):
+    queue = SpillQueue(_HEADER, tmp_path)
+    names = []
+    for idx in range(10):
+        queue.append(_read("read%i" % (idx,), idx))
+        # Reads may be added after reads have been read back
+        if idx % 3 == 2:
+            names.append(queue.popleft().query_name)
+
+    while len(names) < 10:
+        names.append(queue.popleft().query_name)
+
+    assert names == ["read%i" % (idx,) for idx in range(10)]
+    assert not list(tmp_path.iterdir())
+
+
+def test_spill_queue__close_removes_files(tmp_path):
+    queue = SpillQueue(_HEADER, tmp_path)
+    queue.append(_read("read1", 0))
+    queue.append(_read("read2", 0))
+    queue.popleft()
+    queue.append(_read("read3", 0))
+    queue.close()
+
+    assert not list(tmp_path.iterdir())
+
+
+###############################################################################
+###############################################################################
+# process
+
+
+def _random_reads(seed, nreads):
+    rng = random.Random(seed)
+    cigars = (((0, 10),), ((0, 10),), ((4, 2), (0, 8)), ((0, 4), (2, 1), (0, 5)))
+    positions = sorted(rng.randrange(20) for _ in range(nreads))
+
+    reads = []
+    for (idx, pos) in enumerate(positions):
+        cigar = rng.choice(cigars)
+        flag = rng.choice((0, 0, 0x10, 0x1))
+        quality = rng.randrange(40)
+        reads.append(_read("read%i" % (idx,), pos, cigar, quality, flag))
+
+    return reads
+
+
+def _process(reads, *args):
+    args = parse_args(list(args))
+    outfile = _BAM()
+    assert process(args, _BAM(reads), outfile) == 0
+
+    return outfile.reads
+
+
+def test_process__singletons_not_duplicates():
+    reads = [_read("read1", 0), _read("read2", 5), _read("read3", 5, flag=0x10)]
+
+    assert _summarize(_process(reads)) == [
+        ("read1", False, 1),
+        ("read2", False, 1),
+        ("read3", False, 1),
+    ]
+
+
+def test_process__duplicates_marked():
+    reads = [
+        _read("read1", 0, quality=10),
+        _read("read2", 0, quality=20),
+        # Clipped bases are included when comparing alignments
+        _read("read3", 1, cigar=((4, 1), (0, 9)), quality=5),
+        _read("read4", 1),
+    ]
+
+    assert _summarize(_process(reads)) == [
+        ("read1", True, None),
+        ("read2", False, 3),
+        ("read3", True, None),
+        ("read4", False, 1),
+    ]
+
+
+def test_process__duplicates_removed():
+    reads = [_read("read1", 0, quality=10), _read("read2", 0, quality=20)]
+
+    assert _summarize(_process(reads, "--remove-duplicates")) == [
+        ("read2", False, 2),
+    ]
+
+
+def test_process__unsorted_reads(tmp_path):
+    reads = [_read("read1", 5), _read("read2", 0)]
+    args = parse_args(["--max-cached-reads", "0", "--temp-directory", str(tmp_path)])
+
+    assert process(args, _BAM(reads), _BAM()) == 1
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("max_cached_reads", (0, 1, 7))
+def test_process__max_cached_reads(tmp_path, max_cached_reads):
+    # Reads are modified in place, so a new set of reads is needed for each run
+    expected = _summarize(_process(_random_reads(12345, 100)))
+
+    args = ["--max-cached-reads", str(max_cached_reads)]
+    args += ["--temp-directory", str(tmp_path)]
+    reads = _random_reads(12345, 100)
+
+    assert _summarize(_process(reads, *args)) == expected
+    assert not list(tmp_path.iterdir())
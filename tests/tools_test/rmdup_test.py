@@ -0,0 +1,308 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import pysam
+import pytest
+
+from paleomix.tools.rmdup import (
+    MateTracker,
+    MergedFiles,
+    mate_five_prime_end,
+    merge_headers,
+    parse_args,
+)
+from paleomix.tools.rmdup_collapsed import process
+
+
+_HEADER = pysam.AlignmentHeader.from_dict(
+    {"SQ": [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 1000}]}
+)
+
+
+class _BAM:
+    """Minimal stand-in for a pysam.AlignmentFile (see rmdup_collapsed_test)."""
+
+    header = _HEADER
+
+    def __init__(self, reads=()):
+        self.reads = list(reads)
+        self._reads = iter(self.reads)
+
+    def __iter__(self):
+        return self._reads
+
+    def write(self, read):
+        self.reads.append(read)
+
+
+def _read(name, pos, cigar="10M", quality=30, flag=0, tid=0):
+    read = pysam.AlignedSegment(_HEADER)
+    read.query_name = name
+    read.reference_id = tid
+    read.reference_start = pos
+    read.cigarstring = cigar
+    read.flag = flag
+    read.query_sequence = "A" * read.infer_query_length()
+    read.query_qualities = [quality] * read.infer_query_length()
+
+    return read
+
+
+def _pair(name, pos_1, pos_2, cigar_1="10M", cigar_2="10M", quality=30, tid_2=0):
+    """Returns a forward read 1 and a reverse read 2, with MC tags set."""
+    read_1 = _read(name, pos_1, cigar_1, quality, 0x1 | 0x20 | 0x40)
+    read_2 = _read(name, pos_2, cigar_2, quality, 0x1 | 0x10 | 0x80, tid=tid_2)
+
+    for (read, mate) in ((read_1, read_2), (read_2, read_1)):
+        read.next_reference_id = mate.reference_id
+        read.next_reference_start = mate.reference_start
+        read.set_tag("MC", mate.cigarstring)
+
+    return read_1, read_2
+
+
+def _process(reads, *args):
+    args = parse_args(list(args) + ["input.bam"])
+    reads = sorted(reads, key=lambda read: (read.reference_id, read.reference_start))
+    outfile = _BAM()
+    tracker = MateTracker()
+    returncode = process(
+        args, _BAM(reads), outfile, tracker.process_read, tracker.write_read
+    )
+    assert returncode == 0
+
+    return [
+        (read.query_name, read.is_read2, read.is_duplicate) for read in outfile.reads
+    ]
+
+
+###############################################################################
+###############################################################################
+# Single-end reads
+
+
+def test_process__single_end__same_five_prime_end():
+    reads = [
+        _read("read1", 10, "10M", quality=10),
+        _read("read2", 10, "20M", quality=20),
+        _read("read3", 11, "10M"),
+    ]
+
+    assert sorted(_process(reads)) == [
+        ("read1", False, True),
+        ("read2", False, False),
+        ("read3", False, False),
+    ]
+
+
+def test_process__single_end__reverse_reads_compared_by_end():
+    reads = [
+        _read("read1", 10, "20M", quality=20, flag=0x10),
+        _read("read2", 20, "10M", quality=10, flag=0x10),
+        # Clipped bases are included when comparing alignments
+        _read("read3", 15, "10M5S", quality=5, flag=0x10),
+        _read("read4", 20, "10M", quality=30),
+    ]
+
+    assert sorted(_process(reads)) == [
+        ("read1", False, False),
+        ("read2", False, True),
+        ("read3", False, True),
+        ("read4", False, False),
+    ]
+
+
+def test_process__single_end__unmapped_reads_not_filtered():
+    reads = [_read("read1", 10, flag=0x4), _read("read2", 10, flag=0x4)]
+
+    assert sorted(_process(reads)) == [
+        ("read1", False, False),
+        ("read2", False, False),
+    ]
+
+
+###############################################################################
+###############################################################################
+# Paired-end reads
+
+
+def test_process__paired_end__both_mates_marked():
+    reads = []
+    reads.extend(_pair("pair1", 10, 100, quality=10))
+    reads.extend(_pair("pair2", 10, 100, quality=20))
+    reads.extend(_pair("pair3", 10, 101))
+
+    assert sorted(_process(reads)) == [
+        ("pair1", False, True),
+        ("pair1", True, True),
+        ("pair2", False, False),
+        ("pair2", True, False),
+        ("pair3", False, False),
+        ("pair3", True, False),
+    ]
+
+
+def test_process__paired_end__duplicates_removed():
+    reads = []
+    reads.extend(_pair("pair1", 10, 100, quality=10))
+    reads.extend(_pair("pair2", 10, 100, quality=20))
+
+    assert _process(reads, "--remove-duplicates") == [
+        ("pair2", False, False),
+        ("pair2", True, False),
+    ]
+
+
+def test_process__paired_end__mates_compared_using_unclipped_positions():
+    reads = []
+    reads.extend(_pair("pair1", 10, 50, "100M", "100M", quality=10))
+    # Read 2 is seen first, but both reads have the same unclipped 5' positions
+    reads.extend(_pair("pair2", 50, 45, "40S60M", "100M5S"))
+
+    # As in rmdup_collapsed, reads with simpler CIGAR strings are preferred
+    assert sorted(_process(reads)) == [
+        ("pair1", False, False),
+        ("pair1", True, False),
+        ("pair2", False, True),
+        ("pair2", True, True),
+    ]
+
+
+def test_process__paired_end__mates_on_different_contigs():
+    reads = []
+    reads.extend(_pair("pair1", 10, 10, quality=10, tid_2=1))
+    reads.extend(_pair("pair2", 10, 10, quality=20, tid_2=1))
+    reads.extend(_pair("pair3", 10, 10, tid_2=0))
+
+    assert sorted(_process(reads)) == [
+        ("pair1", False, True),
+        ("pair1", True, True),
+        ("pair2", False, False),
+        ("pair2", True, False),
+        ("pair3", False, False),
+        ("pair3", True, False),
+    ]
+
+
+def test_process__paired_end__not_compared_to_single_end_reads():
+    reads = list(_pair("pair1", 10, 100, quality=10))
+    reads.append(_read("read1", 10, quality=20))
+
+    assert sorted(_process(reads)) == [
+        ("pair1", False, False),
+        ("pair1", True, False),
+        ("read1", False, False),
+    ]
+
+
+def test_process__paired_end__unmapped_mates_treated_as_single_end():
+    read_1, read_2 = _pair("pair1", 10, 10, quality=10)
+    read_1.flag |= 0x8
+    read_2.flag |= 0x4
+    reads = [read_1, read_2, _read("read1", 10, quality=20)]
+
+    assert sorted(_process(reads)) == [
+        ("pair1", False, True),
+        ("pair1", True, False),
+        ("read1", False, False),
+    ]
+
+
+def test_mate_five_prime_end():
+    read_1, read_2 = _pair("pair1", 10, 100, cigar_1="2S10M", cigar_2="5M2D5M3S")
+
+    assert mate_five_prime_end(read_1) == (0, True, 115)
+    assert mate_five_prime_end(read_2) == (0, False, 8)
+
+
+###############################################################################
+###############################################################################
+# Merging of BAM files
+
+
+def _header(*read_groups, programs=(), sequences=(("chr1", 1000),)):
+    return pysam.AlignmentHeader.from_dict(
+        {
+            "SQ": [{"SN": name, "LN": length} for (name, length) in sequences],
+            "RG": [{"ID": key, "SM": "sample"} for key in read_groups],
+            "PG": [dict(program) for program in programs],
+        }
+    )
+
+
+def test_merge_headers__read_groups_combined():
+    merged = merge_headers([_header("RG1"), _header("RG2", "RG1")])
+
+    assert [value["ID"] for value in merged["RG"]] == ["RG1", "RG2"]
+
+
+def test_merge_headers__conflicting_read_groups():
+    header_1 = _header("RG1")
+    header_2 = pysam.AlignmentHeader.from_dict(
+        {"SQ": [{"SN": "chr1", "LN": 1000}], "RG": [{"ID": "RG1", "SM": "other"}]}
+    )
+
+    with pytest.raises(ValueError, match="Conflicting read-groups"):
+        merge_headers([header_1, header_2])
+
+
+def test_merge_headers__different_sequences():
+    with pytest.raises(ValueError, match="different reference sequences"):
+        merge_headers([_header(), _header(sequences=(("chr1", 2000),))])
+
+
+def test_merge_headers__conflicting_programs_renamed():
+    programs_1 = [{"ID": "bwa", "CL": "bwa 1"}]
+    programs_2 = [{"ID": "bwa", "CL": "bwa 2"}, {"ID": "cleanup", "PP": "bwa"}]
+    merged = merge_headers(
+        [_header(programs=programs_1), _header(programs=programs_2)]
+    )
+
+    assert merged["PG"] == [
+        {"ID": "bwa", "CL": "bwa 1"},
+        {"ID": "bwa-1", "CL": "bwa 2"},
+        {"ID": "cleanup", "PP": "bwa-1"},
+    ]
+
+
+def test_merge_headers__identical_programs_merged():
+    programs = [{"ID": "bwa", "CL": "bwa 1"}]
+    merged = merge_headers([_header(programs=programs), _header(programs=programs)])
+
+    assert merged["PG"] == programs
+
+
+def test_merged_files__reads_sorted_by_coordinates():
+    unmapped = _read("read5", 0, flag=0x4)
+    unmapped.reference_id = unmapped.reference_start = -1
+
+    file_1 = _BAM([_read("read1", 5), _read("read4", 10, tid=1), unmapped])
+    file_2 = _BAM([_read("read2", 7), _read("read3", 9)])
+    merged = MergedFiles([file_1, file_2])
+
+    assert [read.query_name for read in merged] == [
+        "read1",
+        "read2",
+        "read3",
+        "read4",
+        "read5",
+    ]
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import random
+
+import pysam
+import pytest
+
+from paleomix.tools.vcf_filter import main
+
+
+_HEADER = """##fileformat=VCFv4.2
+##FILTER=<ID=PASS,Description="All filters passed">
+##contig=<ID=chr1,length=100000>
+##contig=<ID=chrX,length=100000>
+##INFO=<ID=INDEL,Number=0,Type=Flag,Description="Indel">
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">
+##INFO=<ID=MQ,Number=1,Type=Integer,Description="Mapping quality">
+##INFO=<ID=PV4,Number=4,Type=Float,Description="P-values for biases">
+##INFO=<ID=DP4,Number=4,Type=Integer,Description="Strand depths">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Likelihoods">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSample
+"""
+
+
+def _random_record(rng, contig, pos):
+    info = ["DP=%i" % (rng.randrange(20),)]
+    if rng.random() < 0.2:
+        ref, alt = "A", rng.choice(("AC", "ACGT"))
+        info.insert(0, "INDEL")
+    elif rng.random() < 0.2:
+        ref, alt = rng.choice("ACGT"), "."
+    else:
+        ref, alt = rng.choice(("A", "C")), rng.choice(("G", "G,T"))
+
+    if rng.random() < 0.8:
+        info.append("MQ=%i" % (rng.randrange(30),))
+    if rng.random() < 0.8:
+        info.append("PV4=%s" % (",".join(rng.choice(("1", "1e-5")) for _ in "1234")))
+    info.append("DP4=%s" % (",".join(str(rng.randrange(4)) for _ in "1234")))
+
+    nalleles = 1 + (alt != ".") + alt.count(",")
+    nlikelihoods = (nalleles * (nalleles + 1)) // 2
+    pl = ",".join(str(rng.choice((0, 0, 3, 30))) for _ in range(nlikelihoods))
+
+    return "\t".join(
+        (
+            contig,
+            str(pos),
+            ".",
+            ref,
+            alt,
+            str(rng.choice((10, 20, 40))),
+            rng.choice((".", ".", "PASS", "q:30")),
+            ";".join(info),
+            "GT:PL",
+            "0/1:" + pl,
+        )
+    )
+
+
+@pytest.fixture
+def vcf_file(tmp_path):
+    rng = random.Random(12345)
+    filename = tmp_path / "input.vcf"
+    with filename.open("w") as handle:
+        handle.write(_HEADER)
+        for contig in ("chr1", "chrX"):
+            pos = 0
+            for _ in range(500):
+                pos += rng.randrange(1, 20)
+                handle.write(_random_record(rng, contig, pos) + "\n")
+
+    return str(filename)
+
+
+def _filter_text(capsys, argv):
+    main(argv)
+
+    result = []
+    for line in capsys.readouterr().out.splitlines():
+        if not line.startswith("#"):
+            fields = line.split("\t")
+            result.append((fields[0], int(fields[1]), fields[6]))
+
+    return result
+
+
+def _filter_htslib(tmp_path, argv, extension):
+    output = str(tmp_path / ("output" + extension))
+    main(argv + ["--output", output])
+
+    result = []
+    with pysam.VariantFile(output) as handle:
+        for record in handle:
+            filters = ";".join(record.filter.keys()) or "."
+            result.append((record.chrom, record.pos, filters))
+
+    return result
+
+
+@pytest.mark.parametrize("extension", (".vcf.gz", ".bcf"))
+@pytest.mark.parametrize(
+    "options",
+    (
+        [],
+        ["--reset-filter"],
+        ["--homozygous-chromosome", "chrX", "-k"],
+        ["-d", "4", "-D", "15", "-Q", "5", "-a", "1", "-w", "5", "-W", "20"],
+    ),
+)
+def test_vcf_filter__htslib_matches_text(
+    capsys, tmp_path, vcf_file, options, extension
+):
+    expected = _filter_text(capsys, [vcf_file] + options)
+    observed = _filter_htslib(tmp_path, [vcf_file] + options, extension)
+
+    assert len(expected) == 1000
+    assert observed == expected
+
+
+def test_vcf_filter__htslib_output_is_indexable(tmp_path, vcf_file):
+    output = str(tmp_path / "output.vcf.gz")
+    main([vcf_file, "--output", output])
+
+    pysam.tabix_index(output, preset="vcf")
+    with pysam.VariantFile(output) as handle:
+        assert "w:3" in handle.header.filters
+        assert len(list(handle.fetch("chrX"))) == 500
+
+
+_RECORDS = (
+    # (QUAL, FILTER, INFO, PL, expected FILTER)
+    ("40", ".", "DP=10;MQ=20;DP4=1,1,2,2", "30,0,30", "PASS"),
+    ("20", "PASS", "DP=10;DP4=1,1,2,2", "30,0,30", "q:30"),
+    ("20", "q:30", "DP=2;MQ=5;DP4=1,1,0,1", "0,0,30", "q:30;d:8;Q:10;a:2;k"),
+    ("40", "q:30", "DP=20;PV4=1e-5,1,1,1e-5;DP4=1,1,2,2", "30,0,30", "q:30;1:%e;4:%e"),
+    ("40", ".", "DP=10;DP4=1,1,2,2", "30,0,30", "HET"),
+)
+
+
+def test_vcf_filter__filters_applied_in_order(capsys, tmp_path):
+    filename = tmp_path / "input.vcf"
+    with filename.open("w") as handle:
+        handle.write(_HEADER)
+        for (pos, (qual, filters, info, pl, _)) in enumerate(_RECORDS, start=1):
+            contig = "chrX" if pos == len(_RECORDS) else "chr1"
+            fields = (contig, pos * 100, ".", "A", "G", qual, filters, info, "GT:PL")
+            handle.write("\t".join(map(str, fields)) + "\t0/1:%s\n" % (pl,))
+
+    argv = [str(filename), "--homozygous-chromosome", "chrX"]
+    expected = [record[-1].replace("%e", "%e" % (1e-4,)) for record in _RECORDS]
+
+    assert [row[2] for row in _filter_text(capsys, argv)] == expected
+    assert [row[2] for row in _filter_htslib(tmp_path, argv, ".bcf")] == expected
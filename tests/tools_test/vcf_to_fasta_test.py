@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020 Mikkel Schubert <MikkelSch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import random
+
+from types import SimpleNamespace
+
+import pysam
+import pytest
+
+from paleomix.tools.vcf_to_fasta import ConsensusBuffer, build_region, flush_fasta
+
+
+###############################################################################
+###############################################################################
+# ConsensusBuffer
+
+
+def test_consensus_buffer__empty():
+    assert ConsensusBuffer(5).to_string(0, 5) == "NNNNN"
+
+
+def test_consensus_buffer__set_base():
+    consensus = ConsensusBuffer(5)
+    consensus.set_base(1, "A")
+    consensus.set_base(3, "R")
+
+    assert consensus.to_string(0, 5) == "NANRN"
+    assert consensus.to_string(1, 4) == "ANR"
+
+
+def test_consensus_buffer__set_multiple_bases():
+    consensus = ConsensusBuffer(5)
+    consensus.set_base(1, "AC")
+
+    assert consensus.to_string(0, 5) == "NACNNN"
+
+
+def test_consensus_buffer__set_base_replaces_multiple_bases():
+    consensus = ConsensusBuffer(5)
+    consensus.set_base(1, "AC")
+    consensus.set_base(1, "G")
+
+    assert consensus.to_string(0, 5) == "NGNNN"
+
+
+def test_consensus_buffer__insertions():
+    consensus = ConsensusBuffer(5)
+    consensus.set_base(1, "A")
+    consensus.insert(1, "CC")
+    consensus.insert(1, "T")
+
+    assert consensus.to_string(0, 5) == "NACCTNNN"
+
+
+def test_consensus_buffer__deletions():
+    consensus = ConsensusBuffer(5)
+    consensus.insert(2, "CC")
+    consensus.delete(1, 3)
+
+    assert consensus.to_string(0, 5) == "NNN"
+
+
+def test_consensus_buffer__insertion_after_deletion():
+    consensus = ConsensusBuffer(5)
+    consensus.delete(1, 3)
+    consensus.insert(2, "CC")
+
+    assert consensus.to_string(0, 5) == "NCCNN"
+
+
+def test_consensus_buffer__edits_outside_range_ignored():
+    consensus = ConsensusBuffer(5)
+    consensus.insert(0, "CC")
+    consensus.delete(4, 5)
+
+    assert consensus.to_string(1, 4) == "NNN"
+
+
+def test_consensus_buffer__insertion_after_last_position_discarded():
+    consensus = ConsensusBuffer(5)
+    consensus.set_base(3, "A")
+    consensus.insert(3, "CC")
+
+    assert consensus.to_string(0, 4) == "NNNA"
+    assert consensus.to_string(0, 5) == "NNNACCN"
+
+
+###############################################################################
+###############################################################################
+# flush_fasta
+
+
+def test_flush_fasta__incomplete_line(capsys):
+    assert flush_fasta("ACGT") == "ACGT"
+    assert flush_fasta("ACGT", "TT") == "TTACGT"
+    assert capsys.readouterr().out == ""
+
+
+def test_flush_fasta__complete_lines(capsys):
+    assert flush_fasta("A" * 130) == "A" * 10
+    assert capsys.readouterr().out == "%s\n%s\n" % ("A" * 60, "A" * 60)
+
+
+def test_flush_fasta__remainder(capsys):
+    assert flush_fasta("C" * 60, "A" * 59) == "C" * 59
+    assert capsys.readouterr().out == "%s\n" % ("A" * 59 + "C",)
+
+
+def test_flush_fasta__random_fragments(capsys):
+    rng = random.Random(12345)
+    fragments = []
+    for _ in range(100):
+        length = rng.randrange(200)
+        fragments.append("".join(rng.choice("ACGT") for _ in range(length)))
+
+    remainder = ""
+    for fragment in fragments:
+        remainder = flush_fasta(fragment, remainder)
+
+    sequence = "".join(fragments)
+    lines = [sequence[idx : idx + 60] for idx in range(0, len(sequence), 60)]
+    assert capsys.readouterr().out + remainder == "\n".join(lines)
+
+
+###############################################################################
+###############################################################################
+# build_region
+
+_HEADER = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=1000>
+##INFO=<ID=INDEL,Number=0,Type=Flag,Description="Indel">
+##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Likelihoods">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSample
+"""
+
+
+def _build_region(tmp_path, records, start, end, **kwargs):
+    filename = str(tmp_path / "genotypes.vcf")
+    with open(filename, "w") as handle:
+        handle.write(_HEADER)
+        for (pos, ref, alt, pl, *info) in records:
+            handle.write(
+                "chr1\t%i\t.\t%s\t%s\t30\tPASS\t%s\tPL\t%s\n"
+                % (pos + 1, ref, alt, ";".join(info) or ".", pl)
+            )
+
+    options = {
+        "nth_sample": 0,
+        "padding": 10,
+        "whole_codon_indels_only": False,
+        "ignore_indels": False,
+    }
+    options.update(kwargs)
+
+    bed = SimpleNamespace(contig="chr1", start=start, end=end)
+    with pysam.TabixFile(pysam.tabix_index(filename, preset="vcf")) as handle:
+        return build_region(SimpleNamespace(**options), handle, bed)
+
+
+def test_build_region__no_records(tmp_path):
+    assert _build_region(tmp_path, [(100, "A", ".", "0")], 10, 15) == "NNNNN"
+
+
+def test_build_region__snps(tmp_path):
+    records = [
+        (10, "A", ".", "0"),
+        (11, "A", "G", "10,0,10"),
+        (12, "A", "G", "10,10,0"),
+        (13, "A", "G", "0,10,10"),
+        (14, "A", "G", "0,0,10"),
+    ]
+
+    assert _build_region(tmp_path, records, 9, 16) == "NARGANN"
+
+
+@pytest.mark.parametrize(
+    "whole_codon, expected",
+    (
+        (False, "NA"),
+        (True, "NACGTG"),
+    ),
+)
+def test_build_region__deletions(tmp_path, whole_codon, expected):
+    records = [(10, "ACGTG", "A", "10,10,0", "INDEL")]
+    for pos in range(10, 15):
+        records.append((pos, "ACGTG"[pos - 10], ".", "0"))
+
+    result = _build_region(
+        tmp_path, records, 9, 15, whole_codon_indels_only=whole_codon
+    )
+
+    assert result == expected
+
+
+def test_build_region__deletion_before_region(tmp_path):
+    records = [(5, "AGGGG", "A", "10,10,0", "INDEL")]
+
+    assert _build_region(tmp_path, records, 8, 12) == "NN"
+
+
+def test_build_region__insertions(tmp_path):
+    records = [
+        (10, "A", ".", "0"),
+        (10, "A", "ACC", "10,10,0", "INDEL"),
+        (12, "A", "ATT", "10,0,10", "INDEL"),
+    ]
+
+    assert _build_region(tmp_path, records, 9, 14) == "NACCNNN"
+
+
+def test_build_region__insertion_at_last_position_discarded(tmp_path):
+    records = [(10, "A", ".", "0"), (10, "A", "ACC", "10,10,0", "INDEL")]
+
+    assert _build_region(tmp_path, records, 9, 11) == "NA"
+
+
+def test_build_region__ignore_indels(tmp_path):
+    records = [
+        (10, "A", ".", "0"),
+        (10, "A", "ACC", "10,10,0", "INDEL"),
+        (11, "AGG", "A", "10,10,0", "INDEL"),
+    ]
+
+    assert _build_region(tmp_path, records, 9, 14, ignore_indels=True) == "NANNN"